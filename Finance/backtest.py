@@ -0,0 +1,632 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import numpy as np
+import polars as pl
+import asyncio
+import logging
+import uuid
+import zlib
+import time as true_time
+from datetime import datetime, timezone, timedelta
+
+from alpaca.trading.models import Order, Position, Clock
+from alpaca.common.exceptions import APIError
+
+from Finance.stockData import STOCKFRAME
+from Finance.portfolio import PORTFOLIO
+from Finance.orders import ORDERS
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Event driven backtest, the bars of STOCKFRAME.data_map are replayed one timestamp at a time through the real ORDERS and
+PORTFOLIO classes, which talk to SimulatedTradingClient instead of the broker. The simulated client fills the orders
+against the bars and sends the same trade_updates messages the trading stream would, straight into
+ORDERS._update_handler. Bars can come from the disk cache, fetch_historical_data serves them from it when the frame
+has a cache_dir.
+
+Fill model, against the OHLC of the first bar after the order was placed (an order placed on a bar's close can only
+fill from the next bar on):
+    market          open of the bar
+    limit           buy if low <= limit at min(open, limit), sell if high >= limit at max(open, limit)
+    stop            buy if high >= stop at max(open, stop), sell if low <= stop at min(open, stop)
+    stop_limit      triggers like a stop, fills at the trigger price if that is within the limit, else rests as a limit
+    trailing_stop   a stop trailing the high (sell) or low (buy) water mark by trail_price or trail_percent, the mark
+                    is moved by the bar after the trigger check so a bar cannot trigger on its own extreme
+Market and stop fills pay slippage_bps, day orders expire when the date of the bars changes. The whole qty fills at
+once, there is no volume model.
+'''
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _stamp(ts: datetime) -> str:
+    return ts.isoformat() + 'Z'
+
+
+def _num(value) -> Union[str, None]:
+    # the api sends numbers as strings
+    return None if value is None else str(value)
+
+
+def _enum(value) -> Union[str, None]:
+    if value is None:
+        return None
+
+    return str(getattr(value, 'value', value))
+
+
+class SimulatedTradingClient:
+
+    def __init__(self, cash: float = 100_000.0, slippage_bps: float = 0.0, commission: float = 0.0):
+        """
+        Stand in for TradingClient which fills orders against replayed bars
+
+        :param cash: starting cash
+        :param slippage_bps: basis points market and stop fills pay over the bar price
+        :param commission: commission per share
+        """
+
+        self.cash = cash
+        self.slippage_bps = slippage_bps
+        self.commission = commission
+
+        # set by the backtest on every bar
+        self.now: datetime = _EPOCH
+        self.step = 0
+
+        # symbol -> column of the bar arrays, set by the backtest
+        self.symbol_index: Dict[str, int] = {}
+        self.qty = np.zeros(0)
+
+        # symbol -> [qty, avg entry price]
+        self.positions: Dict[str, List[float]] = {}
+        # id -> state of the open orders
+        self.open_orders: Dict[str, Dict] = {}
+        self.closed_orders: Dict[str, Dict] = {}
+
+        # trade_updates messages waiting to be dispatched
+        self.pending: List[Dict] = []
+        self.handlers: List[Callable] = []
+
+        self.events = 0
+        self.fills = 0
+        self._executions = 0
+
+    ############################################ trade updates ###################################################
+    def subscribe_trade_updates(self, handler: Callable):
+        if not asyncio.iscoroutinefunction(handler):
+            raise ValueError("handler must be coroutine function.")
+
+        self.handlers.append(handler)
+
+    def _emit(self, event: str, state: Dict, price: float = None, qty: float = None):
+        order = state['json']
+        order['updated_at'] = _stamp(self.now)
+
+        data = {'event': event, 'order': dict(order), 'timestamp': order['updated_at'], 'execution_id': None}
+        if qty is not None:
+            self._executions += 1
+            position = self.positions.get(order['symbol'])
+            data.update({'price': _num(price), 'qty': _num(qty), 'position_qty': _num(position[0] if position else 0),
+                         'execution_id': str(self._executions)})
+
+        self.pending.append({'stream': 'trade_updates', 'data': data})
+        self.events += 1
+
+    async def dispatch(self):
+        """
+        Delivers the pending trade updates to the subscribed handlers
+        """
+
+        while self.pending:
+            pending, self.pending = self.pending, []
+            for message in pending:
+                for handler in self.handlers:
+                    await handler(message)
+
+    ############################################ orders ##########################################################
+    def _order_json(self, request, order_id: str) -> Dict:
+        stamp = _stamp(self.now)
+        order_type = _enum(getattr(request, 'type', None) or getattr(request, 'order_type', None))
+
+        return {
+            'id': order_id, 'client_order_id': getattr(request, 'client_order_id', None) or str(uuid.uuid4()),
+            'created_at': stamp, 'updated_at': stamp, 'submitted_at': stamp, 'filled_at': None, 'expired_at': None,
+            'canceled_at': None, 'failed_at': None, 'replaced_at': None, 'replaced_by': None, 'replaces': None,
+            'asset_id': str(uuid.UUID(int = zlib.crc32(request.symbol.encode()))), 'symbol': request.symbol,
+            'asset_class': 'us_equity', 'notional': _num(getattr(request, 'notional', None)),
+            'qty': _num(getattr(request, 'qty', None)), 'filled_qty': '0', 'filled_avg_price': None,
+            'order_class': _enum(getattr(request, 'order_class', None)) or 'simple', 'order_type': order_type,
+            'type': order_type, 'side': _enum(request.side), 'time_in_force': _enum(request.time_in_force),
+            'limit_price': _num(getattr(request, 'limit_price', None)),
+            'stop_price': _num(getattr(request, 'stop_price', None)), 'status': 'new',
+            'extended_hours': bool(getattr(request, 'extended_hours', False)), 'legs': None,
+            'trail_percent': _num(getattr(request, 'trail_percent', None)),
+            'trail_price': _num(getattr(request, 'trail_price', None)), 'hwm': None
+        }
+
+    @staticmethod
+    def _float(value) -> Union[float, None]:
+        return None if value is None else float(value)
+
+    def _state(self, order: Dict) -> Dict:
+        return {
+            'json': order,
+            'column': self.symbol_index.get(order['symbol']),
+            'buy': order['side'] == 'buy',
+            'type': order['type'],
+            'qty': self._float(order['qty']),
+            'notional': self._float(order['notional']),
+            'limit': self._float(order['limit_price']),
+            'stop': self._float(order['stop_price']),
+            'trail_price': self._float(order['trail_price']),
+            'trail_percent': self._float(order['trail_percent']),
+            'hwm': None,
+            'triggered': False,
+            'day': self.now.date() if order['time_in_force'] == 'day' else None,
+            'step': self.step
+        }
+
+    def submit_order(self, order_data) -> Order:
+        order = self._order_json(order_data, str(uuid.uuid4()))
+        state = self._state(order)
+
+        if state['column'] is None:
+            order['status'] = 'rejected'
+            order['failed_at'] = _stamp(self.now)
+            self.closed_orders[order['id']] = state
+            self._emit('rejected', state)
+            raise APIError(f'{{"code": 42210000, "message": "asset {order["symbol"]} is not in the backtest"}}')
+
+        self.open_orders[order['id']] = state
+        self._emit('new', state)
+
+        return Order(**order)
+
+    def get_orders(self, filter = None) -> List[Order]:
+        return [Order(**state['json']) for state in self.open_orders.values()]
+
+    def get_order_by_id(self, order_id) -> Order:
+        state = self.open_orders.get(str(order_id)) or self.closed_orders.get(str(order_id))
+        if state is None:
+            raise APIError('{"code": 40410000, "message": "order not found"}')
+
+        return Order(**state['json'])
+
+    def _close(self, state: Dict, event: str, status: str, field: str):
+        order = state['json']
+        order['status'] = status
+        order[field] = _stamp(self.now)
+        self.open_orders.pop(order['id'], None)
+        self.closed_orders[order['id']] = state
+        self._emit(event, state)
+
+    def cancel_order_by_id(self, order_id):
+        state = self.open_orders.get(str(order_id))
+        if state is None:
+            raise APIError('{"code": 42210000, "message": "order is not open"}')
+
+        self._close(state, 'canceled', 'canceled', 'canceled_at')
+
+    def cancel_orders(self):
+        for state in list(self.open_orders.values()):
+            self._close(state, 'canceled', 'canceled', 'canceled_at')
+
+    def replace_order_by_id(self, order_id, order_data) -> Order:
+        state = self.open_orders.get(str(order_id))
+        if state is None:
+            raise APIError('{"code": 42210000, "message": "order is not open"}')
+
+        old = state['json']
+        new = dict(old)
+        new.update({'id': str(uuid.uuid4()), 'client_order_id': str(uuid.uuid4()), 'replaces': old['id'],
+                    'status': 'new', 'created_at': _stamp(self.now), 'submitted_at': _stamp(self.now)})
+        for field in ['qty', 'limit_price', 'stop_price']:
+            value = getattr(order_data, field, None)
+            if value is not None:
+                new[field] = _num(value)
+        if getattr(order_data, 'time_in_force', None) is not None:
+            new['time_in_force'] = _enum(order_data.time_in_force)
+        if getattr(order_data, 'trail', None) is not None:
+            new['trail_price' if old['trail_price'] is not None else 'trail_percent'] = _num(order_data.trail)
+
+        old['replaced_by'] = new['id']
+        self._close(state, 'replaced', 'replaced', 'replaced_at')
+
+        state = self._state(new)
+        self.open_orders[new['id']] = state
+        self._emit('new', state)
+
+        return Order(**new)
+
+    ############################################ account #########################################################
+    def _position(self, symbol: str) -> Position:
+        qty, avg = self.positions[symbol]
+        return Position(
+            asset_id = uuid.UUID(int = zlib.crc32(symbol.encode())), symbol = symbol, exchange = 'NASDAQ',
+            asset_class = 'us_equity', avg_entry_price = str(avg), qty = str(qty),
+            side = 'long' if qty > 0 else 'short', cost_basis = str(qty * avg), qty_available = str(qty)
+        )
+
+    def get_all_positions(self) -> List[Position]:
+        return [self._position(symbol) for symbol in self.positions]
+
+    def get_open_position(self, symbol_or_asset_id) -> Position:
+        if symbol_or_asset_id not in self.positions:
+            raise APIError('{"code": 40410000, "message": "position does not exist"}')
+
+        return self._position(symbol_or_asset_id)
+
+    def get_clock(self) -> Clock:
+        return Clock(timestamp = self.now.replace(tzinfo = timezone.utc), is_open = True,
+                     next_open = self.now.replace(tzinfo = timezone.utc) + timedelta(days = 1),
+                     next_close = self.now.replace(tzinfo = timezone.utc) + timedelta(minutes = 1))
+
+    ############################################ matching ########################################################
+    def _fill(self, state: Dict, price: float):
+        order = state['json']
+        symbol = order['symbol']
+        qty = state['qty'] if state['qty'] is not None else state['notional'] / price
+        signed = qty if state['buy'] else -qty
+
+        position = self.positions.get(symbol)
+        current, avg = position if position else (0.0, price)
+        new_qty = current + signed
+
+        if current == 0 or (current > 0) == (signed > 0):
+            avg = (avg * abs(current) + price * qty) / abs(new_qty)
+        elif abs(signed) > abs(current):
+            avg = price
+
+        if abs(new_qty) < 1e-9:
+            self.positions.pop(symbol, None)
+            new_qty = 0.0
+        else:
+            self.positions[symbol] = [new_qty, avg]
+
+        self.qty[state['column']] = new_qty
+        self.cash -= signed * price + self.commission * qty
+
+        order['status'] = 'filled'
+        order['filled_qty'] = _num(qty)
+        order['filled_avg_price'] = _num(price)
+        order['filled_at'] = _stamp(self.now)
+        if state['hwm'] is not None:
+            order['hwm'] = _num(state['hwm'])
+
+        self.open_orders.pop(order['id'], None)
+        self.closed_orders[order['id']] = state
+        self.fills += 1
+        self._emit('fill', state, price, qty)
+
+    def _fill_price(self, state: Dict, o: float, h: float, l: float) -> Union[float, None]:
+        buy = state['buy']
+        kind = state['type']
+        slip = self.slippage_bps * 1e-4
+
+        if kind == 'market':
+            return o * (1 + slip) if buy else o * (1 - slip)
+
+        if kind == 'trailing_stop':
+            # stop from the water mark of the bars before this one, the open counts as the first price of the bar
+            hwm = state['hwm']
+            if hwm is None:
+                hwm = o
+            hwm = min(hwm, o) if buy else max(hwm, o)
+
+            if state['trail_price'] is not None:
+                stop = hwm + state['trail_price'] if buy else hwm - state['trail_price']
+            else:
+                stop = hwm * (1 + state['trail_percent'] / 100) if buy else hwm * (1 - state['trail_percent'] / 100)
+
+            state['hwm'] = min(hwm, l) if buy else max(hwm, h)
+
+            if buy and h >= stop:
+                return max(o, stop) * (1 + slip)
+            if not buy and l <= stop:
+                return min(o, stop) * (1 - slip)
+            return None
+
+        if kind in ('stop', 'stop_limit') and not state['triggered']:
+            stop = state['stop']
+            if buy and h >= stop:
+                trigger = max(o, stop)
+            elif not buy and l <= stop:
+                trigger = min(o, stop)
+            else:
+                return None
+
+            if kind == 'stop':
+                return trigger * (1 + slip) if buy else trigger * (1 - slip)
+
+            state['triggered'] = True
+            limit = state['limit']
+            if (buy and trigger <= limit) or (not buy and trigger >= limit):
+                return trigger
+            return None
+
+        # limit, or a stop limit which triggered on an earlier bar
+        limit = state['limit']
+        if buy and l <= limit:
+            return min(o, limit)
+        if not buy and h >= limit:
+            return max(o, limit)
+
+        return None
+
+    def match(self, o: np.ndarray, h: np.ndarray, l: np.ndarray):
+        """
+        Runs the open orders against the current bar
+
+        :param o: opens of the bar per column, nan where a symbol has no bar
+        :param h: highs of the bar
+        :param l: lows of the bar
+        """
+
+        today = self.now.date()
+
+        for state in list(self.open_orders.values()):
+            if state['day'] is not None and state['day'] != today:
+                self._close(state, 'expired', 'expired', 'expired_at')
+                continue
+
+            # placed on this bar's close at the earliest
+            if state['step'] >= self.step:
+                continue
+
+            column = state['column']
+            bar_open = o[column]
+            if bar_open != bar_open:
+                continue
+
+            price = self._fill_price(state, bar_open, h[column], l[column])
+            if price is not None:
+                self._fill(state, price)
+
+
+class BACKTEST:
+
+    def __init__(self, stockFrame: STOCKFRAME, strategy: Callable, symbols: List[str] = None,
+                 cash: float = 100_000.0, slippage_bps: float = 0.0, commission: float = 0.0,
+                 indicator_columns: List[str] = (), chunk_days: int = 20, mark_every: int = 1):
+        """
+        :param stockFrame: frame with the bars to replay in data_map, and the INDICATORS output in indicator_map if
+                           indicator_columns are asked for
+        :param strategy: called as strategy(backtest) on every timestamp after the orders were matched against the bar,
+                         it reads backtest.open / high / low / close / volume / ind[name] (arrays over backtest.symbols)
+                         and trades through backtest.orders.new_order like it would live
+        :param symbols: symbols to replay, defaults to everything in data_map
+        :param cash: starting cash
+        :param slippage_bps: basis points market and stop fills pay
+        :param commission: commission per share
+        :param indicator_columns: indicator_map columns handed to the strategy
+        :param chunk_days: days of bars turned into arrays at a time, bounds the memory of long runs
+        :param mark_every: bars between marking the portfolio valuation to the closes
+        """
+
+        self.stockFrame = stockFrame
+        self.strategy = strategy
+        self.symbols: List[str] = list(symbols) if symbols else list(stockFrame.data_map.keys())
+        self.indicator_columns = list(indicator_columns)
+        self.chunk_days = chunk_days
+        self.mark_every = mark_every
+
+        self.client = SimulatedTradingClient(cash = cash, slippage_bps = slippage_bps, commission = commission)
+        self.client.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.client.qty = np.zeros(len(self.symbols))
+
+        self.portfolio = PORTFOLIO(trade_client = self.client)
+        self.orders = ORDERS(trade_client = self.client, portfolio = self.portfolio)
+        self.client.subscribe_trade_updates(self.orders._update_handler)
+
+        # current bar, set before every strategy call
+        self.timestamp: Union[datetime, None] = None
+        self.step = 0
+        self.open = self.high = self.low = self.close = self.volume = np.empty(0)
+        self.ind: Dict[str, np.ndarray] = {}
+        self.last_close = np.full(len(self.symbols), np.nan)
+
+    ############################################ data ############################################################
+    def _sources(self) -> List[Tuple[int, np.ndarray, pl.DataFrame]]:
+        sources = []
+        for column, symbol in enumerate(self.symbols):
+            df = self.stockFrame.data_map.get(symbol)
+            if df is None or df.is_empty():
+                log.warning(f"no bars for {symbol}, it is skipped")
+                continue
+
+            df = df.select('timestamp', 'open', 'high', 'low', 'close', 'volume')
+            if self.indicator_columns:
+                indicators = self.stockFrame.indicator_map.get(symbol)
+                if indicators is None:
+                    raise ValueError(f"no indicators for {symbol}, run INDICATORS.compute first.")
+                df = df.join(indicators.select(['timestamp'] + self.indicator_columns), on = 'timestamp', how = 'left')
+
+            df = df.rechunk()
+            stamps = df.get_column('timestamp').cast(pl.Datetime('us')).to_numpy().view(np.int64)
+            sources.append((column, stamps, df))
+
+        return sources
+
+    def _chunks(self):
+        """
+        Yields (timestamps, Dict[column name: T x N array]) for consecutive windows of chunk_days
+        """
+
+        sources = self._sources()
+        if not sources:
+            return
+
+        names = ['open', 'high', 'low', 'close', 'volume'] + self.indicator_columns
+        n = len(self.symbols)
+        first = min(stamps[0] for _, stamps, _ in sources)
+        last = max(stamps[-1] for _, stamps, _ in sources)
+        span = self.chunk_days * 86_400_000_000
+
+        for chunk_start in range(first, last + 1, span):
+            chunk_end = chunk_start + span
+            pieces = []
+            for column, stamps, df in sources:
+                lo, hi = np.searchsorted(stamps, [chunk_start, chunk_end])
+                if hi > lo:
+                    pieces.append((column, stamps[lo:hi], df.slice(lo, hi - lo)))
+
+            if not pieces:
+                continue
+
+            timestamps = np.unique(np.concatenate([stamps for _, stamps, _ in pieces]))
+            arrays = {name: np.full((len(timestamps), n), np.nan) for name in names}
+
+            for column, stamps, df in pieces:
+                rows = np.searchsorted(timestamps, stamps)
+                for name in names:
+                    arrays[name][rows, column] = df.get_column(name).cast(pl.Float64).to_numpy()
+
+            yield timestamps, arrays
+
+    ############################################ replay ##########################################################
+    async def _run(self) -> Dict:
+        client = self.client
+        valuation = self.portfolio.valuation
+        stamps_out = []
+        equity_out = []
+
+        bars = 0
+        t0 = true_time.perf_counter()
+
+        for timestamps, arrays in self._chunks():
+            o, h, l, c, v = arrays['open'], arrays['high'], arrays['low'], arrays['close'], arrays['volume']
+            ind = {name: arrays[name] for name in self.indicator_columns}
+            equity = np.empty(len(timestamps))
+
+            for i in range(len(timestamps)):
+                self.step += 1
+                client.step = self.step
+                self.timestamp = client.now = _EPOCH + timedelta(microseconds = int(timestamps[i]))
+
+                close = c[i]
+                np.copyto(self.last_close, close, where = close == close)
+
+                if client.open_orders:
+                    client.match(o[i], h[i], l[i])
+                if client.pending:
+                    await client.dispatch()
+
+                if self.step % self.mark_every == 0:
+                    valuation.update_prices(self.symbols, close)
+
+                self.open, self.high, self.low, self.close, self.volume = o[i], h[i], l[i], close, v[i]
+                for name, values in ind.items():
+                    self.ind[name] = values[i]
+
+                self.strategy(self)
+                if client.pending:
+                    await client.dispatch()
+
+                equity[i] = client.cash + np.dot(client.qty, np.nan_to_num(self.last_close))
+
+            bars += int(np.count_nonzero(~np.isnan(c)))
+            stamps_out.append(timestamps)
+            equity_out.append(equity)
+
+        seconds = true_time.perf_counter() - t0
+
+        curve = pl.DataFrame({
+            'timestamp': pl.Series(np.concatenate(stamps_out) if stamps_out else np.empty(0, dtype = np.int64))
+            .cast(pl.Datetime('us')),
+            'equity': np.concatenate(equity_out) if equity_out else np.empty(0)
+        })
+
+        return {
+            'equity': curve,
+            'bars': bars,
+            'timestamps': self.step,
+            'events': client.events,
+            'fills': client.fills,
+            'orders': len(client.open_orders) + len(client.closed_orders),
+            'seconds': seconds,
+            'bars_per_second': bars / seconds if seconds else float('nan'),
+            'events_per_second': client.events / seconds if seconds else float('nan')
+        }
+
+    def run(self) -> Dict:
+        """
+        Replays every bar
+
+        :return: equity curve (timestamp, equity) and counts / rates of the run
+        """
+
+        return asyncio.run(self._run())
+
+
+if __name__ == '__main__':
+    import sys
+    from Finance.columnar import BAR_SCHEMA
+
+    # a year of minute bars for 100 symbols by default, python -m Finance.backtest [symbols] [days]
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 252
+
+    rng = np.random.default_rng(0)
+    minutes = np.arange(390) * 60_000_000
+    sessions = np.array([(datetime(2023, 1, 3) + timedelta(days = d) - _EPOCH) // timedelta(microseconds = 1)
+                         for d in range(int(days * 7 / 5) + 7)
+                         if (datetime(2023, 1, 3) + timedelta(days = d)).weekday() < 5][:days])
+    stamps = (sessions[:, None] + 14 * 3_600_000_000 + 30 * 60_000_000 + minutes[None, :]).ravel()
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    symbols = [f"SYM{i}" for i in range(n_symbols)]
+    for symbol in symbols:
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 5e-4, len(stamps))))
+        spread = np.abs(rng.normal(0, 2e-4, len(stamps))) * close
+        frame.data_map[symbol] = pl.DataFrame({
+            'timestamp': pl.Series(stamps).cast(pl.Datetime('us')),
+            'open': np.r_[close[0], close[:-1]], 'high': close + spread, 'low': close - spread, 'close': close,
+            'volume': np.full(len(stamps), 1000.0), 'trade_count': np.full(len(stamps), 10.0), 'vwap': close
+        }).select(list(BAR_SCHEMA))
+
+    def idle(bt: BACKTEST):
+        pass
+
+    types = ['market', 'limit', 'stop', 'stop_limit', 'trailing_stop']
+
+    def trader(every: int) -> Callable:
+        # every few bars one symbol gets an order of the next type, long positions are flattened at market
+        def strategy(bt: BACKTEST):
+            if bt.step % every:
+                return
+
+            column = (bt.step // every) % len(bt.symbols)
+            symbol = bt.symbols[column]
+            price = bt.close[column]
+            if price != price:
+                return
+
+            position = bt.client.positions.get(symbol)
+            if position and position[0] > 0:
+                bt.orders.new_order(symbol, 'sell', position[0], order_type = 'market', time_in_force = 'day')
+                return
+
+            kind = types[(bt.step // every) % len(types)]
+            bt.orders.new_order(symbol, 'buy', 10, order_type = kind, time_in_force = 'day',
+                                limit_price = round(price * 0.999, 2), stop_price = round(price * 1.0005, 2),
+                                trail_percent = 0.1)
+
+        return strategy
+
+    for name, strategy in [('idle', idle), ('active', trader(15)), ('busy', trader(1))]:
+        bt = BACKTEST(frame, strategy, symbols = symbols, slippage_bps = 1.0)
+        result = bt.run()
+
+        print(f"{name:>6}: {result['bars']:,} bars / {result['timestamps']:,} timestamps in {result['seconds']:.1f} s, "
+              f"{result['bars_per_second']:,.0f} bars/s, {result['events']:,} events "
+              f"({result['events_per_second']:,.0f} events/s), {result['fills']:,} fills, "
+              f"final equity {result['equity'].get_column('equity')[-1]:,.2f}")
+
+        # the ledger driven by the trade updates agrees with the simulated broker
+        for symbol, (qty, avg) in bt.client.positions.items():
+            assert abs(bt.portfolio.ledger.get(symbol)['qty'] - qty) < 1e-9
+        assert len(bt.portfolio.ledger) == len(bt.client.positions)
+        assert len(bt.orders.order_store) == len(bt.client.open_orders)
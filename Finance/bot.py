@@ -23,6 +23,16 @@ import json
 
 from Finance.portfolio import PORTFOLIO
 from Finance.orders import ORDERS
+from Finance.stockData import STOCKFRAME
+from Finance.tradeStream import TradeStream
+from Finance.liveIngest import INGESTOR
+from Finance.runtime import RUNTIME
+from Finance.gateway import GATEWAY
+from Finance.marketClock import MarketClock
+from Finance.riskGate import RiskGate
+from Finance.rebalancer import REBALANCER
+from Finance.triggers import TRIGGERS
+from Finance.execution import EXECUTION
 
 
 class BOT:
@@ -45,6 +55,22 @@ class BOT:
         self.orders = ORDERS(api_key = self.api_key, secret_key = self.secret_key, portfolio = self.portfolio,
                              trade_client = self.trade_client)
 
+        # async calls of the trading api, many orders in flight at once
+        self.gateway = GATEWAY(trade_client = self.trade_client, orders = self.orders)
+
+        # market hours from the calendar fetched once
+        self.clock = MarketClock(trade_client = self.trade_client)
+
+        # client side stops, trailing stops, oco and oto, fed by the trades of the market data
+        self.triggers = TRIGGERS(orders = self.orders)
+        self.orders.triggers = self.triggers
+
+        # parent orders worked as twap, vwap or pov children, the volume curve comes from the runtime's stock frame
+        self.execution = EXECUTION(orders = self.orders, fractional = self.fractional_trading)
+
+        # orders taking the positions to target weights
+        self.rebalancer = REBALANCER(orders = self.orders, fractional = self.fractional_trading)
+
     ##################################### Client and calender ##############################################
     @property
     def _make_client(self) -> TradingClient:
@@ -89,6 +115,8 @@ class BOT:
     
     Alpaca returns the time in eastern timezone, but it is a convention and good practise to store the time
     info in UTC time, hence the convention is followed. 
+    
+    The answers come from self.clock, which fetches the calendar once instead of calling get_clock every time.
     '''
     @staticmethod
     def change_timestamps(clock: Clock) -> Clock:
@@ -112,10 +140,7 @@ class BOT:
         :return:whether the market is open for trading
         """
 
-        clock = self.trade_client.get_clock()
-        clock = self.change_timestamps(clock = clock)
-
-        return clock.is_open
+        return self.clock.is_open()
 
     def next_times(self) -> Dict:
         """
@@ -124,16 +149,45 @@ class BOT:
         :return: dict[next_open, next_close]
         """
 
-        clock = self.trade_client.get_clock()
-        clock = self.change_timestamps(clock=clock)
-
         times = {
-            'next_open': clock.next_open,
-            'next_close': clock.next_close
+            'next_open': self.clock.next_open(),
+            'next_close': self.clock.next_close()
         }
 
         return times
 
+    def set_risk_limits(self, limits: Dict[str, float] = None, symbol_limits: Dict[str, float] = None,
+                        price = None) -> RiskGate:
+        """
+        Checks every order against the limits before it is sent, the buying power is the account's
+
+        :param limits: account limits, see riskGate.ACCOUNT_LIMITS
+        :param symbol_limits: limits of every symbol, see riskGate.SYMBOL_LIMITS
+        :param price: returns the latest price of a symbol, for market orders
+        :return: the gate, set_symbol_limits overrides the limits of one symbol
+        """
+
+        self.orders.risk = RiskGate(store = self.orders.order_store, ledger = self.portfolio.ledger, limits = limits,
+                                    symbol_limits = symbol_limits,
+                                    buying_power = float(self.account_details.buying_power), price = price)
+
+        return self.orders.risk
+
+    async def rebalance(self, targets: pl.DataFrame, prices: pl.DataFrame = None, max_in_flight: int = 16,
+                        timeout: float = 60.0) -> pl.DataFrame:
+        """
+        Sends the orders taking the positions to targets, weights are of the account's current equity
+
+        :param targets: symbol and weight or qty, see REBALANCER.plan
+        :param prices: symbol and price, required for symbols not held
+        :param timeout: seconds the positions going through zero have to close, see REBALANCER.rebalance
+        :return: result frames of ORDERS.submit_basket
+        """
+
+        equity = float((await self.gateway.account()).equity)
+        return await self.rebalancer.rebalance(targets, equity = equity, prices = prices, max_in_flight = max_in_flight,
+                                               timeout = timeout)
+
     ##################################################### Portfolio #############################################
     '''
     Creating portfolio related functions below
@@ -144,3 +198,56 @@ class BOT:
 
     def show_orders(self):
         print(self.orders.orders_df)
+
+    ##################################################### Runtime ###############################################
+    def runtime(self, strategy = None, symbols: List[str] = None, stockFrame: STOCKFRAME = None,
+                strategy_interval: float = 1.0, reconcile_interval: float = 60.0, max_workers: int = 8,
+                quotes: bool = False, trades: bool = False) -> RUNTIME:
+        """
+        Puts the trade updates, the market data of symbols, the reconciliation and the strategy on one runtime
+
+        :param strategy: coroutine function awaited with the bot every strategy_interval seconds
+        :param symbols: symbols to stream bars (and quotes, trades) of, None streams no market data
+        :param stockFrame: frame the market data goes into, a new subscribed one by default
+        :param reconcile_interval: seconds between reconciliations of the ledger
+        :param max_workers: threads for the api calls
+        :return: the runtime, start it with start or await run
+        """
+
+        runtime = RUNTIME(max_workers = max_workers)
+
+        runtime.add_trade_updates(self.orders, TradeStream(paper = self.paper, api_key = self.api_key,
+                                                           secret_key = self.secret_key))
+
+        if symbols:
+            if stockFrame is None:
+                stockFrame = STOCKFRAME(api_key = self.api_key, secret_key = self.secret_key,
+                                        trade_client = self.trade_client, subscribed = True, clock = self.clock)
+            self.stockFrame = stockFrame
+            self.execution.stockFrame = stockFrame
+
+            stream = StockDataStream(self.api_key, self.secret_key, raw_data = True)
+            runtime.add_market_data(stream, INGESTOR(stockFrame), symbols, quotes = quotes, trades = trades)
+
+            # the triggers tick on the trades, or on the quotes without trades, after the ingestor subscribed
+            if trades or quotes:
+                self.triggers.subscribe(stream, symbols, quotes = not trades)
+            if trades:
+                self.execution.subscribe(stream, symbols)
+
+        runtime.add_reconciliation(self.portfolio, interval = reconcile_interval)
+
+        if strategy is not None:
+            runtime.add_strategy(strategy, strategy_interval, self)
+
+        return runtime
+
+    def run(self, strategy = None, symbols: List[str] = None, stockFrame: STOCKFRAME = None,
+            strategy_interval: float = 1.0, reconcile_interval: float = 60.0, max_workers: int = 8,
+            quotes: bool = False, trades: bool = False):
+        """
+        Runs the bot in this process until SIGINT or SIGTERM, the arguments are those of runtime
+        """
+
+        self.runtime(strategy, symbols, stockFrame, strategy_interval, reconcile_interval, max_workers, quotes,
+                     trades).start()
@@ -0,0 +1,259 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+from operator import attrgetter
+
+import numpy as np
+import polars as pl
+import logging
+from datetime import datetime
+
+from alpaca.data.models import Bar, Quote, Trade, BarSet, QuoteSet, TradeSet
+from alpaca.data.mappings import BAR_MAPPING, QUOTE_MAPPING, TRADE_MAPPING
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Bulk conversion of alpaca responses into polars frames.
+
+Instead of building a dict per record and letting polars infer a frame from a list of dicts, every field is pulled
+into its own typed column in one pass (np.fromiter for the numeric ones) and the frame is built from the columns.
+Works on the model objects of a BarSet / QuoteSet / TradeSet as well as on the raw json the data client returns when
+it is made with raw_data = True, ie Dict[symbol: List[Dict]] with the short keys ('t', 'o', 'h', ...).
+'''
+
+# schemas of the per symbol frames in STOCKFRAME
+BAR_SCHEMA = {
+    'timestamp': pl.Datetime('us'),
+    'open': pl.Float64,
+    'high': pl.Float64,
+    'low': pl.Float64,
+    'close': pl.Float64,
+    'volume': pl.Float64,
+    'trade_count': pl.Float64,
+    'vwap': pl.Float64
+}
+
+QUOTE_SCHEMA = {
+    'timestamp': pl.Datetime('us'),
+    'ask_price': pl.Float64,
+    'ask_size': pl.Float64,
+    'bid_price': pl.Float64,
+    'bid_size': pl.Float64,
+    'ask_exchange': pl.Utf8,
+    'bid_exchange': pl.Utf8,
+    'conditions': pl.List(pl.Utf8),
+    'tape': pl.Utf8
+}
+
+TRADE_SCHEMA = {
+    'timestamp': pl.Datetime('us'),
+    'price': pl.Float64,
+    'size': pl.Float64,
+    'id': pl.Int64,
+    'exchange': pl.Utf8,
+    'conditions': pl.List(pl.Utf8),
+    'tape': pl.Utf8
+}
+
+# column name -> raw json key
+_RAW_BAR_KEYS = {v: k for k, v in BAR_MAPPING.items()}
+_RAW_QUOTE_KEYS = {v: k for k, v in QUOTE_MAPPING.items()}
+_RAW_TRADE_KEYS = {v: k for k, v in TRADE_MAPPING.items()}
+
+
+def _naive_utc(series: pl.Series) -> pl.Series:
+    """
+    Timestamps are stored as naive utc in the frames
+
+    :param series: datetime series, tz aware or not
+    :return: naive utc datetime series in microseconds
+    """
+
+    dtype = series.dtype
+    if isinstance(dtype, pl.Datetime) and dtype.time_zone:
+        series = series.dt.convert_time_zone('UTC').dt.replace_time_zone(None)
+
+    return series.cast(pl.Datetime('us'))
+
+
+def _to_str(value) -> Union[str, None]:
+    # exchanges come in as Exchange enums on the model objects
+    if value is None:
+        return None
+
+    return getattr(value, 'value', value)
+
+
+def _list_key(value) -> Union[Tuple, None]:
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        return (value,)
+
+    return tuple(value)
+
+
+def _timestamps(values: List) -> pl.Series:
+    """
+    Builds the naive utc timestamp column from rfc3339 strings or tz aware datetimes
+
+    :param values: timestamps of the records
+    :return: naive utc datetime series in microseconds
+    """
+
+    first = values[0]
+
+    # raw json holds rfc3339 strings, let polars parse the whole column at once
+    if isinstance(first, str):
+        return _naive_utc(pl.Series(values = values, dtype = pl.Utf8).str.to_datetime(time_unit = 'us', time_zone = 'UTC'))
+
+    # going through epoch floats is a lot cheaper than handing polars the datetime objects,
+    # float64 still resolves microseconds at current epochs so rounding gives back the exact value
+    if isinstance(first, datetime) and first.tzinfo is not None:
+        epoch = np.fromiter(map(datetime.timestamp, values), dtype = np.float64, count = len(values))
+        return pl.Series(values = np.rint(epoch * 1e6).astype(np.int64)).cast(pl.Datetime('us'))
+
+    return _naive_utc(pl.Series(values = values))
+
+
+def _column(getter: Callable, records: List, dtype, n: int) -> pl.Series:
+    """
+    Fills one typed column from the records
+
+    :param getter: getter of the field
+    :param records: model objects or raw dicts
+    :param dtype: polars dtype of the column
+    :param n: number of records
+    :return: the column
+    """
+
+    if dtype == pl.Float64:
+        # missing values come through fromiter as nan, turn them back into nulls
+        return pl.Series(values = np.fromiter(map(getter, records), dtype = np.float64, count = n), nan_to_null = True)
+
+    elif dtype == pl.Utf8:
+        return pl.Series(values = [_to_str(v) for v in map(getter, records)], dtype = dtype)
+
+    elif isinstance(dtype, pl.List):
+        # condition lists repeat a handful of combinations, so build each distinct list once and gather by code
+        lookup = {}
+        codes = np.fromiter(
+            (lookup.setdefault(_list_key(v), len(lookup)) for v in map(getter, records)),
+            dtype = np.int64, count = n
+        )
+        distinct = pl.Series(values = [list(k) if k is not None else None for k in lookup], dtype = dtype)
+        return distinct.gather(codes)
+
+    return pl.Series(values = list(map(getter, records)), dtype = dtype)
+
+
+def _records_to_frame(records: List, columns: Dict, raw_keys: Union[Dict, None] = None) -> pl.DataFrame:
+    """
+    Builds a frame from model objects, or from raw json dicts when raw_keys is given
+
+    :param records: list of Bar / Quote / Trade or list of raw dicts
+    :param columns: column: dtype of the output
+    :param raw_keys: column -> raw json key
+    :return: frame with exactly the given columns
+    """
+
+    n = len(records)
+    if not n:
+        return pl.DataFrame(schema = columns)
+
+    series = []
+    for name, dtype in columns.items():
+
+        if raw_keys is None:
+            getter = attrgetter(name)
+        else:
+            key = raw_keys[name]
+            getter = lambda record, key = key: record.get(key)
+
+        if name == 'timestamp':
+            series.append(_timestamps(list(map(getter, records))).alias(name))
+
+        else:
+            series.append(_column(getter, records, dtype, n).alias(name))
+
+    return pl.DataFrame(series)
+
+
+def _is_raw(records: List) -> bool:
+    return bool(records) and isinstance(records[0], dict)
+
+
+def bars_to_frame(bars: List[Union[Bar, Dict]]) -> pl.DataFrame:
+    return _records_to_frame(bars, BAR_SCHEMA, _RAW_BAR_KEYS if _is_raw(bars) else None)
+
+
+def quotes_to_frame(quotes: List[Union[Quote, Dict]]) -> pl.DataFrame:
+    return _records_to_frame(quotes, QUOTE_SCHEMA, _RAW_QUOTE_KEYS if _is_raw(quotes) else None)
+
+
+def trades_to_frame(trades: List[Union[Trade, Dict]]) -> pl.DataFrame:
+    return _records_to_frame(trades, TRADE_SCHEMA, _RAW_TRADE_KEYS if _is_raw(trades) else None)
+
+
+def set_data(data_set: Union[BarSet, QuoteSet, TradeSet, Dict]) -> Dict:
+    """
+    The data client returns a BarSet / QuoteSet / TradeSet, or the plain dict when raw_data = True
+
+    :param data_set: response of the data client
+    :return: Dict[symbol: List of records]
+    """
+
+    if isinstance(data_set, dict):
+        return data_set
+
+    return data_set.data
+
+
+if __name__ == '__main__':
+    import time as true_time
+    from datetime import timezone, timedelta
+
+    from Finance.stockData import STOCKFRAME
+
+    # synthetic 1M row TradeSet
+    n = 1_000_000
+    start = datetime(2024, 1, 2, 14, 30, tzinfo = timezone.utc)
+    rng = np.random.default_rng(0)
+    prices = 100 + rng.standard_normal(n).cumsum() * 0.01
+    sizes = rng.integers(1, 500, n)
+
+    raw = {
+        'AAPL': [
+            {
+                't': (start + timedelta(microseconds = 37 * i)).isoformat().replace('+00:00', 'Z'),
+                'x': 'V',
+                'p': float(prices[i]),
+                's': float(sizes[i]),
+                'i': i,
+                'c': ['@'],
+                'z': 'C'
+            }
+            for i in range(n)
+        ]
+    }
+
+    print("building TradeSet objects...")
+    trade_set = TradeSet(raw)
+    trades = trade_set.data['AAPL']
+
+    t0 = true_time.perf_counter()
+    old = pl.DataFrame([STOCKFRAME._format_trade(trade) for trade in trades])
+    t1 = true_time.perf_counter()
+    new = trades_to_frame(trades)
+    t2 = true_time.perf_counter()
+    from_raw = trades_to_frame(raw['AAPL'])
+    t3 = true_time.perf_counter()
+
+    print(f"dict list path      : {t1 - t0:.3f} s")
+    print(f"columnar (objects)  : {t2 - t1:.3f} s")
+    print(f"columnar (raw json) : {t3 - t2:.3f} s")
+
+    assert new.equals(from_raw)
+    assert new.get_column('price').equals(old.get_column('price'))
+    assert new.get_column('timestamp').equals(old.get_column('timestamp').dt.replace_time_zone(None))
@@ -0,0 +1,258 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import logging
+import json
+import os
+import pathlib
+import threading
+from datetime import datetime, timezone, timedelta
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+On disk cache of market data, one arrow ipc file per symbol / timeframe / day
+
+    <root>/<kind>/<symbol>/<timeframe>/<YYYY-MM-DD>.arrow
+    <root>/<kind>/<symbol>/<timeframe>/_coverage.json
+
+kind is bars, quotes or trades and timeframe is the alpaca timeframe value ('1Min', '1Day', ...) or 'tick' for quotes
+and trades. The coverage file holds the merged [start, end) intervals that were fetched from the api, so a request is
+only sent for the parts of a window that were never fetched, even if that part had no data at all (weekends, halts).
+
+Arrow ipc is used over parquet as it can be memory mapped straight back into polars without decoding.
+'''
+
+
+def _utc(ts: datetime) -> datetime:
+    # alpaca hands back naive utc datetimes in places, treat them as utc
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo = timezone.utc)
+
+    return ts.astimezone(timezone.utc)
+
+
+def _merge_intervals(intervals: List[Tuple[datetime, datetime]]) -> List[Tuple[datetime, datetime]]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+class DataCache:
+
+    def __init__(self, root: Union[str, pathlib.Path]):
+        """
+        :param root: directory the cache lives in, created if missing
+        """
+
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents = True, exist_ok = True)
+
+        # Dict[(kind, symbol, timeframe): merged intervals]
+        self._coverage: Dict[Tuple[str, str, str], List[Tuple[datetime, datetime]]] = {}
+        self._lock = threading.Lock()
+
+    ############################################ layout ##########################################################
+    def _dir(self, kind: str, symbol: str, timeframe: str) -> pathlib.Path:
+        return self.root / kind / symbol / timeframe
+
+    def _partition(self, kind: str, symbol: str, timeframe: str, day) -> pathlib.Path:
+        return self._dir(kind, symbol, timeframe) / f"{day.isoformat()}.arrow"
+
+    @staticmethod
+    def _days(start: datetime, end: datetime) -> List:
+        days = []
+        day = start.date()
+        while day <= end.date():
+            days.append(day)
+            day += timedelta(days = 1)
+
+        return days
+
+    ############################################ coverage ########################################################
+    def coverage(self, kind: str, symbol: str, timeframe: str) -> List[Tuple[datetime, datetime]]:
+        key = (kind, symbol, timeframe)
+
+        if key not in self._coverage:
+            path = self._dir(kind, symbol, timeframe) / '_coverage.json'
+            intervals = []
+
+            if path.exists():
+                with open(path, 'r') as f:
+                    intervals = [(datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in json.load(f)]
+
+            self._coverage[key] = _merge_intervals(intervals)
+
+        return self._coverage[key]
+
+    def _add_coverage(self, kind: str, symbol: str, timeframe: str, start: datetime, end: datetime):
+        key = (kind, symbol, timeframe)
+        intervals = _merge_intervals(self.coverage(kind, symbol, timeframe) + [(start, end)])
+        self._coverage[key] = intervals
+
+        path = self._dir(kind, symbol, timeframe) / '_coverage.json'
+        path.parent.mkdir(parents = True, exist_ok = True)
+
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump([[s.isoformat(), e.isoformat()] for s, e in intervals], f)
+        os.replace(tmp, path)
+
+    def missing(self, kind: str, symbol: str, timeframe: str, start: datetime,
+                end: datetime) -> List[Tuple[datetime, datetime]]:
+        """
+        Parts of [start, end) which were never fetched
+
+        :param kind: bars, quotes or trades
+        :param symbol: symbol of the stock
+        :param timeframe: timeframe value or tick
+        :param start: start of the window
+        :param end: end of the window
+        :return: list of (start, end) gaps, empty on a full cache hit
+        """
+
+        start, end = _utc(start), _utc(end)
+        gaps = []
+        cursor = start
+
+        for cov_start, cov_end in self.coverage(kind, symbol, timeframe):
+            if cov_end <= cursor:
+                continue
+            if cov_start >= end:
+                break
+
+            if cov_start > cursor:
+                gaps.append((cursor, cov_start))
+            cursor = max(cursor, cov_end)
+
+            if cursor >= end:
+                break
+
+        if cursor < end:
+            gaps.append((cursor, end))
+
+        return gaps
+
+    ############################################ read / write ####################################################
+    def write(self, kind: str, symbol: str, timeframe: str, df: pl.DataFrame, start: datetime, end: datetime,
+              key: str = 'timestamp'):
+        """
+        Stores fetched rows into their day partitions and marks [start, end) as fetched
+
+        :param kind: bars, quotes or trades
+        :param symbol: symbol of the stock
+        :param timeframe: timeframe value or tick
+        :param df: rows fetched for [start, end), timestamps in naive utc
+        :param start: start of the fetched window
+        :param end: end of the fetched window
+        :param key: timestamp column
+        """
+
+        start, end = _utc(start), _utc(end)
+
+        with self._lock:
+            if not df.is_empty():
+                df = df.with_columns(pl.col(key).dt.date().alias('_day'))
+
+                for (day,), part in df.group_by('_day', maintain_order = True):
+                    path = self._partition(kind, symbol, timeframe, day)
+                    path.parent.mkdir(parents = True, exist_ok = True)
+                    part = part.drop('_day')
+
+                    if path.exists():
+                        # read from bytes rather than a memory map, the file is replaced below
+                        existing = pl.read_ipc(path.read_bytes())
+                        part = (pl.concat([existing, part], how = 'vertical')
+                                .unique(subset = [key], keep = 'last', maintain_order = True)
+                                .sort(key))
+                    else:
+                        part = part.sort(key)
+
+                    # write then rename, so readers holding a memory map keep the old file
+                    tmp = path.with_suffix('.tmp')
+                    part.write_ipc(tmp)
+                    os.replace(tmp, path)
+
+            self._add_coverage(kind, symbol, timeframe, start, end)
+
+    def load(self, kind: str, symbol: str, timeframe: str, start: datetime, end: datetime,
+             key: str = 'timestamp') -> Union[pl.DataFrame, None]:
+        """
+        Memory maps the partitions of [start, end] back into a frame
+
+        :param kind: bars, quotes or trades
+        :param symbol: symbol of the stock
+        :param timeframe: timeframe value or tick
+        :param start: start of the window
+        :param end: end of the window
+        :param key: timestamp column
+        :return: frame of the window or None if nothing is cached
+        """
+
+        start, end = _utc(start), _utc(end)
+
+        paths = []
+        for day in self._days(start, end):
+            path = self._partition(kind, symbol, timeframe, day)
+            if path.exists():
+                paths.append(path)
+
+        if not paths:
+            return None
+
+        lower = start.replace(tzinfo = None)
+        upper = end.replace(tzinfo = None)
+
+        # ipc scans are memory mapped, only the rows of the window get materialised
+        return pl.scan_ipc(paths).filter(pl.col(key).is_between(lower, upper)).collect()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from Finance.stockData import STOCKFRAME
+    from Finance.stubs import FakeStockDataClient
+
+    # cache miss, partial hit and full hit against the fake data client
+    with tempfile.TemporaryDirectory() as cache_dir:
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True,
+                           cache_dir = cache_dir)
+        frame.stock_data_client = FakeStockDataClient()
+
+        start = datetime(2024, 1, 2, 14, 30, tzinfo = timezone.utc)
+        end = start + timedelta(hours = 2)
+
+        frame.fetch_historical_data(['AAPL', 'MSFT'], start = start, end = end)
+        assert len(frame.stock_data_client.calls) == 1
+        assert frame.data_map['AAPL'].height == 121
+
+        # only the extra hour is requested
+        frame.fetch_historical_data(['AAPL', 'MSFT'], start = start, end = end + timedelta(hours = 1))
+        _, symbols, fetch_start, fetch_end = frame.stock_data_client.calls[-1]
+        assert len(frame.stock_data_client.calls) == 2
+        assert fetch_start >= (end - timedelta(minutes = 1)).replace(tzinfo = None)
+        assert frame.data_map['AAPL'].height == 181
+
+        # a fresh frame on the same cache is served without any call
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True,
+                           cache_dir = cache_dir)
+        frame.stock_data_client = FakeStockDataClient()
+        frame.fetch_historical_data(['AAPL', 'MSFT'], start = start, end = end)
+        assert not frame.stock_data_client.calls
+        assert frame.data_map['MSFT'].height == 121
+
+        # the whole of a past window is cached, the same window again makes no call
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True,
+                           cache_dir = cache_dir)
+        frame.stock_data_client = FakeStockDataClient()
+        frame.fetch_historical_data(['AAPL', 'MSFT'], start = start, end = end + timedelta(hours = 1))
+        assert not frame.stock_data_client.calls
+        assert frame.data_map['AAPL'].height == 181
+
+        print("cache miss, partial hit and hit behave as expected")
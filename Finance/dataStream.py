@@ -62,8 +62,17 @@ if __name__ == '__main__':
         print(datetime.now(tz=timezone.utc))
         print()
 
-    s.subscribe_updated_bars(handler, *('AAPL', 'MSFT', 'SPY'))
-    s.subscribe_bars(handler, *('AAPL', 'MSFT', 'SPY'))
+    # live bars go into the frame in micro batches, a stream keeps one handler per channel and symbol so the
+    # ingestor takes the place of the print handler on bars and updated bars
+    from Finance.stockData import STOCKFRAME
+    from Finance.liveIngest import INGESTOR
+
+    frame = STOCKFRAME(api_key, secret_key, trade_client = None, subscribed = False)
+    ingestor = INGESTOR(frame, on_flush = lambda kind, symbol, batch: print(kind, symbol, batch.height, "rows"))
+    ingestor.subscribe(s, ['AAPL', 'MSFT', 'SPY'])
+
+    # s.subscribe_updated_bars(handler, *('AAPL', 'MSFT', 'SPY'))
+    # s.subscribe_bars(handler, *('AAPL', 'MSFT', 'SPY'))
     # s.subscribe_quotes(handler, *('AAPL', 'MSFT'))
     s.run()
 
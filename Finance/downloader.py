@@ -0,0 +1,232 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import logging
+import random
+import threading
+import time as true_time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone, timedelta
+
+from alpaca.data.requests import StockBarsRequest
+from alpaca.data.timeframe import TimeFrame
+
+from Finance.stockData import STOCKFRAME
+from Finance.columnar import bars_to_frame, set_data
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        Token bucket shared by threads, alpaca allows 200 requests a minute on the free plan
+
+        :param rate: requests per second
+        :param burst: max requests let through back to back
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = true_time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a request may go out
+        """
+
+        while True:
+            with self._lock:
+                now = true_time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            true_time.sleep(wait)
+
+
+class DOWNLOADER:
+
+    def __init__(self, stockFrame: STOCKFRAME, max_workers: int = 8, symbols_per_chunk: int = 50,
+                 window: timedelta = timedelta(days = 30), requests_per_minute: float = 200, max_retries: int = 3,
+                 backoff: float = 0.5):
+        """
+        Downloads history for large symbol universes by splitting it into symbol batch x time window chunks which
+        are fetched concurrently. Every chunk is retried on its own and lands in the stock frame (and its disk cache
+        if it has one) as soon as it finishes.
+
+        :param stockFrame: frame the data goes into, its stock_data_client is used for the requests
+        :param max_workers: number of chunks in flight
+        :param symbols_per_chunk: symbols per request
+        :param window: time span per request
+        :param requests_per_minute: rate limit of the requests across all workers
+        :param max_retries: retries of a failed chunk before it is given up
+        :param backoff: base seconds of the exponential backoff between retries
+        """
+
+        self.stockFrame = stockFrame
+        self.max_workers = max_workers
+        self.symbols_per_chunk = symbols_per_chunk
+        self.window = window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limiter = RateLimiter(rate = requests_per_minute / 60, burst = max(1, max_workers))
+
+        # frame stores are plain dicts, chunks are written into them one at a time
+        self._store_lock = threading.Lock()
+
+    def _chunks(self, symbols: List[str], start: datetime, end: datetime) -> List[Tuple[List[str], datetime, datetime]]:
+        chunks = []
+        for i in range(0, len(symbols), self.symbols_per_chunk):
+            batch = symbols[i: i + self.symbols_per_chunk]
+
+            window_start = start
+            while window_start < end:
+                window_end = min(end, window_start + self.window)
+                chunks.append((batch, window_start, window_end))
+                window_start = window_end
+
+        return chunks
+
+    def _fetch_chunk(self, symbols: List[str], start: datetime, end: datetime, timeframe: TimeFrame) -> Dict:
+        """
+        Fetches one chunk, retrying with jittered exponential backoff, and converts it on the worker thread
+
+        :return: Dict[symbol: pl.DataFrame]
+        """
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+
+            try:
+                req = StockBarsRequest(
+                    symbol_or_symbols = symbols,
+                    timeframe = timeframe,
+                    start = start,
+                    end = end
+                )
+                data = set_data(self.stockFrame.stock_data_client.get_stock_bars(req))
+                break
+
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+                wait = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+                log.warning(f"chunk {symbols[0]}..{symbols[-1]} {start} - {end} failed ({e}), "
+                            f"retry {attempt} in {wait:.2f} s")
+                true_time.sleep(wait)
+
+        return {symbol: bars_to_frame(data.get(symbol, [])) for symbol in symbols}
+
+    def _store_chunk(self, frames: Dict, symbols: List[str], start: datetime, end: datetime, timeframe: TimeFrame):
+        settle = self.stockFrame._timeframe_delta(timeframe)
+
+        with self._store_lock:
+            for symbol in symbols:
+                df = frames[symbol]
+
+                if self.stockFrame.cache is not None:
+                    self.stockFrame.cache.write('bars', symbol, timeframe.value, df, start,
+                                                max(start, self.stockFrame._settled(end, settle)))
+
+                self.stockFrame.data_map.append(symbol, df)
+
+    def download(self, symbol_or_symbols: Union[List[str], str], start: datetime, end: datetime = None,
+                 timeframe: str = 'min') -> Dict:
+        """
+        Downloads bars of all the symbols for [start, end]
+
+        :param symbol_or_symbols: symbols to download
+        :param start: start of the history
+        :param end: end of the history, defaults to now
+        :param timeframe: one of day, minute, hour, week or month
+        :return: summary with the number of chunks, failed chunks and the time taken
+        """
+
+        if isinstance(symbol_or_symbols, str):
+            symbol_or_symbols = [symbol_or_symbols]
+
+        timeframe = self.stockFrame._format_timeframe(timeframe)
+        start = self.stockFrame._set_start(start)
+        end = self.stockFrame._set_end(end)
+
+        # chunks already on disk are skipped
+        chunks = []
+        for batch, chunk_start, chunk_end in self._chunks(symbol_or_symbols, start, end):
+            cache = self.stockFrame.cache
+            if cache is not None and not any(cache.missing('bars', s, timeframe.value, chunk_start, chunk_end)
+                                             for s in batch):
+                for symbol in batch:
+                    df = cache.load('bars', symbol, timeframe.value, chunk_start, chunk_end)
+                    if df is not None:
+                        self.stockFrame.data_map.append(symbol, df)
+                continue
+
+            chunks.append((batch, chunk_start, chunk_end))
+
+        log.info(f"downloading {len(chunks)} chunks with {self.max_workers} workers")
+
+        failed = []
+        t0 = true_time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            futures = {
+                pool.submit(self._fetch_chunk, batch, chunk_start, chunk_end, timeframe): (batch, chunk_start, chunk_end)
+                for batch, chunk_start, chunk_end in chunks
+            }
+
+            for future in as_completed(futures):
+                batch, chunk_start, chunk_end = futures[future]
+
+                try:
+                    self._store_chunk(future.result(), batch, chunk_start, chunk_end, timeframe)
+                except Exception as e:
+                    log.error(f"giving up on chunk {batch[0]}..{batch[-1]} {chunk_start} - {chunk_end}: {e}")
+                    failed.append((batch, chunk_start, chunk_end))
+
+        elapsed = true_time.perf_counter() - t0
+
+        return {
+            'chunks': len(chunks),
+            'failed': failed,
+            'seconds': elapsed
+        }
+
+
+if __name__ == '__main__':
+    from Finance.stubs import FakeStockDataClient
+
+    # throughput and rate limiting against a stub client with 100 ms latency, daily bars keep the stub cheap
+    symbols = [f"SYM{i}" for i in range(500)]
+    start = datetime(2023, 1, 1, tzinfo = timezone.utc)
+    end = start + timedelta(days = 360)
+
+    for workers in [1, 4, 16]:
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+        frame.stock_data_client = FakeStockDataClient(latency = 0.1, fail_rate = 0.05)
+
+        downloader = DOWNLOADER(frame, max_workers = workers, symbols_per_chunk = 50, window = timedelta(days = 90),
+                                requests_per_minute = 3000, backoff = 0.01)
+        summary = downloader.download(symbols, start = start, end = end, timeframe = 'day')
+
+        client = frame.stock_data_client
+        times = client.call_times
+        observed_rate = (len(times) - 1) / (times[-1] - times[0]) * 60 if len(times) > 1 else 0
+
+        print(f"workers {workers:>2}: {summary['chunks']} chunks in {summary['seconds']:.2f} s, "
+              f"{len(client.calls)} calls, {len(summary['failed'])} failed, max in flight {client.max_in_flight}, "
+              f"{observed_rate:.0f} req/min")
+        assert observed_rate <= 3000 * 1.1
+        assert frame.data_map['SYM0'].height == 361
@@ -0,0 +1,561 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import asyncio
+import logging
+import math
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import polars as pl
+
+from alpaca.data.models import Trade
+from alpaca.data.live.stock import StockDataStream
+
+from Finance.orders import ORDERS
+from Finance.stockData import STOCKFRAME
+from Finance.liveIngest import subscribe_first
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Parent orders worked as child orders over a window, every parent is a task on the loop.
+
+    twap    the same share of the qty every interval
+    vwap    every interval the share of the day's volume it had on average, from the minute bars of the symbol in
+            STOCKFRAME.data_map (average volume per minute of the day), twap without bars
+    pov     every interval rate times the volume traded since the start, from the trades fed to trade_handler, the
+            rest is sent at the end only with finish = True
+
+A slice sends the qty that takes what was sent up to the schedule, whole shares without fractional trading, the last
+slice sends the rest. Children are market orders, or limit orders at the parent's limit price, with client order id
+<parent id>-<n>, their fills come from the trade updates through ORDERS.subscribe_updates. The qty of a child that is
+cancelled, expires or is rejected goes back to the parent for the next slices.
+
+Slippage is in basis points, positive is a cost, against
+    arrival     the last price when the parent started
+    vwap        the market vwap over the parent's life from the trades seen, or the bars without trades
+
+Time comes from now and sleep, datetime.now and asyncio.sleep by default, a SimClock of stubs runs the schedules on
+simulated time.
+'''
+
+ALGORITHMS = ('twap', 'vwap', 'pov')
+
+REPORT_SCHEMA = {
+    'id': pl.Utf8,
+    'symbol': pl.Utf8,
+    'side': pl.Utf8,
+    'algorithm': pl.Utf8,
+    'state': pl.Utf8,
+    'qty': pl.Float64,
+    'filled_qty': pl.Float64,
+    'filled_avg_price': pl.Float64,
+    'children': pl.Int64,
+    'arrival': pl.Float64,
+    'vwap': pl.Float64,
+    'slippage_arrival': pl.Float64,
+    'slippage_vwap': pl.Float64
+}
+
+# children of a parent: client order id -> [qty, filled_qty, filled_avg_price, done]
+_QTY, _FILLED, _AVG, _DONE = range(4)
+
+
+class _Parent:
+    __slots__ = ('id', 'symbol', 'side', 'qty', 'algorithm', 'start', 'end', 'interval', 'rate', 'finish',
+                 'limit_price', 'state', 'sent', 'children', 'arrival', 'volume', 'notional', 'task')
+
+    def __init__(self, symbol: str, side: str, qty: float, algorithm: str, start: datetime, end: datetime,
+                 interval: float, rate: float, finish: bool, limit_price: Union[float, None]):
+        self.id = str(uuid.uuid4())
+        self.symbol = symbol
+        self.side = side
+        self.qty = qty
+        self.algorithm = algorithm
+        self.start = start
+        self.end = end
+        self.interval = interval
+        self.rate = rate
+        self.finish = finish
+        self.limit_price = limit_price
+        # scheduled, working, done, partial, cancelled
+        self.state = 'scheduled'
+        # qty of the children which are working or filled
+        self.sent = 0.0
+        self.children: Dict[str, List] = {}
+        self.arrival: Union[float, None] = None
+        # traded by the market since the start
+        self.volume = 0.0
+        self.notional = 0.0
+        self.task: Union[asyncio.Task, None] = None
+
+    @property
+    def filled(self) -> float:
+        return sum(child[_FILLED] for child in self.children.values())
+
+    @property
+    def avg_price(self) -> Union[float, None]:
+        filled = self.filled
+        if not filled:
+            return None
+
+        return sum(child[_FILLED] * child[_AVG] for child in self.children.values()) / filled
+
+
+def _utc(ts: datetime) -> datetime:
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo = timezone.utc)
+
+    return ts.astimezone(timezone.utc)
+
+
+class EXECUTION:
+
+    def __init__(self, orders: ORDERS, stockFrame: STOCKFRAME = None, fractional: bool = False,
+                 now: Callable = None, sleep: Callable = None, settle: float = 30.0):
+        """
+        :param orders: ORDERS the children are submitted with, its risk gate checks every child
+        :param stockFrame: frame whose minute bars give the volume curve of vwap
+        :param fractional: fractional children, BOT.fractional_trading
+        :param now: returns the current utc time, datetime.now by default
+        :param sleep: coroutine function sleeping seconds, asyncio.sleep by default
+        :param settle: seconds a parent waits for the fills of its last children
+        """
+
+        self.orders = orders
+        self.stockFrame = stockFrame
+        self.fractional = fractional
+        self._now = now if now is not None else lambda: datetime.now(timezone.utc)
+        self._sleep = sleep if sleep is not None else asyncio.sleep
+        self.settle = settle
+
+        # Dict[id: parent] of every parent made
+        self.parents: Dict[str, _Parent] = {}
+        # Dict[child client order id: parent]
+        self._children: Dict[str, _Parent] = {}
+        # Dict[symbol: running parents], for the trades
+        self._running: Dict[str, List[_Parent]] = {}
+        # Dict[symbol: last trade price]
+        self.last: Dict[str, float] = {}
+
+        orders.subscribe_updates(self._update_handler)
+
+    ############################################ parents #########################################################
+    def execute(self, symbol: str, side: str, qty: float, algorithm: str = 'twap', start: datetime = None,
+                end: datetime = None, duration: float = 3600.0, interval: float = 60.0, rate: float = 0.1,
+                finish: bool = False, limit_price: float = None, arrival: float = None) -> str:
+        """
+        Starts working a parent order, on the running loop
+
+        :param algorithm: twap, vwap or pov
+        :param start: time the first child goes, now by default
+        :param end: time the last child goes by, start + duration seconds by default
+        :param interval: seconds between the children
+        :param rate: share of the market volume, pov only
+        :param finish: pov sends what is left at the end
+        :param limit_price: children are limit orders at it, market orders by default
+        :param arrival: price the arrival slippage is against, the last trade at the start by default
+        :return: id of the parent
+        """
+
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm must be one of {ALGORITHMS}.")
+        if side not in ('buy', 'sell'):
+            raise ValueError("side must be buy or sell.")
+        if qty <= 0 or interval <= 0:
+            raise ValueError("qty and interval must be positive.")
+        if algorithm == 'pov' and not 0 < rate < 1:
+            raise ValueError("rate must be between 0 and 1.")
+
+        start = _utc(start) if start is not None else self._now()
+        end = _utc(end) if end is not None else start + timedelta(seconds = duration)
+        if end <= start:
+            raise ValueError("end must be after start.")
+
+        parent = _Parent(symbol, side, qty, algorithm, start, end, interval, rate, finish, limit_price)
+        parent.arrival = arrival
+        self.parents[parent.id] = parent
+        self._running.setdefault(symbol, []).append(parent)
+
+        parent.task = asyncio.get_running_loop().create_task(self._run(parent))
+        log.info(f"{algorithm} {side} {qty} {symbol} from {start} to {end} is {parent.id}")
+
+        return parent.id
+
+    async def wait(self, parent_id: str = None):
+        """
+        Waits for a parent, or for every parent with None
+        """
+
+        parents = [self.parents[parent_id]] if parent_id is not None else list(self.parents.values())
+        await asyncio.gather(*(parent.task for parent in parents), return_exceptions = True)
+
+    def cancel(self, parent_id: str):
+        """
+        Stops sending children of a parent, the ones working stay
+        """
+
+        parent = self.parents[parent_id]
+        if parent.task is not None:
+            parent.task.cancel()
+
+    async def _run(self, parent: _Parent):
+        try:
+            await self._sleep_until(parent.start)
+            parent.state = 'working'
+            if parent.arrival is None:
+                parent.arrival = self.price(parent.symbol)
+
+            if parent.algorithm == 'pov':
+                await self._pov(parent)
+            else:
+                await self._slices(parent, self.schedule(parent))
+
+            waited = 0.0
+            while any(not child[_DONE] for child in parent.children.values()) and waited < self.settle:
+                await self._sleep(0.5)
+                waited += 0.5
+
+            parent.state = 'done' if parent.filled >= parent.qty - 1e-9 else 'partial'
+            log.info(f"{parent.algorithm} {parent.id} {parent.state}, {parent.filled} of {parent.qty} {parent.symbol}")
+
+        except asyncio.CancelledError:
+            parent.state = 'cancelled'
+            raise
+
+        finally:
+            self._running[parent.symbol].remove(parent)
+
+    async def _sleep_until(self, at: datetime):
+        seconds = (at - self._now()).total_seconds()
+        if seconds > 0:
+            await self._sleep(seconds)
+
+    def _round(self, qty: float) -> float:
+        return math.floor(qty * 1e9) / 1e9 if self.fractional else float(math.floor(qty + 1e-9))
+
+    async def _slices(self, parent: _Parent, schedule: List[float]):
+        last = len(schedule) - 1
+        for k, share in enumerate(schedule):
+            await self._sleep_until(parent.start + timedelta(seconds = k * parent.interval))
+
+            target = parent.qty if k == last else self._round(parent.qty * share)
+            if target - parent.sent > 1e-9:
+                await self._child(parent, target - parent.sent)
+
+    async def _pov(self, parent: _Parent):
+        while parent.sent < parent.qty - 1e-9:
+            target = self._round(min(parent.qty, parent.rate * parent.volume))
+            if target - parent.sent > 1e-9:
+                await self._child(parent, target - parent.sent)
+
+            # the volume up to the end is caught up once more at the end
+            left = (parent.end - self._now()).total_seconds()
+            if left <= 0:
+                break
+            await self._sleep(min(parent.interval, left))
+
+        if parent.finish and parent.qty - parent.sent > 1e-9:
+            await self._child(parent, parent.qty - parent.sent)
+
+    async def _child(self, parent: _Parent, qty: float):
+        client_order_id = f"{parent.id}-{len(parent.children)}"
+        if parent.limit_price:
+            request = self.orders.order_request(parent.symbol, parent.side, qty, order_type = 'limit',
+                                                limit_price = parent.limit_price, time_in_force = 'day')
+        else:
+            request = self.orders.order_request(parent.symbol, parent.side, qty, order_type = 'market',
+                                                time_in_force = 'day')
+        request.client_order_id = client_order_id
+
+        # counted before the submit, its fill can come before the answer
+        parent.children[client_order_id] = [qty, 0.0, 0.0, False]
+        self._children[client_order_id] = parent
+        parent.sent += qty
+
+        try:
+            await self.orders.submit(request)
+        except Exception as e:
+            log.error(f"child {client_order_id} of {parent.symbol} failed: {e}")
+            parent.children[client_order_id][_DONE] = True
+            parent.sent -= qty
+
+    ############################################ schedules #######################################################
+    def schedule(self, parent: _Parent) -> List[float]:
+        """
+        :return: share of the qty sent by the end of every slice, the last one is 1
+        """
+
+        seconds = (parent.end - parent.start).total_seconds()
+        n = max(1, math.ceil(seconds / parent.interval))
+
+        if parent.algorithm == 'vwap':
+            curve = self.volume_curve(parent.symbol, parent.start, seconds, parent.interval)
+            if curve is not None:
+                return curve
+            log.warning(f"no volume for {parent.symbol} in {parent.start} to {parent.end}, vwap goes as twap")
+
+        return [(k + 1) / n for k in range(n)]
+
+    def volume_curve(self, symbol: str, start: datetime, seconds: float,
+                     interval: float) -> Union[List[float], None]:
+        """
+        Share of the volume of a window traded by the end of every interval, from the average volume of every minute
+        of the day in the minute bars of data_map
+
+        :return: cumulative shares, None without bars or volume in the window
+        """
+
+        bars = self.stockFrame.data_map.get(symbol) if self.stockFrame is not None else None
+        if bars is None or bars.is_empty():
+            return None
+
+        profile = bars.lazy().group_by(
+            (pl.col('timestamp').dt.hour().cast(pl.Int64) * 60 + pl.col('timestamp').dt.minute()).alias('minute')
+        ).agg(pl.col('volume').mean())
+
+        # every second of the window, a minute's volume spread over its seconds
+        offset = start.hour * 3600 + start.minute * 60 + start.second
+        curve = pl.LazyFrame({'second': pl.int_range(0, int(seconds), eager = True)}).with_columns(
+            (pl.col('second') // interval).cast(pl.Int64).alias('slice'),
+            ((pl.col('second') + offset) // 60 % 1440).cast(pl.Int64).alias('minute')
+        ).join(profile, on = 'minute', how = 'left').group_by('slice').agg(
+            pl.col('volume').fill_null(0.0).sum()
+        ).sort('slice').collect()
+
+        volume = curve.get_column('volume')
+        total = volume.sum()
+        if not total:
+            return None
+
+        return (volume.cum_sum() / total).to_list()
+
+    ############################################ market and fills ################################################
+    def price(self, symbol: str) -> Union[float, None]:
+        """
+        Last trade seen, the ledger's mark or the last bar's close
+        """
+
+        if symbol in self.last:
+            return self.last[symbol]
+
+        row = self.orders.portfolio.ledger.get(symbol)
+        if row is not None and row['current_price']:
+            return row['current_price']
+
+        bars = self.stockFrame.data_map.get(symbol) if self.stockFrame is not None else None
+        if bars is not None and not bars.is_empty():
+            return bars.get_column('close')[-1]
+
+        return None
+
+    def tick(self, symbol: str, price: float, size: float):
+        """
+        A trade of the market, moves the volume of the parents of symbol inside their window
+        """
+
+        self.last[symbol] = price
+        running = self._running.get(symbol)
+        if not running:
+            return
+
+        now = self._now()
+        for parent in running:
+            if parent.state == 'working' and now < parent.end:
+                parent.volume += size
+                parent.notional += size * price
+
+    async def trade_handler(self, trade: Union[Trade, Dict]):
+        if isinstance(trade, dict):
+            self.tick(trade['S'], trade['p'], trade['s'])
+        else:
+            self.tick(trade.symbol, trade.price, trade.size)
+
+    def subscribe(self, stream: StockDataStream, symbols: List[str]):
+        """
+        Feeds the trades of symbols to trade_handler, before the handlers already there
+        """
+
+        subscribe_first(stream, 'trades', self.trade_handler, symbols)
+
+    def _update_handler(self, event: str, row: Dict):
+        parent = self._children.get(row['client_order_id'])
+        if parent is None:
+            return
+
+        child = parent.children[row['client_order_id']]
+        if row['filled_qty'] and row['filled_avg_price'] is not None:
+            child[_FILLED] = row['filled_qty']
+            child[_AVG] = row['filled_avg_price']
+
+        if event == 'fill':
+            child[_DONE] = True
+        elif event in ('canceled', 'expired', 'rejected'):
+            # the unfilled qty goes back to the schedule, not on done_for_day, the broker resumes the order
+            # the next session
+            child[_DONE] = True
+            parent.sent -= child[_QTY] - child[_FILLED]
+
+        # fills recovered after the parent stopped waiting for them
+        if parent.state == 'partial' and parent.filled >= parent.qty - 1e-9:
+            parent.state = 'done'
+
+    ############################################ report ##########################################################
+    def _vwap(self, parent: _Parent) -> Union[float, None]:
+        if parent.volume:
+            return parent.notional / parent.volume
+
+        bars = self.stockFrame.data_map.get(parent.symbol) if self.stockFrame is not None else None
+        if bars is None or bars.is_empty():
+            return None
+
+        window = bars.filter(pl.col('timestamp').is_between(parent.start.replace(tzinfo = None),
+                                                             parent.end.replace(tzinfo = None), closed = 'left'))
+        volume = window.get_column('volume').sum()
+        if not volume:
+            return None
+
+        return (window.get_column('vwap') * window.get_column('volume')).sum() / volume
+
+    def report(self) -> pl.DataFrame:
+        """
+        Every parent with its fills and slippage in basis points against arrival and vwap, see REPORT_SCHEMA
+        """
+
+        rows = []
+        for parent in self.parents.values():
+            avg_price = parent.avg_price
+            vwap = self._vwap(parent)
+            sign = 1 if parent.side == 'buy' else -1
+
+            def slippage(benchmark: Union[float, None]) -> Union[float, None]:
+                if avg_price is None or not benchmark:
+                    return None
+                return sign * (avg_price - benchmark) / benchmark * 1e4
+
+            rows.append({
+                'id': parent.id, 'symbol': parent.symbol, 'side': parent.side, 'algorithm': parent.algorithm,
+                'state': parent.state, 'qty': float(parent.qty), 'filled_qty': float(parent.filled),
+                'filled_avg_price': avg_price, 'children': len(parent.children), 'arrival': parent.arrival,
+                'vwap': vwap, 'slippage_arrival': slippage(parent.arrival), 'slippage_vwap': slippage(vwap)
+            })
+
+        return pl.DataFrame(rows, schema = REPORT_SCHEMA)
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import time as true_time
+
+    from Finance.portfolio import PORTFOLIO
+    from Finance.stubs import SimClock, SimBroker, InlineExecutor
+
+    # 60 parents on 20 symbols worked over the first two hours of a simulated session, the market prints a trade every
+    # 5 seconds per symbol with a u shaped volume over the day, the same shape as the 5 days of minute bars vwap reads
+    n_parents = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    symbols = [f"SYM{i}" for i in range(20)]
+    open_ = datetime(2024, 1, 8, 14, 30, tzinfo = timezone.utc)
+    minutes = 390
+    logging.getLogger(__name__).setLevel(logging.WARNING)
+    logging.getLogger('Finance.stubs').setLevel(logging.WARNING)
+
+    rng = random.Random(0)
+
+    def volume(minute: int) -> float:
+        # per minute, heavy at the open and the close
+        x = minute / minutes
+        return 2000 + 30000 * ((1 - x) ** 8 + x ** 8)
+
+    clock = SimClock(open_ - timedelta(minutes = 1))
+    prices = {symbol: rng.uniform(20, 400) for symbol in symbols}
+    broker = SimBroker(clock, price = lambda symbol: prices[symbol], impact = 2.0)
+
+    orders = ORDERS(broker, PORTFOLIO(broker))
+    orders.executor = InlineExecutor()
+    broker.on_update = orders._update_handler
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    for symbol in symbols:
+        timestamps = [(open_ - timedelta(days = day) + timedelta(minutes = m)).replace(tzinfo = None)
+                      for day in range(7, 2, -1) for m in range(minutes)]
+        vols = [volume(m) * rng.uniform(0.8, 1.2) for day in range(5) for m in range(minutes)]
+        frame.data_map.append(symbol, pl.DataFrame({
+            'timestamp': timestamps, 'open': prices[symbol], 'high': prices[symbol], 'low': prices[symbol],
+            'close': prices[symbol], 'volume': vols, 'trade_count': 10.0, 'vwap': prices[symbol]
+        }, schema = frame.data_map.schema))
+
+    execution = EXECUTION(orders, stockFrame = frame, now = clock.now, sleep = clock.sleep, settle = 5.0)
+
+    async def market():
+        # every 5 seconds a trade per symbol, a random walk of 1 bp per print
+        for second in range(0, minutes * 60, 5):
+            await clock.sleep((open_ + timedelta(seconds = second) - clock.now()).total_seconds())
+            for symbol in symbols:
+                prices[symbol] *= 1 + rng.gauss(0, 1e-4)
+                execution.tick(symbol, prices[symbol], volume(second // 60) / 12 * rng.uniform(0.5, 1.5))
+
+    async def session():
+        feed = asyncio.create_task(market())
+        await clock.sleep(60)
+
+        algorithms = []
+        for i in range(n_parents):
+            algorithm = ALGORITHMS[i % 3]
+            algorithms.append(algorithm)
+            execution.execute(symbols[i % len(symbols)], rng.choice(('buy', 'sell')), float(rng.randint(10, 50) * 100),
+                              algorithm = algorithm, duration = 7200, interval = 60 if algorithm != 'pov' else 15,
+                              rate = 0.003)
+        await execution.wait()
+        feed.cancel()
+
+    t0 = true_time.perf_counter()
+    asyncio.run(clock.run(session()))
+    seconds = true_time.perf_counter() - t0
+
+    report = execution.report()
+    print(f"{n_parents} parents over {(clock.now() - open_).total_seconds() / 3600:.1f} simulated hours in "
+          f"{seconds:.2f} s, {report.get_column('children').sum()} children, {len(broker.orders)} broker orders")
+    print(report.group_by('algorithm').agg(
+        pl.len().alias('parents'), pl.col('state').unique().alias('states'),
+        (pl.col('filled_qty').sum() / pl.col('qty').sum()).alias('filled'),
+        pl.col('children').mean(), pl.col('slippage_arrival').mean(), pl.col('slippage_vwap').mean(),
+        pl.col('slippage_vwap').abs().mean().alias('abs_slippage_vwap')
+    ).sort('algorithm'))
+
+    # every child went to the broker and filled, twap and vwap finish their qty, pov stays near its rate
+    assert report.get_column('children').sum() == len(broker.orders)
+    scheduled = report.filter(pl.col('algorithm') != 'pov')
+    assert (scheduled.get_column('state') == 'done').all()
+    assert (scheduled.get_column('filled_qty') == scheduled.get_column('qty')).all()
+    for parent in execution.parents.values():
+        if parent.algorithm == 'pov' and parent.state == 'partial':
+            assert parent.filled == math.floor(parent.rate * parent.volume), (parent.filled, parent.volume)
+
+    # vwap sends the volume curve, more at the open than in the middle of the window
+    parent = next(parent for parent in execution.parents.values() if parent.algorithm == 'vwap')
+    sizes = [child[_QTY] for child in parent.children.values()]
+    assert sizes[0] > sizes[len(sizes) // 2], sizes
+
+    # the trade stream drops while a parent works, the fills of its children come with the recovery of the missed
+    # orders once the stream is back, and the parent ends done with all its fills, whether the stream is back within
+    # settle of the last child or after
+    async def dropped(down: float) -> _Parent:
+        since = clock.now()
+        broker.on_update = None
+        parent_id = execution.execute('SYM0', 'buy', 1000.0, algorithm = 'twap', duration = 600, interval = 60)
+        await clock.sleep(down)
+        parent = execution.parents[parent_id]
+        assert not any(child[_DONE] for child in parent.children.values())
+
+        broker.on_update = orders._update_handler
+        await orders._reconnect_handler(since)
+        await execution.wait(parent_id)
+        return parent
+
+    for down in (541, 900):
+        parent = asyncio.run(clock.run(dropped(down)))
+        print(f"stream down {down} s: {parent.state}, {parent.filled} of {parent.qty} filled at "
+              f"{parent.avg_price:.2f}, {len(parent.children)} children")
+        assert parent.state == 'done' and parent.filled == parent.qty and parent.avg_price is not None
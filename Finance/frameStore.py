@@ -0,0 +1,109 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import logging
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+class FrameStore(dict):
+
+    def __init__(self, schema: Dict, key: str = 'timestamp', max_chunks: int = 64):
+        """
+        Dict[symbol: pl.DataFrame] which keeps every symbol's frame unique and sorted on the key column.
+
+        Batches which start after the last stored key are appended in place as new chunks, so a refresh costs
+        O(new rows) instead of O(history). A batch starting on the last stored key replaces that row the same way.
+        Only overlapping or out of order batches fall back to a full merge.
+
+        :param schema: schema of the stored frames
+        :param key: column the frames are sorted and de-duplicated on
+        :param max_chunks: frames are rechunked once they hold more chunks than this
+        """
+
+        super().__init__()
+        self.schema = schema
+        self.key = key
+        self.max_chunks = max_chunks
+
+    def _conform(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Casts a batch to the store schema, timestamps are kept as naive utc like the rest of the frames
+
+        :param df: new batch
+        :return: batch with exactly the store's columns and dtypes
+        """
+
+        if list(df.schema.items()) == list(self.schema.items()):
+            return df
+
+        columns = []
+        for name, dtype in self.schema.items():
+            if name not in df.columns:
+                columns.append(pl.lit(None, dtype = dtype).alias(name))
+                continue
+
+            col = pl.col(name)
+            current = df.schema[name]
+            if isinstance(current, pl.Datetime) and current.time_zone:
+                col = col.dt.convert_time_zone('UTC').dt.replace_time_zone(None)
+
+            columns.append(col.cast(dtype))
+
+        return df.select(columns)
+
+    def empty(self) -> pl.DataFrame:
+        return pl.DataFrame(schema = self.schema)
+
+    def append(self, symbol: str, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Adds a batch of rows to a symbol's frame, newer rows win on duplicate keys
+
+        :param symbol: symbol of the batch
+        :param df: new rows, any order
+        :return: the stored frame of the symbol
+        """
+
+        if df.is_empty():
+            return self.setdefault(symbol, self.empty())
+
+        df = self._conform(df)
+
+        # only the new batch is sorted and de-duplicated here
+        if not df.get_column(self.key).is_sorted():
+            df = df.sort(self.key, maintain_order = True)
+        df = df.unique(subset = [self.key], keep = 'last', maintain_order = True)
+
+        current: Union[pl.DataFrame, None] = self.get(symbol)
+
+        if current is None or current.is_empty():
+            self[symbol] = df
+            return df
+
+        first = df.get_column(self.key)[0]
+        last = current.get_column(self.key)[-1]
+
+        # fast path, batch starts after the stored history so just add it as a chunk
+        if first >= last:
+            if first == last:
+                # batch starts with a correction of the last row (updated bars), the slice is zero copy
+                current = current.slice(0, current.height - 1)
+                self[symbol] = current
+
+            current.vstack(df, in_place = True)
+
+            if current.n_chunks() > self.max_chunks:
+                current = current.rechunk()
+                self[symbol] = current
+
+            return current
+
+        # overlapping or out of order batch, merge with the history
+        log.debug(f"Merging out of order batch of {df.height} rows for {symbol}")
+        current = (pl.concat([current, df], how = 'vertical')
+                   .unique(subset = [self.key], keep = 'last', maintain_order = True)
+                   .sort(self.key, maintain_order = True))
+        self[symbol] = current
+
+        return current
@@ -0,0 +1,276 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import asyncio
+import functools
+import logging
+from uuid import UUID
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from requests.adapters import HTTPAdapter
+
+from alpaca.trading.client import TradingClient
+from alpaca.trading.requests import OrderRequest, ReplaceOrderRequest, GetOrdersRequest
+from alpaca.trading.enums import QueryOrderStatus
+from alpaca.trading.models import Order, Clock, TradeAccount, Position
+
+from Finance.orders import ORDERS
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Async gateway to the trading api.
+
+Every call of TradingClient is a blocking http round trip, the gateway runs them in a thread pool so the loop can have
+many in flight: a basket of orders takes about one round trip instead of one per order.
+
+The client's requests session keeps only 10 connections per host, threads beyond that open a new tcp and tls
+connection for every call and throw it away. The gateway mounts an adapter with a pool as big as its thread pool, so
+every thread keeps its connection alive between calls.
+
+With orders, submitted and replaced orders go into the order store as soon as the api answers, cancels are left to
+the trade updates like in ORDERS.
+'''
+
+
+def pool_session(trade_client: TradingClient, size: int):
+    """
+    Gives the session of trade_client a keep alive pool of size connections per host
+
+    :param trade_client: any alpaca rest client
+    :param size: connections kept per host, the threads making calls at once
+    """
+
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = size)
+    trade_client._session.mount('https://', adapter)
+    trade_client._session.mount('http://', adapter)
+
+
+class GATEWAY:
+
+    def __init__(self, trade_client: TradingClient, orders: ORDERS = None, max_workers: int = 16,
+                 executor: Executor = None):
+        """
+        :param trade_client: client the calls go through
+        :param orders: ORDERS whose store is kept up to date, optional
+        :param max_workers: calls in flight at once, also the size of the connection pool
+        :param executor: pool to run the calls in, a new one of max_workers threads by default
+        """
+
+        self.trade_client = trade_client
+        self.orders = orders
+        self.max_workers = max_workers
+
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers = max_workers,
+                                                                                 thread_name_prefix = 'gateway')
+        pool_session(trade_client, max_workers)
+
+    async def _call(self, fn: Callable, *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def _store(self, order: Order, replaces: Union[UUID, str] = None):
+        if self.orders is None:
+            return
+
+        if replaces is not None:
+            self.orders.order_store.remove(replaces)
+        # not over the trade updates handled while the call was in flight
+        self.orders.order_store.ack(self.orders.process_and_add_order(order, add = False))
+
+    ############################################ orders ##########################################################
+    async def submit(self, request: OrderRequest) -> Order:
+        """
+        :param request: request of ORDERS.order_request
+        :return: the submitted order
+        :raises RiskRejected: if the pre-trade checks of orders reject it, nothing is sent
+        """
+
+        risk = self.orders.risk if self.orders is not None else None
+        if risk is not None:
+            risk.enforce(request)
+
+        try:
+            order = await self._call(self.trade_client.submit_order, order_data = request)
+            self._store(order)
+        finally:
+            if risk is not None:
+                risk.release(request.client_order_id)
+
+        return order
+
+    async def cancel(self, order_id: Union[UUID, str]):
+        await self._call(self.trade_client.cancel_order_by_id, order_id)
+
+    async def replace(self, order_id: Union[UUID, str], request: ReplaceOrderRequest) -> Order:
+        """
+        :param request: request of ORDERS.replace_request
+        :return: the new order
+        """
+
+        order = await self._call(self.trade_client.replace_order_by_id, order_id = order_id, order_data = request)
+        self._store(order, replaces = order_id)
+
+        return order
+
+    async def get_order(self, order_id: Union[UUID, str]) -> Order:
+        return await self._call(self.trade_client.get_order_by_id, order_id)
+
+    async def open_orders(self, symbols: List[str] = None) -> List[Order]:
+        request = GetOrdersRequest(status = QueryOrderStatus.OPEN, symbols = symbols, limit = 500)
+        return await self._call(self.trade_client.get_orders, filter = request)
+
+    ############################################ batches #########################################################
+    async def submit_basket(self, requests: List[OrderRequest],
+                            return_exceptions: bool = True) -> List[Union[Order, Exception]]:
+        """
+        Submits every request at once, at most max_workers are in flight
+
+        :param requests: order requests
+        :param return_exceptions: a failed submit gives its exception in place of the order, False raises the first
+        :return: orders in the order of requests
+        """
+
+        return await asyncio.gather(*(self.submit(request) for request in requests),
+                                    return_exceptions = return_exceptions)
+
+    async def cancel_many(self, order_ids: List[Union[UUID, str]]) -> List[Union[None, Exception]]:
+        """
+        :return: None for every cancelled order, the exception for every failed one
+        """
+
+        return await asyncio.gather(*(self.cancel(order_id) for order_id in order_ids), return_exceptions = True)
+
+    async def cancel_all_for_symbol(self, symbol: str,
+                                    from_store: bool = False) -> Dict[str, Union[None, Exception]]:
+        """
+        Cancels every open order of symbol
+
+        :param from_store: take the open orders from the order store, saves the listing round trip
+        :return: Dict[order id: None or the exception of the failed cancel]
+        """
+
+        if from_store and self.orders is not None:
+            order_ids = list(self.orders.order_store.ids(symbol = symbol))
+        else:
+            order_ids = [str(order.id) for order in await self.open_orders([symbol])]
+
+        return dict(zip(order_ids, await self.cancel_many(order_ids)))
+
+    async def cancel_all(self) -> List:
+        return await self._call(self.trade_client.cancel_orders)
+
+    ############################################ account #########################################################
+    async def clock(self) -> Clock:
+        return await self._call(self.trade_client.get_clock)
+
+    async def is_open(self) -> bool:
+        return (await self.clock()).is_open
+
+    async def next_times(self) -> Dict:
+        """
+        :return: dict[next_open, next_close]
+        """
+
+        clock = await self.clock()
+        return {'next_open': clock.next_open, 'next_close': clock.next_close}
+
+    async def account(self) -> TradeAccount:
+        return await self._call(self.trade_client.get_account)
+
+    async def positions(self) -> List[Position]:
+        return await self._call(self.trade_client.get_all_positions)
+
+    def close(self):
+        self.executor.shutdown(wait = False)
+
+
+if __name__ == '__main__':
+    import sys
+    import time as true_time
+
+    from Finance.portfolio import PORTFOLIO
+    from Finance.stubs import BrokerServer
+
+    # baskets against a local broker answering every request in 20 ms, one submit after the other like
+    # ORDERS.new_order against the gateway at several pool sizes
+    n_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    symbols = [f"SYM{i}" for i in range(n_orders)]
+    # the session without the pool warns on every connection it throws away
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+    def make(server: BrokerServer) -> ORDERS:
+        client = TradingClient('fake', 'fake', url_override = server.url)
+        return ORDERS(client, PORTFOLIO(client))
+
+    server = BrokerServer(latency = latency)
+    server.start()
+    orders = make(server)
+    requests = [orders.order_request(symbol, 'buy', 10, order_type = 'limit', limit_price = 100.0,
+                                     time_in_force = 'day') for symbol in symbols]
+
+    t0 = true_time.perf_counter()
+    for request in requests:
+        orders.process_and_add_order(orders.trade_client.submit_order(order_data = request))
+    sequential = true_time.perf_counter() - t0
+    print(f"sequential: {n_orders} orders in {sequential * 1e3:.0f} ms, {server.connections} connections")
+    server.stop()
+
+    async def basket(max_workers: int, pooled: bool):
+        server = BrokerServer(latency = latency)
+        server.start()
+        orders = make(server)
+        gateway = GATEWAY(orders.trade_client, orders = orders, max_workers = max_workers)
+        if not pooled:
+            pool_session(orders.trade_client, 10)
+
+        # every thread has its connection before the timing, like a bot that has been running
+        await gateway.submit_basket(requests[:max_workers])
+        await gateway.cancel_all()
+        connections = server.connections
+
+        t0 = true_time.perf_counter()
+        results = await gateway.submit_basket(requests)
+        submitted = true_time.perf_counter() - t0
+        assert all(isinstance(order, Order) for order in results)
+        assert {str(order.id) for order in results} <= orders.order_store.ids(status = 'accepted')
+
+        t0 = true_time.perf_counter()
+        cancelled = await gateway.cancel_all_for_symbol(symbols[0])
+        single = true_time.perf_counter() - t0
+        assert list(cancelled.values()) == [None]
+
+        t0 = true_time.perf_counter()
+        failed = [e for e in (await gateway.cancel_many([str(order.id) for order in results[1:]])) if e is not None]
+        cancel = true_time.perf_counter() - t0
+        assert not failed
+        assert not (await gateway.open_orders())
+
+        print(f"gateway {max_workers:>3} workers, {'pooled' if pooled else '10 kept':>7}: basket "
+              f"{submitted * 1e3:.0f} ms ({sequential / submitted:.1f}x), cancel {n_orders - 1} in "
+              f"{cancel * 1e3:.0f} ms, cancel symbol {single * 1e3:.0f} ms, "
+              f"{server.connections - connections} new connections")
+
+        gateway.close()
+        server.stop()
+
+    for max_workers, pooled in [(8, True), (32, False), (32, True)]:
+        asyncio.run(basket(max_workers, pooled))
+
+    # rejected and failed submits come back in place of their orders
+    async def failures():
+        server = BrokerServer(latency = latency, fail_rate = 0.1, reject = tuple(symbols[:5]))
+        server.start()
+        orders = make(server)
+        gateway = GATEWAY(orders.trade_client, orders = orders)
+
+        results = await gateway.submit_basket(requests)
+        errors = [result for result in results if isinstance(result, Exception)]
+        assert len(orders.order_store) == n_orders - len(errors)
+        assert all(isinstance(result, Exception) for result in results[:5])
+        print(f"{len(errors)} of {n_orders} submits failed, {n_orders - len(errors)} orders in the store")
+
+        gateway.close()
+        server.stop()
+
+    asyncio.run(failures())
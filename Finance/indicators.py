@@ -24,13 +24,47 @@ from alpaca.common.exceptions import APIError
 
 from Finance.stockData import STOCKFRAME
 
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
 
 class INDICATORS:
 
-    def __init__(self, stockFrame: STOCKFRAME):
+    def __init__(self, stockFrame: STOCKFRAME, ema_lengths: Tuple[int, ...] = (9, 21), macd: Tuple[int, int, int] = (12, 26, 9),
+                 rsi_length: int = 14, bollinger: Tuple[int, float] = (20, 2.0), atr_length: int = 14,
+                 adx_length: int = 14, supertrend: Tuple[int, float] = (20, 2.0), stochastic: Tuple[int, int] = (14, 3),
+                 donchian_length: int = 20, ichimoku: Tuple[int, int, int] = (9, 26, 52)):
+        """
+        Vectorised indicator engine, every indicator is a polars expression evaluated per symbol with over('symbol')
+        so all the symbols of the stock frame go through one lazy query.
+
+        :param stockFrame: stock frame whose data_map is used
+        :param ema_lengths: spans of the emas
+        :param macd: fast, slow and signal spans
+        :param rsi_length: length of wilder's rsi
+        :param bollinger: length and width in std devs
+        :param atr_length: length of wilder's atr
+        :param adx_length: length of the di and adx smoothing
+        :param supertrend: atr length and factor
+        :param stochastic: length of %k and smoothing of %d
+        :param donchian_length: length of the channel
+        :param ichimoku: tenkan, kijun and senkou b lengths
+        """
+
         self.stockFrame = stockFrame
         # the data needed and will be on the dataFrame is open, high, low, close, volume, trade_count, vwap, exchange
 
+        self.ema_lengths = ema_lengths
+        self.macd = macd
+        self.rsi_length = rsi_length
+        self.bollinger = bollinger
+        self.atr_length = atr_length
+        self.adx_length = adx_length
+        self.supertrend = supertrend
+        self.stochastic = stochastic
+        self.donchian_length = donchian_length
+        self.ichimoku = ichimoku
+
     '''
     ma, macd, rsi, adx, exponentially ma, 
     
@@ -53,4 +87,475 @@ class INDICATORS:
     
     '''
 
+    '''
+    Conventions, the streaming indicators follow the same ones so both agree bar for bar
+        ema: ewm with alpha 2 / (span + 1) seeded with the first close
+        wilder smoothing (rsi, atr, adx): ewm with alpha 1 / length seeded with the first value, the first change of
+                                          a symbol counts as 0 and the first true range is high - low
+        rsi, atr, di: null for the first length bars, adx null for the first 2 * length bars
+        rolling windows (bollinger, stochastic, donchian, ichimoku): null until the window is full, std is the
+                                                                    sample std (ddof 1)
+        vwap: anchored to the new york session date
+    '''
+
+    ############################################ expressions ##################################################
+    '''
+    The frame holds every symbol back to back, sorted by timestamp within a symbol. Recursive indicators (ewm) run
+    per symbol with over('symbol'). Rolling windows and shifts run over the whole column at once and the rows whose
+    window would reach into the previous symbol are blanked with the row number of the bar within its symbol, which
+    is a lot cheaper than a window function per indicator.
+    '''
+
+    @staticmethod
+    def _wilder(expr: pl.Expr, length: int) -> pl.Expr:
+        return expr.ewm_mean(alpha = 1 / length, adjust = False)
+
+    @staticmethod
+    def _warm(length: int) -> pl.Expr:
+        # row number of the bar within its symbol
+        return pl.col('_row') >= length
+
+    def _rolling(self, expr: pl.Expr, length: int) -> pl.Expr:
+        return pl.when(self._warm(length - 1)).then(expr).otherwise(None)
+
+    @staticmethod
+    def _row_exprs() -> List[pl.Expr]:
+        row = pl.int_range(pl.len(), dtype = pl.Int64)
+
+        return [
+            row.over('symbol').alias('_row'),
+            (pl.len() - 1 - row).over('symbol').alias('_rows_left')
+        ]
+
+    def _ema_exprs(self) -> List[pl.Expr]:
+        exprs = [
+            pl.col('close').ewm_mean(span = length, adjust = False).over('symbol').alias(f'ema_{length}')
+            for length in self.ema_lengths
+        ]
+
+        fast, slow, signal = self.macd
+        macd = (pl.col('close').ewm_mean(span = fast, adjust = False) -
+                pl.col('close').ewm_mean(span = slow, adjust = False))
+        exprs.append(macd.over('symbol').alias('macd'))
+        exprs.append(macd.ewm_mean(span = signal, adjust = False).over('symbol').alias('macd_signal'))
+
+        return exprs
+
+    def _rsi_expr(self) -> pl.Expr:
+        n = self.rsi_length
+        change = pl.col('close').diff().fill_null(0)
+        avg_gain = self._wilder(change.clip(lower_bound = 0), n).over('symbol')
+        avg_loss = self._wilder((-change).clip(lower_bound = 0), n).over('symbol')
+
+        rsi = (pl.when(avg_loss == 0).then(100.0)
+               .otherwise(100 - 100 / (1 + avg_gain / avg_loss)))
+
+        return pl.when(self._warm(n)).then(rsi).otherwise(None).alias('rsi')
+
+    def _bollinger_exprs(self) -> List[pl.Expr]:
+        length, width = self.bollinger
+        mid = self._rolling(pl.col('close').rolling_mean(window_size = length), length)
+        std = self._rolling(pl.col('close').rolling_std(window_size = length), length)
+
+        return [
+            mid.alias('bb_mid'),
+            (mid + width * std).alias('bb_upper'),
+            (mid - width * std).alias('bb_lower')
+        ]
+
+    @staticmethod
+    def _true_range() -> pl.Expr:
+        prev_close = pl.col('close').shift(1)
+        return pl.max_horizontal(
+            pl.col('high') - pl.col('low'),
+            (pl.col('high') - prev_close).abs(),
+            (pl.col('low') - prev_close).abs()
+        )
+
+    def _atr_expr(self) -> pl.Expr:
+        n = self.atr_length
+        atr = self._wilder(pl.col('_tr'), n).over('symbol')
+
+        return pl.when(self._warm(n)).then(atr).otherwise(None).alias('atr')
+
+    def _adx_exprs(self) -> List[pl.Expr]:
+        n = self.adx_length
+        up = pl.col('high').diff()
+        down = -pl.col('low').diff()
+
+        plus_dm = pl.when((up > down) & (up > 0)).then(up).otherwise(0.0)
+        minus_dm = pl.when((down > up) & (down > 0)).then(down).otherwise(0.0)
+
+        tr = self._wilder(pl.col('_tr'), n)
+        plus_di = 100 * self._wilder(plus_dm, n) / tr
+        minus_di = 100 * self._wilder(minus_dm, n) / tr
+
+        di_sum = plus_di + minus_di
+        dx = pl.when(di_sum == 0).then(0.0).otherwise(100 * (plus_di - minus_di).abs() / di_sum)
+        adx = self._wilder(dx, n)
+
+        return [
+            pl.when(self._warm(n)).then(plus_di.over('symbol')).otherwise(None).alias('plus_di'),
+            pl.when(self._warm(n)).then(minus_di.over('symbol')).otherwise(None).alias('minus_di'),
+            pl.when(self._warm(2 * n)).then(adx.over('symbol')).otherwise(None).alias('adx')
+        ]
+
+    def _supertrend_band_exprs(self) -> List[pl.Expr]:
+        length, factor = self.supertrend
+        atr = self._wilder(pl.col('_tr'), length).over('symbol')
+        hl2 = (pl.col('high') + pl.col('low')) / 2
+
+        return [
+            (hl2 + factor * atr).alias('_st_basic_upper'),
+            (hl2 - factor * atr).alias('_st_basic_lower')
+        ]
+
+    def _vwap_expr(self) -> pl.Expr:
+        typical = (pl.col('high') + pl.col('low') + pl.col('close')) / 3
+        session = (pl.col('timestamp').dt.replace_time_zone('UTC')
+                   .dt.convert_time_zone('America/New_York').dt.date())
+
+        return ((typical * pl.col('volume')).cum_sum() / pl.col('volume').cum_sum()).over(
+            ['symbol', session]).alias('session_vwap')
+
+    def _channel(self, length: int) -> Tuple[pl.Expr, pl.Expr]:
+        highest = self._rolling(pl.col('high').rolling_max(window_size = length), length)
+        lowest = self._rolling(pl.col('low').rolling_min(window_size = length), length)
+
+        return highest, lowest
+
+    def _stochastic_k_expr(self) -> pl.Expr:
+        highest, lowest = self._channel(self.stochastic[0])
+
+        return (pl.when(highest == lowest).then(50.0)
+                .otherwise(100 * (pl.col('close') - lowest) / (highest - lowest)).alias('stoch_k'))
+
+    def _stochastic_d_expr(self) -> pl.Expr:
+        k_length, d_length = self.stochastic
+
+        return self._rolling(pl.col('stoch_k').rolling_mean(window_size = d_length),
+                             k_length + d_length - 1).alias('stoch_d')
+
+    def _donchian_exprs(self) -> List[pl.Expr]:
+        upper, lower = self._channel(self.donchian_length)
+
+        return [
+            upper.alias('donchian_upper'),
+            lower.alias('donchian_lower'),
+            ((upper + lower) / 2).alias('donchian_mid')
+        ]
+
+    def _ichimoku_line_exprs(self) -> List[pl.Expr]:
+        tenkan_length, kijun_length, senkou_length = self.ichimoku
+
+        def mid(length: int) -> pl.Expr:
+            highest, lowest = self._channel(length)
+            return (highest + lowest) / 2
+
+        return [
+            mid(tenkan_length).alias('tenkan'),
+            mid(kijun_length).alias('kijun'),
+            mid(senkou_length).alias('_senkou_b_mid')
+        ]
+
+    def _ichimoku_shift_exprs(self) -> List[pl.Expr]:
+        kijun_length = self.ichimoku[1]
+
+        # the cloud is plotted kijun bars ahead and the lagging span kijun bars behind
+        return [
+            pl.when(self._warm(kijun_length))
+            .then(((pl.col('tenkan') + pl.col('kijun')) / 2).shift(kijun_length)).otherwise(None).alias('senkou_a'),
+            pl.when(self._warm(kijun_length))
+            .then(pl.col('_senkou_b_mid').shift(kijun_length)).otherwise(None).alias('senkou_b'),
+            pl.when(pl.col('_rows_left') >= kijun_length)
+            .then(pl.col('close').shift(-kijun_length)).otherwise(None).alias('chikou')
+        ]
+
+    ############################################ supertrend ###################################################
+    '''
+    The final supertrend bands are recursive, the upper band is a running min of the basic upper band which restarts
+    whenever the previous close closes above it (the lower band mirrors it with a running max). Every stretch between
+    restarts is one np.minimum.accumulate, the stretch is searched in doubling windows so the cost stays linear
+    in the number of rows instead of looping over every bar in python.
+    '''
+
+    @staticmethod
+    def _latched_band(band: np.ndarray, close: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        """
+        final upper band, running min of band which restarts after close > band and at every symbol start
+
+        :param band: basic upper band
+        :param close: close prices
+        :param starts: indices where a new symbol starts, sorted and including 0
+        :return: final upper band
+        """
+
+        n = len(band)
+        out = np.empty(n)
+        bounds = np.append(starts, n)
+
+        for symbol_start, symbol_end in zip(bounds[:-1], bounds[1:]):
+            r = symbol_start
+
+            while r < symbol_end:
+                pos = r
+                carry = np.inf
+                window = 64
+
+                while True:
+                    stop = min(symbol_end, pos + window)
+                    running = np.minimum(np.minimum.accumulate(band[pos: stop]), carry)
+
+                    # a close above the band at k restarts the band at k + 1
+                    breaks = np.flatnonzero(close[pos: stop] > running)
+                    if breaks.size:
+                        k = pos + breaks[0]
+                        out[pos: k + 1] = running[: k + 1 - pos]
+                        r = k + 1
+                        break
+
+                    out[pos: stop] = running
+                    if stop == symbol_end:
+                        r = symbol_end
+                        break
+
+                    carry = running[-1]
+                    pos = stop
+                    window *= 2
+
+        return out
+
+    def _supertrend_band_expr(self) -> pl.Expr:
+
+        def bands(s: pl.Series) -> pl.Series:
+            upper = s.struct.field('_st_basic_upper').to_numpy()
+            lower = s.struct.field('_st_basic_lower').to_numpy()
+            close = s.struct.field('close').to_numpy()
+            symbol = s.struct.field('symbol')
+            starts = np.flatnonzero((symbol != symbol.shift(1)).fill_null(True).to_numpy())
+
+            final_upper = self._latched_band(upper, close, starts)
+            # the lower band is the same latch on the negated series
+            final_lower = -self._latched_band(-lower, -close, starts)
+
+            return pl.DataFrame({'_st_upper': final_upper, '_st_lower': final_lower}).to_struct()
+
+        # runs over the whole column at once, symbol starts are handled inside
+        return pl.struct(['_st_basic_upper', '_st_basic_lower', 'close', 'symbol']).map_batches(
+            bands, return_dtype = pl.Struct({'_st_upper': pl.Float64, '_st_lower': pl.Float64})
+        ).alias('_st_bands')
+
+    @staticmethod
+    def _supertrend_direction_expr() -> pl.Expr:
+        # close above the upper band turns the trend up, below the lower band turns it down, else it holds
+        up = pl.col('close') > pl.col('_st_upper')
+        down = pl.col('close') < pl.col('_st_lower')
+        direction = (pl.when(up & ~down).then(1).when(down & ~up).then(-1).otherwise(None)
+                     .forward_fill().fill_null(1))
+
+        return direction.over('symbol').cast(pl.Int8).alias('supertrend_dir')
+
+    def _supertrend_expr(self) -> pl.Expr:
+        supertrend = pl.when(pl.col('supertrend_dir') == 1).then(pl.col('_st_lower')).otherwise(pl.col('_st_upper'))
+
+        return pl.when(self._warm(self.supertrend[0])).then(supertrend).otherwise(None).alias('supertrend')
+
+    ############################################## engine ####################################################
+    def _frame(self, symbols: Union[List[str], None] = None) -> pl.LazyFrame:
+        data_map = self.stockFrame.data_map
+        symbols = symbols if symbols else list(data_map.keys())
+
+        return pl.concat(
+            [data_map[symbol].lazy().with_columns(pl.lit(symbol).alias('symbol')) for symbol in symbols
+             if symbol in data_map and not data_map[symbol].is_empty()],
+            how = 'vertical'
+        )
+
+    def query(self, frame: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        All the indicators of a frame of bars as one lazy query
+
+        :param frame: lazy frame of bars with a symbol column, sorted by timestamp within every symbol
+        :return: lazy frame of timestamp, symbol and the indicator columns
+        """
+
+        ema_columns = [f'ema_{length}' for length in self.ema_lengths]
+        columns = ['timestamp', 'symbol'] + ema_columns + [
+            'macd', 'macd_signal', 'macd_hist', 'rsi', 'bb_mid', 'bb_upper', 'bb_lower', 'atr', 'plus_di',
+            'minus_di', 'adx', 'supertrend', 'supertrend_dir', 'session_vwap', 'stoch_k', 'stoch_d',
+            'donchian_upper', 'donchian_lower', 'donchian_mid', 'tenkan', 'kijun', 'senkou_a', 'senkou_b', 'chikou'
+        ]
+
+        return (
+            frame
+            .with_columns(self._row_exprs() + [self._true_range().over('symbol').alias('_tr')])
+            .with_columns(
+                self._ema_exprs() + [self._rsi_expr(), self._atr_expr(), self._vwap_expr(), self._stochastic_k_expr()] +
+                self._bollinger_exprs() + self._adx_exprs() + self._supertrend_band_exprs() + self._donchian_exprs() +
+                self._ichimoku_line_exprs()
+            )
+            .with_columns(
+                [(pl.col('macd') - pl.col('macd_signal')).alias('macd_hist'), self._stochastic_d_expr(),
+                 self._supertrend_band_expr()] + self._ichimoku_shift_exprs()
+            )
+            .unnest('_st_bands')
+            .with_columns(self._supertrend_direction_expr())
+            .with_columns(self._supertrend_expr())
+            .select(columns)
+        )
+
+    def compute(self, symbols: Union[List[str], None] = None) -> pl.DataFrame:
+        """
+        Computes every indicator for the symbols in one query and stores them in the stock frame's indicator_map
+
+        :param symbols: symbols to compute, defaults to every symbol in data_map
+        :return: frame of all the symbols' indicators
+        """
+
+        result = self.query(self._frame(symbols)).collect()
+
+        for (symbol,), df in result.partition_by('symbol', as_dict = True, maintain_order = True).items():
+            self.stockFrame.indicator_map[symbol] = df.drop('symbol')
+
+        return result
+
+
+if __name__ == '__main__':
+    import sys
+    import math
+    import time as true_time
+    from datetime import datetime, timedelta
+
+    '''
+    python -m Finance.indicators [symbols] [days]
+    validates the engine against plain python loops and times it on symbols x days of minute bars,
+    500 x 252 is the target size but needs a machine with a lot of memory
+    '''
+
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 252
+
+    def synthetic_bars(n: int, rng: np.random.Generator) -> pl.DataFrame:
+        # regular session minutes, 390 a day
+        day_starts = np.datetime64('2024-01-02T14:30') + np.arange(math.ceil(n / 390)) * np.timedelta64(1, 'D')
+        timestamps = (day_starts[:, None] + np.arange(390) * np.timedelta64(1, 'm')).ravel()[:n]
+
+        close = 100 + rng.standard_normal(n).cumsum() * 0.1
+        spread = rng.random(n) * 0.2
+        return pl.DataFrame({
+            'timestamp': timestamps.astype('datetime64[us]'),
+            'open': close + rng.standard_normal(n) * 0.02,
+            'high': close + spread,
+            'low': close - spread,
+            'close': close,
+            'volume': rng.integers(100, 10_000, n).astype(np.float64),
+            'trade_count': 10.0,
+            'vwap': close
+        })
+
+    ################################ plain reference implementations ################################
+    def ref_ema(x, span):
+        alpha, out = 2 / (span + 1), []
+        for i, v in enumerate(x):
+            out.append(v if i == 0 else out[-1] + alpha * (v - out[-1]))
+        return out
+
+    def ref_wilder(x, n):
+        out = []
+        for i, v in enumerate(x):
+            out.append(v if i == 0 else out[-1] + (v - out[-1]) / n)
+        return out
+
+    def ref_rsi(close, n):
+        changes = [0.0] + [close[i] - close[i - 1] for i in range(1, len(close))]
+        gains = ref_wilder([max(c, 0.0) for c in changes], n)
+        losses = ref_wilder([max(-c, 0.0) for c in changes], n)
+        return [None if i < n else (100.0 if l == 0 else 100 - 100 / (1 + g / l))
+                for i, (g, l) in enumerate(zip(gains, losses))]
+
+    def ref_tr(high, low, close):
+        return [high[0] - low[0]] + [max(high[i] - low[i], abs(high[i] - close[i - 1]), abs(low[i] - close[i - 1]))
+                                     for i in range(1, len(close))]
+
+    def ref_bollinger_upper(close, n, k):
+        out = []
+        for i in range(len(close)):
+            if i < n - 1:
+                out.append(None)
+                continue
+            window = close[i - n + 1: i + 1]
+            mean = sum(window) / n
+            std = math.sqrt(sum((v - mean) ** 2 for v in window) / (n - 1))
+            out.append(mean + k * std)
+        return out
+
+    def ref_donchian_upper(high, n):
+        return [None if i < n - 1 else max(high[i - n + 1: i + 1]) for i in range(len(high))]
+
+    def ref_supertrend(high, low, close, n, factor):
+        atr = ref_wilder(ref_tr(high, low, close), n)
+        out, direction = [], 1
+        final_upper = final_lower = None
+        for i in range(len(close)):
+            hl2 = (high[i] + low[i]) / 2
+            basic_upper, basic_lower = hl2 + factor * atr[i], hl2 - factor * atr[i]
+
+            if i == 0 or basic_upper < final_upper or close[i - 1] > final_upper:
+                final_upper = basic_upper
+            if i == 0 or basic_lower > final_lower or close[i - 1] < final_lower:
+                final_lower = basic_lower
+
+            up, down = close[i] > final_upper, close[i] < final_lower
+            if up and not down:
+                direction = 1
+            elif down and not up:
+                direction = -1
+
+            out.append(None if i < n else (final_lower if direction == 1 else final_upper))
+        return out
+
+    def close_enough(a, b):
+        return all((x is None and y is None) or (x is not None and y is not None and abs(x - y) < 1e-6)
+                   for x, y in zip(a, b))
+
+    ##################################### validation #############################################
+    class _Frame:
+        def __init__(self):
+            self.data_map = {}
+            self.indicator_map = {}
+
+    rng = np.random.default_rng(7)
+    frame = _Frame()
+    for i in range(3):
+        frame.data_map[f'SYM{i}'] = synthetic_bars(3_000, rng)
+
+    engine = INDICATORS(frame)
+    engine.compute()
+
+    for symbol, bars in frame.data_map.items():
+        result = frame.indicator_map[symbol]
+        high, low, close = bars['high'].to_list(), bars['low'].to_list(), bars['close'].to_list()
+
+        assert close_enough(result['ema_9'].to_list(), ref_ema(close, 9))
+        macd = [f - s for f, s in zip(ref_ema(close, 12), ref_ema(close, 26))]
+        assert close_enough(result['macd_signal'].to_list(), ref_ema(macd, 9))
+        assert close_enough(result['rsi'].to_list(), ref_rsi(close, 14))
+        atr = ref_wilder(ref_tr(high, low, close), 14)
+        assert close_enough(result['atr'].to_list(), [None if i < 14 else v for i, v in enumerate(atr)])
+        assert close_enough(result['bb_upper'].to_list(), ref_bollinger_upper(close, 20, 2.0))
+        assert close_enough(result['donchian_upper'].to_list(), ref_donchian_upper(high, 20))
+        assert close_enough(result['supertrend'].to_list(), ref_supertrend(high, low, close, 20, 2.0))
+
+    print("engine matches the reference implementations")
+
+    ###################################### benchmark #############################################
+    frame = _Frame()
+    for i in range(n_symbols):
+        frame.data_map[f'SYM{i}'] = synthetic_bars(390 * days, rng)
+
+    t0 = true_time.perf_counter()
+    INDICATORS(frame).compute()
+    elapsed = true_time.perf_counter() - t0
 
+    rows = n_symbols * 390 * days
+    print(f"{n_symbols} symbols x {days} days ({rows:,} bars): {elapsed:.2f} s, {rows / elapsed:,.0f} bars/s")
@@ -0,0 +1,382 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import numpy as np
+import polars as pl
+import asyncio
+import logging
+import time as true_time
+from datetime import datetime, timezone, timedelta
+
+import msgpack
+from alpaca.data.models import Bar, Quote, Trade
+from alpaca.data.live.stock import StockDataStream
+
+from Finance.stockData import STOCKFRAME
+from Finance.frameStore import FrameStore
+from Finance.columnar import BAR_SCHEMA, QUOTE_SCHEMA, TRADE_SCHEMA, _RAW_BAR_KEYS, _RAW_QUOTE_KEYS, _RAW_TRADE_KEYS, \
+    _to_str
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Live ingestion of the StockDataStream into the STOCKFRAME maps.
+
+Appending every message to a polars frame costs a new chunk per row, so messages are written into preallocated
+numpy buffers, one per symbol and kind, and handed to the frame stores in micro batches:
+    size trigger    a buffer is flushed as soon as it holds batch_size rows
+    time trigger    every flush_interval seconds all non empty buffers are flushed, so quiet symbols still show up
+
+Updated bars are corrections of a bar that was already sent (late trades), they overwrite the buffered row with the
+same timestamp, or if that row was flushed already the frame store replaces its last row.
+
+Handlers take the model objects as well as the raw dicts of a stream made with raw_data = True.
+'''
+
+_EPOCH = datetime(1970, 1, 1, tzinfo = timezone.utc)
+_MICROSECOND = timedelta(microseconds = 1)
+
+
+def _epoch_us(ts) -> int:
+    """
+    :param ts: msgpack Timestamp of the raw feed, datetime or rfc3339 string
+    :return: microseconds since the epoch, naive datetimes are taken as utc
+    """
+
+    if isinstance(ts, msgpack.Timestamp):
+        return ts.seconds * 1_000_000 + ts.nanoseconds // 1000
+
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts)
+
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo = timezone.utc)
+
+    return (ts - _EPOCH) // _MICROSECOND
+
+
+class _Buffer:
+    __slots__ = ('columns', 'arrays', 'kinds', 'n', 'capacity')
+
+    def __init__(self, schema: Dict, capacity: int):
+        """
+        Preallocated columns of one symbol and kind
+
+        :param schema: schema of the frame store the rows go to
+        :param capacity: rows held before a flush
+        """
+
+        self.columns = list(schema.items())
+        self.capacity = capacity
+        self.n = 0
+        self.arrays = []
+        self.kinds = []
+
+        for name, dtype in self.columns:
+            if isinstance(dtype, pl.Datetime) or dtype == pl.Int64:
+                self.arrays.append(np.empty(capacity, dtype = np.int64))
+            elif dtype == pl.Float64:
+                self.arrays.append(np.empty(capacity, dtype = np.float64))
+            else:
+                self.arrays.append(np.empty(capacity, dtype = object))
+
+    def find(self, ts: int) -> int:
+        """
+        :param ts: epoch microseconds
+        :return: row holding the timestamp, -1 if none does
+        """
+
+        # corrections are almost always of the newest row, so look from the back
+        stamps = self.arrays[0]
+        for row in range(self.n - 1, -1, -1):
+            if stamps[row] == ts:
+                return row
+
+        return -1
+
+    def write(self, row: int, values: Tuple):
+        for array, value in zip(self.arrays, values):
+            array[row] = value
+
+    def to_frame(self) -> pl.DataFrame:
+        """
+        Copies the buffered rows out into a frame and empties the buffer
+        """
+
+        n = self.n
+        series = []
+        for (name, dtype), array in zip(self.columns, self.arrays):
+            if isinstance(dtype, pl.Datetime):
+                series.append(pl.Series(name, array[:n].copy()).cast(dtype))
+            elif dtype == pl.Float64:
+                series.append(pl.Series(name, array[:n].copy(), nan_to_null = True))
+            elif dtype == pl.Int64:
+                series.append(pl.Series(name, array[:n].copy()))
+            else:
+                series.append(pl.Series(name, array[:n].tolist(), dtype = dtype))
+
+        self.n = 0
+        return pl.DataFrame(series)
+
+
+def subscribe_first(stream: StockDataStream, channel: str, handler: Callable, symbols: List[str]):
+    """
+    Subscribes handler on a channel of a data stream, a handler already there for a symbol (the ingestor's) is called
+    after it, the stream only keeps one per symbol
+
+    :param channel: trades, quotes or bars
+    """
+
+    subscribe = {'trades': stream.subscribe_trades, 'quotes': stream.subscribe_quotes,
+                 'bars': stream.subscribe_bars}[channel]
+
+    previous: Dict[Callable, List[str]] = {}
+    for symbol in symbols:
+        previous.setdefault(stream._handlers[channel].get(symbol), []).append(symbol)
+
+    for other, group in previous.items():
+        if other is None:
+            subscribe(handler, *group)
+        else:
+            async def both(msg, other = other):
+                await handler(msg)
+                await other(msg)
+
+            subscribe(both, *group)
+
+
+class INGESTOR:
+
+    def __init__(self, stockFrame: STOCKFRAME, batch_size: int = 256, flush_interval: float = 0.05,
+                 on_flush: Callable = None):
+        """
+        Buffers live bars, quotes and trades and flushes them into stockFrame.data_map, lvl1_data_map and
+        trade_data_map in micro batches
+
+        :param stockFrame: frame the data goes into
+        :param batch_size: rows per symbol and kind that trigger a flush, also the size of the buffers
+        :param flush_interval: seconds between the timed flushes of all buffers
+        :param on_flush: called with (kind, symbol, batch) after every flush, kind is bars, quotes or trades
+        """
+
+        self.stockFrame = stockFrame
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+
+        # kind: (frame store, schema, raw key of every column)
+        self._kinds: Dict[str, Tuple[FrameStore, Dict, List[str]]] = {
+            'bars': (stockFrame.data_map, BAR_SCHEMA, [_RAW_BAR_KEYS[c] for c in BAR_SCHEMA]),
+            'quotes': (stockFrame.lvl1_data_map, QUOTE_SCHEMA, [_RAW_QUOTE_KEYS[c] for c in QUOTE_SCHEMA]),
+            'trades': (stockFrame.trade_data_map, TRADE_SCHEMA, [_RAW_TRADE_KEYS[c] for c in TRADE_SCHEMA])
+        }
+        # Dict[(kind, symbol): _Buffer]
+        self._buffers: Dict[Tuple[str, str], _Buffer] = {}
+        self._flush_task: Union[asyncio.Task, None] = None
+
+        self.messages = 0
+        self.flushes = 0
+
+    ############################################ buffering #######################################################
+    def _row(self, kind: str, msg: Union[Bar, Quote, Trade, Dict]) -> Tuple[str, Tuple]:
+        """
+        :return: symbol and the column values of a message in schema order
+        """
+
+        store, schema, raw_keys = self._kinds[kind]
+
+        if isinstance(msg, dict):
+            symbol = msg['S']
+            values = [msg.get(key) for key in raw_keys]
+        else:
+            symbol = msg.symbol
+            values = [getattr(msg, name, None) for name in schema]
+
+        row = []
+        for (name, dtype), value in zip(schema.items(), values):
+            if name == 'timestamp':
+                row.append(_epoch_us(value))
+            elif dtype == pl.Float64:
+                row.append(np.nan if value is None else value)
+            elif dtype == pl.Int64:
+                row.append(0 if value is None else value)
+            elif dtype == pl.Utf8:
+                row.append(_to_str(value))
+            else:
+                row.append(None if value is None else list(value))
+
+        return symbol, tuple(row)
+
+    def _buffer(self, kind: str, symbol: str) -> _Buffer:
+        buffer = self._buffers.get((kind, symbol))
+        if buffer is None:
+            buffer = _Buffer(self._kinds[kind][1], self.batch_size)
+            self._buffers[(kind, symbol)] = buffer
+
+        return buffer
+
+    def push(self, kind: str, msg: Union[Bar, Quote, Trade, Dict], correction: bool = False):
+        """
+        Buffers one message, flushing its buffer once it is full
+
+        :param kind: bars, quotes or trades
+        :param msg: model object or raw dict
+        :param correction: the message replaces the row with the same timestamp (updated bars)
+        """
+
+        symbol, row = self._row(kind, msg)
+        buffer = self._buffer(kind, symbol)
+        self.messages += 1
+
+        if correction:
+            index = buffer.find(row[0])
+            if index >= 0:
+                buffer.write(index, row)
+                return
+
+        buffer.write(buffer.n, row)
+        buffer.n += 1
+
+        if buffer.n == buffer.capacity:
+            self._flush(kind, symbol, buffer)
+
+        self._ensure_flush_task()
+
+    ############################################ flushing ########################################################
+    def _flush(self, kind: str, symbol: str, buffer: _Buffer):
+        batch = buffer.to_frame()
+        self._kinds[kind][0].append(symbol, batch)
+        self.flushes += 1
+
+        if self.on_flush is not None:
+            self.on_flush(kind, symbol, batch)
+
+    def flush(self):
+        """
+        Flushes every non empty buffer
+        """
+
+        for (kind, symbol), buffer in self._buffers.items():
+            if buffer.n:
+                self._flush(kind, symbol, buffer)
+
+    def _ensure_flush_task(self):
+        # the task lives on the loop of the stream, which only exists once messages come in
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._flush_task = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"flush failed: {e}")
+
+    async def stop(self):
+        """
+        Stops the timed flushes and flushes what is left
+        """
+
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        self.flush()
+
+    ############################################ stream handlers #################################################
+    async def bar_handler(self, bar: Union[Bar, Dict]):
+        self.push('bars', bar)
+
+    async def updated_bar_handler(self, bar: Union[Bar, Dict]):
+        self.push('bars', bar, correction = True)
+
+    async def quote_handler(self, quote: Union[Quote, Dict]):
+        self.push('quotes', quote)
+
+    async def trade_handler(self, trade: Union[Trade, Dict]):
+        self.push('trades', trade)
+
+    def subscribe(self, stream: StockDataStream, symbols: List[str], bars: bool = True, updated_bars: bool = True,
+                  quotes: bool = False, trades: bool = False):
+        """
+        Subscribes the handlers of the ingestor on a data stream
+
+        :param stream: StockDataStream, raw_data = True saves building the model objects
+        :param symbols: symbols to subscribe, '*' for all
+        """
+
+        if bars:
+            stream.subscribe_bars(self.bar_handler, *symbols)
+        if updated_bars:
+            stream.subscribe_updated_bars(self.updated_bar_handler, *symbols)
+        if quotes:
+            stream.subscribe_quotes(self.quote_handler, *symbols)
+        if trades:
+            stream.subscribe_trades(self.trade_handler, *symbols)
+
+
+if __name__ == '__main__':
+    import sys
+    from Finance.stubs import ReplayServer, stream_messages
+
+    # end to end through a local replay server: websocket, msgpack decode, alpaca dispatch, buffers, frame stores
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    minutes = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    symbols = [f"SYM{i}" for i in range(n_symbols)]
+    messages = stream_messages(symbols, minutes = minutes, ticks = 10)
+
+    async def replay(rate: Union[float, None], batch_size: int, flush_interval: float) -> Dict:
+        server = ReplayServer(messages, batch_size = 100, rate = rate)
+        await server.start()
+
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+        latencies = []
+
+        def on_flush(kind, symbol, batch):
+            # trade ids of the replay are the positions of the messages, so every trade has a send time
+            if kind == 'trades':
+                now = true_time.perf_counter()
+                latencies.extend(now - server.sent_at[i] for i in batch.get_column('id').to_list())
+
+        ingestor = INGESTOR(frame, batch_size = batch_size, flush_interval = flush_interval, on_flush = on_flush)
+        stream = StockDataStream('fake', 'fake', raw_data = True, url_override = server.url)
+        ingestor.subscribe(stream, symbols, quotes = True, trades = True)
+
+        runner = asyncio.create_task(stream._run_forever())
+        await server.done.wait()
+        while ingestor.messages < len(messages):
+            await asyncio.sleep(0.001)
+        elapsed = true_time.perf_counter() - min(server.sent_at)
+
+        await ingestor.stop()
+        await stream.stop_ws()
+        await runner
+        await server.stop()
+
+        # every bar landed once, with the correction of its updated bar applied
+        bars = frame.data_map[symbols[0]]
+        assert bars.height == minutes
+        assert frame.trade_data_map[symbols[0]].height == minutes * 10
+        assert frame.lvl1_data_map[symbols[0]].height == minutes * 10
+        assert bars.get_column('volume').to_list() == [1100.0] * minutes
+
+        latencies.sort()
+        return {
+            'rate': len(messages) / elapsed,
+            'p50': latencies[len(latencies) // 2] * 1e3,
+            'p99': latencies[int(len(latencies) * 0.99)] * 1e3,
+            'flushes': ingestor.flushes
+        }
+
+    print(f"{len(messages)} messages, {n_symbols} symbols")
+    for rate, batch_size, flush_interval in [(None, 256, 0.05), (None, 32, 0.01), (5000, 256, 0.05), (5000, 32, 0.01)]:
+        result = asyncio.run(replay(rate, batch_size, flush_interval))
+        label = 'max' if rate is None else f"{rate}/s"
+        print(f"feed {label:>7}, batch {batch_size:>3}, interval {flush_interval * 1e3:>3.0f} ms: "
+              f"{result['rate']:,.0f} msgs/s, latency p50 {result['p50']:.1f} ms p99 {result['p99']:.1f} ms, "
+              f"{result['flushes']} flushes")
@@ -0,0 +1,204 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import bisect
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+import pytz
+
+from alpaca.trading.client import TradingClient
+from alpaca.trading.requests import GetCalendarRequest
+from alpaca.trading.models import Clock
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Market clock answered locally.
+
+get_clock is a round trip, and STOCKFRAME asked it twice per fetch (_set_start and _set_end) just to know whether the
+market is open. The session boundaries only change a few times a day, so they are fetched once:
+    calendar    get_calendar for the next days gives every session's open and close (early closes included), they are
+                kept as two sorted lists and every question is a bisect
+    clock       a client without get_calendar (the backtest's simulated broker) gives one get_clock, which knows the
+                open session's close or the next session
+The boundaries are good until the last session they know of starts, only then are they fetched again.
+
+Times are utc, the calendar's are new york wall times.
+'''
+
+NEW_YORK = pytz.timezone('America/New_York')
+
+
+def _utc(ts: datetime) -> datetime:
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo = timezone.utc)
+
+    return ts.astimezone(timezone.utc)
+
+
+class MarketClock:
+
+    def __init__(self, trade_client: TradingClient, days: int = 14, now: Callable = None):
+        """
+        :param trade_client: client the calendar or clock comes from
+        :param days: days of sessions fetched at once
+        :param now: returns the current utc time, datetime.now by default, a simulated clock in backtests
+        """
+
+        self.trade_client = trade_client
+        self.days = days
+        self._now = now if now is not None else lambda: datetime.now(timezone.utc)
+
+        self._opens: List[datetime] = []
+        self._closes: List[datetime] = []
+        # the boundaries are fetched again from here on
+        self._expires: Union[datetime, None] = None
+        self._lock = threading.Lock()
+
+        self.fetches = 0
+
+    def refresh(self, at: datetime = None):
+        """
+        Fetches the sessions from at on
+        """
+
+        at = _utc(at) if at is not None else self._now()
+        self.fetches += 1
+
+        if hasattr(self.trade_client, 'get_calendar'):
+            request = GetCalendarRequest(start = (at - timedelta(days = 1)).date(),
+                                         end = (at + timedelta(days = self.days)).date())
+            calendar = self.trade_client.get_calendar(request)
+            sessions = [(NEW_YORK.localize(day.open).astimezone(timezone.utc),
+                         NEW_YORK.localize(day.close).astimezone(timezone.utc)) for day in calendar]
+        else:
+            sessions = []
+
+        if sessions:
+            # past the last open the next open is unknown
+            expires = sessions[-1][0]
+        else:
+            clock = self.trade_client.get_clock()
+            timestamp, next_open, next_close = _utc(clock.timestamp), _utc(clock.next_open), _utc(clock.next_close)
+
+            if clock.is_open:
+                # the open session and the start of the next one
+                sessions = [(timestamp, next_close), (next_open, next_open)]
+                expires = next_close
+            else:
+                # once the next session opened the one after it is unknown
+                sessions = [(next_open, next_close)]
+                expires = next_open
+
+        self._opens = [open_ for open_, close in sessions]
+        self._closes = [close for open_, close in sessions]
+        self._expires = max(expires, at + timedelta(seconds = 1))
+
+        log.info(f"market clock has {len(sessions)} sessions until {self._expires}")
+
+    def _session(self, at: Union[datetime, None]) -> Tuple[datetime, int]:
+        """
+        :return: the time asked about and the position of the first session opening after it
+        """
+
+        at = _utc(at) if at is not None else self._now()
+
+        if self._expires is None or at >= self._expires:
+            with self._lock:
+                if self._expires is None or at >= self._expires:
+                    self.refresh(at)
+
+        return at, bisect.bisect_right(self._opens, at)
+
+    def is_open(self, at: datetime = None) -> bool:
+        """
+        :param at: time asked about, now by default
+        :return: whether the market is open at
+        """
+
+        at, i = self._session(at)
+        return i > 0 and at < self._closes[i - 1]
+
+    def next_open(self, at: datetime = None) -> datetime:
+        at, i = self._session(at)
+        return self._opens[i]
+
+    def next_close(self, at: datetime = None) -> datetime:
+        """
+        :return: close of the open session, or of the next one if the market is closed
+        """
+
+        at, i = self._session(at)
+        if i > 0 and at < self._closes[i - 1]:
+            return self._closes[i - 1]
+
+        return self._closes[i]
+
+    def clock(self, at: datetime = None) -> Clock:
+        """
+        :return: the Clock get_clock would give, built locally
+        """
+
+        at = _utc(at) if at is not None else self._now()
+        return Clock(timestamp = at, is_open = self.is_open(at), next_open = self.next_open(at),
+                     next_close = self.next_close(at))
+
+
+if __name__ == '__main__':
+    import time as true_time
+
+    from Finance.stockData import STOCKFRAME
+    from Finance.stubs import BrokerServer
+
+    # the fetch windows of 1000 history requests against a broker answering in 20 ms, asking the clock every time
+    # like before against asking the cached clock
+    server = BrokerServer(latency = 0.02)
+    server.start()
+    client = TradingClient('fake', 'fake', url_override = server.url)
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = client)
+    start = datetime.now(timezone.utc) - timedelta(days = 5)
+
+    t0 = true_time.perf_counter()
+    for _ in range(100):
+        [client.get_clock().is_open, client.get_clock().is_open]
+    direct = (true_time.perf_counter() - t0) / 100
+    print(f"get_clock twice per fetch: {direct * 1e3:.2f} ms per fetch")
+
+    server.calls.clear()
+    t0 = true_time.perf_counter()
+    windows = [(frame._set_start(start), frame._set_end(None)) for _ in range(1000)]
+    cached = (true_time.perf_counter() - t0) / 1000
+    print(f"cached clock: {cached * 1e6:.1f} us per fetch, {len(server.calls)} api calls for 1000 fetches")
+    assert len(server.calls) == 1
+
+    # the cached answers are the broker's
+    broker = client.get_clock()
+    assert frame.clock.is_open() == broker.is_open
+    assert frame.clock.next_open() == _utc(broker.next_open)
+    assert frame.clock.next_close() == _utc(broker.next_close)
+
+    # thirty days of minutes against the calendar, a fetch every days of sessions
+    clock = MarketClock(client, days = 14)
+    minutes = [start + timedelta(minutes = i) for i in range(60 * 24 * 30)]
+    t0 = true_time.perf_counter()
+    open_minutes = sum(clock.is_open(minute) for minute in minutes)
+    seconds = true_time.perf_counter() - t0
+    print(f"{len(minutes)} minutes in {seconds * 1e3:.0f} ms, {open_minutes} open, {clock.fetches} fetches")
+
+    server.stop()
+
+    # without a calendar, from get_clock while the market is closed, the session it gives is asked about
+    closed = Clock(timestamp = datetime(2024, 1, 6, 15, tzinfo = timezone.utc), is_open = False,
+                   next_open = datetime(2024, 1, 8, 14, 30, tzinfo = timezone.utc),
+                   next_close = datetime(2024, 1, 8, 21, tzinfo = timezone.utc))
+    opened = Clock(timestamp = datetime(2024, 1, 8, 15, tzinfo = timezone.utc), is_open = True,
+                   next_open = datetime(2024, 1, 9, 14, 30, tzinfo = timezone.utc),
+                   next_close = datetime(2024, 1, 8, 21, tzinfo = timezone.utc))
+    answers = iter([closed, opened])
+    clock = MarketClock(type('CLIENT', (), {'get_clock': lambda self: next(answers)})())
+    assert not clock.is_open(closed.timestamp)
+    assert clock.is_open(opened.timestamp) and clock.next_open(opened.timestamp) == opened.next_open
+    assert clock.fetches == 2
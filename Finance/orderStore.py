@@ -0,0 +1,376 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import logging
+from datetime import datetime, timezone
+
+from alpaca.trading.models import Order
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+In memory mirror of the open orders, fed by the trade_updates stream.
+
+Orders are kept as plain dicts keyed by id, with sets of ids per symbol and per status next to them, so applying an
+event is a couple of dict / set operations whatever the number of open orders. The unfilled qty and notional of the
+open orders are kept as running sums per symbol and side the same way, for the pre-trade checks (see riskGate).
+An order is valued at its limit or stop price, notional orders at their notional, market orders by qty only count
+in qty. The polars frame of the orders is
+only built when something asks for it, and is reused until the next event changes the store.
+The response of a submit can come after the trade updates of the order, ack keeps it from bringing back a closed
+order or an older state.
+
+trade_updates events, see https://docs.alpaca.markets/docs/websocket-streaming
+    new, pending_new, accepted, partial_fill, done_for_day ...  the order is (still) open, its row is upserted
+    fill, canceled, expired, rejected, replaced, ...            the order is done and leaves the store
+'''
+
+ORDER_SCHEMA = {
+    "symbol": pl.Utf8,
+    "asset_type": pl.Utf8,
+    "status": pl.Utf8,
+    "id": pl.Utf8,
+    "client_order_id": pl.Utf8,
+    "created_at": pl.Datetime("us", time_zone=None),
+    "updated_at": pl.Datetime("us", time_zone=None),
+    "submitted_at": pl.Datetime("us", time_zone=None),
+    "filled_at": pl.Datetime("us", time_zone=None),
+    "expired_at": pl.Datetime("us", time_zone=None),
+    "canceled_at": pl.Datetime("us", time_zone=None),
+    "failed_at": pl.Datetime("us", time_zone=None),
+    "replaced_at": pl.Datetime("us", time_zone=None),
+    "replaced_by": pl.Utf8,
+    "replaces": pl.Utf8,
+    "asset_id": pl.Utf8,
+    "notional": pl.Float64,
+    "qty": pl.Float64,
+    "filled_qty": pl.Float64,
+    "filled_avg_price": pl.Float64,
+    "order_class": pl.Utf8,
+    "type": pl.Utf8,
+    "side": pl.Utf8,
+    "time_in_force": pl.Utf8,
+    "limit_price": pl.Float64,
+    "stop_price": pl.Float64,
+    "extended_hours": pl.Boolean,
+    "legs": pl.List(pl.Utf8),
+    "trail_percent": pl.Float64,
+    "trail_price": pl.Float64,
+    "hwm": pl.Float64
+}
+
+# events after which the order can never be executed again
+# done_for_day is not closing, a gtc order stopped for the day is resumed the next session
+CLOSING_EVENTS = {'fill', 'canceled', 'expired', 'rejected', 'suspended', 'replaced'}
+
+# closed ids remembered, for the rest responses arriving after the update which closed the order
+_CLOSED_KEPT = 10_000
+
+_TIMESTAMPS = [name for name, dtype in ORDER_SCHEMA.items() if isinstance(dtype, pl.Datetime)]
+_FLOATS = [name for name, dtype in ORDER_SCHEMA.items() if dtype == pl.Float64]
+
+
+def _naive_utc(ts) -> Union[datetime, None]:
+    # the api sends rfc3339 strings, the models carry tz aware datetimes, the frame holds naive utc
+    if ts is None:
+        return None
+
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts)
+
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo = None)
+
+    return ts
+
+
+def _value(value) -> Union[str, None]:
+    if value is None:
+        return None
+
+    return str(getattr(value, 'value', value))
+
+
+def order_row(order: Union[Order, Dict]) -> Dict:
+    """
+    Flattens an order into a row of ORDER_SCHEMA
+
+    :param order: Order model or the raw order json of a trade update
+    :return: Dict[column: value]
+    """
+
+    if not isinstance(order, dict):
+        order = dict(order)
+
+    row = {
+        "symbol": order.get('symbol'),
+        "asset_type": _value(order.get('asset_class')),
+        "status": _value(order.get('status')),
+        "id": _value(order.get('id')),
+        "client_order_id": _value(order.get('client_order_id')),
+        "replaced_by": _value(order.get('replaced_by')),
+        "replaces": _value(order.get('replaces')),
+        "asset_id": _value(order.get('asset_id')),
+        "order_class": _value(order.get('order_class')),
+        "type": _value(order.get('type') or order.get('order_type')),
+        "side": _value(order.get('side')),
+        "time_in_force": _value(order.get('time_in_force')),
+        "extended_hours": order.get('extended_hours'),
+        "legs": [_value(getattr(leg, 'id', None) or leg.get('id')) for leg in order['legs']]
+        if order.get('legs') else None
+    }
+
+    for name in _TIMESTAMPS:
+        row[name] = _naive_utc(order.get(name))
+
+    # the api sends numbers as strings
+    for name in _FLOATS:
+        value = order.get(name)
+        row[name] = float(value) if value is not None else None
+
+    if row['filled_qty'] is None:
+        row['filled_qty'] = 0.0
+
+    return row
+
+
+class OrderStore:
+
+    def __init__(self):
+        """
+        Open orders by id, with ids indexed by symbol and by status
+        """
+
+        self.orders: Dict[str, Dict] = {}
+        self.by_symbol: Dict[str, set] = {}
+        self.by_status: Dict[str, set] = {}
+
+        # unfilled [buy qty, sell qty, buy notional, sell notional] by symbol, and the notionals over all symbols
+        self.pending: Dict[str, List[float]] = {}
+        self.pending_buy_notional = 0.0
+        self.pending_sell_notional = 0.0
+
+        # ids closed by a trade update lately, oldest first
+        self.closed: Dict[str, None] = {}
+
+        # bumped on every change, the snapshot is rebuilt only when it moved
+        self.version = 0
+        self._snapshot: Union[pl.DataFrame, None] = None
+        self._snapshot_version = -1
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def __contains__(self, order_id) -> bool:
+        return str(order_id) in self.orders
+
+    def get(self, order_id) -> Union[Dict, None]:
+        return self.orders.get(str(order_id))
+
+    @staticmethod
+    def _unfilled(row: Dict) -> Tuple[float, float]:
+        """
+        :return: unfilled qty and notional of an order
+        """
+
+        filled = row['filled_qty'] or 0.0
+
+        if row['qty'] is None:
+            # notional order, the qty is only known once filled
+            return 0.0, max((row['notional'] or 0.0) - filled * (row['filled_avg_price'] or 0.0), 0.0)
+
+        qty = max(row['qty'] - filled, 0.0)
+        return qty, qty * (row['limit_price'] or row['stop_price'] or 0.0)
+
+    def _add_pending(self, row: Dict, sign: float):
+        qty, notional = self._unfilled(row)
+        if not qty and not notional:
+            return
+
+        pending = self.pending.setdefault(row['symbol'], [0.0, 0.0, 0.0, 0.0])
+        if row['side'] == 'buy':
+            pending[0] += sign * qty
+            pending[2] += sign * notional
+            self.pending_buy_notional += sign * notional
+        else:
+            pending[1] += sign * qty
+            pending[3] += sign * notional
+            self.pending_sell_notional += sign * notional
+
+    def _index(self, row: Dict):
+        self.by_symbol.setdefault(row['symbol'], set()).add(row['id'])
+        self.by_status.setdefault(row['status'], set()).add(row['id'])
+        self._add_pending(row, 1.0)
+
+    def _unindex(self, row: Dict):
+        for index, key in ((self.by_symbol, row['symbol']), (self.by_status, row['status'])):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(row['id'])
+                if not ids:
+                    del index[key]
+
+        self._add_pending(row, -1.0)
+        # no rounding left behind
+        if row['symbol'] not in self.by_symbol:
+            self.pending.pop(row['symbol'], None)
+        if not self.by_symbol:
+            self.pending_buy_notional = self.pending_sell_notional = 0.0
+
+    def upsert(self, row: Dict):
+        """
+        Adds an order row or replaces the row with the same id
+
+        :param row: row made by order_row
+        """
+
+        old = self.orders.get(row['id'])
+        if old is not None:
+            self._unindex(old)
+
+        self.orders[row['id']] = row
+        self._index(row)
+        self.version += 1
+
+    def ack(self, row: Dict) -> bool:
+        """
+        Upserts the row of a rest response, unless the trade updates got there first: the order was closed while
+        the call was in flight, or the row in the store is more recent
+
+        :param row: row made by order_row
+        :return: whether the row went in
+        """
+
+        if row['id'] in self.closed:
+            return False
+
+        old = self.orders.get(row['id'])
+        if old is not None and old['updated_at'] is not None and row['updated_at'] is not None \
+                and old['updated_at'] > row['updated_at']:
+            return False
+
+        self.upsert(row)
+        return True
+
+    def remove(self, order_id) -> Union[Dict, None]:
+        """
+        :return: row of the removed order, None if it was not in the store
+        """
+
+        row = self.orders.pop(str(order_id), None)
+        if row is not None:
+            self._unindex(row)
+            self.version += 1
+
+        return row
+
+    def apply(self, event: str, order: Union[Order, Dict]) -> Dict:
+        """
+        Applies one trade update
+
+        :param event: event of the update, fill, partial_fill, canceled ...
+        :param order: order of the update, model or raw json
+        :return: row of the order after the event
+        """
+
+        row = order_row(order)
+
+        if event in CLOSING_EVENTS:
+            self.remove(row['id'])
+            self.closed[row['id']] = None
+            if len(self.closed) > _CLOSED_KEPT:
+                del self.closed[next(iter(self.closed))]
+        else:
+            self.upsert(row)
+
+        return row
+
+    def ids(self, symbol: str = None, status: str = None) -> set:
+        """
+        :param symbol: only orders of the symbol
+        :param status: only orders in the status
+        :return: set of order ids
+        """
+
+        if symbol is None and status is None:
+            return set(self.orders)
+
+        if symbol is None:
+            return set(self.by_status.get(status, ()))
+
+        ids = set(self.by_symbol.get(symbol, ()))
+        if status is not None:
+            ids &= self.by_status.get(status, set())
+
+        return ids
+
+    def snapshot(self, symbol: str = None, status: str = None) -> pl.DataFrame:
+        """
+        Orders as a frame of ORDER_SCHEMA, the full snapshot is cached until the store changes
+
+        :param symbol: only orders of the symbol
+        :param status: only orders in the status
+        """
+
+        if symbol is not None or status is not None:
+            return self._frame([self.orders[i] for i in self.ids(symbol, status)])
+
+        if self._snapshot_version != self.version:
+            self._snapshot = self._frame(list(self.orders.values()))
+            self._snapshot_version = self.version
+
+        return self._snapshot
+
+    @staticmethod
+    def _frame(rows: List[Dict]) -> pl.DataFrame:
+        # column by column, polars does not have to infer anything from the dicts
+        return pl.DataFrame({name: [row[name] for row in rows] for name in ORDER_SCHEMA}, schema = ORDER_SCHEMA)
+
+
+if __name__ == '__main__':
+    import time as true_time
+    from Finance.stubs import trade_update_events
+
+    n_events = 100_000
+    events = trade_update_events(n_events, open_orders = 2_000)
+
+    # store, every event is a few dict and set operations
+    store = OrderStore()
+    t0 = true_time.perf_counter()
+    for update in events:
+        store.apply(update['data']['event'], update['data']['order'])
+    store_seconds = true_time.perf_counter() - t0
+
+    t0 = true_time.perf_counter()
+    snapshot = store.snapshot()
+    snapshot_seconds = true_time.perf_counter() - t0
+
+    # the old way, a filter and a concat of the whole frame per event, only run on a slice and scaled up
+    legacy_events = events[:5_000]
+    orders_df = pl.DataFrame(schema = ORDER_SCHEMA)
+    t0 = true_time.perf_counter()
+    for update in legacy_events:
+        row = order_row(update['data']['order'])
+        orders_df = orders_df.filter(pl.col('id') != row['id'])
+        if update['data']['event'] not in CLOSING_EVENTS:
+            orders_df = pl.concat([orders_df, pl.DataFrame([row], schema = ORDER_SCHEMA)], how = 'vertical')
+    legacy_seconds = (true_time.perf_counter() - t0) * n_events / len(legacy_events)
+
+    # both end up with the same open orders
+    check = OrderStore()
+    for update in legacy_events:
+        check.apply(update['data']['event'], update['data']['order'])
+    assert set(orders_df.get_column('id').to_list()) == check.ids()
+
+    # the fill came in before the response of the submit, the order stays closed
+    late = OrderStore()
+    submitted = events[0]['data']['order']
+    late.apply('fill', {**submitted, 'status': 'filled', 'filled_qty': submitted['qty']})
+    assert not late.ack(order_row(submitted)) and not late.pending and submitted['id'] not in late
+
+    print(f"{n_events} trade updates, {len(store)} open orders at the end")
+    print(f"order store : {store_seconds:.2f} s, {n_events / store_seconds:,.0f} events/s, "
+          f"snapshot of {snapshot.height} rows in {snapshot_seconds * 1e3:.1f} ms")
+    print(f"frame rebuild: {legacy_seconds:.2f} s (scaled from {len(legacy_events)} events), "
+          f"{n_events / legacy_seconds:,.0f} events/s")
@@ -4,10 +4,13 @@ from typing import List, Dict, Tuple, Union, Any, Optional, Callable
 import numpy as np
 import polars as pl
 import asyncio
+import functools
 import websockets
 import json
 import logging
-from datetime import datetime, timezone
+import uuid
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import Executor
 
 import alpaca
 from alpaca.data.live.stock import *
@@ -24,22 +27,94 @@ from alpaca.common.exceptions import APIError
 
 from Finance.portfolio import PORTFOLIO
 from Finance.tradeStream import TradeStream
+from Finance.tradeDecoder import TradeUpdate
+from Finance.orderStore import OrderStore, order_row, _value
+from Finance.riskGate import RiskGate
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# trade update event an order's status comes from, the others are named alike
+_STATUS_EVENTS = {'filled': 'fill', 'partially_filled': 'partial_fill'}
+
+'''
+Baskets, many orders from one frame.
+
+A basket is a polars frame with a row per order, only symbol, side and one of qty / notional are required:
+    symbol, side, qty, notional, type, time_in_force, limit_price, stop_price, trail_price, trail_percent,
+    extended_hours, client_order_id
+The names of the sides, types and time in force are mapped and every row is validated with column expressions, so a
+bad row gets its error without a python call per row, only the valid rows become requests. type defaults to market
+and time_in_force to day (notional orders are day only). Rows without a client_order_id get one, a retried submit the
+broker did take is then refused as a duplicate instead of sent twice.
+'''
+
+BASKET_SCHEMA = {
+    'symbol': pl.Utf8,
+    'side': pl.Utf8,
+    'qty': pl.Float64,
+    'notional': pl.Float64,
+    'type': pl.Utf8,
+    'time_in_force': pl.Utf8,
+    'limit_price': pl.Float64,
+    'stop_price': pl.Float64,
+    'trail_price': pl.Float64,
+    'trail_percent': pl.Float64,
+    'extended_hours': pl.Boolean,
+    'client_order_id': pl.Utf8
+}
+
+# names the _format_ methods take, to the api value
+_SIDES = {'buy': 'buy', 'sell': 'sell'}
+_TYPES = {'market': 'market', 'mkt': 'market', 'limit': 'limit', 'lmt': 'limit', 'stop': 'stop', 'stp': 'stop',
+          'stop_limit': 'stop_limit', 'stp_lmt': 'stop_limit', 'stop limit': 'stop_limit', 'stp lmt': 'stop_limit',
+          'trailing stop': 'trailing_stop', 'trailing_stop': 'trailing_stop'}
+_TIME_IN_FORCE = {name: name for name in ('day', 'gtc', 'opg', 'cls', 'ioc', 'fok')}
+
+_REQUESTS = {'market': MarketOrderRequest, 'limit': LimitOrderRequest, 'stop': StopOrderRequest,
+             'stop_limit': StopLimitOrderRequest, 'trailing_stop': TrailingStopOrderRequest}
+# columns of the request of every type, on top of symbol, side, qty / notional, time_in_force and extended_hours
+_REQUEST_COLUMNS = {'market': (), 'limit': ('limit_price',), 'stop': ('stop_price',),
+                    'stop_limit': ('limit_price', 'stop_price'), 'trailing_stop': ('trail_price', 'trail_percent')}
+
+BASKET_RESULT_SCHEMA = {'client_order_id': pl.Utf8, 'id': pl.Utf8, 'status': pl.Utf8, 'error': pl.Utf8,
+                        'attempts': pl.Int64}
+
 
 class ORDERS:
 
     def __init__(self, trade_client: TradingClient, portfolio: PORTFOLIO, api_key: str = '', secret_key: str = ''):
 
         self.trade_client = trade_client
-        self.orders_df: pl.DataFrame = self.get_all_orders()
+
+        # open orders by id, kept up to date by the trade updates
+        self.order_store = OrderStore()
+        self.get_all_orders()
         self._api_key = api_key
         self._secret_key = secret_key
 
         self.portfolio = portfolio
 
+        # pool the api calls made from the event loop go to, None is the loop's default pool
+        self.executor: Union[Executor, None] = None
+
+        # pre-trade checks of every order, None sends orders unchecked
+        self.risk: Union[RiskGate, None] = None
+
+        # client side stops, trailing stops, oco and oto, TRIGGERS of triggers.py, see add_stop_loss
+        self.triggers = None
+
+        # called with (event, row) after every trade update is applied to the store
+        self._update_handlers: List[Callable] = []
+
+    @property
+    def orders_df(self) -> pl.DataFrame:
+        """
+        Open orders as a frame, built from the order store only when it changed since the last call
+        """
+
+        return self.order_store.snapshot()
+
     def get_all_orders(self) -> pl.DataFrame:
 
         log.info("starting to fetch all orders")
@@ -47,51 +122,10 @@ class ORDERS:
         if orders:
             log.info("got some orders")
 
-        schema = {
-            "symbol": pl.Utf8,
-            "asset_type": pl.Utf8,
-            "status": pl.Utf8,
-            "id": pl.Utf8,
-            "client_order_id": pl.Utf8,
-            "created_at": pl.Datetime("us", time_zone=None),
-            "updated_at": pl.Datetime("us", time_zone=None),
-            "submitted_at": pl.Datetime("us", time_zone=None),
-            "filled_at": pl.Datetime("us", time_zone=None),
-            "expired_at": pl.Datetime("us", time_zone=None),
-            "canceled_at": pl.Datetime("us", time_zone=None),
-            "failed_at": pl.Datetime("us", time_zone=None),
-            "replaced_at": pl.Datetime("us", time_zone=None),
-            "replaced_by": pl.Utf8,
-            "replaces": pl.Utf8,
-            "asset_id": pl.Utf8,
-            "notional": pl.Float64,
-            "qty": pl.Float64,
-            "filled_qty": pl.Float64,
-            "filled_avg_price": pl.Float64,
-            "order_class": pl.Utf8,
-            "type": pl.Utf8,
-            "side": pl.Utf8,
-            "time_in_force": pl.Utf8,
-            "limit_price": pl.Float64,
-            "stop_price": pl.Float64,
-            "extended_hours": pl.Boolean,
-            "legs": pl.List(pl.Utf8),
-            "trail_percent": pl.Float64,
-            "trail_price": pl.Float64,
-            "hwm": pl.Float64
-        }
-
-        orders_df: pl.DataFrame = pl.DataFrame(schema = schema)
-
-        dict_list = []
         for order in orders:
-            dict_list.append(self.process_and_add_order(order, add = False))
-
-        if dict_list:
-            log.info("dict_list is non empty.")
-            orders_df = pl.concat([orders_df, pl.DataFrame(dict_list)], how = 'vertical')
+            self.process_and_add_order(order)
 
-        return orders_df
+        return self.orders_df
 
     ################################# prepping requests ##########################################
     @staticmethod
@@ -212,7 +246,7 @@ class ORDERS:
         elif order_type.lower() in ['stop_limit', 'stp_lmt', 'stop limit', 'stp lmt']:
             return OrderType.STOP_LIMIT
 
-        elif order_type.lower() == 'trailing stop' or order_type.lower() == 'trialing_stop':
+        elif order_type.lower() in ['trailing stop', 'trailing_stop', 'trialing_stop']:
             return OrderType.TRAILING_STOP
 
         else:
@@ -269,47 +303,14 @@ class ORDERS:
             raise ValueError("Position intent must be one of buy_to_open, buy_to_close, sell_to_open, sell_to_close.")
 
     ########################################## end of static methods #####################################
-    # id is not saved, check into it
     def process_and_add_order(self, order: Order, add: bool = True) -> Union[Dict, None]:
 
-        new_order = {
-            "symbol": order.symbol,
-            "asset_type": order.asset_class.value,
-            "status": order.status.value,
-            "id": str(order.id),
-            "client_order_id": str(order.client_order_id),
-            "created_at": order.created_at.replace(tzinfo=timezone.utc) if order.created_at else None,
-            "updated_at": order.updated_at.replace(tzinfo=timezone.utc) if order.updated_at else None,
-            "submitted_at": order.submitted_at.replace(tzinfo=timezone.utc) if order.submitted_at else None,
-            "filled_at": order.filled_at.replace(tzinfo=timezone.utc) if order.filled_at else None,
-            "expired_at": order.expired_at.replace(tzinfo=timezone.utc) if order.expired_at else None,
-            "canceled_at": order.canceled_at.replace(tzinfo=timezone.utc) if order.canceled_at else None,
-            "failed_at": order.failed_at.replace(tzinfo=timezone.utc) if order.failed_at else None,
-            "replaced_at": order.replaced_at.replace(tzinfo=timezone.utc) if order.replaced_at else None,
-            "replaced_by": order.replaced_by,
-            "replaces": str(order.replaces),
-            "asset_id": str(order.asset_id),
-            "notional": float(order.notional) if order.notional else None,
-            "qty": float(order.qty) if order.qty else None,
-            "filled_qty": float(order.filled_qty) if order.filled_qty else 0,
-            "filled_avg_price": float(order.filled_avg_price) if order.filled_avg_price else None,
-            "order_class": order.order_class.value,
-            "type": order.type.value,
-            "side": order.side.value,
-            "time_in_force": order.time_in_force.value,
-            "limit_price": float(order.limit_price) if order.limit_price else None,
-            "stop_price": float(order.stop_price) if order.stop_price else None,
-            "extended_hours": order.extended_hours,
-            "legs": order.legs,
-            "trail_percent": float(order.trail_percent) if order.trail_percent else None,
-            "trail_price": float(order.trail_price) if order.trail_price else None,
-            "hwm": float(order.hwm) if order.hwm else None
-        }
+        new_order = order_row(order)
+
         if not add:
             return new_order
         else:
-            self.orders_df = pl.concat([self.orders_df,
-                                        pl.DataFrame(new_order)], how = 'vertical')
+            self.order_store.ack(new_order)
 
     def new_order(self, symbol: str, buy_or_sell: str, value: float, is_qty: bool = True, order_type: str = 'market',
                   asset_type: str = 'equity', time_in_force: str = 'gtc', stop_price: float = 0.0,
@@ -318,6 +319,61 @@ class ORDERS:
                   stop_loss: bool = False, position_intent: Union[str, None] = None,
                   order_class: str = 'simple'):
         """
+        Builds and submits an order, the arguments are those of order_request
+        """
+
+        request = self.order_request(symbol, buy_or_sell, value, is_qty, order_type, asset_type, time_in_force,
+                                     stop_price, limit_price, trail_price, trail_percent, extended_hours, take_profit,
+                                     stop_loss, position_intent, order_class)
+
+        # raises RiskRejected before anything is sent
+        if self.risk is not None:
+            self.risk.enforce(request)
+
+        try:
+            # submission
+            nueva_new_order = self.trade_client.submit_order(order_data = request)
+
+            # add to orders df
+            self.process_and_add_order(nueva_new_order)
+        finally:
+            if self.risk is not None:
+                self.risk.release(request.client_order_id)
+
+    async def submit(self, request: OrderRequest) -> Union[Dict, None]:
+        """
+        Submits an order request from the event loop, the api call goes to the executor and the store is updated on
+        the loop like the trade updates are
+
+        :param request: request of order_request
+        :return: row of the submitted order
+        """
+
+        if self.risk is not None:
+            self.risk.enforce(request)
+
+        loop = asyncio.get_running_loop()
+        try:
+            order = await loop.run_in_executor(self.executor, functools.partial(self.trade_client.submit_order,
+                                                                                 order_data = request))
+
+            # the trade updates of the order may have been handled while the call was in flight
+            row = self.process_and_add_order(order, add = False)
+            self.order_store.ack(row)
+        finally:
+            # in the store now, or not sent
+            if self.risk is not None:
+                self.risk.release(request.client_order_id)
+
+        return row
+
+    def order_request(self, symbol: str, buy_or_sell: str, value: float, is_qty: bool = True,
+                      order_type: str = 'market', asset_type: str = 'equity', time_in_force: str = 'gtc',
+                      stop_price: float = 0.0, limit_price: float = 0.0, trail_price: float = 0.0,
+                      trail_percent: float = 0.0, extended_hours: bool = False,
+                      take_profit: Union[float, None] = None, stop_loss: bool = False,
+                      position_intent: Union[str, None] = None, order_class: str = 'simple') -> OrderRequest:
+        """
 
         only stock trades are designed right now, and only simple and bracket order, oco and oto are not designed yet
 
@@ -338,7 +394,7 @@ class ORDERS:
         :param stop_loss: stop loss required or not
         :param position_intent: one of buy_to_open, buy_to_close, sell_to_open, sell_to_close
         :param order_class: simple, bracket, oco (one cancels other) or oto (one triggers other)
-        :return:
+        :return: the order request
         """
 
         order_side: OrderSide = self._format_order_side(buy_or_sell)
@@ -376,7 +432,7 @@ class ORDERS:
         if stop_loss:
             if not stop_price:
                 raise ValueError("Stop price is required.")
-            stop_loss = {'stop_price': 100.0}
+            stop_loss = {'stop_price': stop_price}
 
             # in here if the limit price is not provided, then the order will turn into a market order
             if limit_price:
@@ -412,8 +468,11 @@ class ORDERS:
                 request = StopLimitOrderRequest(**req_params)
 
             elif order_type.value == 'trailing_stop':
-                req_params['trail_price'] = trail_price
-                req_params['trail_percent'] = trail_percent
+                # the api takes exactly one of the two
+                if trail_price:
+                    req_params['trail_price'] = trail_price
+                else:
+                    req_params['trail_percent'] = trail_percent
                 request = TrailingStopOrderRequest(**req_params)
 
         # BRACKET ORDER
@@ -424,56 +483,305 @@ class ORDERS:
             req_params['type'] = self._format_order_type('market')
 
         ##################### oco and oto are not implemented in api properly #######################################
+        # client side oco and oto are in triggers.py
 
+        return request
 
-        ################## order submission and updation #########################################
+    ###################### baskets ##########################
+    @staticmethod
+    def basket_frame(basket: pl.DataFrame) -> pl.DataFrame:
+        """
+        Normalises and validates a basket, see BASKET_SCHEMA
 
-        # submission
-        nueva_new_order = self.trade_client.submit_order(order_data = request)
+        :param basket: frame of orders, missing optional columns are filled in
+        :return: the basket with side, type and time_in_force mapped to api values and an error column, null for
+                 valid rows
+        """
 
-        # add to orders df
-        self.process_and_add_order(nueva_new_order)
+        for name in ('symbol', 'side'):
+            if name not in basket.columns:
+                raise ValueError(f"basket needs a {name} column.")
+        if 'qty' not in basket.columns and 'notional' not in basket.columns:
+            raise ValueError("basket needs a qty or a notional column.")
+
+        frame = basket.with_columns([pl.lit(None, dtype).alias(name) for name, dtype in BASKET_SCHEMA.items()
+                                     if name not in basket.columns])
+        frame = frame.with_columns([pl.col(name).cast(dtype) for name, dtype in BASKET_SCHEMA.items()])
+
+        def mapped(name: str, names: Dict[str, str], default: str = None) -> pl.Expr:
+            column = pl.col(name).str.to_lowercase().str.strip_chars()
+            if default is not None:
+                column = column.fill_null(default)
+            return column.replace_strict(names, default = None, return_dtype = pl.Utf8)
+
+        frame = frame.with_columns(
+            mapped('side', _SIDES).alias('side'),
+            mapped('type', _TYPES, 'market').alias('type'),
+            mapped('time_in_force', _TIME_IN_FORCE, 'day').alias('time_in_force'),
+            pl.col('extended_hours').fill_null(False)
+        )
 
-    ###################### trade updates ##########################
-    async def _update_handler(self, response: Dict):
+        positive = lambda name: pl.col(name).is_not_null() & (pl.col(name) > 0)
+        order_type = pl.col('type')
+
+        # first failing rule of every row
+        error = pl.when(pl.col('symbol').is_null() | (pl.col('symbol') == '')).then(pl.lit("symbol is missing"))
+        for rule, message in [
+            (pl.col('side').is_null(), "side must be buy or sell"),
+            (order_type.is_null(), "type must be one of market, limit, stop, stop_limit or trailing_stop"),
+            (pl.col('time_in_force').is_null(), "time_in_force must be one of day, gtc, opg, cls, ioc, fok"),
+            (positive('qty') == positive('notional'), "exactly one of qty and notional must be positive"),
+            (positive('notional') & ((order_type != 'market') | (pl.col('time_in_force') != 'day')),
+             "notional orders must be day market orders"),
+            (order_type.is_in(['limit', 'stop_limit']) & ~positive('limit_price'), "limit_price is required"),
+            (order_type.is_in(['stop', 'stop_limit']) & ~positive('stop_price'), "stop_price is required"),
+            ((order_type == 'trailing_stop') & (positive('trail_price') == positive('trail_percent')),
+             "exactly one of trail_price and trail_percent must be positive")
+        ]:
+            error = error.when(rule).then(pl.lit(message))
+
+        return frame.with_columns(error.otherwise(pl.lit(None, pl.Utf8)).alias('error'))
 
-        if response.get('data').get('event') in ['fill', 'partial_fill']:
+    @staticmethod
+    def basket_requests(frame: pl.DataFrame) -> List[Tuple[int, Union[OrderRequest, None], Union[str, None]]]:
+        """
+        :param frame: basket of basket_frame
+        :return: (row, request, error) of every row, request is None where error is not
+        """
 
-            self.portfolio.on_order_fill(symbol = response.get('data').get('symbol'))
+        results = []
+        rows = frame.with_row_index('_row').to_dicts()
 
-            # on fill delete it from orders_df
-            if response.get('data').get('event') == 'fill':
-                self.orders_df = self.orders_df.filter(
-                    pl.col('id') != response.get('data').get('id')
-                )
+        for row in rows:
+            if row['error'] is not None:
+                results.append((row['_row'], None, row['error']))
+                continue
 
-        else:
+            params = {'symbol': row['symbol'], 'side': row['side'], 'time_in_force': row['time_in_force'],
+                      'extended_hours': row['extended_hours'],
+                      'client_order_id': row['client_order_id'] or str(uuid.uuid4())}
+            if row['qty'] is not None and row['qty'] > 0:
+                params['qty'] = row['qty']
+            else:
+                params['notional'] = row['notional']
+            for name in _REQUEST_COLUMNS[row['type']]:
+                if row[name] is not None and row[name] > 0:
+                    params[name] = row[name]
 
-            # remove the order if it can never be executed
-            if response.get('data').get('event') in ['canceled', 'expired', 'rejected', 'suspended']:
-                log.info(f"Order response for {response.get('data').get('symbol')} is "
-                         f"{response.get('data').get('event')} and is being removed from active orders.")
+            try:
+                results.append((row['_row'], _REQUESTS[row['type']](**params), None))
+            except ValueError as e:
+                # what the api models check on top, fractional qty of non market orders, price increments ...
+                results.append((row['_row'], None, str(e).splitlines()[0]))
 
-                self.orders_df: pl.DataFrame = self.orders_df.filter(
-                    (pl.col('id') != response.get('data').get('id'))
-                )
+        return results
 
-                return
+    async def _order_by_client_id(self, client_order_id: str) -> Union[Dict, None]:
+        loop = asyncio.get_running_loop()
+        try:
+            order = await loop.run_in_executor(self.executor, self.trade_client.get_order_by_client_id,
+                                               client_order_id)
+        except Exception:
+            # not found, or the connection is still down
+            return None
+
+        row = self.process_and_add_order(order, add = False)
+        self.order_store.ack(row)
 
+        return row
+
+    async def submit_basket(self, basket: pl.DataFrame, max_in_flight: int = 16, retries: int = 1) -> pl.DataFrame:
+        """
+        Validates a basket and submits its valid rows concurrently, the calls go to the executor
+
+        :param basket: frame of orders, see BASKET_SCHEMA
+        :param max_in_flight: submits in flight at once
+        :param retries: submits again of rows the broker failed with a 5xx or 429, the client order id keeps a submit
+                        the broker did take from going in twice, it is looked up instead. A row still failing after
+                        the last attempt, or on a connection error, is looked up too before it is reported failed
+        :return: the basket, normalised, with the broker's id, status, error and attempts of every row
+        """
+
+        frame = self.basket_frame(basket)
+        prepared = self.basket_requests(frame)
+        results: List[Dict] = [{} for _ in range(frame.height)]
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def found(row: int, request: OrderRequest, attempts: int) -> bool:
+            # the broker may have taken an order whose answer was lost
+            order = await self._order_by_client_id(request.client_order_id)
+            if order is None:
+                return False
+
+            results[row] = {'client_order_id': request.client_order_id, 'id': order['id'],
+                            'status': order['status'], 'error': None, 'attempts': attempts}
+            return True
+
+        async def send(row: int, request: OrderRequest):
+            attempts = 0
+            while True:
+                attempts += 1
+                try:
+                    async with semaphore:
+                        order = await self.submit(request)
+                    results[row] = {'client_order_id': request.client_order_id, 'id': order['id'],
+                                    'status': order['status'], 'error': None, 'attempts': attempts}
+                    return
+
+                except APIError as e:
+                    status = e.status_code
+                    retryable = status is not None and (status >= 500 or status == 429)
+                    if attempts <= retries and retryable:
+                        continue
+
+                    # out of retries, or an earlier attempt went in
+                    if (retryable or (attempts > 1 and status == 422)) and await found(row, request, attempts):
+                        return
+
+                    results[row] = {'client_order_id': request.client_order_id, 'id': None, 'status': 'failed',
+                                    'error': f"{status}: {e}", 'attempts': attempts}
+                    return
+
+                except Exception as e:
+                    # rejected by the risk gate or the request, or the connection, which may have sent the order
+                    if not isinstance(e, ValueError) and await found(row, request, attempts):
+                        return
+
+                    results[row] = {'client_order_id': request.client_order_id, 'id': None,
+                                    'status': 'rejected' if isinstance(e, ValueError) else 'failed',
+                                    'error': str(e), 'attempts': attempts}
+                    return
+
+        client_ids = frame.get_column('client_order_id').to_list()
+        sends = []
+        for row, request, error in prepared:
+            if request is None:
+                results[row] = {'client_order_id': client_ids[row], 'id': None, 'status': 'invalid', 'error': error,
+                                'attempts': 0}
             else:
+                sends.append(send(row, request))
+
+        await asyncio.gather(*sends)
+
+        result = pl.DataFrame({name: [row[name] for row in results] for name in BASKET_RESULT_SCHEMA},
+                              schema = BASKET_RESULT_SCHEMA)
+
+        return pl.concat([frame.drop('error', 'client_order_id'), result], how = 'horizontal')
+
+    ###################### trade updates ##########################
+    async def _update_handler(self, response: Union[TradeUpdate, Dict]):
+
+        # decoded by the stream's TradeUpdateDecoder, or the raw dict of the message
+        if isinstance(response, TradeUpdate):
+            data, event, order = response, response.event, response.order
+        else:
+            data = response.get('data')
+            event, order = data.get('event'), data.get('order')
 
-                new_order_dict = self.process_and_add_order(add = False)
+        # the store drops orders which can never be executed anymore and upserts the rest
+        row = self.order_store.apply(event, order)
+        # the order is in the store, or done, before the response of its submit
+        if self.risk is not None:
+            self.risk.release(row['client_order_id'])
 
-                # add the new_order dict replacing the id if it already exists
-                self.orders_df = pl.concat(
-                    [self.orders_df.filter( pl.col('id') != new_order_dict.get('id') ), pl.DataFrame(new_order_dict)],
-                    how='vertical'
-                )
-        pass
+        if event in ['canceled', 'expired', 'rejected', 'suspended']:
+            log.info(f"Order response for {row['symbol']} is {event} and is being removed from active orders.")
+
+        if event in ['fill', 'partial_fill']:
+            await self.portfolio.on_order_fill_async(symbol = row['symbol'], event = data, executor = self.executor)
+
+        for handler in self._update_handlers:
+            handler(event, row)
+
+    def subscribe_updates(self, handler: Callable):
+        """
+        :param handler: called with (event, row) after every trade update, on the loop, must not block
+        """
+
+        self._update_handlers.append(handler)
+
+    def orders_since(self, since: Union[datetime, str]) -> List[Order]:
+        """
+        Orders which may have changed since a time, to catch up on the trade updates missed while disconnected.
+        The api filters on submission time, so it takes
+            orders submitted since, paged through get_orders with the after filter
+            the broker's open orders, paged the same way
+            open orders of the store which are in neither, they were closed meanwhile, one by one
+        which is about the open orders and the orders that moved meanwhile rather than the whole history.
+
+        :param since: time of the last trade update seen, rfc3339 string or datetime
+        :return: latest state of the orders
+        """
+
+        after = datetime.fromisoformat(since) if isinstance(since, str) else since
+
+        changed = self._orders_after(QueryOrderStatus.ALL, after)
+        changed.update(self._orders_after(QueryOrderStatus.OPEN))
+
+        for order_id in self.order_store.ids() - set(changed):
+            try:
+                changed[order_id] = self.trade_client.get_order_by_id(order_id)
+            except APIError as e:
+                log.warning(f"order {order_id} could not be recovered: {e}")
+
+        return list(changed.values())
+
+    def _orders_after(self, status: QueryOrderStatus, after: datetime = None) -> Dict[str, Order]:
+        # pages of 500, the most the api returns, oldest first
+        orders: Dict[str, Order] = {}
+
+        while True:
+            page = self.trade_client.get_orders(filter = GetOrdersRequest(
+                status = status, after = after, direction = Sort.ASC, limit = 500))
+            new = {str(order.id): order for order in page if str(order.id) not in orders}
+            orders.update(new)
+
+            if len(page) < 500:
+                return orders
+            if not new:
+                log.warning(f"more than 500 orders submitted at {page[-1].submitted_at}, the rest are not paged")
+                return orders
+
+            # after is exclusive, orders sharing the last time may be on the next page, the repeats are dropped
+            after = page[-1].submitted_at - timedelta(microseconds = 1)
+
+    def apply_orders(self, orders: List[Order]):
+        """
+        Applies the latest states of orders to the store, as if their last trade update came in. The update handlers
+        see the orders whose state changed, once
+        """
+
+        store = self.order_store
+        for order in orders:
+            status = _value(order.status)
+            event = _STATUS_EVENTS.get(status, status)
+
+            order_id = str(order.id)
+            old = store.get(order_id)
+            closed = order_id in store.closed
+            row = store.apply(event, order)
+
+            # a closed order was seen closing already, an open one only moved if its status or fills did
+            if closed or (old is not None and (old['status'], old['filled_qty']) == (row['status'], row['filled_qty'])):
+                continue
+            for handler in self._update_handlers:
+                handler(event, row)
+
+    async def _reconnect_handler(self, since: str):
+        # the api calls go to a thread, the store and the ledger only change on the loop like with the updates
+        loop = asyncio.get_running_loop()
+        orders = await loop.run_in_executor(self.executor, self.orders_since, since)
+        self.apply_orders(orders)
+
+        positions = await loop.run_in_executor(self.executor, self.trade_client.get_all_positions)
+        self.portfolio.ledger.reconcile(positions)
+
+        log.info(f"recovered {len(orders)} orders and {len(positions)} positions since {since}")
 
     def take_updates(self):
         self._trade_stream = TradeStream(api_key = self._api_key, secret_key = self._secret_key)
         self._trade_stream.subscribe_trade_updates(handler = self._update_handler)
+        self._trade_stream.subscribe_reconnect(handler = self._reconnect_handler)
         self._trade_stream.run()
 
     def stop_taking_updates(self):
@@ -488,18 +796,39 @@ class ORDERS:
     def update_order(self, id: Union[UUID, str], qty: int = 0, time_in_force: str = None, limit_price: float = 0.0,
                      stop_price: float = 0.0, trail: float = 0.0):
 
+        req = self.replace_request(id, qty, time_in_force, limit_price, stop_price, trail)
+        if req is None:
+            return
+
+        # check what error is given if given
+        try:
+            new_order = self.trade_client.replace_order_by_id(order_id=id, order_data=req)
+        except Exception as e:
+            log.error(f"error in replacing order: {e}")
+            raise warnings.warn(f"error in replacing order: {e}")
+        # the replaced order is done, the new one takes its place
+        self.order_store.remove(id)
+        self.process_and_add_order(new_order)
+
+    def replace_request(self, id: Union[UUID, str], qty: int = 0, time_in_force: str = None,
+                        limit_price: float = 0.0, stop_price: float = 0.0,
+                        trail: float = 0.0) -> Union[ReplaceOrderRequest, None]:
+        """
+        Request replacing an open order, the prices that apply depend on the order's type
+
+        :return: the request, None if the order is not open
+        """
+
         # check if order exists
-        tmp = self.orders_df.filter(
-            pl.col('id') == id
-        )
+        tmp = self.order_store.get(id)
 
-        if tmp.is_empty():
+        if tmp is None:
             warnings.warn("No such order exists", UserWarning)
             log.warning("Order ID given for cancellation does not exist.")
-            return
+            return None
 
         # if asset type mentioned
-        order_type = tmp.filter( pl.col('type') ).to_series()[0]
+        order_type = tmp['type']
 
         # req dict
         req_dict = {}
@@ -536,29 +865,125 @@ class ORDERS:
         req = ReplaceOrderRequest(**req_dict)
         # many order modifications can be done here, but is not required in the basic version
 
-        # check what error is given if given
-        try:
-            new_order = self.trade_client.replace_order_by_id(order_id=id, order_data=req)
-        except Exception as e:
-            log.error(f"error in replacing order: {e}")
-            raise warnings.warn(f"error in replacing order: {e}")
-        new_order = self.process_and_add_order(new_order, add=False)
-        self.orders_df = pl.concat( [self.orders_df.filter( pl.col('id') != id ), pl.DataFrame(new_order)],
-                                    how='vertical')
-
-
-    # adds stop loss to existing order, ie places limit or stop sell order... figure it out
-    def add_stop_loss(self):
-        pass
-
+        return req
 
 
+    def add_stop_loss(self, id: Union[UUID, str], stop_price: float = 0.0, limit_price: float = 0.0,
+                      trail_price: float = 0.0, trail_percent: float = 0.0, take_profit: float = 0.0) -> List[str]:
+        """
+        Adds a client side stop loss to an open order, armed once the order fills (oto), see TRIGGERS.protect
 
+        :param id: id of the open order
+        :param stop_price: stop price, or trail_price / trail_percent for a trailing stop
+        :param limit_price: makes the stop a stop limit
+        :param take_profit: limit price of a take profit, oco with the stop
+        :return: ids of the triggers
+        """
 
-# if __name__ == '__main__':
-#     trade_client = TradingClient(api_key, secret_key)
-#     portfolio = PORTFOLIO(trade_client)
-#     o = ORDERS(api_key=api_key, secret_key=secret_key, portfolio=portfolio, trade_client=trade_client)
+        if self.triggers is None:
+            raise ValueError("No trigger engine, set triggers (BOT makes one).")
+        if not (stop_price or trail_price or trail_percent):
+            raise ValueError("Stop price, trail price or trail percent is required.")
+
+        return self.triggers.protect(str(id), stop_price = stop_price, limit_price = limit_price,
+                                     trail_price = trail_price, trail_percent = trail_percent,
+                                     take_profit = take_profit)
+
+
+
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import time as true_time
+    from concurrent.futures import ThreadPoolExecutor
+
+    from Finance.stubs import BrokerServer
+    from Finance.gateway import pool_session
+
+    # a 300 name basket against a broker answering in 20 ms that fails 10% of the submits (half of them after the
+    # order went in), with some rows that do not validate
+    n_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rng = random.Random(0)
+    basket = pl.DataFrame({
+        'symbol': [f"SYM{i}" for i in range(n_orders)],
+        'side': [rng.choice(['buy', 'sell', 'BUY', 'Sell']) for _ in range(n_orders)],
+        'qty': [float(rng.randint(1, 100)) for _ in range(n_orders)],
+        'type': [rng.choice(['market', 'limit', 'lmt']) for _ in range(n_orders)],
+        'limit_price': [round(rng.uniform(10, 500), 2) for _ in range(n_orders)]
+    })
+    # broken rows
+    basket = basket.with_columns(
+        pl.when(pl.int_range(pl.len()) == 0).then(pl.lit('hold')).otherwise(pl.col('side')).alias('side'),
+        pl.when(pl.int_range(pl.len()) == 1).then(None).otherwise(pl.col('limit_price')).alias('limit_price'),
+        pl.when(pl.int_range(pl.len()) == 2).then(-5.0).otherwise(pl.col('qty')).alias('qty')
+    ).with_columns(pl.when(pl.int_range(pl.len()) == 1).then(pl.lit('limit')).otherwise(pl.col('type')).alias('type'))
+
+    def make(server: BrokerServer, workers: int) -> ORDERS:
+        client = TradingClient('fake', 'fake', url_override = server.url)
+        orders = ORDERS(client, PORTFOLIO(client))
+        orders.executor = ThreadPoolExecutor(max_workers = workers)
+        pool_session(client, workers)
+        return orders
+
+    t0 = true_time.perf_counter()
+    frame = ORDERS.basket_frame(basket)
+    prepared = ORDERS.basket_requests(frame)
+    print(f"validate and build {n_orders} requests: {(true_time.perf_counter() - t0) * 1e3:.1f} ms")
+
+    # one submit after the other, like a loop of new_order
+    server = BrokerServer(latency = 0.02)
+    server.start()
+    orders = make(server, 1)
+    t0 = true_time.perf_counter()
+    for row, request, error in prepared:
+        if request is not None:
+            orders.process_and_add_order(orders.trade_client.submit_order(order_data = request))
+    sequential = true_time.perf_counter() - t0
+    print(f"sequential: {sequential * 1e3:.0f} ms")
+    server.stop()
+
+    for max_in_flight, retries in [(8, 2), (32, 2), (32, 0)]:
+        server = BrokerServer(latency = 0.02, fail_rate = 0.1, seed = max_in_flight)
+        server.start()
+        orders = make(server, max_in_flight)
+
+        t0 = true_time.perf_counter()
+        result = asyncio.run(orders.submit_basket(basket, max_in_flight = max_in_flight, retries = retries))
+        seconds = true_time.perf_counter() - t0
+        server.stop()
+
+        counts = dict(result.group_by('status').len().iter_rows())
+        print(f"basket {max_in_flight:>2} in flight, {retries} retries: {seconds * 1e3:.0f} ms "
+              f"({sequential / seconds:.1f}x), {counts}, "
+              f"{result.get_column('attempts').sum() - n_orders + counts.get('invalid', 0)} resubmits")
+
+        # every valid row went in once at most, lost answers were found by client order id
+        assert result.height == n_orders
+        assert result.filter(pl.col('status') == 'invalid').height == 3
+        placed = result.filter(pl.col('id').is_not_null())
+        assert placed.get_column('id').n_unique() == placed.height
+        assert set(placed.get_column('id')) <= orders.order_store.ids()
+        assert len(server.orders) == placed.height
+
+    print(result.filter(pl.col('error').is_not_null()).select('symbol', 'side', 'type', 'status', 'attempts',
+                                                               'error'))
+
+    # the risk gate counts the submits in flight, only one of five concurrent orders fits the limits
+    server = BrokerServer(latency = 0.02)
+    server.start()
+    orders = make(server, 8)
+    orders.risk = RiskGate(orders.order_store, orders.portfolio.ledger,
+                           symbol_limits = {'max_open_orders': 1, 'max_position': 10})
+    result = asyncio.run(orders.submit_basket(pl.DataFrame({'symbol': ['AAPL'] * 5, 'side': ['buy'] * 5,
+                                                            'qty': [10.0] * 5, 'type': ['limit'] * 5,
+                                                            'limit_price': [100.0] * 5})))
+    server.stop()
+    print(f"risk gate, 5 concurrent orders: {dict(result.group_by('status').len().iter_rows())}")
+    assert result.filter(pl.col('status') == 'rejected').height == 4 and len(server.orders) == 1
+    assert len(orders.order_store) == 1 and orders.order_store.pending['AAPL'][0] == 10.0
+    assert not orders.risk.in_flight
 
 
 
@@ -17,19 +17,72 @@ from alpaca.trading.enums import *
 from alpaca.common.exceptions import APIError
 
 import warnings
+import logging
+import asyncio
+from concurrent.futures import Executor
+
+from Finance.positionLedger import PositionLedger
+from Finance.valuation import Valuation
+from Finance.risk import RISK
+from Finance.tradeDecoder import TradeUpdate
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
 
 
 class PORTFOLIO:
 
-    def __init__(self, trade_client: TradingClient) -> None:
+    def __init__(self, trade_client: TradingClient, reconcile_interval: float = 300.0) -> None:
         """
         initialises new instance of portfolio class, where info is stored
+
+        :param trade_client: trading client of the account
+        :param reconcile_interval: seconds between full reconciliations of the local ledger with the broker
         """
 
         self.trade_client = trade_client
 
-        # pl.dataframe
-        self.positions: Union[pl.DataFrame, None] = self.load_existing_position
+        # positions are kept locally and moved by fills, the broker is only asked every reconcile_interval
+        self.ledger = PositionLedger(reconcile_interval = reconcile_interval)
+        self.reconcile()
+
+        # marks the positions to the latest quotes / trades, feed it from the data stream or the stock frame
+        self.valuation = Valuation(self.ledger)
+
+        # made on the first call of portfolio_metrics
+        self.risk: Union[RISK, None] = None
+
+    @property
+    def positions(self) -> Union[pl.DataFrame, None]:
+        """
+        Current positions from the local ledger marked to the latest prices, None if there are no positions
+        """
+
+        if not len(self.ledger):
+            return None
+
+        return self.valuation.frame()
+
+    def mark_to_market(self, stockFrame = None, kind: str = 'quotes') -> Dict[str, float]:
+        """
+        Values the book at the latest prices, never calls the api
+
+        :param stockFrame: if given the newest quote or trade of every position is taken from its maps first
+        :param kind: quotes or trades
+        :return: market value, cost basis, unrealised, intraday, realised and total pl of the book
+        """
+
+        if stockFrame is not None:
+            self.valuation.update_from_frames(stockFrame, kind = kind)
+
+        return self.valuation.pnl()
+
+    def reconcile(self):
+        """
+        Replaces the ledger with the broker's positions
+        """
+
+        self.ledger.reconcile(self.trade_client.get_all_positions())
 
     '''
     A lil explanation about position object, to know more refer this link
@@ -105,30 +158,28 @@ class PORTFOLIO:
         if not req:
             raise KeyError("You must provide requests array.")
 
-        self.positions = self.positions.lazy()
+        positions = self.positions
+        if positions is None:
+            return None
+
+        positions = positions.lazy()
         filter_expressions = []
 
         for symbol, asset_type in req:
             if symbol and asset_type:
                 filter_expressions.append(
-                    self.positions.filter(
-                        (pl.col('symbol') == symbol) &
-                        (pl.col('asset_type') == asset_type)
-                    )
+                    (pl.col('symbol') == symbol) &
+                    (pl.col('asset_type') == asset_type)
                 )
 
             elif symbol:
                 filter_expressions.append(
-                    self.positions.filter(
-                        pl.col('symbol') == symbol
-                    )
+                    pl.col('symbol') == symbol
                 )
 
             elif asset_type:
                 filter_expressions.append(
-                    self.positions.filter(
-                        pl.col('asset_type') == asset_type
-                    )
+                    pl.col('asset_type') == asset_type
                 )
 
             else:
@@ -139,7 +190,7 @@ class PORTFOLIO:
             for expr in filter_expressions[1:]:
                 final_expr |= expr
 
-            final_res = self.positions.filter(final_expr).sort(['symbol', 'asset_type']).collect()
+            final_res = positions.filter(final_expr).sort(['symbol', 'asset_type']).collect()
 
             if final_res.is_empty():
                 return None
@@ -147,7 +198,6 @@ class PORTFOLIO:
                 return final_res
 
         else:
-            self.positions.collect()
             return None
 
 
@@ -157,28 +207,117 @@ class PORTFOLIO:
     whenever order are filled in.
     
     maybe a function to just fetch curr prices would be better thant o fetch all the portfolio position, dk measure it with timers
+    -> prices now come from the data stream into self.valuation, see mark_to_market
+
+    The fill events carry price, qty and the broker's position qty after the fill, so the ledger moves without any
+    api call and only goes back to the broker when it disagrees with position_qty or every reconcile_interval.
     '''
 
     # update portfolio once the order is filled
-    def on_order_fill(self, symbol: str):
-        # check if on partial fill, it is updated as a open position in api
-        # if it throws an api error just continue
+    def on_order_fill(self, symbol: str, event: Union[TradeUpdate, Dict, None] = None):
+        """
+        :param symbol: symbol of the filled order
+        :param event: fill or partial_fill trade update (or its data dict), without it the position is fetched from the
+                      api
+        """
+
+        # a reconciliation may take the fill in, apply_event still realises it against the book from before
+        if self.ledger.due:
+            self.reconcile()
+            if event is None:
+                return
+
+        if event is not None and self.ledger.apply_event(event):
+            return
+
+        # no event or the ledger drifted from the broker, take the broker's position for this symbol
+        self.ledger.reconcile_symbol(symbol, self._open_position(symbol))
+
+    async def on_order_fill_async(self, symbol: str, event: Union[TradeUpdate, Dict, None] = None,
+                                  executor: Executor = None):
+        """
+        on_order_fill for the event loop, the api calls go to the executor and the ledger only changes on the loop
+
+        :param symbol: symbol of the filled order
+        :param event: fill or partial_fill trade update
+        :param executor: pool of the api calls, None for the loop's default pool
+        """
+
+        loop = asyncio.get_running_loop()
+
+        if self.ledger.due:
+            self.ledger.reconcile(await loop.run_in_executor(executor, self.trade_client.get_all_positions))
+            if event is None:
+                return
+
+        if event is not None and self.ledger.apply_event(event):
+            return
+
+        self.ledger.reconcile_symbol(symbol, await loop.run_in_executor(executor, self._open_position, symbol))
+
+    def _open_position(self, symbol: str) -> Union[Position, None]:
         try:
-            new_position = self.trade_client.get_open_position(symbol_or_asset_id = symbol)
+            return self.trade_client.get_open_position(symbol_or_asset_id = symbol)
         except APIError as e:
-            pass
-        # implement a function to add position
-        pass
+            # no open position
+            return None
 
     # to remove a position
     def remove_position(self):
         pass
 
+    def exposures(self) -> Dict[str, float]:
+        """
+        Dollar exposure of every position at the latest prices, negative for shorts
+        """
+
+        if not len(self.ledger):
+            return {}
+
+        values = self.valuation.values()
+        return dict(zip(self.ledger.positions, values['market_value'].tolist()))
+
     # to calculate varience, risk etc
-    def portfolio_metrics(self):
-        pass
+    def portfolio_metrics(self, stockFrame = None, benchmark: str = 'SPY', confidence: float = 0.95,
+                          window: int = 390) -> Union[Dict[str, float], None]:
+        """
+        Risk of the current book from the bars in stockFrame.data_map, see Finance.risk for the definitions.
+        The risk engine is kept between calls, roll it forward with self.risk.update_from_frames() on every bar.
+
+        :param stockFrame: frame with the bars of the positions and the benchmark, needed on the first call
+        :param benchmark: symbol the beta is taken against
+        :param confidence: confidence of VaR and CVaR
+        :param window: bars of returns
+        :return: dict of the metrics, None without positions
+        """
+
+        exposures = self.exposures()
+        if not exposures:
+            return None
+
+        risk = self.risk
+        if risk is None or (stockFrame is not None and risk.stockFrame is not stockFrame) or \
+                (risk.benchmark, risk.confidence, risk.window) != (benchmark, confidence, window):
+            if stockFrame is None:
+                raise ValueError("stockFrame is required the first time the metrics are computed.")
+
+            self.risk = RISK(stockFrame, benchmark = benchmark, confidence = confidence, window = window)
+
+        return self.risk.metrics(exposures)
 
     # gives summary of overall portfolio, graphs n stuff can be implemented for visuals
-    def summary(self):
-        pass
+    def summary(self, stockFrame = None) -> Dict[str, float]:
+        """
+        P&L of the book at the latest prices, plus its risk if bars are available
+
+        :param stockFrame: frame with the bars, see portfolio_metrics
+        :return: dict of the pl and risk figures
+        """
+
+        summary = {'positions': len(self.ledger), **self.valuation.pnl()}
+
+        if stockFrame is not None or self.risk is not None:
+            summary.update(self.portfolio_metrics(stockFrame) or {})
+
+        return summary
 
@@ -0,0 +1,353 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import logging
+import time as true_time
+
+from alpaca.trading.models import Position
+
+from Finance.tradeDecoder import TradeUpdate
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Local book of the open positions, moved by the fills of the trade_updates stream instead of asking the api.
+
+Average cost accounting, qty is signed (negative for shorts) like the api has it:
+    adding to a position        avg_entry_price = (avg_entry_price * |qty| + price * fill) / (|qty| + fill)
+    reducing a position         avg_entry_price stays, (price - avg_entry_price) * closed qty is realised
+    flipping through zero       the rest of the fill opens the new side at the fill price
+
+Every fill event carries the position qty the broker has after the fill (position_qty), the ledger checks itself
+against it and reconciles the symbol with the broker when they disagree (missed events, fills from another session).
+A fill a reconciliation already took in is still realised, against the qty and avg entry price the book had before.
+'''
+
+POSITION_SCHEMA = {
+    'symbol': pl.Utf8,
+    'asset_type': pl.Utf8,
+    'asset_marginable': pl.Boolean,
+    'avg_entry_price': pl.Float64,
+    'qty': pl.Float64,
+    'side': pl.Utf8,
+    'market_value': pl.Float64,
+    'cost_basis': pl.Float64,
+    'unrealized_pl': pl.Float64,
+    'unrealized_plpc': pl.Float64,
+    'unrealized_intraday_pl': pl.Float64,
+    'unrealized_intraday_plpc': pl.Float64,
+    'current_price': pl.Float64,
+    'lastday_price': pl.Float64,
+    'change_today': pl.Float64,
+    'swap_rate': pl.Float64,
+    'avg_entry_swap_rate': pl.Float64,
+    'qty_available': pl.Float64,
+    'asset_id': pl.Utf8,
+    'asset_exchange': pl.Utf8,
+    'realized_pl': pl.Float64
+}
+
+# qty below this is treated as flat, fractional shares go down to 1e-9
+_EPSILON = 1e-9
+
+
+def _float(value) -> Union[float, None]:
+    return float(value) if value is not None else None
+
+
+def _value(value) -> Union[str, None]:
+    if value is None:
+        return None
+
+    return str(getattr(value, 'value', value))
+
+
+def position_row(position: Position) -> Dict:
+    """
+    Flattens a position of the api into a row of POSITION_SCHEMA, the api sends every number as a string
+    """
+
+    return {
+        'symbol': position.symbol,
+        'asset_type': _value(position.asset_class),
+        'asset_marginable': position.asset_marginable,
+        'avg_entry_price': _float(position.avg_entry_price),
+        'qty': _float(position.qty),
+        'side': _value(position.side),
+        'market_value': _float(position.market_value),
+        'cost_basis': _float(position.cost_basis),
+        'unrealized_pl': _float(position.unrealized_pl),
+        'unrealized_plpc': _float(position.unrealized_plpc),
+        'unrealized_intraday_pl': _float(position.unrealized_intraday_pl),
+        'unrealized_intraday_plpc': _float(position.unrealized_intraday_plpc),
+        'current_price': _float(position.current_price),
+        'lastday_price': _float(position.lastday_price),
+        'change_today': _float(position.change_today),
+        'swap_rate': _float(position.swap_rate),
+        'avg_entry_swap_rate': _float(position.avg_entry_swap_rate),
+        'qty_available': _float(position.qty_available),
+        'asset_id': _value(position.asset_id),
+        'asset_exchange': _value(position.exchange),
+        'realized_pl': 0.0
+    }
+
+
+class PositionLedger:
+
+    def __init__(self, reconcile_interval: float = 300.0):
+        """
+        Open positions by symbol
+
+        :param reconcile_interval: seconds after which the ledger asks for a full reconciliation with the broker
+        """
+
+        self.positions: Dict[str, Dict] = {}
+        # realised pl of the session by symbol, kept after a position is closed
+        self.realized_pl: Dict[str, float] = {}
+        # [qty, avg entry price] of the book before the last reconciliation, by symbol, moved by the fills the
+        # reconciliation took in so they are still realised
+        self._before: Dict[str, List[float]] = {}
+        self.reconcile_interval = reconcile_interval
+        self.last_reconciled = true_time.monotonic()
+
+        self.version = 0
+        self._snapshot: Union[pl.DataFrame, None] = None
+        self._snapshot_version = -1
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self.positions
+
+    def get(self, symbol: str) -> Union[Dict, None]:
+        return self.positions.get(symbol)
+
+    @property
+    def due(self) -> bool:
+        """
+        Whether a periodic reconciliation is due
+        """
+
+        return true_time.monotonic() - self.last_reconciled >= self.reconcile_interval
+
+    @staticmethod
+    def _mark(row: Dict, price: float):
+        # values which follow from qty, avg entry and the latest price
+        qty = row['qty']
+        row['current_price'] = price
+        row['market_value'] = qty * price
+        row['cost_basis'] = qty * row['avg_entry_price']
+        row['unrealized_pl'] = row['market_value'] - row['cost_basis']
+        row['unrealized_plpc'] = row['unrealized_pl'] / abs(row['cost_basis']) if row['cost_basis'] else 0.0
+
+    @staticmethod
+    def _move(current: float, avg_entry_price: float, signed: float, price: float) -> Tuple[float, float, float]:
+        """
+        :return: qty, avg entry price and realised pl of a position of current qty after a fill of signed qty
+        """
+
+        new_qty = current + signed
+        realized = 0.0
+
+        if current == 0 or (current > 0) == (signed > 0):
+            # opening or adding
+            avg_entry_price = ((avg_entry_price or 0.0) * abs(current) + price * abs(signed)) / abs(new_qty)
+
+        else:
+            # reducing, and opening the other side with what is left
+            closed = min(abs(signed), abs(current))
+            realized = (price - avg_entry_price) * closed * (1 if current > 0 else -1)
+
+            if abs(signed) > abs(current) + _EPSILON:
+                avg_entry_price = price
+
+        return new_qty, avg_entry_price, realized
+
+    def _realize(self, symbol: str, realized: float):
+        self.realized_pl[symbol] = self.realized_pl.get(symbol, 0.0) + realized
+
+    def apply_fill(self, symbol: str, side: str, qty: float, price: float, position_qty: float = None,
+                   asset_type: str = 'us_equity', asset_id: str = None) -> bool:
+        """
+        Moves the position of a symbol by one fill
+
+        :param symbol: symbol of the fill
+        :param side: buy or sell
+        :param qty: filled qty of this execution, unsigned
+        :param price: fill price
+        :param position_qty: the broker's position qty after the fill, if known
+        :param asset_type: asset class of a newly opened position
+        :param asset_id: asset id of a newly opened position
+        :return: True if the ledger agrees with position_qty (or it was not given), False on a mismatch
+        """
+
+        signed = qty if side == 'buy' else -qty
+        row = self.positions.get(symbol)
+
+        if position_qty is not None and abs((row['qty'] if row else 0.0) - position_qty) < _EPSILON:
+            # the book is already where this fill leaves it, a reconciliation after the fill took it in, its pl is
+            # realised against the book from before the reconciliation
+            before = self._before.get(symbol)
+            if before is not None:
+                before[0], before[1], realized = self._move(before[0], before[1], signed, price)
+                if realized:
+                    self._realize(symbol, realized)
+                    if row is not None:
+                        row['realized_pl'] = self.realized_pl[symbol]
+                    self.version += 1
+            return True
+
+        # the book moved on from the reconciliation
+        self._before.pop(symbol, None)
+
+        if row is None:
+            row = {name: None for name in POSITION_SCHEMA}
+            row.update({'symbol': symbol, 'asset_type': asset_type, 'asset_id': asset_id, 'qty': 0.0,
+                        'avg_entry_price': price, 'realized_pl': 0.0})
+
+        new_qty, row['avg_entry_price'], realized = self._move(row['qty'], row['avg_entry_price'], signed, price)
+
+        row['qty'] = new_qty
+        row['qty_available'] = new_qty
+        row['side'] = 'long' if new_qty > 0 else 'short'
+        self._realize(symbol, realized)
+        row['realized_pl'] = self.realized_pl[symbol]
+
+        if abs(new_qty) < _EPSILON:
+            self.positions.pop(symbol, None)
+        else:
+            self._mark(row, price)
+            self.positions[symbol] = row
+
+        self.version += 1
+
+        if position_qty is not None and abs(position_qty - new_qty) > _EPSILON:
+            log.warning(f"ledger has {new_qty} {symbol}, broker has {position_qty}")
+            return False
+
+        return True
+
+    def apply_event(self, data: Union[TradeUpdate, Dict]) -> bool:
+        """
+        Applies the data of a fill or partial_fill trade update
+
+        :param data: decoded TradeUpdate, or the data dict of the trade update with the order and the price, qty and
+                     position_qty of the execution
+        :return: see apply_fill
+        """
+
+        if isinstance(data, TradeUpdate):
+            return self.apply_fill(
+                symbol = data.symbol,
+                side = data.side,
+                qty = data.qty,
+                price = data.price,
+                position_qty = data.position_qty,
+                asset_type = data.order.get('asset_class') or 'us_equity',
+                asset_id = data.order.get('asset_id')
+            )
+
+        order = data.get('order')
+        if not isinstance(order, dict):
+            order = dict(order)
+
+        return self.apply_fill(
+            symbol = order.get('symbol'),
+            side = _value(order.get('side')),
+            qty = float(data.get('qty')),
+            price = float(data.get('price')),
+            position_qty = _float(data.get('position_qty')),
+            asset_type = _value(order.get('asset_class')) or 'us_equity',
+            asset_id = _value(order.get('asset_id'))
+        )
+
+    def reconcile(self, positions: List[Position]):
+        """
+        Replaces the book with the broker's positions, realised pl of the session is kept
+
+        :param positions: all the open positions, from get_all_positions
+        """
+
+        self._before = {symbol: [row['qty'], row['avg_entry_price']] for symbol, row in self.positions.items()}
+        self.positions = {}
+
+        for position in positions:
+            row = position_row(position)
+            row['realized_pl'] = self.realized_pl.get(row['symbol'], 0.0)
+            self.positions[row['symbol']] = row
+
+        self.last_reconciled = true_time.monotonic()
+        self.version += 1
+
+    def reconcile_symbol(self, symbol: str, position: Union[Position, None]):
+        """
+        Replaces one symbol with the broker's position
+
+        :param symbol: symbol to replace
+        :param position: the broker's position, None if it is flat
+        """
+
+        row = self.positions.pop(symbol, None)
+        self._before[symbol] = [row['qty'], row['avg_entry_price']] if row is not None else [0.0, None]
+
+        if position is not None:
+            row = position_row(position)
+            row['realized_pl'] = self.realized_pl.get(symbol, 0.0)
+            self.positions[symbol] = row
+
+        self.version += 1
+
+    def snapshot(self) -> pl.DataFrame:
+        """
+        Positions as a frame of POSITION_SCHEMA, cached until the ledger changes
+        """
+
+        if self._snapshot_version != self.version:
+            rows = list(self.positions.values())
+            self._snapshot = pl.DataFrame({name: [row[name] for row in rows] for name in POSITION_SCHEMA},
+                                          schema = POSITION_SCHEMA)
+            self._snapshot_version = self.version
+
+        return self._snapshot
+
+
+if __name__ == '__main__':
+    from Finance.stubs import trade_update_events
+
+    # the stub feed tracks the position qty per symbol like the broker, the ledger has to agree on every fill
+    events = trade_update_events(100_000, open_orders = 2_000)
+    fills = [update['data'] for update in events if update['data']['event'] in ('fill', 'partial_fill')]
+
+    ledger = PositionLedger()
+    t0 = true_time.perf_counter()
+    mismatches = sum(not ledger.apply_event(data) for data in fills)
+    seconds = true_time.perf_counter() - t0
+
+    assert not mismatches
+
+    # a reconciliation took in the sell closing the position before its fill came, the fill is still realised
+    ledger.apply_fill('RECON', 'buy', 10.0, 100.0)
+    ledger.reconcile_symbol('RECON', None)
+    assert ledger.apply_fill('RECON', 'sell', 10.0, 110.0, position_qty = 0.0)
+    assert 'RECON' not in ledger and abs(ledger.realized_pl['RECON'] - 100.0) < 1e-9
+
+    # the same when the portfolio reconciles on a fill because a reconciliation is due
+    from datetime import datetime, timezone
+    from Finance.portfolio import PORTFOLIO
+    from Finance.stubs import FakeTradingClient, _order_json
+
+    client = FakeTradingClient()
+    portfolio = PORTFOLIO(client, reconcile_interval = 0)
+    for i, (side, price, position) in enumerate([('buy', 100.0, 10.0), ('sell', 110.0, 0.0)]):
+        order = {**_order_json(i, 'X', side, 10.0, price, datetime(2024, 1, 2, 15, tzinfo = timezone.utc)),
+                 'status': 'filled', 'filled_qty': '10.0', 'filled_avg_price': str(price)}
+        message = {'stream': 'trade_updates', 'data': {'event': 'fill', 'order': order, 'price': str(price),
+                                                       'qty': '10.0', 'position_qty': str(position)}}
+        client.apply(message)
+        portfolio.on_order_fill('X', message['data'])
+    assert 'X' not in portfolio.ledger and abs(portfolio.ledger.realized_pl['X'] - 100.0) < 1e-9
+    print(f"{len(fills)} fills in {seconds:.2f} s, {len(fills) / seconds:,.0f} fills/s, {len(ledger)} positions, "
+          f"no mismatches with the broker's position qty")
+    print(ledger.snapshot().select('symbol', 'qty', 'side', 'avg_entry_price', 'cost_basis', 'realized_pl').head())
@@ -0,0 +1,310 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import polars as pl
+import asyncio
+import logging
+
+from Finance.orders import ORDERS, BASKET_SCHEMA
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+From a target allocation to the orders that reach it.
+
+Targets are a frame of symbol and weight (share of equity, negative is short) or qty. They are joined with the
+ledger's positions and the unfilled qty of the open orders in one lazy query:
+    projected   position + open buys - open sells, what is held once the open orders fill
+    target      weight * equity / price, or the qty given
+                rounded towards zero to whole lots, or to 1e-9 shares with fractional trading (longs only, the api
+                does not take fractional shorts)
+    delta       target - projected, the open orders are netted out so nothing is ordered twice
+Deltas below a lot or min_notional are dropped. A delta that takes a position through zero is split into the order
+closing it and the order opening the other side, the api does not flip a position in one order. Held symbols that
+are not in the targets are closed with liquidate = True.
+
+The orders come out as a basket (see ORDERS.submit_basket), market day orders, largest notional first. rebalance sends
+the opening legs through zero in a second basket, once the closing legs filled, the api rejects an order opening the
+other side while the position is still held.
+'''
+
+# decimals of fractional qty the api takes
+_FRACTION = 9
+
+
+class REBALANCER:
+
+    def __init__(self, orders: ORDERS, fractional: bool = False, lot_size: int = 1, min_notional: float = 1.0,
+                 liquidate: bool = True):
+        """
+        :param orders: ORDERS, its store and its portfolio's ledger give the open orders and positions
+        :param fractional: fractional shares allowed, BOT.fractional_trading
+        :param lot_size: shares per lot without fractional trading
+        :param min_notional: smallest order value sent
+        :param liquidate: close held symbols which are not in the targets
+        """
+
+        if lot_size < 1:
+            raise ValueError("lot_size must be at least 1.")
+
+        self.orders = orders
+        self.fractional = fractional
+        self.lot_size = lot_size
+        self.min_notional = min_notional
+        self.liquidate = liquidate
+
+    def _book(self) -> pl.LazyFrame:
+        """
+        :return: symbol, position, pending (signed unfilled qty of the open orders) and price of the held symbols
+        """
+
+        positions = self.orders.portfolio.ledger.snapshot().lazy().select(
+            'symbol', pl.col('qty').alias('position'), pl.col('current_price').alias('held_price')
+        )
+
+        # notional orders have no qty until they fill, they are left out
+        pending = self.orders.order_store.snapshot().lazy().filter(pl.col('qty').is_not_null()) \
+            .group_by('symbol').agg(
+            ((pl.col('qty') - pl.col('filled_qty')) * pl.when(pl.col('side') == 'buy').then(1.0).otherwise(-1.0))
+            .sum().alias('pending')
+        )
+
+        return positions.join(pending, on = 'symbol', how = 'full', coalesce = True)
+
+    def plan(self, targets: pl.DataFrame, equity: float = None, prices: pl.DataFrame = None) -> pl.DataFrame:
+        """
+        Orders taking the book to targets
+
+        :param targets: symbol and weight or qty
+        :param equity: account equity the weights are of, required with weights
+        :param prices: symbol and price, the ledger's mark by default, required for symbols not held
+        :return: basket of symbol, side, qty, type, time_in_force, plus position, pending, target, price, value of
+                 the order and leg, close and open for the two orders through zero, delta for the others
+        """
+
+        if 'symbol' not in targets.columns or ('weight' in targets.columns) == ('qty' in targets.columns):
+            raise ValueError("targets need a symbol column and one of weight and qty.")
+        if 'weight' in targets.columns and equity is None:
+            raise ValueError("equity is required with weights.")
+
+        by_weight = 'weight' in targets.columns
+        target = targets.lazy().select('symbol', pl.col('weight' if by_weight else 'qty').cast(pl.Float64)
+                                       .alias('goal'))
+
+        frame = target.join(self._book(), on = 'symbol', how = 'full' if self.liquidate else 'left',
+                            coalesce = True)
+
+        if prices is not None:
+            frame = frame.join(prices.lazy().select('symbol', pl.col('price').cast(pl.Float64)), on = 'symbol',
+                               how = 'left')
+            price = pl.coalesce('price', 'held_price')
+        else:
+            price = pl.col('held_price')
+
+        frame = frame.with_columns(
+            price.alias('price'),
+            pl.col('goal').fill_null(0.0),
+            pl.col('position').fill_null(0.0),
+            pl.col('pending').fill_null(0.0)
+        )
+
+        # a zero weight is a zero qty whatever the price
+        raw = pl.when(pl.col('goal') == 0).then(0.0).otherwise(pl.col('goal') * equity / pl.col('price')) \
+            if by_weight else pl.col('goal')
+
+        # towards zero so the allocation is never overshot
+        if self.fractional:
+            target_qty = pl.when(raw >= 0).then((raw * 10 ** _FRACTION).floor() / 10 ** _FRACTION) \
+                .otherwise((raw / self.lot_size).ceil() * self.lot_size)
+        else:
+            target_qty = pl.when(raw >= 0).then((raw / self.lot_size).floor() * self.lot_size) \
+                .otherwise((raw / self.lot_size).ceil() * self.lot_size)
+
+        frame = frame.with_columns(target_qty.alias('target')).with_columns(
+            (pl.col('position') + pl.col('pending')).alias('projected')
+        )
+
+        # without a price a weight has no target, and no order can be valued
+        missing = frame.filter(pl.col('price').is_null() &
+                               (pl.col('target').is_null() | (pl.col('target') != pl.col('projected')))) \
+            .select('symbol').collect()
+        if missing.height:
+            raise ValueError(f"no price for {missing.get_column('symbol').to_list()[:10]}, pass prices.")
+
+        frame = frame.with_columns((pl.col('target') - pl.col('projected')).alias('delta'))
+
+        # through zero, the close and then the open
+        crossing = (pl.col('projected') * pl.col('target')) < 0
+        legs = pl.concat([
+            frame.filter(~crossing).with_columns(pl.col('delta').alias('order'), pl.lit('delta').alias('leg')),
+            frame.filter(crossing).with_columns((-pl.col('projected')).alias('order'), pl.lit('close').alias('leg')),
+            frame.filter(crossing).with_columns(pl.col('target').alias('order'), pl.lit('open').alias('leg'))
+        ])
+
+        smallest = 10 ** -_FRACTION if self.fractional else self.lot_size
+        return legs.filter(
+            (pl.col('order').abs() >= smallest - 1e-12) & (pl.col('order').abs() * pl.col('price') >= self.min_notional)
+        ).with_columns(
+            pl.when(pl.col('order') > 0).then(pl.lit('buy')).otherwise(pl.lit('sell')).alias('side'),
+            pl.col('order').abs().round(_FRACTION).alias('qty'),
+            pl.lit('market').alias('type'),
+            pl.lit('day').alias('time_in_force'),
+            (pl.col('order').abs() * pl.col('price')).alias('value')
+        ).sort('value', descending = True).select(
+            'symbol', 'side', 'qty', 'type', 'time_in_force', 'position', 'pending', 'target', 'price', 'value', 'leg'
+        ).collect()
+
+    async def rebalance(self, targets: pl.DataFrame, equity: float = None, prices: pl.DataFrame = None,
+                        max_in_flight: int = 16, timeout: float = 60.0, poll: float = 0.1) -> pl.DataFrame:
+        """
+        Plans and submits the orders, see plan and ORDERS.submit_basket. The legs opening a position through zero
+        are sent once the legs closing it are filled
+
+        :param timeout: seconds the closing legs have to fill, the opening legs of positions still held are not sent
+        :param poll: seconds between two looks at the closing legs
+        :return: the result frames of submit_basket, the closing basket and then the opening one, with the leg of
+                 every row, the opening legs not sent have status skipped
+        """
+
+        basket = self.plan(targets, equity = equity, prices = prices)
+        if basket.is_empty():
+            log.info("book is at its targets, nothing to send")
+
+        columns = [name for name in BASKET_SCHEMA if name in basket.columns]
+        first = basket.filter(pl.col('leg') != 'open')
+        second = basket.filter(pl.col('leg') == 'open')
+
+        result = (await self.orders.submit_basket(first.select(columns), max_in_flight = max_in_flight)) \
+            .with_columns(first.get_column('leg'))
+        if second.is_empty():
+            return result
+
+        # the closing legs leave the store once done
+        store = self.orders.order_store
+        closes = result.filter((pl.col('leg') == 'close') & pl.col('id').is_not_null()).get_column('id').to_list()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while any(order_id in store for order_id in closes) and loop.time() < deadline:
+            await asyncio.sleep(poll)
+
+        ledger = self.orders.portfolio.ledger
+        flat = pl.Series([ledger.get(symbol) is None or not ledger.get(symbol)['qty']
+                          for symbol in second.get_column('symbol')], dtype = pl.Boolean)
+        ready, held = second.filter(flat), second.filter(~flat)
+        if held.height:
+            log.warning(f"{held.height} positions not closed in {timeout} s, the other side is not opened for "
+                        f"{held.get_column('symbol').to_list()[:10]}")
+
+        frames = [result, (await self.orders.submit_basket(ready.select(columns), max_in_flight = max_in_flight))
+                  .with_columns(ready.get_column('leg'))]
+        if held.height:
+            frames.append(ORDERS.basket_frame(held.select(columns)).drop('error', 'client_order_id').with_columns(
+                pl.lit(None, pl.Utf8).alias('client_order_id'), pl.lit(None, pl.Utf8).alias('id'),
+                pl.lit('skipped').alias('status'), pl.lit('position not closed').alias('error'),
+                pl.lit(0, pl.Int64).alias('attempts'), held.get_column('leg')
+            ))
+
+        return pl.concat(frames, how = 'vertical')
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import time as true_time
+    from datetime import datetime, timezone
+
+    from Finance.orderStore import order_row
+    from Finance.positionLedger import PositionLedger
+    from Finance.stubs import _order_json
+
+    # 5000 symbols, 4000 held, 2000 open orders, new weights for 4500 of them
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(0)
+    symbols = [f"SYM{i}" for i in range(n_symbols)]
+    prices = {symbol: round(rng.uniform(5, 500), 2) for symbol in symbols}
+    equity = 10_000_000.0
+
+    class Book:
+        # the parts of ORDERS the rebalancer reads
+        def __init__(self):
+            from Finance.orderStore import OrderStore
+            self.order_store = OrderStore()
+            self.portfolio = type('PORTFOLIO', (), {})()
+            self.portfolio.ledger = PositionLedger()
+
+    book = Book()
+    for symbol in symbols[:int(n_symbols * 0.8)]:
+        book.portfolio.ledger.apply_fill(symbol, rng.choice(['buy', 'sell']), float(rng.randint(1, 400)),
+                                         prices[symbol])
+    now = datetime(2024, 1, 2, 15, tzinfo = timezone.utc)
+    for i in range(int(n_symbols * 0.4)):
+        symbol = rng.choice(symbols)
+        book.order_store.upsert(order_row(_order_json(i, symbol, rng.choice(['buy', 'sell']),
+                                                      float(rng.randint(1, 50)), prices[symbol], now)))
+
+    weights = pl.DataFrame({'symbol': symbols[:int(n_symbols * 0.9)]}).with_columns(
+        pl.Series('weight', [rng.uniform(-0.3, 1.0) for _ in range(int(n_symbols * 0.9))])
+    ).with_columns(pl.col('weight') / pl.col('weight').abs().sum())
+    price_frame = pl.DataFrame({'symbol': list(prices), 'price': list(prices.values())})
+
+    for fractional in (False, True):
+        rebalancer = REBALANCER(book, fractional = fractional)
+
+        times = []
+        for _ in range(5):
+            t0 = true_time.perf_counter()
+            plan = rebalancer.plan(weights, equity = equity, prices = price_frame)
+            times.append(true_time.perf_counter() - t0)
+
+        print(f"fractional {fractional!s:>5}: {n_symbols} symbols planned in {min(times) * 1e3:.1f} ms "
+              f"(first {times[0] * 1e3:.1f} ms), {plan.height} orders, "
+              f"{plan.filter(pl.col('side') == 'buy').height} buys")
+
+        # the orders take every symbol to its target, none is ordered twice except the two legs through zero
+        after = plan.group_by('symbol').agg(
+            pl.when(pl.col('side') == 'buy').then(pl.col('qty')).otherwise(-pl.col('qty')).sum().alias('ordered'),
+            pl.col('position').first(), pl.col('pending').first(), pl.col('target').first(), pl.len().alias('legs')
+        )
+        assert (after.get_column('legs') <= 2).all()
+        assert ((after.get_column('position') + after.get_column('pending') + after.get_column('ordered')
+                 - after.get_column('target')).abs() < 1e-6).all()
+        if not fractional:
+            assert (plan.get_column('qty') == plan.get_column('qty').round(0)).all()
+
+    # once the orders fill the book is at its targets and nothing more is planned
+    for row in plan.iter_rows(named = True):
+        book.portfolio.ledger.apply_fill(row['symbol'], row['side'], row['qty'], row['price'])
+    for order_id in list(book.order_store.orders):
+        row = book.order_store.remove(order_id)
+        book.portfolio.ledger.apply_fill(row['symbol'], row['side'], row['qty'], row['limit_price'])
+    again = rebalancer.plan(weights, equity = equity, prices = price_frame)
+    print(f"after the fills: {again.height} orders")
+    assert again.is_empty()
+
+    # a weight of a symbol without a price is an error, not an order left out
+    try:
+        rebalancer.plan(pl.DataFrame({'symbol': ['NOPRICE'], 'weight': [0.1]}), equity = equity)
+        raise AssertionError("planned without a price")
+    except ValueError as e:
+        assert 'NOPRICE' in str(e)
+
+    # through zero, the sell opening the short goes once the sell closing the long filled
+    import asyncio
+    from Finance.portfolio import PORTFOLIO
+    from Finance.stubs import SimClock, SimBroker, InlineExecutor
+
+    async def flip() -> pl.DataFrame:
+        broker = SimBroker(SimClock(now), price = lambda symbol: 100.0)
+        orders = ORDERS(broker, PORTFOLIO(broker))
+        orders.executor = InlineExecutor()
+        broker.on_update = orders._update_handler
+        await orders.submit(orders.order_request('AAPL', 'buy', 10))
+        await asyncio.sleep(0.01)
+
+        result = await REBALANCER(orders).rebalance(pl.DataFrame({'symbol': ['AAPL'], 'qty': [-5.0]}))
+        assert [order['qty'] for order in broker.orders.values()] == ['10.0', '10.0', '5.0']
+        assert orders.portfolio.ledger.get('AAPL')['qty'] == -5.0
+        return result
+
+    result = asyncio.run(flip())
+    print(f"through zero: {result.select('side', 'qty', 'leg', 'status').rows()}")
@@ -0,0 +1,399 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import math
+import numpy as np
+import polars as pl
+import logging
+from collections import deque
+from statistics import NormalDist
+
+from Finance.stockData import STOCKFRAME
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Risk of the book from the bar returns in STOCKFRAME.data_map.
+
+Returns are simple close to close returns of the bars, one column per symbol aligned on the bar timestamps. A symbol
+without a bar at a timestamp carries its last close forward, ie a return of 0, and rows before a symbol's first bar
+count as 0 as well.
+
+With w the dollar exposures (market values) of the positions, R the T x N returns of the window and S their covariance
+    portfolio variance          w' S w (in dollars squared), also reported per dollar of gross exposure
+    parametric VaR / CVaR       normal, VaR = -(mu + z sigma), CVaR = sigma phi(z) / (1 - c) - mu, z = N^-1(1 - c)
+    historical VaR / CVaR       from the pl series R w, the (1 - c) quantile and the mean of the tail beyond it
+    beta                        cov(R w, r_spy) / var(r_spy), per asset betas come from the same matrix product,
+                                nan while the benchmark has no bars, the other figures do not need it
+    max drawdown                of the compounded portfolio returns over the window
+Losses are reported as positive numbers.
+
+The incremental mode keeps the window mean and covariance with Welford updates, so a new return row costs O(N^2)
+instead of the O(T N^2) of recomputing the covariance.
+'''
+
+
+class IncrementalCovariance:
+
+    def __init__(self, n_assets: int, window: int):
+        """
+        Mean and covariance over the last window rows, every update adds the newest row and drops the oldest
+        (Welford's update and its inverse). The sums are rebuilt from the window every window updates so rounding
+        does not drift.
+
+        :param n_assets: columns of the rows
+        :param window: rows in the window
+        """
+
+        self.n_assets = n_assets
+        self.window = window
+        self.rows: deque = deque()
+        self.mean = np.zeros(n_assets)
+        # sum of the outer products of the deviations
+        self.m2 = np.zeros((n_assets, n_assets))
+        self._since_exact = 0
+
+    @property
+    def n(self) -> int:
+        return len(self.rows)
+
+    def fit(self, rows: np.ndarray):
+        """
+        :param rows: T x N returns, only the last window rows are kept
+        """
+
+        rows = np.asarray(rows, dtype = np.float64)[-self.window:]
+        self.rows = deque(rows)
+        self._rebuild()
+
+    def _rebuild(self):
+        if not self.rows:
+            self.mean = np.zeros(self.n_assets)
+            self.m2 = np.zeros((self.n_assets, self.n_assets))
+        else:
+            matrix = np.array(self.rows)
+            self.mean = matrix.mean(axis = 0)
+            centred = matrix - self.mean
+            self.m2 = centred.T @ centred
+
+        self._since_exact = 0
+
+    def update(self, row: np.ndarray):
+        """
+        :param row: returns of the newest bar, N values
+        """
+
+        row = np.asarray(row, dtype = np.float64)
+
+        if len(self.rows) == self.window:
+            old = self.rows.popleft()
+            n = len(self.rows)
+            if n:
+                delta = old - self.mean
+                self.mean -= delta / n
+                self.m2 -= np.outer(delta, old - self.mean)
+            else:
+                self.mean[:] = 0
+                self.m2[:] = 0
+
+        self.rows.append(row)
+        n = len(self.rows)
+        delta = row - self.mean
+        self.mean += delta / n
+        self.m2 += np.outer(delta, row - self.mean)
+
+        self._since_exact += 1
+        if self._since_exact >= self.window:
+            self._rebuild()
+
+    def covariance(self) -> np.ndarray:
+        if self.n < 2:
+            return np.zeros((self.n_assets, self.n_assets))
+
+        return self.m2 / (self.n - 1)
+
+    def matrix(self) -> np.ndarray:
+        return np.array(self.rows) if self.rows else np.zeros((0, self.n_assets))
+
+
+class RISK:
+
+    def __init__(self, stockFrame: STOCKFRAME, benchmark: str = 'SPY', confidence: float = 0.95, window: int = 390):
+        """
+        :param stockFrame: frame holding the bars of the positions and the benchmark
+        :param benchmark: symbol the betas are taken against
+        :param confidence: confidence of VaR and CVaR
+        :param window: bars of returns the metrics are computed over, 390 is a day of minute bars
+        """
+
+        if not 0 < confidence < 1:
+            raise ValueError("confidence must be between 0 and 1.")
+
+        self.stockFrame = stockFrame
+        self.benchmark = benchmark
+        self.confidence = confidence
+        self.window = window
+
+        self.symbols: List[str] = []
+        self._index: Dict[str, int] = {}
+        self.cov: Union[IncrementalCovariance, None] = None
+
+        # close and timestamp of the last bar taken per symbol, for the incremental returns
+        self._last_close: Union[np.ndarray, None] = None
+        self._last_timestamp = None
+
+    ############################################ returns #########################################################
+    def returns(self, symbols: List[str]) -> Tuple[pl.Series, np.ndarray]:
+        """
+        Aligned close to close returns of the symbols
+
+        :param symbols: symbols with bars in data_map
+        :return: timestamps and the T x N returns
+        """
+
+        frames = []
+        for symbol in symbols:
+            df = self.stockFrame.data_map.get(symbol)
+            if df is None or df.is_empty():
+                raise ValueError(f"no bars for {symbol} in data_map, fetch them first.")
+
+            frames.append(df.select('timestamp', 'close').tail(self.window + 1).with_columns(pl.lit(symbol).alias('symbol')))
+
+        wide = (pl.concat(frames, how = 'vertical')
+                .pivot(on = 'symbol', index = 'timestamp', values = 'close')
+                .sort('timestamp')
+                .tail(self.window + 1))
+
+        closes = wide.select(pl.col(symbols).forward_fill())
+        returns = closes.select(pl.all().pct_change().fill_null(0.0)).slice(1)
+
+        self._last_close = closes.tail(1).to_numpy()[0].astype(np.float64)
+        self._last_timestamp = wide.get_column('timestamp')[-1]
+
+        return wide.get_column('timestamp').slice(1), returns.to_numpy().astype(np.float64)
+
+    def _has_bars(self, symbol: str) -> bool:
+        df = self.stockFrame.data_map.get(symbol)
+        return df is not None and not df.is_empty()
+
+    def fit(self, symbols: List[str]):
+        """
+        Full computation of the window for the symbols, the benchmark is added if it has bars
+
+        :param symbols: symbols of the book
+        """
+
+        benchmark = [self.benchmark] if self._has_bars(self.benchmark) else []
+        if not benchmark:
+            log.warning(f"no bars for the benchmark {self.benchmark}, betas are nan")
+
+        symbols = list(dict.fromkeys(list(symbols) + benchmark))
+        self.symbols = symbols
+        self._index = {symbol: i for i, symbol in enumerate(symbols)}
+
+        _, matrix = self.returns(symbols)
+        self.cov = IncrementalCovariance(len(symbols), self.window)
+        self.cov.fit(matrix)
+
+    def update(self, row: np.ndarray):
+        """
+        Adds one row of returns, in the order of self.symbols
+        """
+
+        if self.cov is None:
+            raise ValueError("fit the risk engine before updating it.")
+
+        self.cov.update(row)
+
+    def update_from_frames(self) -> bool:
+        """
+        Takes the newest bar of every symbol from data_map as the next return row, symbols without a new bar count
+        a return of 0. Meant to be called once per bar, eg every minute.
+
+        :return: True if a row was added
+        """
+
+        if self.cov is None:
+            raise ValueError("fit the risk engine before updating it.")
+
+        closes = self._last_close.copy()
+        newest = self._last_timestamp
+
+        for symbol, i in self._index.items():
+            df = self.stockFrame.data_map.get(symbol)
+            if df is None or df.is_empty():
+                continue
+
+            timestamp = df.get_column('timestamp')[-1]
+            if timestamp > self._last_timestamp:
+                closes[i] = df.get_column('close')[-1]
+                newest = max(newest, timestamp)
+
+        if newest == self._last_timestamp:
+            return False
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            row = np.where(self._last_close > 0, closes / self._last_close - 1, 0.0)
+
+        self.cov.update(np.nan_to_num(row))
+        self._last_close = closes
+        self._last_timestamp = newest
+
+        return True
+
+    ############################################ metrics #########################################################
+    def _weights(self, exposures: Dict[str, float]) -> np.ndarray:
+        weights = np.zeros(len(self.symbols))
+        for symbol, value in exposures.items():
+            weights[self._index[symbol]] = value
+
+        return weights
+
+    def metrics(self, exposures: Dict[str, float]) -> Dict[str, float]:
+        """
+        Risk of a book
+
+        :param exposures: Dict[symbol: market value], negative for shorts
+        :return: dict of the metrics, money figures are in dollars per bar of the window
+        """
+
+        missing = [symbol for symbol in exposures if symbol not in self._index]
+        if self.benchmark not in self._index and self._has_bars(self.benchmark):
+            missing.append(self.benchmark)
+        if self.cov is None or missing:
+            log.info(f"fitting risk engine for {len(exposures)} positions")
+            self.fit(list(exposures))
+
+        w = self._weights(exposures)
+        gross = float(np.abs(w).sum())
+        cov = self.cov.covariance()
+        matrix = self.cov.matrix()
+
+        # parametric
+        mu = float(self.cov.mean @ w)
+        variance = float(w @ cov @ w)
+        sigma = math.sqrt(max(variance, 0.0))
+        normal = NormalDist()
+        z = normal.inv_cdf(1 - self.confidence)
+        parametric_var = -(mu + z * sigma)
+        parametric_cvar = sigma * normal.pdf(z) / (1 - self.confidence) - mu
+
+        # historical, from the pl of the book over the window
+        pl_series = matrix @ w
+        if len(pl_series):
+            cutoff = float(np.quantile(pl_series, 1 - self.confidence))
+            historical_var = -cutoff
+            historical_cvar = -float(pl_series[pl_series <= cutoff].mean())
+        else:
+            historical_var = historical_cvar = float('nan')
+
+        # beta of the book and of every asset to the benchmark
+        b = self._index.get(self.benchmark)
+        benchmark_var = cov[b, b] if b is not None else 0.0
+        beta = float(cov[b] @ w / benchmark_var / gross) if benchmark_var > 0 and gross else float('nan')
+
+        # drawdown of the book as a fraction of gross exposure
+        max_drawdown = float('nan')
+        if len(pl_series) and gross:
+            equity = np.cumprod(1 + pl_series / gross)
+            max_drawdown = float(-(equity / np.maximum.accumulate(equity) - 1).min())
+
+        return {
+            'gross_exposure': gross,
+            'net_exposure': float(w.sum()),
+            'variance': variance,
+            'volatility': sigma,
+            'volatility_pct': sigma / gross if gross else float('nan'),
+            'parametric_var': parametric_var,
+            'parametric_cvar': parametric_cvar,
+            'historical_var': historical_var,
+            'historical_cvar': historical_cvar,
+            'beta': beta,
+            'max_drawdown': max_drawdown,
+            'observations': self.cov.n
+        }
+
+    def betas(self) -> Dict[str, float]:
+        """
+        Beta of every symbol to the benchmark over the window
+        """
+
+        cov = self.cov.covariance()
+        b = self._index.get(self.benchmark)
+        if b is None or cov[b, b] <= 0:
+            return {symbol: float('nan') for symbol in self.symbols}
+
+        return dict(zip(self.symbols, (cov[:, b] / cov[b, b]).tolist()))
+
+
+if __name__ == '__main__':
+    import sys
+    import time as true_time
+    from datetime import datetime, timedelta
+
+    from Finance.columnar import BAR_SCHEMA
+
+    n_assets = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    window = 390
+
+    # random walks with a common market factor, two days of minute bars
+    rng = np.random.default_rng(0)
+    steps = 2 * window
+    market = rng.normal(0, 1e-3, steps)
+    symbols = [f"SYM{i}" for i in range(n_assets)] + ['SPY']
+    loadings = np.append(rng.uniform(0.5, 1.5, n_assets), 1.0)
+    noise = rng.normal(0, 1e-3, (steps, n_assets + 1))
+    noise[:, -1] = 0
+    closes = 100 * np.cumprod(1 + market[:, None] * loadings + noise, axis = 0)
+    timestamps = [datetime(2024, 1, 2, 14, 30) + timedelta(minutes = i) for i in range(steps)]
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    for j, symbol in enumerate(symbols):
+        frame.data_map[symbol] = pl.DataFrame({'timestamp': timestamps, 'close': closes[:, j]}).with_columns(
+            [pl.col('close').alias(c) for c in ['open', 'high', 'low']] +
+            [pl.lit(1.0).alias(c) for c in ['volume', 'trade_count', 'vwap']]
+        ).select(list(BAR_SCHEMA)).cast(BAR_SCHEMA)
+
+    exposures = {symbol: float(v) for symbol, v in zip(symbols[:-1], rng.uniform(-10_000, 10_000, n_assets))}
+
+    # fit on the first day, then roll the second day in one bar at a time
+    first_day = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    for symbol in symbols:
+        first_day.data_map[symbol] = frame.data_map[symbol].head(window + 1)
+
+    risk = RISK(first_day, window = window)
+    t0 = true_time.perf_counter()
+    risk.fit(list(exposures))
+    fit_seconds = true_time.perf_counter() - t0
+
+    t0 = true_time.perf_counter()
+    for i in range(window + 1, steps):
+        for symbol in symbols:
+            first_day.data_map[symbol] = frame.data_map[symbol].head(i + 1)
+        risk.update_from_frames()
+    roll_seconds = (true_time.perf_counter() - t0) / (steps - window - 1)
+
+    t0 = true_time.perf_counter()
+    metrics = risk.metrics(exposures)
+    metrics_seconds = true_time.perf_counter() - t0
+
+    # the rolled covariance matches a full recomputation of the same window
+    full = RISK(frame, window = window)
+    full.fit(list(exposures))
+    assert np.allclose(risk.cov.covariance(), full.cov.covariance(), rtol = 1e-8, atol = 1e-14)
+    assert np.allclose(full.cov.covariance(), np.cov(full.cov.matrix(), rowvar = False), rtol = 1e-10, atol = 1e-16)
+
+    # without benchmark bars only the beta is missing
+    no_benchmark = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    for symbol in symbols[:-1]:
+        no_benchmark.data_map[symbol] = frame.data_map[symbol]
+    partial = RISK(no_benchmark, window = window).metrics(exposures)
+    assert math.isnan(partial['beta'])
+    assert all(math.isclose(partial[key], full.metrics(exposures)[key], rel_tol = 1e-9)
+               for key in ('parametric_var', 'historical_var', 'historical_cvar', 'max_drawdown'))
+
+    print(f"{n_assets} assets, {window} bar window")
+    print(f"full fit {fit_seconds * 1e3:.0f} ms, incremental bar {roll_seconds * 1e3:.1f} ms "
+          f"(frame lookups included), metrics {metrics_seconds * 1e3:.1f} ms")
+    for key, value in metrics.items():
+        print(f"    {key:<16} {value:,.4f}")
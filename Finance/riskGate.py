@@ -0,0 +1,346 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import logging
+import time as true_time
+import uuid
+from collections import deque
+
+from alpaca.trading.requests import OrderRequest
+
+from Finance.orderStore import OrderStore, _value
+from Finance.positionLedger import PositionLedger
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Pre-trade checks of an order against the local state, no api call.
+
+Every check reads running numbers the order store and the ledger keep up to date with every trade update (the open
+orders and unfilled qty / notional per symbol, the position qty), so it costs a few dict lookups:
+    max_position            |position + unfilled orders on the same side + order| in shares, per symbol
+    max_notional            per symbol, the same worst case position at the order's price
+                            for the account, the unfilled notional of all open orders plus the order
+    max_open_orders         open orders of the symbol / of the account
+    max_orders_per_second   orders passed in the last second, of the symbol / of the account
+    buying_power            unfilled buy notional plus a buy order, from BOT.account_details
+Symbol limits are defaults for every symbol, set_symbol_limits overrides them for one. None is no limit.
+
+An order which passes is counted as in flight under its client order id, in the open orders, the unfilled qty and the
+notionals, until it is in the store: the caller releases it once the submit returned or failed, and ORDERS once the
+first trade update of the order came in. Concurrent submits see each other that way.
+
+A rejected order raises RiskRejected before anything is sent, check gives the reason without raising.
+'''
+
+SYMBOL_LIMITS = ('max_position', 'max_notional', 'max_open_orders', 'max_orders_per_second')
+ACCOUNT_LIMITS = ('max_notional', 'max_open_orders', 'max_orders_per_second')
+
+
+class RiskRejected(ValueError):
+
+    def __init__(self, symbol: str, reason: str):
+        """
+        :param symbol: symbol of the rejected order
+        :param reason: limit that was hit
+        """
+
+        super().__init__(f"order for {symbol} rejected: {reason}")
+        self.symbol = symbol
+        self.reason = reason
+
+
+def _limits(names: Tuple[str, ...], limits: Union[Dict, None]) -> Dict[str, float]:
+    limits = dict(limits or {})
+    unknown = set(limits) - set(names)
+    if unknown:
+        raise ValueError(f"unknown limits {sorted(unknown)}, limits are {names}.")
+
+    return {name: limits.get(name) for name in names}
+
+
+class RiskGate:
+
+    def __init__(self, store: OrderStore, ledger: PositionLedger, limits: Dict[str, float] = None,
+                 symbol_limits: Dict[str, float] = None, buying_power: float = None, price: Callable = None):
+        """
+        :param store: order store of ORDERS
+        :param ledger: position ledger of PORTFOLIO
+        :param limits: account limits, see ACCOUNT_LIMITS
+        :param symbol_limits: limits of every symbol, see SYMBOL_LIMITS
+        :param buying_power: buying power of the account, None does not check it
+        :param price: returns the latest price of a symbol, for market orders, the ledger's mark by default
+        """
+
+        self.store = store
+        self.ledger = ledger
+        self.limits = _limits(ACCOUNT_LIMITS, limits)
+        self.symbol_limits = _limits(SYMBOL_LIMITS, symbol_limits)
+        self.buying_power = buying_power
+        self._price = price
+
+        # Dict[symbol: limits], only symbols with their own limits
+        self._overrides: Dict[str, Dict[str, float]] = {}
+
+        # orders passed and not in the store yet, Dict[client_order_id: (symbol, buy, qty, notional)]
+        self.in_flight: Dict[str, Tuple[str, bool, float, float]] = {}
+        # [orders, buy qty, sell qty] in flight by symbol, and the notionals in flight over all symbols
+        self._flight: Dict[str, List[float]] = {}
+        self._flight_buy_notional = 0.0
+        self._flight_sell_notional = 0.0
+
+        # monotonic times of the orders passed in the last second
+        self._sent: deque = deque()
+        self._sent_by_symbol: Dict[str, deque] = {}
+
+        self.checks = 0
+        self.rejections: Dict[str, int] = {}
+
+    def set_symbol_limits(self, symbol: str, **limits):
+        """
+        Overrides limits of one symbol, the others stay the defaults
+        """
+
+        self._overrides[symbol] = {**self.symbol_limits, **_limits(SYMBOL_LIMITS, limits)}
+
+    def set_buying_power(self, buying_power: float):
+        """
+        :param buying_power: buying power of the account, eg float(BOT.account_details.buying_power)
+        """
+
+        self.buying_power = buying_power
+
+    def price(self, symbol: str) -> Union[float, None]:
+        if self._price is not None:
+            price = self._price(symbol)
+            if price is not None:
+                return price
+
+        row = self.ledger.get(symbol)
+        return row['current_price'] if row is not None else None
+
+    @staticmethod
+    def _rate(window: deque, now: float) -> int:
+        while window and window[0] <= now - 1.0:
+            window.popleft()
+
+        return len(window)
+
+    def _reserve(self, client_order_id: str, symbol: str, buy: bool, qty: float, notional: float):
+        self.release(client_order_id)
+
+        self.in_flight[client_order_id] = (symbol, buy, qty, notional)
+        flight = self._flight.setdefault(symbol, [0, 0.0, 0.0])
+        flight[0] += 1
+        if buy:
+            flight[1] += qty
+            self._flight_buy_notional += notional
+        else:
+            flight[2] += qty
+            self._flight_sell_notional += notional
+
+    def release(self, client_order_id: str) -> bool:
+        """
+        Stops counting an order as in flight, once its submit returned or failed, or its first trade update is in
+
+        :param client_order_id: client order id the order was checked with
+        :return: whether the order was in flight
+        """
+
+        held = self.in_flight.pop(client_order_id, None)
+        if held is None:
+            return False
+
+        symbol, buy, qty, notional = held
+        flight = self._flight[symbol]
+        flight[0] -= 1
+        if buy:
+            flight[1] -= qty
+            self._flight_buy_notional -= notional
+        else:
+            flight[2] -= qty
+            self._flight_sell_notional -= notional
+
+        # no rounding left behind
+        if not flight[0]:
+            del self._flight[symbol]
+        if not self.in_flight:
+            self._flight_buy_notional = self._flight_sell_notional = 0.0
+
+        return True
+
+    def _reject(self, reason: str) -> str:
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+        return reason
+
+    def check(self, symbol: str, side: str, qty: float = None, notional: float = None,
+              price: float = None, client_order_id: str = None) -> Union[str, None]:
+        """
+        Checks an order and counts it towards the rates if it passes
+
+        :param symbol: symbol of the order
+        :param side: buy or sell
+        :param qty: qty of the order, or
+        :param notional: notional of the order
+        :param price: limit or stop price, None prices a market order at the latest price
+        :param client_order_id: the order is counted as in flight under it if it passes, until release
+        :return: None if the order passes, the limit it hits otherwise
+        """
+
+        self.checks += 1
+        limits = self._overrides.get(symbol, self.symbol_limits)
+        account = self.limits
+        now = true_time.monotonic()
+        flight = self._flight.get(symbol)
+
+        # rates and counts
+        symbol_window = self._sent_by_symbol.get(symbol)
+        if limits['max_orders_per_second'] is not None and symbol_window is not None and \
+                self._rate(symbol_window, now) >= limits['max_orders_per_second']:
+            return self._reject('symbol max_orders_per_second')
+        if account['max_orders_per_second'] is not None and \
+                self._rate(self._sent, now) >= account['max_orders_per_second']:
+            return self._reject('account max_orders_per_second')
+
+        if limits['max_open_orders'] is not None and \
+                len(self.store.by_symbol.get(symbol, ())) + (flight[0] if flight else 0) >= limits['max_open_orders']:
+            return self._reject('symbol max_open_orders')
+        if account['max_open_orders'] is not None and \
+                len(self.store) + len(self.in_flight) >= account['max_open_orders']:
+            return self._reject('account max_open_orders')
+
+        # size, without a price the qty of a notional order and the notional of a qty order are not known
+        buy = side == 'buy'
+        if price is None:
+            price = self.price(symbol)
+        if price:
+            if qty is None:
+                qty = notional / price
+            if notional is None:
+                notional = qty * price
+        elif limits['max_notional'] is not None or (qty is None and limits['max_position'] is not None) or \
+                (notional is None and (account['max_notional'] is not None or
+                                       (buy and self.buying_power is not None))):
+            return self._reject('no price')
+
+        if limits['max_position'] is not None or limits['max_notional'] is not None:
+            pending = self.store.pending.get(symbol)
+            row = self.ledger.get(symbol)
+            position = row['qty'] if row is not None else 0.0
+
+            # worst case, every open order and order in flight on the same side fills
+            if buy:
+                worst = position + (pending[0] if pending else 0.0) + (flight[1] if flight else 0.0) + qty
+            else:
+                worst = position - (pending[1] if pending else 0.0) - (flight[2] if flight else 0.0) - qty
+
+            if limits['max_position'] is not None and abs(worst) > limits['max_position']:
+                return self._reject('symbol max_position')
+            if limits['max_notional'] is not None and abs(worst) * price > limits['max_notional']:
+                return self._reject('symbol max_notional')
+        if account['max_notional'] is not None and \
+                self.store.pending_buy_notional + self.store.pending_sell_notional + self._flight_buy_notional + \
+                self._flight_sell_notional + notional > account['max_notional']:
+            return self._reject('account max_notional')
+        if buy and self.buying_power is not None and \
+                self.store.pending_buy_notional + self._flight_buy_notional + notional > self.buying_power:
+            return self._reject('buying_power')
+
+        # passed, counts towards the rates
+        self._sent.append(now)
+        if symbol_window is None:
+            symbol_window = self._sent_by_symbol[symbol] = deque()
+        symbol_window.append(now)
+
+        if client_order_id is not None:
+            self._reserve(client_order_id, symbol, buy, qty or 0.0, notional or 0.0)
+
+        return None
+
+    def enforce(self, request: OrderRequest):
+        """
+        Checks an order request of ORDERS.order_request, a request which passes is in flight until release of its
+        client order id, one is set if the request has none
+
+        :raises RiskRejected: if the request hits a limit
+        """
+
+        if request.client_order_id is None:
+            request.client_order_id = str(uuid.uuid4())
+
+        price = getattr(request, 'limit_price', None) or getattr(request, 'stop_price', None)
+        reason = self.check(request.symbol, _value(request.side), qty = request.qty, notional = request.notional,
+                            price = price, client_order_id = request.client_order_id)
+
+        if reason is not None:
+            log.warning(f"order for {request.symbol} rejected: {reason}")
+            raise RiskRejected(request.symbol, reason)
+
+
+if __name__ == '__main__':
+    import random
+
+    from Finance.orderStore import order_row
+    from Finance.stubs import _order_json
+    from datetime import datetime, timezone
+
+    # a burst of 10k limit orders over 500 symbols, every order that passes goes into the store so the counters the
+    # next checks read move like they would live, the timings include the upserts
+    symbols = [f"SYM{i}" for i in range(500)]
+    rng = random.Random(0)
+    now = datetime(2024, 1, 2, 15, tzinfo = timezone.utc)
+    orders = [(rng.choice(symbols), rng.choice(('buy', 'sell')), float(rng.randint(1, 100)),
+               round(rng.uniform(10, 500), 2)) for _ in range(10_000)]
+    rows = [order_row(_order_json(i, symbol, side, qty, price, now)) for i, (symbol, side, qty, price) in
+            enumerate(orders)]
+
+    def burst(label: str, **settings) -> RiskGate:
+        store = OrderStore()
+        ledger = PositionLedger()
+        for symbol in symbols[:100]:
+            ledger.apply_fill(symbol, 'buy', 200.0, 100.0)
+
+        gate = RiskGate(store, ledger, **settings)
+
+        t0 = true_time.perf_counter()
+        for (symbol, side, qty, price), row in zip(orders, rows):
+            if gate.check(symbol, side, qty = qty, price = price) is None:
+                store.upsert(row)
+        seconds = true_time.perf_counter() - t0
+
+        passed = len(store)
+        print(f"{label:>15}: {len(orders) / seconds:,.0f} checks/s "
+              f"({seconds / len(orders) * 1e6:.2f} us), {passed} passed, rejections {gate.rejections}")
+        return gate
+
+    burst('no limits')
+    burst('size limits', symbol_limits = {'max_position': 500, 'max_notional': 100_000, 'max_open_orders': 15},
+          limits = {'max_open_orders': 8_000, 'max_notional': 5e7}, buying_power = 2e7)
+    gate = burst('rate limits', symbol_limits = {'max_position': 500, 'max_orders_per_second': 10},
+                 limits = {'max_orders_per_second': 2_000}, buying_power = 2e7)
+
+    # the counters are the sums over the open orders
+    store = gate.store
+    for symbol in symbols:
+        buy_qty = sum(row['qty'] for row in store.orders.values() if row['symbol'] == symbol and row['side'] == 'buy')
+        assert abs(store.pending.get(symbol, [0.0])[0] - buy_qty) < 1e-6
+    assert abs(store.pending_buy_notional - sum(row['qty'] * row['limit_price'] for row in store.orders.values()
+                                                if row['side'] == 'buy')) < 1e-3
+    for order_id in list(store.orders):
+        store.remove(order_id)
+    assert not store.pending and store.pending_buy_notional == 0.0
+
+    # concurrent submits, each passed order counts until it is in the store
+    gate = RiskGate(OrderStore(), PositionLedger(), symbol_limits = {'max_open_orders': 1, 'max_position': 10})
+    passed = [gate.check('AAPL', 'buy', qty = 10, price = 100.0, client_order_id = f"client-{i}") for i in range(5)]
+    assert passed.count(None) == 1 and gate.in_flight
+    gate.store.upsert(order_row(_order_json(0, 'AAPL', 'buy', 10, 100.0, now)))
+    assert gate.release('client-0') and not gate.in_flight and not gate._flight
+    assert gate.check('AAPL', 'buy', qty = 10, price = 100.0, client_order_id = 'client-1') is not None
+
+    # a notional order of a symbol without a price cannot be sized against the limits
+    gate = RiskGate(OrderStore(), PositionLedger(), symbol_limits = {'max_notional': 10_000})
+    assert gate.check('NOPRICE', 'buy', notional = 500.0) == 'no price'
+    gate = RiskGate(OrderStore(), PositionLedger(), symbol_limits = {'max_position': 10})
+    assert gate.check('NOPRICE', 'buy', notional = 1e9) == 'no price'
+    assert gate.check('NOPRICE', 'buy', qty = 5) is None
@@ -0,0 +1,438 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import asyncio
+import functools
+import logging
+import math
+import signal
+import time as true_time
+from concurrent.futures import ThreadPoolExecutor
+
+from alpaca.data.live.stock import StockDataStream
+
+from Finance.orders import ORDERS
+from Finance.portfolio import PORTFOLIO
+from Finance.tradeStream import TradeStream
+from Finance.liveIngest import INGESTOR
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+One event loop for the whole bot.
+
+The trade updates, the market data streams, the periodic reconciliation and the strategy all run as tasks of one
+asyncio loop, nothing blocks it:
+    streams         the _run_forever of a TradeStream or StockDataStream, their handlers run on the loop
+    periodic        every(interval) runs a coroutine, or a blocking function in the pool, on a fixed schedule. A run
+                    that overruns skips the ticks it missed instead of running them back to back
+    blocking calls  rest calls (submit, positions, reconciliation) go to a bounded thread pool through call, ORDERS
+                    and PORTFOLIO use the same pool, the state they change is only changed on the loop
+
+Every task is supervised, a task that raises is logged and started again after restart_delay. health() gives the state,
+restarts, last error and for periodic tasks the runs, scheduling lag and duration, plus what the probe of a task adds
+(eg messages received by a stream).
+
+Shutdown on SIGINT / SIGTERM or stop():
+    1. periodic tasks finish the run they are in and end
+    2. streams are stopped last added first (the strategy stops before the data it reads), their queued messages
+       are handled
+    3. whatever has not ended after grace seconds is cancelled
+    4. the thread pool is shut down
+'''
+
+
+class _Task:
+    __slots__ = ('name', 'factory', 'on_stop', 'restart', 'probe', 'periodic', 'state', 'restarts', 'last_error',
+                 'runs', 'lag', 'max_lag', 'duration', 'last_run', 'future')
+
+    def __init__(self, name: str, factory: Callable, on_stop: Callable = None, restart: bool = True,
+                 probe: Callable = None, periodic: bool = False):
+        self.name = name
+        self.factory = factory
+        self.on_stop = on_stop
+        self.restart = restart
+        self.probe = probe
+        self.periodic = periodic
+
+        self.state = 'pending'
+        self.restarts = 0
+        self.last_error: Union[str, None] = None
+
+        # periodic tasks, seconds
+        self.runs = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.duration = 0.0
+        self.last_run: Union[float, None] = None
+
+        self.future: Union[asyncio.Task, None] = None
+
+
+class RUNTIME:
+
+    def __init__(self, max_workers: int = 8, grace: float = 5.0, restart_delay: float = 1.0):
+        """
+        :param max_workers: threads of the pool the blocking calls go to
+        :param grace: seconds the tasks get to end on shutdown before they are cancelled
+        :param restart_delay: seconds before a failed task is started again
+        """
+
+        self.max_workers = max_workers
+        self.grace = grace
+        self.restart_delay = restart_delay
+
+        self.executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'runtime')
+        self.tasks: Dict[str, _Task] = {}
+
+        self._loop: Union[asyncio.AbstractEventLoop, None] = None
+        self._stopping: Union[asyncio.Event, None] = None
+
+        self.in_flight = 0
+        self.shutdown_seconds: Union[float, None] = None
+
+    async def call(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Runs a blocking function in the pool
+
+        :return: what fn returns
+        """
+
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                    functools.partial(fn, *args, **kwargs))
+        finally:
+            self.in_flight -= 1
+
+    ############################################ tasks ###########################################################
+    def add_task(self, name: str, factory: Callable, on_stop: Callable = None, restart: bool = True,
+                 probe: Callable = None) -> _Task:
+        """
+        :param name: unique name of the task
+        :param factory: coroutine function started as the task, called again on a restart
+        :param on_stop: coroutine function that asks the task to end on shutdown, None cancels it
+        :param restart: start the task again when it raises
+        :param probe: returns a dict added to the health of the task
+        :return: the task record
+        """
+
+        if name in self.tasks:
+            raise ValueError(f"task {name} already exists.")
+        if not asyncio.iscoroutinefunction(factory):
+            raise ValueError("factory must be coroutine function.")
+
+        task = _Task(name, factory, on_stop = on_stop, restart = restart, probe = probe)
+        self.tasks[name] = task
+
+        return task
+
+    def every(self, name: str, interval: float, fn: Callable, blocking: bool = False) -> _Task:
+        """
+        Runs fn every interval seconds
+
+        :param name: unique name of the task
+        :param interval: seconds between the starts of the runs
+        :param fn: coroutine function, or a blocking function with blocking = True
+        :param blocking: fn goes to the pool
+        :return: the task record
+        """
+
+        if interval <= 0:
+            raise ValueError("interval must be positive.")
+        if not blocking and not asyncio.iscoroutinefunction(fn):
+            raise ValueError("fn must be coroutine function, pass blocking = True for a plain function.")
+
+        async def periodic():
+            loop = asyncio.get_running_loop()
+            scheduled = loop.time()
+
+            while not self._stopping.is_set():
+                now = loop.time()
+                task.lag = now - scheduled
+                task.max_lag = max(task.max_lag, task.lag)
+
+                await (self.call(fn) if blocking else fn())
+
+                task.runs += 1
+                task.last_run = loop.time()
+                task.duration = task.last_run - now
+
+                # ticks missed by an overrun are skipped
+                scheduled += interval
+                if scheduled < task.last_run:
+                    scheduled += math.ceil((task.last_run - scheduled) / interval) * interval
+
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), scheduled - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+
+        task = self.add_task(name, periodic)
+        task.periodic = True
+
+        return task
+
+    def add_trade_updates(self, orders: ORDERS, stream: TradeStream, name: str = 'trade_updates') -> _Task:
+        """
+        Trade updates into ORDERS and the ledger, the api calls of their handlers go to the pool
+        """
+
+        orders.executor = self.executor
+        stream.subscribe_trade_updates(orders._update_handler)
+        stream.subscribe_reconnect(orders._reconnect_handler)
+        orders._trade_stream = stream
+
+        def probe() -> Dict:
+            return {'received': stream.received, 'handled': stream.handled, 'dropped': stream.dropped,
+                    'connections': stream.connections}
+
+        # restarting a stopped stream would return straight away, its own loop reconnects
+        return self.add_task(name, stream._run_forever, on_stop = stream._stop_ws, restart = False, probe = probe)
+
+    def add_market_data(self, stream: StockDataStream, ingestor: INGESTOR, symbols: List[str], bars: bool = True,
+                        updated_bars: bool = True, quotes: bool = False, trades: bool = False,
+                        name: str = 'market_data') -> _Task:
+        """
+        Bars, quotes and trades of symbols into the frames of the ingestor
+        """
+
+        ingestor.subscribe(stream, symbols, bars = bars, updated_bars = updated_bars, quotes = quotes,
+                           trades = trades)
+
+        async def on_stop():
+            await stream.stop_ws()
+            # the stream only looks at the stop between reads, which wait up to 5 seconds, closing the socket ends the
+            # read
+            await stream.close()
+            await ingestor.stop()
+
+        def probe() -> Dict:
+            return {'messages': ingestor.messages, 'flushes': ingestor.flushes}
+
+        return self.add_task(name, stream._run_forever, on_stop = on_stop, restart = False, probe = probe)
+
+    def add_reconciliation(self, portfolio: PORTFOLIO, interval: float = 60.0, name: str = 'reconciliation') -> _Task:
+        """
+        Replaces the ledger with the broker's positions every interval seconds, the positions are fetched in the pool
+        """
+
+        async def reconcile():
+            portfolio.ledger.reconcile(await self.call(portfolio.trade_client.get_all_positions))
+
+        return self.every(name, interval, reconcile)
+
+    def add_strategy(self, strategy: Callable, interval: float, *args, name: str = 'strategy') -> _Task:
+        """
+        :param strategy: coroutine function awaited every interval seconds with args, blocking work inside it goes
+                         through call
+        """
+
+        if not asyncio.iscoroutinefunction(strategy):
+            raise ValueError("strategy must be coroutine function.")
+
+        return self.every(name, interval, functools.partial(strategy, *args) if args else strategy)
+
+    ############################################ health ##########################################################
+    def health(self) -> Dict[str, Dict]:
+        """
+        :return: Dict[task name: health], times in ms, last_run is seconds ago
+        """
+
+        now = self._loop.time() if self._loop is not None else None
+        health = {}
+
+        for name, task in self.tasks.items():
+            row = {'state': task.state, 'restarts': task.restarts, 'last_error': task.last_error}
+
+            if task.periodic:
+                row.update({
+                    'runs': task.runs,
+                    'lag': task.lag * 1e3,
+                    'max_lag': task.max_lag * 1e3,
+                    'duration': task.duration * 1e3,
+                    'last_run': now - task.last_run if task.last_run is not None and now is not None else None
+                })
+
+            if task.probe is not None:
+                row.update(task.probe())
+
+            health[name] = row
+
+        return health
+
+    ############################################ running #########################################################
+    async def _supervise(self, task: _Task):
+        while True:
+            task.state = 'running'
+
+            try:
+                await task.factory()
+                task.state = 'stopped'
+                return
+
+            except asyncio.CancelledError:
+                task.state = 'cancelled'
+                raise
+
+            except Exception as e:
+                task.last_error = repr(e)
+                log.exception(f"task {task.name} failed: {e}")
+
+                if not task.restart or self._stopping.is_set():
+                    task.state = 'failed'
+                    return
+
+            task.restarts += 1
+            task.state = 'restarting'
+
+            # a stop during the delay ends the task
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.restart_delay)
+                task.state = 'stopped'
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def _shutdown(self):
+        t0 = true_time.perf_counter()
+        tasks = [task for task in self.tasks.values() if task.future is not None]
+
+        # periodic tasks see _stopping and end after their run, the rest is asked to stop, last added first
+        for task in reversed(tasks):
+            if task.periodic or task.future.done():
+                continue
+            if task.on_stop is None:
+                task.future.cancel()
+                continue
+            try:
+                await task.on_stop()
+            except Exception as e:
+                log.exception(f"stopping {task.name} failed: {e}")
+
+        futures = [task.future for task in tasks]
+        if futures:
+            done, pending = await asyncio.wait(futures, timeout = self.grace)
+            for future in pending:
+                log.warning(f"task {future.get_name()} did not stop within {self.grace} seconds, cancelling")
+                future.cancel()
+            await asyncio.gather(*futures, return_exceptions = True)
+
+        self.executor.shutdown(wait = False, cancel_futures = True)
+        self.shutdown_seconds = true_time.perf_counter() - t0
+        log.info(f"runtime stopped in {self.shutdown_seconds:.2f} seconds")
+
+    async def run(self):
+        """
+        Runs every task until SIGINT, SIGTERM or stop, then shuts down
+        """
+
+        self._loop = asyncio.get_running_loop()
+        if self._stopping is None:
+            self._stopping = asyncio.Event()
+
+        signals = []
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(sig, self._stopping.set)
+                signals.append(sig)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not the main thread, or windows
+                pass
+
+        for task in self.tasks.values():
+            task.future = self._loop.create_task(self._supervise(task), name = task.name)
+
+        try:
+            await self._stopping.wait()
+        finally:
+            await self._shutdown()
+            for sig in signals:
+                self._loop.remove_signal_handler(sig)
+
+    def start(self):
+        """
+        Blocks on run
+        """
+
+        asyncio.run(self.run())
+
+    def stop(self):
+        """
+        Starts the shutdown, safe to call from any thread
+        """
+
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+
+if __name__ == '__main__':
+    import numpy as np
+
+    from Finance.stockData import STOCKFRAME
+    from Finance.stubs import TradeUpdateServer, FakeTradingClient, ReplayServer, trade_update_events, \
+        stream_messages
+
+    # trade updates at 2000/s and market data at 5000/s on one loop, a strategy every 50 ms and the ledger
+    # reconciled every 200 ms through the pool, the strategy's scheduling lag is the latency the bot sees
+    symbols = [f"SYM{i}" for i in range(20)]
+    events = trade_update_events(6_000, open_orders = 500)
+    messages = stream_messages(symbols, minutes = 30, ticks = 10)
+
+    async def main():
+        broker = FakeTradingClient()
+        trade_server = TradeUpdateServer(events, rate = 2000, on_event = broker.apply)
+        data_server = ReplayServer(messages, batch_size = 50, rate = 5000)
+        await trade_server.start()
+        await data_server.start()
+
+        runtime = RUNTIME(max_workers = 4, grace = 5.0)
+
+        portfolio = PORTFOLIO(broker, reconcile_interval = 1e9)
+        orders = ORDERS(broker, portfolio)
+        trade_stream = TradeStream(url_override = trade_server.url, workers = 4)
+        runtime.add_trade_updates(orders, trade_stream)
+
+        frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+        ingestor = INGESTOR(frame)
+        data_stream = StockDataStream('fake', 'fake', raw_data = True, url_override = data_server.url)
+        runtime.add_market_data(data_stream, ingestor, symbols, quotes = True, trades = True)
+
+        runtime.add_reconciliation(portfolio, interval = 0.2)
+
+        lags = []
+
+        async def strategy():
+            task = runtime.tasks['strategy']
+            lags.append(task.lag)
+            # reads what the streams wrote, a blocking call goes to the pool
+            _ = len(ingestor.stockFrame.data_map[symbols[0]]) if symbols[0] in ingestor.stockFrame.data_map else 0
+            await runtime.call(broker.get_all_positions)
+
+        runtime.add_strategy(strategy, 0.05)
+
+        runner = asyncio.create_task(runtime.run())
+
+        await trade_server.done.wait()
+        await data_server.done.wait()
+        while trade_stream.received < len(events) or ingestor.messages < len(messages):
+            await asyncio.sleep(0.01)
+
+        runtime.stop()
+        await runner
+        await trade_server.stop()
+        await data_server.stop()
+
+        lags = np.array(lags) * 1e3
+        print(f"strategy ticks {len(lags)}, lag p50 {np.percentile(lags, 50):.2f} ms, "
+              f"p99 {np.percentile(lags, 99):.2f} ms")
+        for name, row in runtime.health().items():
+            print(f"{name:>15}: " + ", ".join(f"{k} {v:.2f}" if isinstance(v, float) else f"{k} {v}"
+                                               for k, v in row.items()))
+        print(f"shutdown in {runtime.shutdown_seconds * 1e3:.1f} ms")
+
+        assert all(row['state'] == 'stopped' for row in runtime.health().values())
+        assert trade_stream.handled == len(events)
+        assert frame.data_map[symbols[0]].height == 30
+
+    asyncio.run(main())
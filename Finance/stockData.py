@@ -23,26 +23,39 @@ from alpaca.trading.requests import *
 from alpaca.trading.enums import *
 from alpaca.common.exceptions import APIError
 
+from Finance.frameStore import FrameStore
+from Finance.marketClock import MarketClock
+from Finance.dataCache import DataCache
+from Finance.columnar import BAR_SCHEMA, QUOTE_SCHEMA, TRADE_SCHEMA, bars_to_frame, quotes_to_frame, trades_to_frame, set_data
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
 class STOCKFRAME:
 
-    def __init__(self, api_key: str, secret_key: str, trade_client: TradingClient, subscribed: bool = False):
+    def __init__(self, api_key: str, secret_key: str, trade_client: TradingClient, subscribed: bool = False,
+                 cache_dir: Union[str, None] = None, clock: Union[MarketClock, None] = None):
         self.api_key = api_key
         self.secret_key = secret_key
         self.trade_client = trade_client
         self.subscribed = subscribed
 
+        # market hours answered locally, shared with the bot when it makes the frame
+        self.clock: Union[MarketClock, None] = clock if clock is not None else \
+            MarketClock(trade_client) if trade_client is not None else None
+
+        # on disk cache of fetched history, None disables it
+        self.cache: Union[DataCache, None] = DataCache(cache_dir) if cache_dir else None
+
         self.stock_data_client: StockHistoricalDataClient = StockHistoricalDataClient(api_key=self.api_key, secret_key=self.secret_key)
         log.info("Client successful")
         self.options_data_client: OptionHistoricalDataClient = OptionHistoricalDataClient(self.api_key, self.secret_key)
 
-        # Dict[symbol: pl.DataFrame]
-        self.data_map: Dict[str: pl.DataFrame] = {}
-        self.lvl1_data_map: Dict[str: pl.DataFrame] = {}
-        self.trade_data_map: Dict[str: pl.DataFrame] = {}
+        # Dict[symbol: pl.DataFrame], append optimised so refreshes only cost the new rows
+        self.data_map: FrameStore = FrameStore(schema = BAR_SCHEMA)
+        self.lvl1_data_map: FrameStore = FrameStore(schema = QUOTE_SCHEMA)
+        self.trade_data_map: FrameStore = FrameStore(schema = TRADE_SCHEMA)
 
         # Dict[symbol: Indicators...]
         self.indicator_map: Dict[str: List] = {}
@@ -65,7 +78,7 @@ class STOCKFRAME:
 
     @property
     def is_open(self) -> bool:
-        return self.trade_client.get_clock().is_open
+        return self.clock.is_open()
 
     def _set_start(self, start) -> datetime:
         if self.subscribed or not self.is_open:
@@ -120,36 +133,19 @@ class STOCKFRAME:
                     'vwap': bar.vwap
                 }
 
-    def _format_barSet_data(self, barSet: BarSet) -> None:
+    def _format_barSet_data(self, barSet: Union[BarSet, Dict]) -> None:
         """
         parses and formats the received data from api into symbol's respective data frames
 
-        :param barSet: BarSet object from alpaca library
+        :param barSet: BarSet object from alpaca library or the raw dict of it
         """
 
-        # Dict[ symbol: List of Bars]
-        data = barSet.data
-        schema = {
-            'timestamp': pl.Datetime('us'),
-            'open': pl.Float64,
-            'high': pl.Float64,
-            'low': pl.Float64,
-            'close': pl.Float64,
-            'volume': pl.Float64,
-            'trade_count': pl.Float64,
-            'vwap': pl.Float64
-        }
+        # Dict[ symbol: List of Bars], or of raw dicts if the client returns raw data
+        data = set_data(barSet)
 
+        # open, high, low, close, volume, trade_count, vwap, exchange
         for symbol, bars in data.items():
-            df: pl.DataFrame = self.data_map.get(symbol, pl.DataFrame(schema=schema))
-            dict_list = []
-
-            # open, high, low, close, volume, trade_count, vwap, exchange
-            for bar in bars:
-                dict_list.append(self._format_bar(bar=bar))
-
-            df = pl.concat([df, pl.DataFrame(dict_list)], how = 'vertical_relaxed').unique(subset = ['timestamp']).sort('timestamp')
-            self.data_map[symbol] = df
+            self.data_map.append(symbol, bars_to_frame(bars))
 
     @staticmethod
     def _format_quote(quote: Quote) -> Dict:
@@ -165,29 +161,11 @@ class STOCKFRAME:
                     'tape': quote.tape
                 }
 
-    def _format_quoteSet_data(self, quoteSet: QuoteSet):
-        quoteSet = quoteSet.data
-        schema = {
-            'timestamp': pl.Datetime('us'),
-            'ask_price': pl.Float64,
-            'ask_size': pl.Float64,
-            'bid_price': pl.Float64,
-            'bid_size': pl.Float64,
-            'ask_exchange': pl.Utf8,
-            'bid_exchange': pl.Utf8,
-            'conditions': pl.List(pl.Utf8),
-            'tape': pl.Utf8
-        }
+    def _format_quoteSet_data(self, quoteSet: Union[QuoteSet, Dict]):
+        quoteSet = set_data(quoteSet)
 
         for symbol, quotes in quoteSet.items():
-            df: pl.DataFrame = self.lvl1_data_map.get(symbol, pl.DataFrame(schema=schema))
-            dict_list = []
-
-            for quote in quotes:
-                dict_list.append(self._format_quote(quote))
-
-            df = pl.concat([df, pl.DataFrame(dict_list)], how = 'vertical_relaxed').unique(subset = ['timestamp']).sort('timestamp')
-            self.lvl1_data_map[symbol] = df
+            self.lvl1_data_map.append(symbol, quotes_to_frame(quotes))
 
     @staticmethod
     def _format_trade(trade: Trade) -> Dict:
@@ -200,32 +178,81 @@ class STOCKFRAME:
                     'conditions': trade.conditions,
                     'tape': trade.tape
                 }
-    def _formate_tradeSet_data(self, tradeSet: TradeSet):
-
-        tradeSet = tradeSet.data
-        schema = {
-            'timestamp': pl.Datetime('us'),
-            'price': pl.Float64,
-            'size': pl.Float64,
-            'id': pl.Int64,
-            'exchange': pl.Utf8,
-            'conditions': pl.List(pl.Utf8),
-            'tape': pl.Utf8
-        }
-
-        for symbol, trades in tradeSet.items():
-            df: pl.DataFrame = self.trade_data_map.get(symbol, pl.DataFrame(schema=schema))
-            dict_list = []
+    def _formate_tradeSet_data(self, tradeSet: Union[TradeSet, Dict]):
 
-            for trade in trades:
-                dict_list.append(self._format_trade(trade))
+        tradeSet = set_data(tradeSet)
 
-            df = pl.concat([df, pl.DataFrame(dict_list)], how='vertical_relaxed').unique(subset=['timestamp']).sort('timestamp')
-            self.trade_data_map[symbol] = df
+        for symbol, trades in tradeSet.items():
+            self.trade_data_map.append(symbol, trades_to_frame(trades))
 
     ####################################### end of data formatting ###############################################
 
     ######################################## data fetch #########################################################
+    @staticmethod
+    def _timeframe_delta(timeframe: TimeFrame) -> timedelta:
+        unit = {
+            TimeFrameUnit.Minute: timedelta(minutes = 1),
+            TimeFrameUnit.Hour: timedelta(hours = 1),
+            TimeFrameUnit.Day: timedelta(days = 1),
+            TimeFrameUnit.Week: timedelta(weeks = 1),
+            TimeFrameUnit.Month: timedelta(days = 31)
+        }
+
+        return unit[timeframe.unit_value] * timeframe.amount_value
+
+    @staticmethod
+    def _settled(end: datetime, settle: timedelta) -> datetime:
+        """
+        :return: end of the fetched window which can be marked as cached, a window ending within settle of now may
+                 still have its last bar forming
+        """
+
+        utc_end = end if end.tzinfo is not None else end.replace(tzinfo = timezone.utc)
+        if utc_end > datetime.now(tz = timezone.utc) - settle:
+            return end - settle
+
+        return end
+
+    def _fetch_cached(self, kind: str, timeframe_key: str, symbols: List[str], start: datetime, end: datetime,
+                      fetch: Callable, to_frame: Callable, store: FrameStore, settle: timedelta = timedelta(0)):
+        """
+        Serves a fetch from the disk cache, only the never fetched parts of the window are requested from the api
+
+        :param kind: bars, quotes or trades
+        :param timeframe_key: timeframe value or tick
+        :param symbols: symbols to fetch
+        :param start: start of the window
+        :param end: end of the window
+        :param fetch: fetch(symbols, start, end) -> data set from the api
+        :param to_frame: converts the records of one symbol into a frame
+        :param store: frame store the window is loaded into
+        :param settle: the last stretch of a fetched window is not marked as cached if it is within settle of now,
+                       so a bar still forming at the end is fetched again next time
+        """
+
+        # symbols with the same gaps are fetched together
+        gap_groups: Dict[Tuple, List[str]] = {}
+        for symbol in symbols:
+            gaps = tuple(self.cache.missing(kind, symbol, timeframe_key, start, end))
+            if gaps:
+                gap_groups.setdefault(gaps, []).append(symbol)
+
+        log.info(f"{len(symbols) - sum(len(v) for v in gap_groups.values())} of {len(symbols)} symbols "
+                 f"served fully from cache")
+
+        for gaps, group in gap_groups.items():
+            for gap_start, gap_end in gaps:
+                data = set_data(fetch(group, gap_start, gap_end))
+
+                for symbol in group:
+                    self.cache.write(kind, symbol, timeframe_key, to_frame(data.get(symbol, [])),
+                                     gap_start, max(gap_start, self._settled(gap_end, settle)))
+
+        for symbol in symbols:
+            df = self.cache.load(kind, symbol, timeframe_key, start, end)
+            if df is not None:
+                store.append(symbol, df)
+
     # normal market data
     def fetch_historical_data(self, symbol_or_symbols: Union[List[str], str], start: datetime,
                               end: datetime = None, timeframe: str = "min", limit: int = None):
@@ -235,7 +262,7 @@ class STOCKFRAME:
         :param start:
         :param end:
         :param timeframe: defaults to minute
-        :param limit: max number of bars
+        :param limit: max number of bars, a limited fetch does not go through the cache
         """
 
         # if string make it into list
@@ -248,19 +275,27 @@ class STOCKFRAME:
 
         log.info("Attempting to fetch data")
 
-        req = StockBarsRequest(
-            symbol_or_symbols= symbol_or_symbols,
-            timeframe=timeframe,
-            start=start,
-            end=end,
-            limit=limit
-        )
+        def fetch(symbols: List[str], fetch_start: datetime, fetch_end: datetime):
+            req = StockBarsRequest(
+                symbol_or_symbols= symbols,
+                timeframe=timeframe,
+                start=fetch_start,
+                end=fetch_end,
+                limit=limit
+            )
+
+            return self.stock_data_client.get_stock_bars(req)
 
         # figure out the type of errors api can throw and accept those errors
         try:
-            barSet = self.stock_data_client.get_stock_bars(req)
+            if self.cache and not limit:
+                self._fetch_cached('bars', timeframe.value, symbol_or_symbols, start, end, fetch,
+                                   bars_to_frame, self.data_map, settle = self._timeframe_delta(timeframe))
+            else:
+                barSet = fetch(symbol_or_symbols, start, end)
+                self._format_barSet_data(barSet = barSet)
+
             log.info("Fetch data successful.")
-            self._format_barSet_data(barSet = barSet)
         except Exception as e:
             log.error(f"Error encountered while data fetch and process: {e}")
             pass
@@ -278,18 +313,26 @@ class STOCKFRAME:
 
         log.info("Attempting to fetch lvl1 data")
 
-        req = StockQuotesRequest(
-            symbol_or_symbols=symbol_or_symbols,
-            start=start,
-            end=end,
-            limit=limit
-        )
+        def fetch(symbols: List[str], fetch_start: datetime, fetch_end: datetime):
+            req = StockQuotesRequest(
+                symbol_or_symbols=symbols,
+                start=fetch_start,
+                end=fetch_end,
+                limit=limit
+            )
+
+            return self.stock_data_client.get_stock_quotes(req)
 
         # figure out the type of errors api can throw and accept those errors
         try:
-            quoteSet = self.stock_data_client.get_stock_quotes(req)
+            if self.cache and not limit:
+                self._fetch_cached('quotes', 'tick', symbol_or_symbols, start, end, fetch,
+                                   quotes_to_frame, self.lvl1_data_map)
+            else:
+                quoteSet = fetch(symbol_or_symbols, start, end)
+                self._format_quoteSet_data(quoteSet = quoteSet)
+
             log.info("Fetch lvl1 data successful.")
-            self._format_quoteSet_data(quoteSet = quoteSet)
 
         except Exception as e:
             log.error(f"Error encountered while lvl1 data fetch and process: {e}")
@@ -307,16 +350,25 @@ class STOCKFRAME:
 
         log.info("Attempting to fetch trade data")
 
-        req = StockTradesRequest(
-            symbol_or_symbols=symbol_or_symbols,
-            start=start,
-            end=end,
-            limit=limit
-        )
+        def fetch(symbols: List[str], fetch_start: datetime, fetch_end: datetime):
+            req = StockTradesRequest(
+                symbol_or_symbols=symbols,
+                start=fetch_start,
+                end=fetch_end,
+                limit=limit
+            )
+
+            return self.stock_data_client.get_stock_trades(req)
 
         # figure out the type of errors api can throw and accept those errors
         try:
-            tradeSet = self.stock_data_client.get_stock_trades(req)
+            if self.cache and not limit:
+                self._fetch_cached('trades', 'tick', symbol_or_symbols, start, end, fetch,
+                                   trades_to_frame, self.trade_data_map)
+            else:
+                tradeSet = fetch(symbol_or_symbols, start, end)
+                self._formate_tradeSet_data(tradeSet = tradeSet)
+
             log.info("Fetch trade data successful.")
 
         except Exception as e:
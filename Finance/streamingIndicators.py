@@ -0,0 +1,420 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import math
+import polars as pl
+import pytz
+import logging
+from collections import deque
+from datetime import datetime
+
+from alpaca.data.models import Bar
+
+from Finance.indicators import INDICATORS
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+NEW_YORK = pytz.timezone('America/New_York')
+
+
+class _Extreme:
+    __slots__ = ('length', 'is_max', '_window')
+
+    def __init__(self, length: int, is_max: bool):
+        """
+        Rolling max or min over the last length bars, a monotonic deque so every update is amortised O(1)
+
+        :param length: window length
+        :param is_max: max if true else min
+        """
+
+        self.length = length
+        self.is_max = is_max
+        # (row, value) with values monotonic from the front
+        self._window: deque = deque()
+
+    def update(self, row: int, value: float) -> float:
+        window = self._window
+
+        if self.is_max:
+            while window and window[-1][1] <= value:
+                window.pop()
+        else:
+            while window and window[-1][1] >= value:
+                window.pop()
+
+        window.append((row, value))
+        while window[0][0] <= row - self.length:
+            window.popleft()
+
+        return window[0][1]
+
+
+class _Moments:
+    __slots__ = ('length', '_window', '_sum', '_sum_sq', '_since_exact')
+
+    def __init__(self, length: int):
+        """
+        Rolling mean and sample std over a ring buffer, the running sums are rebuilt from the buffer every length
+        updates so rounding does not drift over a long session
+
+        :param length: window length
+        """
+
+        self.length = length
+        self._window: deque = deque(maxlen = length)
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self._since_exact = 0
+
+    def update(self, value: float) -> Tuple[float, float]:
+        window = self._window
+
+        if len(window) == self.length:
+            old = window[0]
+            self._sum -= old
+            self._sum_sq -= old * old
+
+        window.append(value)
+        self._sum += value
+        self._sum_sq += value * value
+
+        self._since_exact += 1
+        if self._since_exact >= self.length:
+            self._sum = math.fsum(window)
+            self._sum_sq = math.fsum(v * v for v in window)
+            self._since_exact = 0
+
+        n = len(window)
+        mean = self._sum / n
+        var = (self._sum_sq - self._sum * mean) / (n - 1) if n > 1 else 0.0
+
+        return mean, math.sqrt(max(var, 0.0))
+
+
+class _SymbolState:
+    __slots__ = ('row', 'prev_close', 'prev_high', 'prev_low', 'ema', 'macd_fast', 'macd_slow', 'macd_signal',
+                 'avg_gain', 'avg_loss', 'atr', 'adx_tr', 'adx_plus', 'adx_minus', 'adx', 'st_atr', 'st_upper',
+                 'st_lower', 'st_dir', 'bollinger', 'extremes', 'stoch_k', 'ichimoku_lines', 'vwap_session',
+                 'vwap_pv', 'vwap_v', 'values')
+
+    def __init__(self, indicators: INDICATORS):
+        self.row = -1
+        self.prev_close = self.prev_high = self.prev_low = None
+
+        self.ema: Dict[int, float] = {}
+        self.macd_fast = self.macd_slow = self.macd_signal = None
+        self.avg_gain = self.avg_loss = None
+        self.atr = None
+        self.adx_tr = self.adx_plus = self.adx_minus = self.adx = None
+        self.st_atr = self.st_upper = self.st_lower = None
+        self.st_dir = 1
+
+        self.bollinger = _Moments(indicators.bollinger[0])
+
+        # Dict[(column, length): rolling extreme]
+        lengths = {indicators.stochastic[0], indicators.donchian_length, *indicators.ichimoku}
+        self.extremes: Dict[Tuple[str, int], _Extreme] = {}
+        for length in lengths:
+            self.extremes[('high', length)] = _Extreme(length, is_max = True)
+            self.extremes[('low', length)] = _Extreme(length, is_max = False)
+
+        self.stoch_k: deque = deque(maxlen = indicators.stochastic[1])
+
+        # (tenkan + kijun) / 2 and the senkou b mid of the last kijun + 1 bars, the cloud is shifted kijun bars
+        self.ichimoku_lines: deque = deque(maxlen = indicators.ichimoku[1] + 1)
+
+        self.vwap_session = None
+        self.vwap_pv = self.vwap_v = 0.0
+
+        self.values: Dict[str, Union[float, None]] = {}
+
+
+class StreamingIndicators:
+
+    def __init__(self, indicators: INDICATORS, on_update: Union[Callable, None] = None):
+        """
+        Incremental counterpart of INDICATORS, keeps rolling state per symbol so every new bar costs O(1) instead of
+        recomputing over the whole history. Replayed over a history it gives the same values as INDICATORS with the
+        same parameters, except chikou which looks kijun bars ahead and so is never known live.
+
+        :param indicators: batch engine whose parameters are used
+        :param on_update: optional callback(symbol, values) after every bar
+        """
+
+        self.indicators = indicators
+        self.on_update = on_update
+
+        # Dict[symbol: state]
+        self.states: Dict[str, _SymbolState] = {}
+
+    @staticmethod
+    def _smooth(prev: Union[float, None], value: float, alpha: float) -> float:
+        # ewm with adjust = False, seeded with the first value
+        if prev is None:
+            return value
+
+        return prev + alpha * (value - prev)
+
+    @staticmethod
+    def _session(timestamp: datetime) -> Tuple[datetime, datetime]:
+        """
+        :return: utc start and end of the new york date the timestamp falls in
+        """
+
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo = pytz.utc)
+
+        day = timestamp.astimezone(NEW_YORK).date()
+        start = NEW_YORK.localize(datetime(day.year, day.month, day.day))
+        end = NEW_YORK.localize(datetime.fromordinal(day.toordinal() + 1))
+
+        return start.astimezone(pytz.utc), end.astimezone(pytz.utc)
+
+    def values(self, symbol: str) -> Dict[str, Union[float, None]]:
+        """
+        :return: latest indicator values of the symbol
+        """
+
+        state = self.states.get(symbol)
+        return state.values if state else {}
+
+    def update(self, symbol: str, timestamp: datetime, high: float, low: float, close: float,
+               volume: float) -> Dict[str, Union[float, None]]:
+        """
+        Feeds one new bar of a symbol
+
+        :return: indicator values after the bar, same names as the INDICATORS columns
+        """
+
+        ind = self.indicators
+        state = self.states.get(symbol)
+        if state is None:
+            state = _SymbolState(ind)
+            self.states[symbol] = state
+
+        state.row += 1
+        row = state.row
+        prev_close = state.prev_close
+        values = {}
+
+        # ema and macd
+        for span in ind.ema_lengths:
+            state.ema[span] = self._smooth(state.ema.get(span), close, 2 / (span + 1))
+            values[f'ema_{span}'] = state.ema[span]
+
+        fast, slow, signal = ind.macd
+        state.macd_fast = self._smooth(state.macd_fast, close, 2 / (fast + 1))
+        state.macd_slow = self._smooth(state.macd_slow, close, 2 / (slow + 1))
+        macd = state.macd_fast - state.macd_slow
+        state.macd_signal = self._smooth(state.macd_signal, macd, 2 / (signal + 1))
+        values['macd'] = macd
+        values['macd_signal'] = state.macd_signal
+        values['macd_hist'] = macd - state.macd_signal
+
+        # rsi
+        n = ind.rsi_length
+        change = close - prev_close if prev_close is not None else 0.0
+        state.avg_gain = self._smooth(state.avg_gain, max(change, 0.0), 1 / n)
+        state.avg_loss = self._smooth(state.avg_loss, max(-change, 0.0), 1 / n)
+        if row < n:
+            values['rsi'] = None
+        elif state.avg_loss == 0:
+            values['rsi'] = 100.0
+        else:
+            values['rsi'] = 100 - 100 / (1 + state.avg_gain / state.avg_loss)
+
+        # bollinger
+        length, width = ind.bollinger
+        mean, std = state.bollinger.update(close)
+        if row < length - 1:
+            values['bb_mid'] = values['bb_upper'] = values['bb_lower'] = None
+        else:
+            values['bb_mid'] = mean
+            values['bb_upper'] = mean + width * std
+            values['bb_lower'] = mean - width * std
+
+        # true range based, atr, adx and supertrend
+        if prev_close is None:
+            tr = high - low
+        else:
+            tr = max(high - low, abs(high - prev_close), abs(low - prev_close))
+
+        n = ind.atr_length
+        state.atr = self._smooth(state.atr, tr, 1 / n)
+        values['atr'] = state.atr if row >= n else None
+
+        n = ind.adx_length
+        if state.prev_high is None:
+            plus_dm = minus_dm = 0.0
+        else:
+            up = high - state.prev_high
+            down = state.prev_low - low
+            plus_dm = up if (up > down and up > 0) else 0.0
+            minus_dm = down if (down > up and down > 0) else 0.0
+
+        state.adx_tr = self._smooth(state.adx_tr, tr, 1 / n)
+        state.adx_plus = self._smooth(state.adx_plus, plus_dm, 1 / n)
+        state.adx_minus = self._smooth(state.adx_minus, minus_dm, 1 / n)
+        plus_di = 100 * state.adx_plus / state.adx_tr
+        minus_di = 100 * state.adx_minus / state.adx_tr
+        di_sum = plus_di + minus_di
+        dx = 0.0 if di_sum == 0 else 100 * abs(plus_di - minus_di) / di_sum
+        state.adx = self._smooth(state.adx, dx, 1 / n)
+        values['plus_di'] = plus_di if row >= n else None
+        values['minus_di'] = minus_di if row >= n else None
+        values['adx'] = state.adx if row >= 2 * n else None
+
+        st_length, factor = ind.supertrend
+        state.st_atr = self._smooth(state.st_atr, tr, 1 / st_length)
+        hl2 = (high + low) / 2
+        basic_upper = hl2 + factor * state.st_atr
+        basic_lower = hl2 - factor * state.st_atr
+
+        if state.st_upper is None or basic_upper < state.st_upper or prev_close > state.st_upper:
+            state.st_upper = basic_upper
+        if state.st_lower is None or basic_lower > state.st_lower or prev_close < state.st_lower:
+            state.st_lower = basic_lower
+
+        up, down = close > state.st_upper, close < state.st_lower
+        if up and not down:
+            state.st_dir = 1
+        elif down and not up:
+            state.st_dir = -1
+
+        values['supertrend_dir'] = state.st_dir
+        if row < st_length:
+            values['supertrend'] = None
+        else:
+            values['supertrend'] = state.st_lower if state.st_dir == 1 else state.st_upper
+
+        # session vwap
+        # the session bounds are only worked out again once a bar falls outside them
+        aware = timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo = pytz.utc)
+        if state.vwap_session is None or not state.vwap_session[0] <= aware < state.vwap_session[1]:
+            state.vwap_session = self._session(aware)
+            state.vwap_pv = state.vwap_v = 0.0
+        state.vwap_pv += (high + low + close) / 3 * volume
+        state.vwap_v += volume
+        values['session_vwap'] = state.vwap_pv / state.vwap_v if state.vwap_v else float('nan')
+
+        # channels
+        def channel(length: int) -> Tuple[Union[float, None], Union[float, None]]:
+            highest = state.extremes[('high', length)].update(row, high)
+            lowest = state.extremes[('low', length)].update(row, low)
+            if row < length - 1:
+                return None, None
+            return highest, lowest
+
+        channels = {length: channel(length) for length in {ind.stochastic[0], ind.donchian_length, *ind.ichimoku}}
+
+        k_length, d_length = ind.stochastic
+        highest, lowest = channels[k_length]
+        if highest is None:
+            stoch_k = None
+        elif highest == lowest:
+            stoch_k = 50.0
+        else:
+            stoch_k = 100 * (close - lowest) / (highest - lowest)
+        state.stoch_k.append(stoch_k)
+        values['stoch_k'] = stoch_k
+        values['stoch_d'] = sum(state.stoch_k) / d_length if row >= k_length + d_length - 2 else None
+
+        upper, lower = channels[ind.donchian_length]
+        values['donchian_upper'] = upper
+        values['donchian_lower'] = lower
+        values['donchian_mid'] = (upper + lower) / 2 if upper is not None else None
+
+        tenkan_length, kijun_length, senkou_length = ind.ichimoku
+        tenkan = (channels[tenkan_length][0] + channels[tenkan_length][1]) / 2 if row >= tenkan_length - 1 else None
+        kijun = (channels[kijun_length][0] + channels[kijun_length][1]) / 2 if row >= kijun_length - 1 else None
+        senkou_b_mid = ((channels[senkou_length][0] + channels[senkou_length][1]) / 2
+                        if row >= senkou_length - 1 else None)
+        cloud = (tenkan + kijun) / 2 if tenkan is not None and kijun is not None else None
+
+        state.ichimoku_lines.append((cloud, senkou_b_mid))
+        values['tenkan'] = tenkan
+        values['kijun'] = kijun
+        if row >= kijun_length:
+            values['senkou_a'], values['senkou_b'] = state.ichimoku_lines[0]
+        else:
+            values['senkou_a'] = values['senkou_b'] = None
+
+        state.prev_close, state.prev_high, state.prev_low = close, high, low
+        state.values = values
+
+        if self.on_update:
+            self.on_update(symbol, values)
+
+        return values
+
+    def on_bar(self, bar: Bar) -> Dict[str, Union[float, None]]:
+        return self.update(bar.symbol, bar.timestamp, bar.high, bar.low, bar.close, bar.volume)
+
+    async def bar_handler(self, bar: Bar):
+        """
+        Handler to pass to StockDataStream.subscribe_bars
+        """
+
+        self.on_bar(bar)
+
+    def replay(self, symbol: str, bars: pl.DataFrame) -> pl.DataFrame:
+        """
+        Feeds a frame of bars through the incremental state, used to warm up from history and to check it against
+        the batch engine
+
+        :param symbol: symbol of the bars
+        :param bars: frame of bars sorted by timestamp
+        :return: frame of timestamp and the indicator values after every bar
+        """
+
+        rows = []
+        for timestamp, high, low, close, volume in bars.select(
+                ['timestamp', 'high', 'low', 'close', 'volume']).iter_rows():
+            rows.append(self.update(symbol, timestamp, high, low, close, volume))
+
+        return pl.DataFrame(rows).insert_column(0, bars.get_column('timestamp'))
+
+
+if __name__ == '__main__':
+    import time as true_time
+    import numpy as np
+
+    # replays synthetic history through the incremental state and compares it with the batch engine
+    class _Frame:
+        def __init__(self):
+            self.data_map = {}
+            self.indicator_map = {}
+
+    rng = np.random.default_rng(3)
+    frame = _Frame()
+    n = 390 * 5
+    timestamps = (np.datetime64('2024-01-02T14:30') + np.arange(5)[:, None] * np.timedelta64(1, 'D') +
+                  np.arange(390) * np.timedelta64(1, 'm')).ravel().astype('datetime64[us]')
+
+    for i in range(3):
+        close = 100 + rng.standard_normal(n).cumsum() * 0.1
+        spread = rng.random(n) * 0.2
+        frame.data_map[f'SYM{i}'] = pl.DataFrame({
+            'timestamp': timestamps, 'open': close, 'high': close + spread, 'low': close - spread, 'close': close,
+            'volume': rng.integers(100, 10_000, n).astype(np.float64), 'trade_count': 10.0, 'vwap': close
+        })
+
+    batch = INDICATORS(frame)
+    batch.compute()
+    streaming = StreamingIndicators(batch)
+
+    elapsed = 0.0
+    for symbol, bars in frame.data_map.items():
+        t0 = true_time.perf_counter()
+        live = streaming.replay(symbol, bars)
+        elapsed += true_time.perf_counter() - t0
+        expected = frame.indicator_map[symbol]
+
+        for column in live.columns[1:]:
+            a, b = live.get_column(column).to_list(), expected.get_column(column).to_list()
+            for i, (x, y) in enumerate(zip(a, b)):
+                same = (x is None and y is None) or (x is not None and y is not None and abs(x - y) <= 1e-8 * max(1, abs(y)))
+                assert same, f"{symbol} {column} row {i}: streaming {x} batch {y}"
+
+    print(f"streaming state matches the batch engine, {3 * n / elapsed:,.0f} bars/s")
@@ -0,0 +1,945 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import zlib
+import uuid
+import time as true_time
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import Executor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import msgpack
+import pytz
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from alpaca.data.models import BarSet, QuoteSet, TradeSet
+from alpaca.data.timeframe import TimeFrame, TimeFrameUnit
+from alpaca.trading.models import Order, Position
+from alpaca.common.exceptions import APIError
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Local stand ins for the alpaca clients, used to exercise the data and trading layers without an account or network.
+'''
+
+
+def _utc(ts: datetime) -> datetime:
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo = timezone.utc)
+
+    return ts.astimezone(timezone.utc)
+
+
+def _rfc3339(ts: datetime) -> str:
+    return ts.isoformat().replace('+00:00', 'Z')
+
+
+class FakeStockDataClient:
+
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, raw_data: bool = True, seed: int = 0):
+        """
+        Stand in for StockHistoricalDataClient which makes up deterministic data for any symbol and window.
+        The same symbol and timestamp always give the same values, so overlapping fetches agree.
+
+        :param latency: seconds every call sleeps for, to mimic the round trip
+        :param fail_rate: probability of a call raising, to exercise retries
+        :param raw_data: return raw dicts like the real client with raw_data = True, else the set objects
+        :param seed: seed of the failure draws
+        """
+
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.raw_data = raw_data
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # (kind, symbols, start, end) of every call
+        self.calls: List[Tuple[str, Tuple[str], datetime, datetime]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.call_times: List[float] = []
+
+    def _enter(self, kind: str, req):
+        symbols = req.symbol_or_symbols
+        if isinstance(symbols, str):
+            symbols = [symbols]
+
+        with self._lock:
+            self.calls.append((kind, tuple(symbols), req.start, req.end))
+            self.call_times.append(true_time.monotonic())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail = self._random.random() < self.fail_rate
+
+        try:
+            if self.latency:
+                true_time.sleep(self.latency)
+            if fail:
+                raise ConnectionError(f"injected failure for {kind} {symbols}")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        return symbols
+
+    @staticmethod
+    def _grid(start: datetime, end: datetime, step: timedelta, limit: Union[int, None]) -> List[datetime]:
+        start = _utc(start)
+        end = _utc(end) if end else datetime.now(tz = timezone.utc)
+
+        # align to the step like the real bars are
+        epoch = datetime(1970, 1, 1, tzinfo = timezone.utc)
+        steps = -((epoch - start) // step)
+        ts = epoch + steps * step
+
+        grid = []
+        while ts <= end and (not limit or len(grid) < limit):
+            grid.append(ts)
+            ts += step
+
+        return grid
+
+    @staticmethod
+    def _price(symbol: str, ts: datetime) -> float:
+        seed = zlib.crc32(symbol.encode()) % 1000
+        minute = ts.timestamp() / 60
+        return round(50 + seed / 10 + 5 * math.sin(minute / 390 + seed), 4)
+
+    def get_stock_bars(self, req) -> Union[BarSet, Dict]:
+        symbols = self._enter('bars', req)
+        timeframe: TimeFrame = req.timeframe
+        unit = {
+            TimeFrameUnit.Minute: timedelta(minutes = 1),
+            TimeFrameUnit.Hour: timedelta(hours = 1),
+            TimeFrameUnit.Day: timedelta(days = 1),
+            TimeFrameUnit.Week: timedelta(weeks = 1),
+            TimeFrameUnit.Month: timedelta(days = 30)
+        }[timeframe.unit_value] * timeframe.amount_value
+
+        data = {}
+        for symbol in symbols:
+            bars = []
+            for ts in self._grid(req.start, req.end, unit, req.limit):
+                price = self._price(symbol, ts)
+                bars.append({'t': _rfc3339(ts), 'o': price, 'h': price + 0.05, 'l': price - 0.05,
+                             'c': price + 0.01, 'v': 1000.0, 'n': 10, 'vw': price})
+            if bars:
+                data[symbol] = bars
+
+        return data if self.raw_data else BarSet(data)
+
+    def get_stock_quotes(self, req) -> Union[QuoteSet, Dict]:
+        symbols = self._enter('quotes', req)
+
+        data = {}
+        for symbol in symbols:
+            quotes = []
+            for ts in self._grid(req.start, req.end, timedelta(seconds = 1), req.limit):
+                price = self._price(symbol, ts)
+                quotes.append({'t': _rfc3339(ts), 'ax': 'V', 'ap': price + 0.01, 'as': 100, 'bx': 'V',
+                               'bp': price - 0.01, 'bs': 100, 'c': ['R'], 'z': 'C'})
+            if quotes:
+                data[symbol] = quotes
+
+        return data if self.raw_data else QuoteSet(data)
+
+    def get_stock_trades(self, req) -> Union[TradeSet, Dict]:
+        symbols = self._enter('trades', req)
+
+        data = {}
+        for symbol in symbols:
+            trades = []
+            for ts in self._grid(req.start, req.end, timedelta(seconds = 1), req.limit):
+                trades.append({'t': _rfc3339(ts), 'x': 'V', 'p': self._price(symbol, ts), 's': 100,
+                               'i': int(ts.timestamp()), 'c': ['@'], 'z': 'C'})
+            if trades:
+                data[symbol] = trades
+
+        return data if self.raw_data else TradeSet(data)
+
+
+def stream_messages(symbols: List[str], minutes: int, ticks: int = 10,
+                    start: datetime = datetime(2024, 1, 2, 14, 30, tzinfo = timezone.utc)) -> List[Dict]:
+    """
+    Raw StockDataStream messages in the order the feed would send them, per minute and symbol a bar, then ticks
+    quotes and trades, then an updated bar correcting the bar. Trade ids are the position of the message in the list.
+
+    :param symbols: symbols of the feed
+    :param minutes: minutes of the feed
+    :param ticks: quotes and trades per symbol and minute
+    :param start: time of the first bar
+    :return: list of raw message dicts with the short keys
+    """
+
+    messages = []
+    for minute in range(minutes):
+        ts = _utc(start) + timedelta(minutes = minute)
+
+        for symbol in symbols:
+            price = FakeStockDataClient._price(symbol, ts)
+            bar = {'T': 'b', 'S': symbol, 't': msgpack.Timestamp.from_datetime(ts), 'o': price, 'h': price + 0.05,
+                   'l': price - 0.05, 'c': price + 0.01, 'v': 1000, 'n': 10, 'vw': price}
+            messages.append(bar)
+
+            for tick in range(ticks):
+                tick_ts = msgpack.Timestamp.from_datetime(ts + timedelta(milliseconds = 1 + tick * 50))
+                messages.append({'T': 'q', 'S': symbol, 't': tick_ts, 'ax': 'V', 'ap': price + 0.01, 'as': 1,
+                                 'bx': 'V', 'bp': price - 0.01, 'bs': 1, 'c': ['R'], 'z': 'C'})
+                messages.append({'T': 't', 'S': symbol, 't': tick_ts, 'x': 'V', 'p': price, 's': 100,
+                                 'i': len(messages), 'c': ['@'], 'z': 'C'})
+
+            # late trades move the close and volume of the bar
+            messages.append({**bar, 'T': 'u', 'c': price + 0.02, 'v': 1100, 'n': 11})
+
+    return messages
+
+
+class ReplayServer:
+
+    _CHANNELS = {'b': 'bars', 'u': 'updatedBars', 'q': 'quotes', 't': 'trades'}
+
+    def __init__(self, messages: List[Dict], batch_size: int = 100, rate: float = None, host: str = '127.0.0.1',
+                 port: int = 0):
+        """
+        Local websocket server speaking the msgpack protocol of the alpaca market data stream, it replays a fixed list
+        of raw messages to every client once the client has authenticated and subscribed.
+        Point a StockDataStream at it with url_override = server.url.
+
+        :param messages: raw messages to send, see stream_messages
+        :param batch_size: messages per websocket frame, the feed batches messages the same way
+        :param rate: messages per second, None sends as fast as the client reads
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free one
+        """
+
+        self.messages = messages
+        self.batch_size = batch_size
+        self.rate = rate
+        self.host = host
+        self.port = port
+
+        # perf_counter time each message was sent at, by position in messages
+        self.sent_at: List[float] = [0.0] * len(messages)
+        self.done = asyncio.Event()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await serve(self._handler, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handler(self, ws):
+        await ws.send(msgpack.packb([{'T': 'success', 'msg': 'connected'}]))
+
+        auth = msgpack.unpackb(await ws.recv())
+        if auth.get('action') != 'auth':
+            await ws.send(msgpack.packb([{'T': 'error', 'code': 401, 'msg': 'not authenticated'}]))
+            return
+        await ws.send(msgpack.packb([{'T': 'success', 'msg': 'authenticated'}]))
+
+        sub = msgpack.unpackb(await ws.recv())
+        channels = {channel: set(sub.get(channel, [])) for channel in self._CHANNELS.values()}
+        await ws.send(msgpack.packb([{'T': 'subscription', **{k: sorted(v) for k, v in channels.items()}}]))
+
+        # pack up front so the server costs as little as possible of the shared cpu during the replay
+        positions = [i for i, msg in enumerate(self.messages)
+                     if msg['S'] in channels[self._CHANNELS[msg['T']]] or '*' in channels[self._CHANNELS[msg['T']]]]
+        batches = []
+        for i in range(0, len(positions), self.batch_size):
+            batch = positions[i: i + self.batch_size]
+            batches.append((batch, msgpack.packb([self.messages[j] for j in batch])))
+
+        t0 = true_time.perf_counter()
+        sent = 0
+        for batch, payload in batches:
+            if self.rate:
+                wait = t0 + sent / self.rate - true_time.perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            else:
+                # let the client get a turn, it usually shares the loop in benchmarks
+                await asyncio.sleep(0)
+
+            now = true_time.perf_counter()
+            for j in batch:
+                self.sent_at[j] = now
+            await ws.send(payload)
+            sent += len(batch)
+
+        self.done.set()
+        await ws.wait_closed()
+
+
+class TradeUpdateServer:
+
+    def __init__(self, messages: List[Dict], rate: float = None, host: str = '127.0.0.1', port: int = 0,
+                 drop_every: int = None, gap: int = 0, on_event: Callable = None):
+        """
+        Local websocket server speaking the json protocol of the alpaca trading stream, it replays a fixed list of
+        trade_updates to every client once the client has authenticated and listens to trade_updates.
+        Every message is sent in its own frame like the trading stream does, with its position in messages as seq.
+        Point a TradeStream at it with url_override = server.url.
+
+        With drop_every the server drops the connection every drop_every messages, the next gap messages happen while
+        the client is away and are never sent, a reconnecting client carries on after them.
+
+        :param messages: messages to send, see trade_update_events
+        :param rate: messages per second, None sends as fast as the client reads
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free one
+        :param drop_every: messages sent per connection before it is dropped
+        :param gap: messages lost on every drop
+        :param on_event: called with every message as it happens, sent or lost, eg FakeTradingClient.apply
+        """
+
+        self.messages = messages
+        self.rate = rate
+        self.host = host
+        self.port = port
+        self.drop_every = drop_every
+        self.gap = gap
+        self.on_event = on_event
+
+        # next message to send, kept over connections
+        self.cursor = 0
+        self.lost: List[int] = []
+
+        self.sent_at: List[float] = [0.0] * len(messages)
+        self.done = asyncio.Event()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await serve(self._handler, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handler(self, ws):
+        auth = json.loads(await ws.recv())
+        status = 'authorized' if auth.get('action') == 'authenticate' else 'unauthorized'
+        await ws.send(json.dumps({'stream': 'authorization', 'data': {'status': status, 'action': 'authenticate'}}))
+        if status != 'authorized':
+            return
+
+        listen = json.loads(await ws.recv())
+        streams = listen.get('data', {}).get('streams', [])
+        await ws.send(json.dumps({'stream': 'listening', 'data': {'streams': streams}}))
+        if 'trade_updates' not in streams:
+            await ws.wait_closed()
+            return
+
+        t0 = true_time.perf_counter()
+        start = self.cursor
+        while self.cursor < len(self.messages):
+            i = self.cursor
+            if self.rate:
+                wait = t0 + (i - start) / self.rate - true_time.perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            elif i % 100 == 0:
+                await asyncio.sleep(0)
+
+            if self.drop_every and i > start and (i - start) % self.drop_every == 0:
+                lost = range(i, min(i + self.gap, len(self.messages)))
+                for j in lost:
+                    if self.on_event:
+                        self.on_event(self.messages[j])
+                self.lost.extend(lost)
+                self.cursor = lost.stop
+
+                await ws.close(code = 1011, reason = 'dropped')
+                if self.cursor >= len(self.messages):
+                    self.done.set()
+                return
+
+            if self.on_event:
+                self.on_event(self.messages[i])
+            self.sent_at[i] = true_time.perf_counter()
+            try:
+                await ws.send(json.dumps({**self.messages[i], 'seq': i}))
+            except ConnectionClosed:
+                # the client went away, it picks up from here when it is back
+                return
+            self.cursor += 1
+
+        self.done.set()
+        await ws.wait_closed()
+
+
+class FakeTradingClient:
+
+    _CLOSED = {'filled', 'canceled', 'expired', 'rejected', 'replaced', 'suspended'}
+
+    def __init__(self):
+        """
+        Stand in for TradingClient on the broker side of a stream of trade updates, it applies every update as it
+        happens (hand apply to TradeUpdateServer as on_event) whether the client got it or not, so its orders and
+        positions are what a client finds when it asks the api after missing updates.
+        """
+
+        # latest json of every order by id
+        self.orders: Dict[str, Dict] = {}
+        # qty and average entry price by symbol
+        self.positions: Dict[str, List[float]] = {}
+        self.calls: List[str] = []
+        # the updates come on the server's loop, the calls from the client's threads
+        self._lock = threading.Lock()
+
+    def apply(self, message: Dict):
+        with self._lock:
+            self._apply(message)
+
+    def _apply(self, message: Dict):
+        data = message['data']
+        order = data['order']
+        self.orders[order['id']] = order
+
+        if data.get('position_qty') is not None:
+            qty, avg = self.positions.pop(order['symbol'], [0.0, 0.0])
+            new_qty = float(data['position_qty'])
+            price = float(data['price'])
+
+            if new_qty == 0:
+                return
+            if qty == 0 or (qty > 0) != (new_qty > 0):
+                # opened or flipped
+                avg = price
+            elif abs(new_qty) > abs(qty):
+                avg = (avg * abs(qty) + price * (abs(new_qty) - abs(qty))) / abs(new_qty)
+            self.positions[order['symbol']] = [new_qty, avg]
+
+    def get_orders(self, filter = None) -> List[Order]:
+        self.calls.append('get_orders')
+
+        status = str(getattr(getattr(filter, 'status', None), 'value', 'open'))
+        after = getattr(filter, 'after', None)
+        limit = getattr(filter, 'limit', None) or 50
+        descending = str(getattr(getattr(filter, 'direction', None), 'value', 'desc')) == 'desc'
+
+        with self._lock:
+            orders = list(self.orders.values())
+
+        orders = [order for order in orders
+                  if status == 'all' or (status == 'closed') == (order['status'] in self._CLOSED)]
+        if after is not None:
+            orders = [order for order in orders if datetime.fromisoformat(order['submitted_at']) > _utc(after)]
+
+        orders.sort(key = lambda order: order['submitted_at'], reverse = descending)
+        return [Order(**order) for order in orders[:limit]]
+
+    def get_order_by_id(self, order_id) -> Order:
+        self.calls.append('get_order_by_id')
+        with self._lock:
+            return Order(**self.orders[str(order_id)])
+
+    def _position(self, symbol: str) -> Position:
+        qty, avg = self.positions[symbol]
+        return Position(
+            asset_id = f"00000000-0000-0000-0001-{zlib.crc32(symbol.encode()):012d}", symbol = symbol,
+            exchange = 'NASDAQ', asset_class = 'us_equity', avg_entry_price = str(avg), qty = str(qty),
+            side = 'long' if qty > 0 else 'short', cost_basis = str(qty * avg), qty_available = str(qty)
+        )
+
+    def get_all_positions(self) -> List[Position]:
+        self.calls.append('get_all_positions')
+        with self._lock:
+            return [self._position(symbol) for symbol in self.positions]
+
+    def get_open_position(self, symbol_or_asset_id) -> Position:
+        self.calls.append('get_open_position')
+        with self._lock:
+            if symbol_or_asset_id not in self.positions:
+                raise APIError('{"code": 40410000, "message": "position does not exist"}')
+
+            return self._position(symbol_or_asset_id)
+
+
+def _order_json(order_id: int, symbol: str, side: str, qty: float, limit_price: float, ts: datetime) -> Dict:
+    stamp = _rfc3339(ts)
+    return {
+        'id': f"00000000-0000-0000-0000-{order_id:012d}", 'client_order_id': f"client-{order_id}",
+        'created_at': stamp, 'updated_at': stamp, 'submitted_at': stamp, 'filled_at': None, 'expired_at': None,
+        'canceled_at': None, 'failed_at': None, 'replaced_at': None, 'replaced_by': None, 'replaces': None,
+        'asset_id': f"00000000-0000-0000-0001-{zlib.crc32(symbol.encode()):012d}", 'symbol': symbol, 'asset_class': 'us_equity', 'notional': None,
+        'qty': str(qty), 'filled_qty': '0', 'filled_avg_price': None, 'order_class': 'simple',
+        'order_type': 'limit', 'type': 'limit', 'side': side, 'time_in_force': 'day',
+        'limit_price': str(limit_price), 'stop_price': None, 'status': 'new', 'extended_hours': False,
+        'legs': None, 'trail_percent': None, 'trail_price': None, 'hwm': None
+    }
+
+
+class BrokerServer:
+
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, reject: Tuple[str, ...] = (),
+                 host: str = '127.0.0.1', port: int = 0, seed: int = 0):
+        """
+        Local http server speaking the order, position, clock and calendar endpoints of the alpaca trading api, point
+        a TradingClient at it with url_override = server.url. Connections are kept alive like the api does.
+
+        Submitted orders are accepted and stay open until cancelled or replaced.
+
+        :param latency: seconds every request takes
+        :param fail_rate: share of order submissions answered with a 500, half of them after the order went in
+        :param reject: symbols whose orders are rejected with a 403, like insufficient buying power
+        :param host: interface to listen on
+        :param port: port to listen on, 0 picks a free one
+        """
+
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.reject = set(reject)
+        self.host = host
+        self.port = port
+
+        self.orders: Dict[str, Dict] = {}
+        self._client_ids = set()
+        # requests by method and path head, and tcp connections accepted
+        self.calls: List[Tuple[str, str]] = []
+        self.connections = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Union[ThreadingHTTPServer, None] = None
+        self._thread: Union[threading.Thread, None] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        broker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body in one segment, split writes stall on delayed acks
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with broker._lock:
+                    broker.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body = None):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _route(self, method: str):
+                parts = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+                if broker.latency:
+                    true_time.sleep(broker.latency)
+
+                status, response = broker._handle(method, parts.path, body, query)
+                self._send(status, response)
+
+            def do_GET(self):
+                self._route('GET')
+
+            def do_POST(self):
+                self._route('POST')
+
+            def do_PATCH(self):
+                self._route('PATCH')
+
+            def do_DELETE(self):
+                self._route('DELETE')
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @staticmethod
+    def _clock(now: datetime) -> Dict:
+        # sessions are 09:30 to 16:00 new york time on weekdays, no holidays
+        new_york = pytz.timezone('America/New_York')
+        local = now.astimezone(new_york)
+        sessions = []
+        for i in range(-1, 8):
+            day = (local + timedelta(days = i)).date()
+            if day.weekday() < 5:
+                sessions.append((new_york.localize(datetime(day.year, day.month, day.day, 9, 30)),
+                                 new_york.localize(datetime(day.year, day.month, day.day, 16))))
+
+        is_open = any(open_ <= now < close for open_, close in sessions)
+        next_open = min(open_ for open_, close in sessions if open_ > now)
+        next_close = min(close for open_, close in sessions if close > now)
+
+        return {'timestamp': now.astimezone(new_york).isoformat(), 'is_open': is_open,
+                'next_open': next_open.isoformat(), 'next_close': next_close.isoformat()}
+
+    @staticmethod
+    def _error(status: int, code: int, message: str) -> Tuple[int, Dict]:
+        return status, {'code': code, 'message': message}
+
+    def _new_order(self, body: Dict, replaces: Dict = None) -> Dict:
+        stamp = _rfc3339(datetime.now(timezone.utc))
+        order_id = str(uuid.uuid4())
+        symbol = body.get('symbol') or replaces['symbol']
+        order = _order_json(0, symbol, body.get('side') or replaces['side'], 0.0, 0.0, datetime.now(timezone.utc))
+
+        order.update({
+            'id': order_id, 'client_order_id': body.get('client_order_id') or order_id,
+            'qty': body.get('qty', replaces['qty'] if replaces else None), 'notional': body.get('notional'),
+            'type': body.get('type') or replaces['type'], 'order_type': body.get('type') or replaces['type'],
+            'time_in_force': body.get('time_in_force') or replaces['time_in_force'],
+            'limit_price': body.get('limit_price', replaces['limit_price'] if replaces else None),
+            'stop_price': body.get('stop_price', replaces['stop_price'] if replaces else None),
+            'trail_price': body.get('trail_price'), 'trail_percent': body.get('trail_percent'),
+            'order_class': body.get('order_class') or 'simple', 'extended_hours': bool(body.get('extended_hours')),
+            'status': 'accepted', 'submitted_at': stamp, 'created_at': stamp, 'updated_at': stamp,
+            'replaces': replaces['id'] if replaces else None
+        })
+
+        return order
+
+    def _handle(self, method: str, path: str, body: Dict, query: Dict) -> Tuple[int, Any]:
+        parts = path.strip('/').split('/')[1:]
+        self.calls.append((method, '/'.join(parts[:1])))
+
+        with self._lock:
+            if parts == ['clock']:
+                return 200, self._clock(datetime.now(timezone.utc))
+
+            if parts == ['calendar']:
+                start = datetime.fromisoformat(query['start']).date()
+                end = datetime.fromisoformat(query['end']).date()
+                return 200, [{'date': day.isoformat(), 'open': '09:30', 'close': '16:00'}
+                             for day in (start + timedelta(days = i) for i in range((end - start).days + 1))
+                             if day.weekday() < 5]
+
+            if parts == ['positions']:
+                # orders never fill
+                return 200, []
+
+            if parts == ['orders:by_client_order_id']:
+                for order in self.orders.values():
+                    if order['client_order_id'] == query.get('client_order_id'):
+                        return 200, order
+                return self._error(404, 40410000, 'order not found')
+
+            if parts[0] != 'orders':
+                return self._error(404, 40410000, 'not found')
+
+            if method == 'POST':
+                if body.get('symbol') in self.reject:
+                    return self._error(403, 40310000, 'insufficient buying power')
+                if body.get('client_order_id') in self._client_ids:
+                    return self._error(422, 40010001, 'client_order_id must be unique')
+
+                draw = self._random.random()
+                if draw < self.fail_rate / 2:
+                    return self._error(500, 50010000, 'internal server error')
+
+                order = self._new_order(body)
+                self.orders[order['id']] = order
+                self._client_ids.add(order['client_order_id'])
+
+                if draw < self.fail_rate:
+                    # the order went in but the answer is lost
+                    return self._error(500, 50010000, 'internal server error')
+
+                return 200, order
+
+            if len(parts) == 1:
+                open_orders = [order for order in self.orders.values()
+                               if order['status'] not in FakeTradingClient._CLOSED]
+
+                if method == 'DELETE':
+                    for order in open_orders:
+                        order['status'] = 'canceled'
+                    return 207, [{'id': order['id'], 'status': 200} for order in open_orders]
+
+                symbols = set(query['symbols'].split(',')) if query.get('symbols') else None
+                status = query.get('status', 'open')
+                orders = list(self.orders.values()) if status == 'all' else open_orders if status == 'open' else \
+                    [order for order in self.orders.values() if order['status'] in FakeTradingClient._CLOSED]
+                return 200, [order for order in orders if symbols is None or order['symbol'] in symbols]
+
+            order = self.orders.get(parts[1])
+            if order is None:
+                return self._error(404, 40410000, 'order not found')
+
+            if method == 'GET':
+                return 200, order
+
+            if order['status'] in FakeTradingClient._CLOSED:
+                return self._error(422, 42210000, f"order is already in {order['status']} state")
+
+            if method == 'DELETE':
+                order['status'] = 'canceled'
+                return 204, None
+
+            # PATCH, a replace makes a new order
+            new = self._new_order(body, replaces = order)
+            order['status'] = 'replaced'
+            order['replaced_by'] = new['id']
+            self.orders[new['id']] = new
+            return 200, new
+
+
+class SimClock:
+
+    def __init__(self, start: datetime):
+        """
+        Simulated time for the tasks of an event loop. sleep waits until every task of the loop is waiting, then the
+        time jumps to the earliest wake up, so hours of schedules run in moments. Hand now and sleep to whatever takes
+        them (MarketClock, EXECUTION) and run the tasks through run, every other wait must be on the loop too, see
+        InlineExecutor.
+
+        :param start: simulated time to start at
+        """
+
+        self.time = _utc(start)
+        # (wake up, sequence, future)
+        self._sleepers: List[Tuple[datetime, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    def now(self) -> datetime:
+        return self.time
+
+    async def sleep(self, seconds: float):
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.time + timedelta(seconds = seconds), next(self._sequence), future))
+        await future
+
+    async def run(self, coro) -> Any:
+        """
+        Runs coro on simulated time
+
+        :return: result of coro
+        """
+
+        task = asyncio.ensure_future(coro)
+        loop = asyncio.get_running_loop()
+
+        while not task.done():
+            # the ready queue of the loop is empty once every other task waits
+            await asyncio.sleep(0)
+            if loop._ready:
+                continue
+
+            if not self._sleepers:
+                # waiting on something outside the loop
+                await asyncio.sleep(0.001)
+                continue
+
+            self.time = max(self.time, self._sleepers[0][0])
+            while self._sleepers and self._sleepers[0][0] <= self.time:
+                future = heapq.heappop(self._sleepers)[2]
+                if not future.done():
+                    future.set_result(None)
+
+        return task.result()
+
+
+class InlineExecutor(Executor):
+    """
+    Runs every call at once on the calling thread, run_in_executor then stays on the loop, for a SimClock
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+        return future
+
+
+class SimBroker(FakeTradingClient):
+
+    def __init__(self, clock: SimClock, price: Callable, impact: float = 0.0, on_update: Callable = None):
+        """
+        Stand in for TradingClient on a SimClock. Market orders and marketable limit orders fill in full at
+        price(symbol) moved impact basis points against the order, the other limit orders rest. Every fill goes to
+        on_update as a trade update right after the submit, hand it ORDERS._update_handler.
+
+        :param clock: clock the orders are stamped with
+        :param price: returns the market price of a symbol
+        :param impact: basis points every fill pays
+        :param on_update: coroutine function taking the trade update messages
+        """
+
+        super().__init__()
+        self.clock = clock
+        self.price = price
+        self.impact = impact
+        self.on_update = on_update
+        self._next_id = 0
+
+    def submit_order(self, order_data) -> Order:
+        self.calls.append('submit_order')
+        # enums to their api values
+        fields = {name: getattr(value, 'value', value) for name, value in order_data.to_request_fields().items()}
+        side = fields['side']
+
+        self._next_id += 1
+        order = _order_json(self._next_id, fields['symbol'], side, float(fields['qty']),
+                            fields.get('limit_price') or 0.0, self.clock.now())
+        order.update({'id': str(uuid.uuid4()), 'client_order_id': fields.get('client_order_id') or str(uuid.uuid4()),
+                      'type': fields['type'], 'order_type': fields['type'],
+                      'time_in_force': fields['time_in_force'], 'status': 'accepted',
+                      'limit_price': str(fields['limit_price']) if fields.get('limit_price') else None})
+        with self._lock:
+            self.orders[order['id']] = order
+
+        price = self.price(fields['symbol']) * (1 + (self.impact if side == 'buy' else -self.impact) / 1e4)
+        limit = fields.get('limit_price')
+        if limit is None or (price <= limit if side == 'buy' else price >= limit):
+            asyncio.get_running_loop().call_soon(self._fill, order, round(price, 4))
+
+        return Order(**order)
+
+    def _fill(self, order: Dict, price: float):
+        stamp = _rfc3339(self.clock.now())
+        qty = float(order['qty'])
+        position = self.positions.get(order['symbol'], [0.0, 0.0])[0] + (qty if order['side'] == 'buy' else -qty)
+
+        order = {**order, 'status': 'filled', 'filled_qty': str(qty), 'filled_avg_price': str(price),
+                 'filled_at': stamp, 'updated_at': stamp}
+        message = {'stream': 'trade_updates',
+                   'data': {'event': 'fill', 'order': order, 'timestamp': stamp, 'price': str(price),
+                            'qty': str(qty), 'position_qty': str(position), 'execution_id': str(uuid.uuid4())}}
+        self.apply(message)
+
+        if self.on_update is not None:
+            asyncio.get_running_loop().create_task(self.on_update(message))
+
+
+def trade_update_events(n: int, open_orders: int = 1000, symbols: List[str] = None, seed: int = 0,
+                        start: datetime = datetime(2024, 1, 2, 14, 30, tzinfo = timezone.utc)) -> List[Dict]:
+    """
+    Synthetic trade_updates messages, as the trading stream sends them once decoded from json.
+    Orders go through new, partial fills, replaces and end in a fill, cancel or expiry, about open_orders of them
+    are open at any time.
+
+    :param n: number of events
+    :param open_orders: open orders the stream hovers around
+    :param symbols: symbols of the orders
+    :param seed: seed of the draws
+    :param start: time of the first event
+    :return: list of {'stream': 'trade_updates', 'data': {...}}
+    """
+
+    rng = random.Random(seed)
+    symbols = symbols or [f"SYM{i}" for i in range(100)]
+
+    live: List[Dict] = []
+    events = []
+    next_id = 0
+    position: Dict[str, float] = {}
+
+    def emit(event: str, order: Dict, ts: datetime, price: float = None, qty: float = None):
+        stamp = _rfc3339(ts)
+        order = {**order, 'updated_at': stamp}
+        data = {'event': event, 'order': order, 'timestamp': stamp, 'execution_id': None}
+        if qty is not None:
+            sign = 1 if order['side'] == 'buy' else -1
+            position[order['symbol']] = position.get(order['symbol'], 0.0) + sign * qty
+            data.update({'price': str(price), 'qty': str(qty), 'position_qty': str(position[order['symbol']]),
+                         'execution_id': f"exec-{len(events)}"})
+        events.append({'stream': 'trade_updates', 'data': data})
+        return order
+
+    while len(events) < n:
+        ts = start + timedelta(milliseconds = len(events))
+
+        if not live or (len(live) < open_orders and rng.random() < 0.5):
+            symbol = rng.choice(symbols)
+            price = FakeStockDataClient._price(symbol, ts)
+            order = _order_json(next_id, symbol, rng.choice(['buy', 'sell']), float(rng.randint(1, 10) * 10),
+                                price, ts)
+            next_id += 1
+            live.append(emit('new', order, ts))
+            continue
+
+        i = rng.randrange(len(live))
+        order = live[i]
+        draw = rng.random()
+        qty = float(order['qty'])
+        filled = float(order['filled_qty'])
+        price = float(order['limit_price'])
+
+        if draw < 0.45 and qty - filled > 10:
+            fill_qty = 10.0
+            order = {**order, 'status': 'partially_filled', 'filled_qty': str(filled + fill_qty),
+                     'filled_avg_price': str(price)}
+            live[i] = emit('partial_fill', order, ts, price, fill_qty)
+            continue
+
+        # the last open order takes the place of the finished one
+        live[i] = live[-1]
+        live.pop()
+
+        if draw < 0.75:
+            order = {**order, 'status': 'filled', 'filled_qty': str(qty), 'filled_avg_price': str(price),
+                     'filled_at': _rfc3339(ts)}
+            emit('fill', order, ts, price, qty - filled)
+
+        elif draw < 0.9:
+            emit('canceled', {**order, 'status': 'canceled', 'canceled_at': _rfc3339(ts)}, ts)
+
+        elif draw < 0.95:
+            emit('expired', {**order, 'status': 'expired', 'expired_at': _rfc3339(ts)}, ts)
+
+        else:
+            # replace, the old order ends and a new one with the new limit takes over
+            new = _order_json(next_id, order['symbol'], order['side'], qty, round(price * 1.001, 4), ts)
+            new['replaces'] = order['id']
+            next_id += 1
+            emit('replaced', {**order, 'status': 'replaced', 'replaced_by': new['id'],
+                              'replaced_at': _rfc3339(ts)}, ts)
+            live.append(emit('new', new, ts))
+
+    return events[:n]
@@ -0,0 +1,298 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import os
+import inspect
+import itertools
+import pathlib
+import random
+import shutil
+import tempfile
+import polars as pl
+import logging
+import time as true_time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from Finance.stockData import STOCKFRAME
+from Finance.indicators import INDICATORS
+from Finance.vectorBacktest import VECTORBACKTEST
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Parameter sweeps of VECTORBACKTEST strategies over a process pool.
+
+The bars of the stock frame are written once to one arrow ipc file (uncompressed, the rows of a symbol together),
+every worker scans it memory mapped, so the data is shared through the page cache and never pickled. A task is one
+parameter set, only the parameters and the names of the splits go over the pipe:
+    parameters  dicts, keys named like the arguments of INDICATORS (rsi_length, supertrend, bollinger, ...) build the
+                indicators, the whole dict goes to the signal function which returns the entry and exit expressions
+    splits      walk forward windows (train start, train end = test start, test end), the indicators of a parameter
+                set are computed once over all the bars and every window is backtested on its slice
+The signal function is pickled by reference, it has to be a module level function.
+
+Results come back as one polars table, one row per parameter set, split and fold (train / test), with the stats of
+VECTORBACKTEST. walk_forward picks the best train row of every split and reports its test row, the out of sample
+result of the optimisation.
+'''
+
+# INDICATORS arguments a parameter set can set
+INDICATOR_PARAMETERS = set(inspect.signature(INDICATORS.__init__).parameters) - {'self', 'stockFrame'}
+
+# columns of the results table which are not parameters
+_RESULT_COLUMNS = {'split', 'fold', 'start', 'end', 'seconds', 'total_return', 'sharpe', 'max_drawdown', 'trades',
+                   'win_rate', 'fees', 'timestamps'}
+
+_BARS: Union[pl.LazyFrame, None] = None
+
+
+def grid(**space: List) -> List[Dict]:
+    """
+    Every combination of the values
+
+    :param space: parameter name to the list of its values
+    :return: list of parameter sets
+    """
+
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_parameters(n: int, seed: int = 0, **space: Union[List, Callable]) -> List[Dict]:
+    """
+    Random search
+
+    :param n: number of parameter sets
+    :param seed: seed of the draws
+    :param space: parameter name to a list to choose from or a function drawing a value from a random.Random
+    :return: list of parameter sets
+    """
+
+    rng = random.Random(seed)
+    return [{name: values(rng) if callable(values) else rng.choice(values) for name, values in space.items()}
+            for _ in range(n)]
+
+
+def _init_worker(path: str):
+    global _BARS
+    _BARS = pl.scan_ipc(path)
+
+
+def _evaluate(task: Tuple[Dict, Callable, List[Tuple[datetime, datetime, datetime]], Dict]) -> List[Dict]:
+    params, signal, splits, settings = task
+
+    t0 = true_time.perf_counter()
+    indicators = INDICATORS(None, **{name: value for name, value in params.items() if name in INDICATOR_PARAMETERS})
+    vector = VECTORBACKTEST(None, indicators = indicators, **settings)
+    entry, exit = signal(params)
+
+    # only the indicator columns the signal reads get computed, once for every split
+    columns = set(entry.meta.root_names()) | (set(exit.meta.root_names()) if exit is not None else set())
+    bars = _BARS.collect_schema().names()
+    frame = vector.frame(bars = _BARS).select(bars + sorted(columns - set(bars))).collect()
+    indicator_seconds = true_time.perf_counter() - t0
+
+    row = {name: str(value) if isinstance(value, tuple) else value for name, value in params.items()}
+    rows = []
+    for split, (start, middle, end) in enumerate(splits):
+        for fold, lower, upper in (('train', start, middle), ('test', middle, end)):
+            if lower >= upper:
+                continue
+
+            window = frame.filter((pl.col('timestamp') >= lower) & (pl.col('timestamp') < upper))
+            result = vector.run(entry, exit, frame = window.lazy())
+
+            rows.append({**row, 'split': split, 'fold': fold, 'start': lower, 'end': upper, **result['stats'],
+                         'seconds': result['seconds'] + indicator_seconds / (2 * len(splits))})
+
+    return rows
+
+
+class SWEEP:
+
+    def __init__(self, stockFrame: STOCKFRAME, signal: Callable[[Dict], Tuple[pl.Expr, pl.Expr]],
+                 symbols: List[str] = None, workers: int = None, root: Union[str, pathlib.Path] = None,
+                 **settings):
+        """
+        :param stockFrame: frame with the bars in data_map
+        :param signal: module level function of a parameter set returning the entry and exit expressions
+        :param symbols: symbols to backtest, defaults to every symbol in data_map
+        :param workers: processes of the pool, defaults to the cpu count
+        :param root: directory of the shared bars file, a temporary one is made (and removed on close) if not given
+        :param settings: VECTORBACKTEST arguments (cash, allocation, fee_bps, slippage_bps, ...)
+        """
+
+        self.signal = signal
+        self.workers = workers or os.cpu_count() or 1
+        self.settings = settings
+
+        self._temporary = root is None
+        self.root = pathlib.Path(tempfile.mkdtemp(prefix = 'sweep_') if root is None else root)
+        self.root.mkdir(parents = True, exist_ok = True)
+        self.path = self.root / 'bars.arrow'
+
+        INDICATORS(stockFrame)._frame(symbols).collect().write_ipc(self.path, compression = 'uncompressed')
+        self.first, self.last = pl.scan_ipc(self.path).select(
+            pl.col('timestamp').min().alias('first'), pl.col('timestamp').max().alias('last')).collect().row(0)
+
+    def close(self):
+        if self._temporary:
+            shutil.rmtree(self.root, ignore_errors = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def splits(self, train: timedelta, test: timedelta, step: timedelta = None,
+               anchored: bool = False) -> List[Tuple[datetime, datetime, datetime]]:
+        """
+        Walk forward windows over the bars
+
+        :param train: length of the train window
+        :param test: length of the test window, it starts where the train window ends
+        :param step: how far the windows move, defaults to test
+        :param anchored: train windows all start at the first bar and grow
+        :return: list of (train start, test start, test end)
+        """
+
+        step = step or test
+        splits = []
+        start = self.first
+        while start + train < self.last:
+            middle = start + train
+            splits.append((self.first if anchored else start, middle, min(middle + test, self.last + timedelta(1))))
+            start += step
+
+        return splits
+
+    def run(self, parameters: List[Dict], splits: List[Tuple[datetime, datetime, datetime]] = None,
+            workers: int = None, chunksize: int = 1) -> pl.DataFrame:
+        """
+        Backtests every parameter set on every split
+
+        :param parameters: parameter sets, see grid and random_parameters
+        :param splits: walk forward windows, defaults to all the bars as one train window
+        :param workers: processes for this run, defaults to the sweep's
+        :param chunksize: parameter sets sent to a worker at once
+        :return: one row per parameter set, split and fold
+        """
+
+        if not parameters:
+            raise ValueError("no parameter sets to run.")
+
+        if splits is None:
+            end = self.last + timedelta(1)
+            splits = [(self.first, end, end)]
+
+        tasks = [(params, self.signal, splits, self.settings) for params in parameters]
+        workers = min(workers or self.workers, len(tasks))
+
+        # spawn, forked polars thread pools can deadlock
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers = workers, mp_context = context, initializer = _init_worker,
+                                 initargs = (str(self.path),)) as pool:
+            rows = [row for result in pool.map(_evaluate, tasks, chunksize = chunksize) for row in result]
+
+        return pl.DataFrame(rows)
+
+    @staticmethod
+    def walk_forward(results: pl.DataFrame, metric: str = 'sharpe', maximize: bool = True) -> pl.DataFrame:
+        """
+        Out of sample result of optimising metric on every train window
+
+        :param results: table of run, with splits
+        :param metric: stat column to optimise
+        :param maximize: False to pick the lowest metric (eg max_drawdown)
+        :return: one row per split, the parameters chosen on the train window and their test stats
+        """
+
+        params = [name for name in results.columns if name not in _RESULT_COLUMNS]
+
+        train = results.filter(pl.col('fold') == 'train').with_columns(pl.col(metric).fill_nan(None))
+        best = (
+            train.sort(metric, descending = maximize, nulls_last = True)
+            .group_by('split', maintain_order = True).first()
+            .select(['split'] + params + [pl.col(metric).alias(f'train_{metric}')])
+        )
+
+        return (
+            best.join(results.filter(pl.col('fold') == 'test'), on = ['split'] + params, how = 'left')
+            .drop('fold')
+            .sort('split')
+        )
+
+
+def rsi_signal(params: Dict) -> Tuple[pl.Expr, pl.Expr]:
+    """
+    Example signal, buys rsi under the oversold level and sells rsi over the overbought level or a supertrend flip
+    """
+
+    entry = pl.col('rsi') < params.get('oversold', 30)
+    exit = (pl.col('rsi') > params.get('overbought', 70)) | (pl.col('supertrend_dir') < 0)
+    return entry, exit
+
+
+if __name__ == '__main__':
+    import sys
+    import numpy as np
+
+    from Finance.columnar import BAR_SCHEMA
+
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    rng = np.random.default_rng(0)
+    stamps = np.concatenate([
+        np.datetime64(datetime(2024, 1, 2, 14, 30) + timedelta(days = d), 'us') + np.arange(390) * np.timedelta64(1, 'm')
+        for d in range(days)
+    ])
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    for i in range(n_symbols):
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 1e-3, len(stamps))))
+        spread = np.abs(rng.normal(0, 3e-4, len(stamps))) * close
+        frame.data_map[f"SYM{i}"] = pl.DataFrame({
+            'timestamp': stamps, 'open': np.r_[close[0], close[:-1]], 'high': close + spread, 'low': close - spread,
+            'close': close, 'volume': np.full(len(stamps), 1000.0), 'trade_count': np.full(len(stamps), 10.0),
+            'vwap': close
+        }).select(list(BAR_SCHEMA)).cast(BAR_SCHEMA)
+
+    parameters = grid(rsi_length = [7, 14, 21], supertrend = [(10, 2.0), (20, 3.0)], oversold = [20, 30],
+                      overbought = [70])
+    parameters += random_parameters(8, seed = 1, rsi_length = lambda r: r.randint(5, 30), oversold = [25, 30, 35],
+                                    overbought = lambda r: r.choice([65, 70, 75]), supertrend = [(10, 2.0)])
+
+    with SWEEP(frame, rsi_signal, cash = n_symbols * 10_000.0, fee_bps = 1.0) as sweep:
+        splits = sweep.splits(train = timedelta(days = 10), test = timedelta(days = 5))
+
+        # the same run over 1 to N processes, the efficiency is the speedup over the number of processes
+        timings = {}
+        for workers in range(1, (os.cpu_count() or 1) + 1):
+            t0 = true_time.perf_counter()
+            results = sweep.run(parameters, splits, workers = workers)
+            timings[workers] = true_time.perf_counter() - t0
+
+            print(f"{workers} processes: {len(parameters)} parameter sets x {len(splits)} splits "
+                  f"({results.height} backtests of {n_symbols} symbols) in {timings[workers]:.2f} s, "
+                  f"efficiency {timings[1] / (workers * timings[workers]):.0%}")
+
+        assert results.height == len(parameters) * len(splits) * 2
+
+        # a worker reads the shared file, it has to agree with a backtest straight off the stock frame
+        params = parameters[0]
+        vector = VECTORBACKTEST(frame, indicators = INDICATORS(frame, rsi_length = params['rsi_length'],
+                                                                supertrend = params['supertrend']),
+                                cash = n_symbols * 10_000.0, fee_bps = 1.0)
+        start, middle, end = splits[0]
+        window = vector.frame().filter((pl.col('timestamp') >= start) & (pl.col('timestamp') < middle))
+        expected = vector.run(*rsi_signal(params), frame = window)['stats']['total_return']
+        got = results.filter((pl.col('split') == 0) & (pl.col('fold') == 'train')).row(0, named = True)
+        assert abs(got['total_return'] - expected) < 1e-12, (got['total_return'], expected)
+
+        print(results.with_columns(pl.col('sharpe').fill_nan(None)).sort('sharpe', descending = True, nulls_last = True)
+              .head())
+        print(SWEEP.walk_forward(results))
@@ -0,0 +1,142 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import json
+import logging
+import time as true_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Decoding of the trading stream frames.
+
+The json parser is whichever of msgspec, orjson and the stdlib is installed, in that order. Trade updates are then
+turned into TradeUpdate, a slotted object with the fields handlers read as attributes, numbers already floats:
+    event, timestamp, execution_id, price, qty, position_qty
+    order_id, symbol, side      pulled up from the order
+    order                       the raw order json, for the order store
+Control messages (authorization, listening) stay dicts.
+'''
+
+_LOADERS = {
+    'msgspec': msgspec.json.decode if msgspec is not None else None,
+    'orjson': orjson.loads if orjson is not None else None,
+    'json': json.loads
+}
+
+# installed json backends, fastest first
+BACKENDS = tuple(name for name, loads in _LOADERS.items() if loads is not None)
+
+
+def _float(value) -> Union[float, None]:
+    return float(value) if value is not None else None
+
+
+class TradeUpdate:
+    __slots__ = ('event', 'timestamp', 'execution_id', 'price', 'qty', 'position_qty', 'order_id', 'symbol', 'side',
+                 'order')
+
+    stream = 'trade_updates'
+
+    def __init__(self, data: Dict):
+        """
+        :param data: data of a trade_updates message
+        """
+
+        order = data.get('order') or {}
+
+        self.event: str = data.get('event')
+        self.timestamp: str = data.get('timestamp')
+        self.execution_id: Union[str, None] = data.get('execution_id')
+        self.price: Union[float, None] = _float(data.get('price'))
+        self.qty: Union[float, None] = _float(data.get('qty'))
+        self.position_qty: Union[float, None] = _float(data.get('position_qty'))
+        self.order_id: str = order.get('id', '')
+        self.symbol: str = order.get('symbol')
+        self.side: str = order.get('side')
+        self.order: Dict = order
+
+    def __repr__(self) -> str:
+        return f"TradeUpdate({self.event} {self.side} {self.symbol} {self.qty}@{self.price} order {self.order_id})"
+
+
+class TradeUpdateDecoder:
+
+    def __init__(self, backend: str = None, structs: bool = True):
+        """
+        :param backend: json backend, one of BACKENDS, defaults to the fastest installed
+        :param structs: decode trade updates into TradeUpdate, False keeps the dicts of the stream
+        """
+
+        backend = backend or BACKENDS[0]
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of the installed {BACKENDS}.")
+
+        self.backend = backend
+        self.structs = structs
+        self._loads = _LOADERS[backend]
+
+    def __call__(self, frame: Union[str, bytes]) -> Union[TradeUpdate, Dict]:
+        message = self._loads(frame)
+
+        if self.structs and message.get('stream') == 'trade_updates':
+            return TradeUpdate(message['data'])
+
+        return message
+
+
+if __name__ == '__main__':
+    from Finance.stubs import trade_update_events
+
+    # decode and dispatch of the frames the stream receives, the stream routes on the stream name and order id, the
+    # handler reads what ORDERS and the ledger read
+    events = trade_update_events(100_000, open_orders = 2_000)
+    frames = [json.dumps(event).encode() for event in events]
+
+    def dict_handler(response: Dict):
+        if response.get('stream') != 'trade_updates':
+            return None
+        shard = hash(response.get('data', {}).get('order', {}).get('id', '')) % 8
+
+        data = response.get('data')
+        order = data.get('order')
+        if data.get('event') in ('fill', 'partial_fill'):
+            return shard, order.get('symbol'), order.get('side'), float(data.get('qty')), float(data.get('price')), \
+                float(data.get('position_qty'))
+        return shard, order.get('id'), data.get('event')
+
+    def struct_handler(update: TradeUpdate):
+        if not isinstance(update, TradeUpdate):
+            return None
+        shard = hash(update.order_id) % 8
+
+        if update.event in ('fill', 'partial_fill'):
+            return shard, update.symbol, update.side, update.qty, update.price, update.position_qty
+        return shard, update.order_id, update.event
+
+    results = {}
+    for backend in BACKENDS:
+        for structs in (False, True):
+            decode = TradeUpdateDecoder(backend, structs = structs)
+            handler = struct_handler if structs else dict_handler
+
+            t0 = true_time.perf_counter()
+            out = [handler(decode(frame)) for frame in frames]
+            seconds = true_time.perf_counter() - t0
+
+            results[(backend, structs)] = out
+            print(f"{backend:>7} {'structs' if structs else 'dicts':>7}: {len(frames) / seconds:,.0f} msgs/s")
+
+    # every decoder hands the same values to the handler
+    reference = results[('json', False)]
+    assert all(out == reference for out in results.values())
@@ -4,9 +4,11 @@ from typing import List, Dict, Tuple, Union, Any, Optional, Callable
 import numpy as np
 import pandas as pd
 import asyncio
+import collections
+from datetime import datetime, timezone
+import random
 import websockets
 import json
-import queue
 import logging
 
 import alpaca
@@ -22,21 +24,82 @@ from alpaca.trading.requests import *
 from alpaca.trading.enums import *
 from alpaca.common.exceptions import APIError
 
+from Finance.tradeDecoder import TradeUpdate, TradeUpdateDecoder
+
 
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
-#may have to alter sleep times coz if orders r rapid dk how its gonna react
+
+'''
+The socket is read by one reader task which only parses and queues, the handler runs in worker tasks, so a slow
+handler (a reconciliation going to the api) never holds up the reads.
+
+Messages are sharded over the workers by symbol, the updates of an order, and of all the orders of a symbol (the
+ledger checks every fill against the position qty after it), are handled in the order they came in, different symbols
+are handled concurrently. Each worker has a bounded queue of queue_size / workers messages, what
+happens when it is full is the policy:
+    block           the reader waits for room, the socket buffers and the server slows down, nothing is lost
+    drop_oldest     the oldest queued message of the worker is dropped for the new one
+    coalesce        an order with an update still queued has it replaced by the newest one, the order keeps its place
+                    in the queue. The order store only needs the latest state, fills merged away are caught by the
+                    position_qty check of the ledger. Full queues block like block
+workers = 0 handles every message inline in the reader, the behaviour of the old stream.
+
+Frames are decoded by decoder, by default a TradeUpdateDecoder, so handlers get TradeUpdate objects (see
+tradeDecoder), a TradeUpdateDecoder(structs = False) keeps the dicts.
+
+Dropped connections are retried with full jitter exponential backoff, a random wait between 0 and
+min(max_backoff, backoff * 2 ** attempt), attempts start over once a connection got updates. Updates sent while the
+stream was down are lost, after every reconnect the handlers given to subscribe_reconnect are awaited with the
+timestamp of the last update seen (the first connect time if none) to fetch what changed since, once the queued
+updates are handled and before the new ones are read.
+
+stop sets an asyncio.Event, the reader and the reconnect loop wake on it right away, the queued messages are handled
+before the workers end.
+'''
+
+POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+class _Shard:
+    __slots__ = ('queue', 'latest', 'dropped', 'coalesced')
+
+    def __init__(self, size: int):
+        self.queue = asyncio.Queue(maxsize = size)
+        # coalesce, latest message of every queued order id
+        self.latest: Dict[str, Dict] = {}
+        self.dropped = 0
+        self.coalesced = 0
+
 
 class TradeStream:
     def __init__(self, paper: bool = True, url_override: str = None, websocket_params: Optional[Dict] = None,
-                 api_key: str = '', secret_key: str = ''):
+                 api_key: str = '', secret_key: str = '', workers: int = 4, queue_size: int = 4096,
+                 policy: str = 'block', decoder: Callable = None, backoff: float = 0.1, max_backoff: float = 30.0):
+        """
+        :param paper: paper or live endpoint
+        :param url_override: endpoint to use instead, eg a local replay server
+        :param websocket_params: arguments of websockets.connect
+        :param api_key: api key
+        :param secret_key: secret key
+        :param workers: handler tasks, 0 handles inline in the reader
+        :param queue_size: messages queued over all the workers
+        :param policy: what a full queue does, block, drop_oldest or coalesce
+        :param decoder: turns a frame into a message, defaults to TradeUpdateDecoder()
+        :param backoff: seconds of the first reconnect backoff, doubled every failed attempt
+        :param max_backoff: cap of the reconnect backoff
+        """
+
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}.")
+
         self.paper = paper
         self._api_key = api_key
         self._secret_key = secret_key
         self._end_point = url_override if url_override else 'wss://paper-api.alpaca.markets/stream' if (
             self.paper) else 'wss://data.alpaca.markets/stream'
 
-        self._ws: Union[websockets.WebSocketClientProtocol, None] = None
+        self._ws = None
         self._websocket_params = {
             "ping_interval": 10,
             "ping_timeout": 180,
@@ -46,11 +109,39 @@ class TradeStream:
         if websocket_params:
             self._websocket_params = websocket_params
 
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self._decode = decoder if decoder is not None else TradeUpdateDecoder()
+
         self._running = False
         self._should_run = False
         self._loop = None
-        self._stop_stream_queue = queue.Queue()
+        self._stop = asyncio.Event()
+        self._subscribed = asyncio.Event()
         self._handler = None
+        self._reconnect_handler = None
+
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._attempts = 0
+        self.connections = 0
+        # rfc3339 timestamp of the last trade update
+        self.last_event_at: Union[str, None] = None
+        self._connected_at: Union[str, None] = None
+
+        self._shards: List[_Shard] = []
+        self._tasks: List[asyncio.Task] = []
+        self.received = 0
+        self.handled = 0
+
+    @property
+    def dropped(self) -> int:
+        return sum(shard.dropped for shard in self._shards)
+
+    @property
+    def coalesced(self) -> int:
+        return sum(shard.coalesced for shard in self._shards)
 
     async def _connect(self):
         log.info(f"Connecting to {self._end_point}")
@@ -93,8 +184,24 @@ class TradeStream:
 
         self._handler = handler
 
-        if self._running:
-            asyncio.run_coroutine_threadsafe(self._subscribe_trade_updates(), self._loop).result()
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._subscribed.set)
+
+            if self._running:
+                asyncio.run_coroutine_threadsafe(self._subscribe_trade_updates(), self._loop).result()
+        else:
+            self._subscribed.set()
+
+    def subscribe_reconnect(self, handler: Callable):
+        """
+        :param handler: coroutine function awaited after every reconnect with the rfc3339 timestamp updates may have
+                        been missed since
+        """
+
+        if not asyncio.iscoroutinefunction(handler):
+            raise ValueError("handler must be coroutine function.")
+
+        self._reconnect_handler = handler
 
     def run(self):
         try:
@@ -117,81 +224,311 @@ class TradeStream:
             self._running = False
             log.info("Terminating websocket connection.")
 
-    async def _dispatch(self, response: Dict):
-        stream = response.get('stream')
+    ############################################ queueing ########################################################
+    @staticmethod
+    def _keys(response: Union[TradeUpdate, Dict]) -> Tuple[str, str]:
+        # symbol and order id
+        if isinstance(response, TradeUpdate):
+            return response.symbol, response.order_id
+
+        order = response.get('data', {}).get('order') or {}
+        return order.get('symbol', ''), order.get('id', '')
+
+    async def _put(self, response: Union[TradeUpdate, Dict]):
+        symbol, order_id = self._keys(response)
+        shard = self._shards[hash(symbol) % len(self._shards)]
+
+        if self.policy == 'coalesce':
+            if order_id in shard.latest:
+                shard.latest[order_id] = response
+                shard.coalesced += 1
+                return
+
+            shard.latest[order_id] = response
+            await shard.queue.put(order_id)
+
+        elif self.policy == 'drop_oldest':
+            if shard.queue.full():
+                shard.queue.get_nowait()
+                shard.queue.task_done()
+                shard.dropped += 1
+            shard.queue.put_nowait(response)
+
+        else:
+            await shard.queue.put(response)
+
+    async def _handle(self, response: Union[TradeUpdate, Dict]):
+        try:
+            await self._handler(response)
+        except Exception as e:
+            # one bad update must not take the stream down
+            log.exception(f"trade update handler failed: {e}")
+
+        self.handled += 1
+
+    async def _work(self, shard: _Shard):
+        while True:
+            item = await shard.queue.get()
+
+            if self.policy == 'coalesce':
+                item = shard.latest.pop(item)
+
+            await self._handle(item)
+            shard.queue.task_done()
+
+    async def _dispatch(self, response: Union[TradeUpdate, Dict]):
+        stream = response.stream if isinstance(response, TradeUpdate) else response.get('stream')
 
         if stream == 'trade_updates':
+            self.received += 1
+            self.last_event_at = response.timestamp if isinstance(response, TradeUpdate) else \
+                response.get('data', {}).get('timestamp')
+
             if self._handler:
-                await self._handler(response)
+                if self._shards:
+                    await self._put(response)
+                else:
+                    await self._handle(response)
 
-    async def _consume(self):
-        while True:
-            if not self._stop_stream_queue.empty():
-                self._stop_stream_queue.get(timeout = 1)
-                await self._close_ws()
-                break
+        elif stream == 'listening':
+            log.info(f"listening to {response.get('data', {}).get('streams')}")
 
-            else:
-                try:
-                    response = await asyncio.wait_for(self._ws.recv(), 5)
-                    response = json.loads(response)
-                    await self._dispatch(response)
+    async def _consume(self):
+        # closing the socket on stop ends the iteration
+        async for response in self._ws:
+            await self._dispatch(self._decode(response))
 
-                except asyncio.TimeoutError:
-                    log.info("No updates yet, listening.....")
-                    pass
+    async def _stop_on_event(self):
+        await self._stop.wait()
+        await self._close_ws()
 
     async def _run_forever(self):
         self._loop = asyncio.get_running_loop()
 
         # do not start until subscribed
-        while not self._handler:
-            if not self._stop_stream_queue.empty():
-                self._stop_stream_queue.get(timeout = 1)
+        if not self._handler:
+            await asyncio.wait([asyncio.ensure_future(self._subscribed.wait()),
+                                asyncio.ensure_future(self._stop.wait())], return_when = asyncio.FIRST_COMPLETED)
+            if self._stop.is_set():
                 return
-            await asyncio.sleep(0.1)
 
         logging.info("started streaming")
         self._should_run = True
         self._running = False
 
-        while True:
-            try:
-                if not self._should_run:
-                    log.info("stopping trading stream.")
-                    return
+        if self.workers:
+            size = max(1, self.queue_size // self.workers)
+            self._shards = [_Shard(size) for _ in range(self.workers)]
+            self._tasks = [asyncio.create_task(self._work(shard)) for shard in self._shards]
 
-                if not self._running:
+        stopper = asyncio.create_task(self._stop_on_event())
+
+        try:
+            while not self._stop.is_set():
+                received = self.received
+
+                try:
                     log.info("establishing websocket connection")
                     await self._start_ws()
 
+                    if self.connections:
+                        await self._recover()
+                    else:
+                        self._connected_at = datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+                    self.connections += 1
                     self._running = True
                     await self._consume()
 
-            except websockets.WebSocketException as wse:
-                await self._close_ws()
-                self._running = False
+                except (websockets.WebSocketException, OSError) as e:
+                    log.warning("websocket error, restarting connection: " + str(e))
 
-                log.warning("websocket error, restarting connection: " + str(wse))
+                except Exception as e:
+                    log.exception("Exception during websocket: " + str(e))
 
-            except Exception as e:
-                log.exception("Exception during websocket: " + str(e))
+                finally:
+                    await self._close_ws()
 
-            finally:
-                await asyncio.sleep(0.01)
+                if self.received > received:
+                    self._attempts = 0
+                await self._backoff()
+
+            log.info("stopping trading stream.")
+
+        finally:
+            stopper.cancel()
+            await self._close_ws()
+
+            # handle what is already queued, then end the workers
+            for shard in self._shards:
+                await shard.queue.join()
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions = True)
+            self._tasks = []
+
+    async def _backoff(self):
+        if self._stop.is_set():
+            return
+
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** self._attempts))
+        self._attempts += 1
+
+        # a stop cuts the wait short
+        try:
+            await asyncio.wait_for(self._stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _recover(self):
+        since = self.last_event_at or self._connected_at
+        log.info(f"reconnected, recovering trade updates since {since}")
+
+        # updates from before the drop go first, the recovery brings newer states
+        for shard in self._shards:
+            await shard.queue.join()
+
+        if self._reconnect_handler:
+            await self._reconnect_handler(since)
 
     async def _stop_ws(self):
         self._should_run = False
-        if self._stop_stream_queue.empty():
-            self._stop_stream_queue.put_nowait({'should_stop': True})
+        self._stop.set()
 
     def stop(self):
         if self._loop.is_running():
             asyncio.run_coroutine_threadsafe(self._stop_ws(), self._loop).result()
 
+
 if __name__ == '__main__':
-    t = TradeStream()
-    async def handler(msg):
-        print(msg)
-    t.subscribe_trade_updates(handler)
-    t.run()
+    import time as true_time
+
+    from Finance.stubs import TradeUpdateServer, FakeTradingClient, trade_update_events
+
+    # trade updates at 5000/s, the handler takes 20 us and one update in 200 goes to the api for 20 ms
+    events = trade_update_events(20_000, open_orders = 1_000)
+
+    def percentiles(values: List[float]) -> str:
+        values = np.array(values) * 1e3
+        return f"p50 {np.percentile(values, 50):.2f} ms, p99 {np.percentile(values, 99):.2f} ms"
+
+    async def replay(workers: int, policy: str):
+        server = TradeUpdateServer(events, rate = 5000)
+        await server.start()
+
+        # dicts, the seq of the replay server is not a field of TradeUpdate
+        stream = TradeStream(url_override = server.url, workers = workers, policy = policy,
+                             decoder = TradeUpdateDecoder(structs = False))
+        read_at, handled_at = {}, {}
+
+        original = stream._dispatch
+
+        async def dispatch(response: Dict):
+            if 'seq' in response:
+                read_at[response['seq']] = true_time.perf_counter()
+            await original(response)
+
+        stream._dispatch = dispatch
+
+        async def handler(response: Dict):
+            if response['seq'] % 200 == 0:
+                await asyncio.sleep(0.02)
+            else:
+                end = true_time.perf_counter() + 20e-6
+                while true_time.perf_counter() < end:
+                    pass
+            handled_at[response['seq']] = true_time.perf_counter()
+
+        stream.subscribe_trade_updates(handler)
+        runner = asyncio.create_task(stream._run_forever())
+
+        await server.done.wait()
+        while len(read_at) < len(events):
+            await asyncio.sleep(0.01)
+
+        t0 = true_time.perf_counter()
+        await stream._stop_ws()
+        await runner
+        stop_ms = (true_time.perf_counter() - t0) * 1e3
+        await server.stop()
+
+        read = [read_at[i] - server.sent_at[i] for i in read_at]
+        handled = [handled_at[i] - server.sent_at[i] for i in handled_at]
+        print(f"workers {workers} {policy:>11}: read {percentiles(read)}, handled {percentiles(handled)}, "
+              f"{stream.handled} handled, {stream.dropped} dropped, {stream.coalesced} coalesced, "
+              f"stopped in {stop_ms:.1f} ms")
+
+        return stream
+
+    async def main():
+        await replay(0, 'block')
+        stream = await replay(8, 'block')
+        assert stream.handled == len(events)
+        await replay(8, 'drop_oldest')
+        await replay(8, 'coalesce')
+
+        # per order ordering, the updates of every order reach the handler in the order they were sent
+        server = TradeUpdateServer(events)
+        await server.start()
+        stream = TradeStream(url_override = server.url, workers = 8, queue_size = 64, policy = 'block',
+                             decoder = TradeUpdateDecoder(structs = False))
+        seen: Dict[str, List[int]] = collections.defaultdict(list)
+
+        async def ordered(response: Dict):
+            if response['seq'] % 97 == 0:
+                await asyncio.sleep(0.001)
+            seen[TradeStream._keys(response)[1]].append(response['seq'])
+
+        stream.subscribe_trade_updates(ordered)
+        runner = asyncio.create_task(stream._run_forever())
+        await server.done.wait()
+        while stream.received < len(events):
+            await asyncio.sleep(0.01)
+        await stream._stop_ws()
+        await runner
+        await server.stop()
+
+        assert sum(len(seqs) for seqs in seen.values()) == len(events)
+        assert all(seqs == sorted(seqs) for seqs in seen.values())
+        print(f"{len(seen)} orders, every order's updates handled in order")
+
+        # the server drops the connection every 3000 updates and 200 more happen before the stream is back, the
+        # recovery brings ORDERS and the ledger back in line with the broker
+        from Finance.orders import ORDERS
+        from Finance.portfolio import PORTFOLIO
+
+        for recover in (False, True):
+            broker = FakeTradingClient()
+            server = TradeUpdateServer(events, drop_every = 3000, gap = 200, on_event = broker.apply)
+            await server.start()
+
+            orders = ORDERS(broker, PORTFOLIO(broker, reconcile_interval = 1e9))
+            stream = TradeStream(url_override = server.url, workers = 4, backoff = 0.01, max_backoff = 0.1)
+            stream.subscribe_trade_updates(orders._update_handler)
+            if recover:
+                stream.subscribe_reconnect(orders._reconnect_handler)
+
+            runner = asyncio.create_task(stream._run_forever())
+            await server.done.wait()
+            while stream.received < len(events) - len(server.lost):
+                await asyncio.sleep(0.01)
+            await stream._stop_ws()
+            await runner
+            await server.stop()
+
+            broker_open = {order_id for order_id, order in broker.orders.items()
+                           if order['status'] not in FakeTradingClient._CLOSED}
+            drift = len(broker_open ^ orders.order_store.ids())
+            ledger = orders.portfolio.ledger
+            positions = sum(abs(ledger.get(symbol)['qty'] - qty) > 1e-9 if symbol in ledger else 1
+                            for symbol, (qty, avg) in broker.positions.items()) + \
+                sum(symbol not in broker.positions for symbol in ledger.positions)
+            calls = collections.Counter(broker.calls)
+
+            print(f"recovery {'on ' if recover else 'off'}: {stream.connections} connections, {len(server.lost)} updates "
+                  f"lost, {drift} orders and {positions} positions off the broker, api calls {dict(calls)}")
+
+            if recover:
+                assert not drift and not positions
+
+    asyncio.run(main())
@@ -0,0 +1,690 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import uuid
+
+from alpaca.data.models import Quote, Trade
+from alpaca.data.live.stock import StockDataStream
+from alpaca.trading.requests import OrderRequest
+
+from Finance.orders import ORDERS
+from Finance.liveIngest import subscribe_first
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Client side order types, held locally and sent through ORDERS once they trigger.
+
+    stop            sells once the price falls to the stop price, buys once it rises to it, a market order or with
+                    limit_price a limit order (stop limit)
+    take_profit     sells once the price rises to the limit price, buys once it falls to it, a limit order
+    trailing_stop   a stop trail_price or trail_percent away from the best price since it was armed, market order
+    oco             triggers of which the first one to trigger cancels the others
+    oto             triggers armed once an order (a broker order or a trigger's order) fills
+
+Every trigger waits for the price to fall to its level or to rise to it. Rising ones are kept on the negated price,
+so both wait for x <= level and each symbol has the same structures twice:
+    levels      stops and take profits, a heap with the highest level on top
+    trails      trailing stops, grouped by their best price: a trailing stop armed at x has the best price x, every
+                older one has a best price >= x. The groups form a stack with the lowest best price on top and a new
+                best price only merges the groups on top of it. Each group is a heap of trails, the smallest on top,
+                and a heap over the groups gives the group whose stop is the highest.
+A tick that triggers nothing looks at the top of a few heaps, whatever the number of resting triggers. Cancelled
+triggers stay in the heaps until they come to the top, or until they are half of a symbol's and the heaps are rebuilt.
+
+Trades move both sides, quotes move the falling triggers on the bid and the rising ones on the ask. A trigger's id is
+the client order id of the order it sends, so oto children are found from the trade updates of either.
+'''
+
+# cancelled entries of a symbol before its heaps are rebuilt
+_COMPACT_AFTER = 1024
+
+_sequence = itertools.count()
+
+
+class _Trigger:
+    __slots__ = ('id', 'symbol', 'side', 'qty', 'kind', 'rising', 'level', 'trail', 'percent', 'limit_price',
+                 'time_in_force', 'state', 'oco', 'children', 'order_id', 'price')
+
+    def __init__(self, symbol: str, side: str, qty: float, kind: str, rising: bool, limit_price: Union[float, None],
+                 time_in_force: str):
+        self.id = str(uuid.uuid4())
+        self.symbol = symbol
+        self.side = side
+        self.qty = qty
+        self.kind = kind
+        self.rising = rising
+        # on the side's price, negated for rising triggers
+        self.level: Union[float, None] = None
+        self.trail: Union[float, None] = None
+        self.percent = False
+        self.limit_price = limit_price
+        self.time_in_force = time_in_force
+        # waiting (oto child), armed, triggered or cancelled
+        self.state = 'waiting'
+        self.oco: Union[List['_Trigger'], None] = None
+        self.children: Union[List['_Trigger'], None] = None
+        self.order_id: Union[str, None] = None
+        # price it triggered at
+        self.price: Union[float, None] = None
+
+
+class _Levels:
+    __slots__ = ('heap',)
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, _Trigger]] = []
+
+    def add(self, trigger: _Trigger):
+        heapq.heappush(self.heap, (-trigger.level, next(_sequence), trigger))
+
+    def tick(self, x: float, triggered: List[_Trigger]):
+        heap = self.heap
+        while heap and -heap[0][0] >= x:
+            trigger = heapq.heappop(heap)[2]
+            if trigger.state == 'armed':
+                triggered.append(trigger)
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap if entry[2].state == 'armed']
+        heapq.heapify(self.heap)
+
+
+class _Group:
+    __slots__ = ('best', 'heap', 'version')
+
+    def __init__(self, best: float):
+        self.best = best
+        self.heap: List[Tuple[float, int, _Trigger]] = []
+        self.version = 0
+
+
+class _Trails:
+    __slots__ = ('percent', 'stack', 'keys')
+
+    def __init__(self, percent: bool):
+        self.percent = percent
+        # lowest best price on top
+        self.stack: List[_Group] = []
+        # (-stop of the group, sequence, version, group)
+        self.keys: List[Tuple[float, int, int, _Group]] = []
+
+    def _stop(self, best: float, trail: float) -> float:
+        return best - abs(best) * trail if self.percent else best - trail
+
+    def _key(self, group: _Group):
+        heap = group.heap
+        while heap and heap[0][2].state != 'armed':
+            heapq.heappop(heap)
+
+        # the keys pushed before are stale
+        group.version += 1
+        if heap:
+            heapq.heappush(self.keys, (-self._stop(group.best, heap[0][0]), next(_sequence), group.version, group))
+
+    def add(self, trigger: _Trigger, x: float):
+        stack = self.stack
+        # best prices fall towards the top, a reference price above some of them goes below those
+        i = bisect.bisect_left(stack, -x, key = lambda group: -group.best)
+        if i < len(stack) and stack[i].best == x:
+            group = stack[i]
+        else:
+            group = _Group(x)
+            stack.insert(i, group)
+
+        heapq.heappush(group.heap, (trigger.trail, next(_sequence), trigger))
+        self._key(group)
+
+    def tick(self, x: float, triggered: List[_Trigger]):
+        stack = self.stack
+
+        # a new best price for the groups below it, smaller heaps go into larger ones
+        if stack and stack[-1].best < x:
+            merged = stack.pop()
+            while stack and stack[-1].best < x:
+                group = stack.pop()
+                if len(group.heap) > len(merged.heap):
+                    group, merged = merged, group
+                for entry in group.heap:
+                    heapq.heappush(merged.heap, entry)
+                group.version += 1
+
+            merged.best = x
+            stack.append(merged)
+            self._key(merged)
+
+        keys = self.keys
+        while keys and -keys[0][0] >= x:
+            _, _, version, group = heapq.heappop(keys)
+            if version != group.version:
+                continue
+
+            heap = group.heap
+            while heap and self._stop(group.best, heap[0][0]) >= x:
+                trigger = heapq.heappop(heap)[2]
+                if trigger.state == 'armed':
+                    trigger.level = self._stop(group.best, trigger.trail)
+                    triggered.append(trigger)
+            self._key(group)
+
+    def compact(self):
+        for group in self.stack:
+            group.heap = [entry for entry in group.heap if entry[2].state == 'armed']
+            heapq.heapify(group.heap)
+
+        self.stack = [group for group in self.stack if group.heap]
+        self.keys = []
+        for group in self.stack:
+            self._key(group)
+
+
+class _Book:
+    __slots__ = ('falling', 'rising', 'armed', 'cancelled')
+
+    def __init__(self):
+        # levels, trail_price trails, trail_percent trails
+        self.falling = (_Levels(), _Trails(False), _Trails(True))
+        self.rising = (_Levels(), _Trails(False), _Trails(True))
+        self.armed = 0
+        self.cancelled = 0
+
+    def add(self, trigger: _Trigger, x: float):
+        levels, trails, percents = self.rising if trigger.rising else self.falling
+        if trigger.trail is None:
+            levels.add(trigger)
+        elif trigger.percent:
+            percents.add(trigger, x)
+        else:
+            trails.add(trigger, x)
+        self.armed += 1
+
+    def tick(self, falling: float, rising: float, triggered: List[_Trigger]):
+        for structure in self.falling:
+            structure.tick(falling, triggered)
+        for structure in self.rising:
+            structure.tick(-rising, triggered)
+
+    def compact(self):
+        for structure in self.falling + self.rising:
+            structure.compact()
+        self.cancelled = 0
+
+
+class TRIGGERS:
+
+    def __init__(self, orders: ORDERS):
+        """
+        Holds the triggers and sends their orders through orders, fills of the orders arm the oto children
+
+        :param orders: ORDERS the orders are submitted with, its risk gate checks them when they trigger
+        """
+
+        self.orders = orders
+
+        # Dict[id: trigger] of the waiting and armed triggers
+        self.triggers: Dict[str, _Trigger] = {}
+        self._books: Dict[str, _Book] = {}
+        # Dict[symbol: (bid, ask)] of the last tick, the reference price of trailing stops
+        self.last: Dict[str, Tuple[float, float]] = {}
+        # Dict[order id or client order id: children armed once it fills]
+        self._parents: Dict[str, List[_Trigger]] = {}
+        # submits in flight, kept so they are not collected
+        self._sends = set()
+
+        self.ticks = 0
+        self.triggered = 0
+
+        orders.subscribe_updates(self._update_handler)
+
+    def __len__(self) -> int:
+        return len(self.triggers)
+
+    ############################################ making triggers #################################################
+    def _make(self, trigger: _Trigger, arm: bool, price: float = None) -> str:
+        if trigger.side not in ('buy', 'sell'):
+            raise ValueError("side must be buy or sell.")
+        if trigger.qty <= 0:
+            raise ValueError("qty must be positive.")
+
+        self.triggers[trigger.id] = trigger
+        if arm:
+            self._arm(trigger, price)
+
+        return trigger.id
+
+    def _arm(self, trigger: _Trigger, price: float = None):
+        book = self._books.get(trigger.symbol)
+        if book is None:
+            book = self._books[trigger.symbol] = _Book()
+
+        x = None
+        if trigger.trail is not None:
+            if price is None:
+                last = self.last.get(trigger.symbol)
+                if last is not None:
+                    price = last[1] if trigger.rising else last[0]
+                else:
+                    row = self.orders.portfolio.ledger.get(trigger.symbol)
+                    price = row['current_price'] if row is not None else None
+            if price is None:
+                raise ValueError(f"no price for {trigger.symbol} to trail, pass price.")
+            x = -price if trigger.rising else price
+
+        trigger.state = 'armed'
+        book.add(trigger, x)
+
+    def stop(self, symbol: str, side: str, qty: float, stop_price: float, limit_price: float = None,
+             time_in_force: str = 'day', arm: bool = True) -> str:
+        """
+        :param side: sell triggers once the price falls to stop_price, buy once it rises to it
+        :param limit_price: sends a limit order at limit_price instead of a market order
+        :param arm: False waits for oto
+        :return: id of the trigger
+        """
+
+        trigger = _Trigger(symbol, side, qty, 'stop_limit' if limit_price else 'stop', side == 'buy', limit_price,
+                           time_in_force)
+        trigger.level = -stop_price if trigger.rising else stop_price
+
+        return self._make(trigger, arm)
+
+    def take_profit(self, symbol: str, side: str, qty: float, limit_price: float, time_in_force: str = 'day',
+                    arm: bool = True) -> str:
+        """
+        :param side: sell triggers once the price rises to limit_price, buy once it falls to it
+        :return: id of the trigger
+        """
+
+        trigger = _Trigger(symbol, side, qty, 'take_profit', side == 'sell', limit_price, time_in_force)
+        trigger.level = -limit_price if trigger.rising else limit_price
+
+        return self._make(trigger, arm)
+
+    def trailing_stop(self, symbol: str, side: str, qty: float, trail_price: float = None,
+                      trail_percent: float = None, price: float = None, time_in_force: str = 'day',
+                      arm: bool = True) -> str:
+        """
+        :param side: sell trails below the highest price, buy above the lowest
+        :param trail_price: distance in dollars, or
+        :param trail_percent: distance in percent of the best price
+        :param price: price it is armed at, the last tick or the ledger's mark by default
+        :return: id of the trigger
+        """
+
+        if (trail_price is None) == (trail_percent is None):
+            raise ValueError("trailing stop needs one of trail_price and trail_percent.")
+
+        trigger = _Trigger(symbol, side, qty, 'trailing_stop', side == 'buy', None, time_in_force)
+        trigger.percent = trail_percent is not None
+        trigger.trail = trail_percent / 100 if trigger.percent else trail_price
+
+        return self._make(trigger, arm, price)
+
+    def oco(self, *ids: str):
+        """
+        The first of the triggers to trigger cancels the others
+        """
+
+        triggers = [self.triggers[trigger_id] for trigger_id in ids]
+        for trigger in triggers:
+            trigger.oco = triggers
+
+    def oto(self, parent: str, *ids: str):
+        """
+        Arms the triggers once parent fills, cancels them if it is cancelled, expires or is rejected
+
+        :param parent: id of a trigger, or id or client order id of a broker order
+        :param ids: triggers made with arm = False
+        """
+
+        children = [self.triggers[trigger_id] for trigger_id in ids]
+        if any(child.state != 'waiting' for child in children):
+            raise ValueError("oto children must be made with arm = False.")
+
+        if parent in self.triggers:
+            trigger = self.triggers[parent]
+            trigger.children = (trigger.children or []) + children
+        else:
+            self._parents.setdefault(parent, []).extend(children)
+
+    def protect(self, order_id: str, stop_price: float = None, limit_price: float = None, trail_price: float = None,
+                trail_percent: float = None, take_profit: float = None) -> List[str]:
+        """
+        Closes an open order's position once it fills: a stop, stop limit or trailing stop, and with take_profit a
+        take profit, oco with each other
+
+        :param order_id: id of an order in the order store
+        :return: ids of the triggers
+        """
+
+        row = self.orders.order_store.get(order_id)
+        if row is None or row['qty'] is None:
+            raise ValueError(f"{order_id} is not an open order with a qty.")
+
+        side = 'sell' if row['side'] == 'buy' else 'buy'
+        qty = row['qty']
+        if stop_price:
+            ids = [self.stop(row['symbol'], side, qty, stop_price, limit_price = limit_price,
+                             time_in_force = 'gtc', arm = False)]
+        else:
+            ids = [self.trailing_stop(row['symbol'], side, qty, trail_price = trail_price or None,
+                                      trail_percent = trail_percent or None, time_in_force = 'gtc', arm = False)]
+        if take_profit:
+            ids.append(self.take_profit(row['symbol'], side, qty, take_profit, time_in_force = 'gtc', arm = False))
+            self.oco(*ids)
+
+        self.oto(row['id'], *ids)
+        return ids
+
+    def cancel(self, trigger_id: str):
+        """
+        Cancels a trigger and its oto children
+        """
+
+        trigger = self.triggers.get(trigger_id)
+        if trigger is not None:
+            self._cancel(trigger)
+
+    def _cancel(self, trigger: _Trigger):
+        if trigger.state == 'armed':
+            book = self._books[trigger.symbol]
+            book.armed -= 1
+            book.cancelled += 1
+            if book.cancelled > _COMPACT_AFTER and book.cancelled > book.armed:
+                book.compact()
+
+        trigger.state = 'cancelled'
+        self.triggers.pop(trigger.id, None)
+        for child in trigger.children or ():
+            self._cancel(child)
+
+    ############################################ ticks ###########################################################
+    def tick(self, symbol: str, price: float) -> List[_Trigger]:
+        """
+        Last trade price of symbol, sends the orders of the triggers it triggers
+
+        :return: the triggered triggers
+        """
+
+        return self.tick_quote(symbol, price, price)
+
+    def tick_quote(self, symbol: str, bid: float, ask: float) -> List[_Trigger]:
+        """
+        Quote of symbol, falling triggers look at the bid and rising ones at the ask
+        """
+
+        self.ticks += 1
+        self.last[symbol] = (bid, ask)
+
+        book = self._books.get(symbol)
+        if book is None or not book.armed:
+            return []
+
+        triggered: List[_Trigger] = []
+        book.tick(bid, ask, triggered)
+
+        for trigger in triggered:
+            # an oco sibling in the same tick
+            if trigger.state == 'armed':
+                book.armed -= 1
+                self._trigger(trigger, ask if trigger.rising else bid)
+
+        return triggered
+
+    async def trade_handler(self, trade: Union[Trade, Dict]):
+        if isinstance(trade, dict):
+            self.tick(trade['S'], trade['p'])
+        else:
+            self.tick(trade.symbol, trade.price)
+
+    async def quote_handler(self, quote: Union[Quote, Dict]):
+        if isinstance(quote, dict):
+            self.tick_quote(quote['S'], quote['bp'], quote['ap'])
+        else:
+            self.tick_quote(quote.symbol, quote.bid_price, quote.ask_price)
+
+    def subscribe(self, stream: StockDataStream, symbols: List[str], quotes: bool = False):
+        """
+        Subscribes the handlers on a data stream, a handler already there for a symbol (the ingestor's) is called
+        after the trigger's
+
+        :param quotes: ticks on quotes instead of trades
+        """
+
+        if quotes:
+            subscribe_first(stream, 'quotes', self.quote_handler, symbols)
+        else:
+            subscribe_first(stream, 'trades', self.trade_handler, symbols)
+
+    ############################################ orders ##########################################################
+    def _request(self, trigger: _Trigger) -> OrderRequest:
+        if trigger.limit_price:
+            request = self.orders.order_request(trigger.symbol, trigger.side, trigger.qty, order_type = 'limit',
+                                                limit_price = trigger.limit_price,
+                                                time_in_force = trigger.time_in_force)
+        else:
+            request = self.orders.order_request(trigger.symbol, trigger.side, trigger.qty, order_type = 'market',
+                                                time_in_force = trigger.time_in_force)
+
+        request.client_order_id = trigger.id
+        return request
+
+    def _trigger(self, trigger: _Trigger, price: float):
+        trigger.state = 'triggered'
+        trigger.price = price
+        self.triggers.pop(trigger.id, None)
+        self.triggered += 1
+
+        for sibling in trigger.oco or ():
+            if sibling is not trigger and sibling.state in ('waiting', 'armed'):
+                self._cancel(sibling)
+
+        if trigger.children:
+            self._parents[trigger.id] = trigger.children
+
+        log.info(f"{trigger.kind} {trigger.side} {trigger.qty} {trigger.symbol} triggered at {price}")
+
+        send = asyncio.get_running_loop().create_task(self._send(trigger))
+        self._sends.add(send)
+        send.add_done_callback(self._sends.discard)
+
+    async def _send(self, trigger: _Trigger):
+        try:
+            row = await self.orders.submit(self._request(trigger))
+            trigger.order_id = row['id']
+        except Exception as e:
+            log.error(f"order of {trigger.kind} {trigger.id} for {trigger.symbol} failed: {e}")
+            for child in self._parents.pop(trigger.id, ()):
+                self._cancel(child)
+
+    async def drain(self):
+        """
+        Waits for the submits in flight
+        """
+
+        while self._sends:
+            await asyncio.gather(*list(self._sends), return_exceptions = True)
+
+    def _update_handler(self, event: str, row: Dict):
+        key = row['id'] if row['id'] in self._parents else row['client_order_id']
+        if key not in self._parents:
+            return
+
+        if event == 'fill':
+            for child in self._parents.pop(key):
+                if child.state == 'waiting':
+                    self._arm(child, row['filled_avg_price'] if child.trail is not None else None)
+
+        elif event in ('canceled', 'expired', 'rejected'):
+            for child in self._parents.pop(key):
+                self._cancel(child)
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import time as true_time
+
+    from alpaca.trading.client import TradingClient
+
+    from Finance.portfolio import PORTFOLIO
+    from Finance.stubs import BrokerServer
+
+    # 50k triggers resting on 50 symbols, 100k trades of random walks, every triggered order is sent to a local broker
+    n_triggers = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    n_ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    # ticks the scan of every trigger is checked against
+    n_checked = 10_000
+    symbols = [f"SYM{i}" for i in range(50)]
+    logging.getLogger(__name__).setLevel(logging.WARNING)
+
+    def place(triggers: TRIGGERS, rng: random.Random, n: int, prices: Dict[str, float]) -> Dict[str, Tuple]:
+        placed = {}
+        for _ in range(n):
+            symbol = rng.choice(symbols)
+            price = prices[symbol]
+            side = rng.choice(('buy', 'sell'))
+            kind = rng.choice(('stop', 'take_profit', 'trail', 'percent'))
+            away = price * rng.uniform(0.01, 0.2)
+            below, above = round(price - away, 2), round(price + away, 2)
+
+            if kind == 'stop':
+                trigger_id = triggers.stop(symbol, side, 1, above if side == 'buy' else below)
+            elif kind == 'take_profit':
+                trigger_id = triggers.take_profit(symbol, side, 1, below if side == 'buy' else above)
+            elif kind == 'trail':
+                trigger_id = triggers.trailing_stop(symbol, side, 1, trail_price = round(away, 2))
+            else:
+                trigger_id = triggers.trailing_stop(symbol, side, 1, trail_percent = round(rng.uniform(1, 20), 2))
+            trigger = triggers.triggers[trigger_id]
+            placed[trigger_id] = (symbol, trigger.rising, trigger.level, trigger.trail, trigger.percent)
+
+        return placed
+
+    def walk(rng: random.Random, prices: Dict[str, float], n: int) -> List[Tuple[str, float]]:
+        prices = dict(prices)
+        ticks = []
+        for _ in range(n):
+            symbol = rng.choice(symbols)
+            prices[symbol] = round(prices[symbol] * (1 + rng.gauss(0, 0.002)), 2)
+            ticks.append((symbol, prices[symbol]))
+        return ticks
+
+    def reference(placed: Dict[str, Tuple], start: Dict[str, float], ticks: List[Tuple[str, float]]) -> Dict:
+        # every trigger of the symbol on every tick
+        by_symbol: Dict[str, List] = {}
+        for trigger_id, (symbol, rising, level, trail, percent) in placed.items():
+            x = -start[symbol] if rising else start[symbol]
+            by_symbol.setdefault(symbol, []).append([trigger_id, rising, level, trail, percent, x])
+
+        triggered = {}
+        for i, (symbol, price) in enumerate(ticks):
+            resting = by_symbol.get(symbol, [])
+            for entry in resting:
+                trigger_id, rising, level, trail, percent, best = entry
+                x = -price if rising else price
+                if trail is not None:
+                    best = entry[5] = max(best, x)
+                    level = best - abs(best) * trail if percent else best - trail
+                if x <= level:
+                    triggered[trigger_id] = i
+            by_symbol[symbol] = [entry for entry in resting if entry[0] not in triggered]
+
+        return triggered
+
+    async def run():
+        server = BrokerServer()
+        server.start()
+        client = TradingClient('fake', 'fake', url_override = server.url)
+        orders = ORDERS(client, PORTFOLIO(client))
+        triggers = TRIGGERS(orders)
+
+        rng = random.Random(0)
+        start = {symbol: round(rng.uniform(10, 500), 2) for symbol in symbols}
+        for symbol, price in start.items():
+            triggers.tick(symbol, price)
+
+        t0 = true_time.perf_counter()
+        placed = place(triggers, rng, n_triggers, start)
+        placing = true_time.perf_counter() - t0
+
+        ticks = walk(rng, start, n_ticks)
+        triggered = {}
+        ticking = 0.0
+        for i, (symbol, price) in enumerate(ticks):
+            t0 = true_time.perf_counter()
+            fired = triggers.tick(symbol, price)
+            ticking += true_time.perf_counter() - t0
+            for trigger in fired:
+                triggered[trigger.id] = i
+            # the submits go out between ticks like they would between stream messages
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+        await triggers.drain()
+
+        print(f"{n_triggers} triggers placed in {placing * 1e3:.0f} ms ({placing / n_triggers * 1e6:.1f} us), "
+              f"{n_ticks} ticks in {ticking * 1e3:.0f} ms ({ticking / n_ticks * 1e6:.1f} us per tick), "
+              f"{len(triggered)} triggered, {len(triggers)} resting")
+
+        assert len(server.orders) == len(triggered)
+        assert {order['client_order_id'] for order in server.orders.values()} == set(triggered)
+
+        # the first ticks against every trigger
+        t0 = true_time.perf_counter()
+        expected = reference(placed, start, ticks[:n_checked])
+        scan = true_time.perf_counter() - t0
+        assert {trigger_id: i for trigger_id, i in triggered.items() if i < n_checked} == expected
+        print(f"first {n_checked} ticks trigger the same as scanning every trigger of the symbol "
+              f"({scan / n_checked * 1e6:.0f} us per tick)")
+
+        # oco and oto, a buy protected by a stop and a take profit once it fills
+        orders.order_store.upsert(orders.process_and_add_order(
+            client.submit_order(order_data = orders.order_request('AAA', 'buy', 10, order_type = 'limit',
+                                                                  limit_price = 100.0, time_in_force = 'day')),
+            add = False))
+        order_id = next(iter(orders.order_store.ids(symbol = 'AAA')))
+        stop_id, profit_id = triggers.protect(order_id, stop_price = 95.0, take_profit = 110.0)
+        assert not triggers.tick('AAA', 90.0)
+
+        # the fill as ORDERS hands it over from the trade updates
+        row = dict(orders.order_store.get(order_id), status = 'filled', filled_qty = 10.0, filled_avg_price = 100.0)
+        triggers._update_handler('fill', row)
+        assert [trigger.id for trigger in triggers.tick('AAA', 111.0)] == [profit_id]
+        assert stop_id not in triggers.triggers and not triggers.tick('AAA', 90.0)
+        await triggers.drain()
+        assert any(order['client_order_id'] == profit_id for order in server.orders.values())
+        print("oto / oco: take profit sent once the buy filled, stop cancelled")
+
+        # the buy fills while the trade stream is down, the recovery of the missed orders hands the fill over once
+        order = client.submit_order(order_data = orders.order_request('CCC', 'buy', 10, order_type = 'limit',
+                                                                      limit_price = 100.0, time_in_force = 'day'))
+        orders.order_store.ack(orders.process_and_add_order(order, add = False))
+        stop_id, profit_id = triggers.protect(str(order.id), stop_price = 95.0, take_profit = 110.0)
+        server.orders[str(order.id)].update(status = 'filled', filled_qty = '10', filled_avg_price = '100')
+        seen = []
+        orders.subscribe_updates(lambda event, row: seen.append(event))
+        for _ in range(2):
+            orders.apply_orders([client.get_order_by_id(order.id)])
+        assert seen == ['fill'] and str(order.id) not in orders.order_store
+        assert [trigger.id for trigger in triggers.tick('CCC', 111.0)] == [profit_id]
+        await triggers.drain()
+        print("oto after a reconnect: the recovered fill arms the take profit")
+
+        # cancelled triggers leave the heaps once they are most of a symbol's
+        ids = [triggers.stop('BBB', 'sell', 1, 50.0 - i / 1000) for i in range(5000)]
+        t0 = true_time.perf_counter()
+        for trigger_id in ids[100:]:
+            triggers.cancel(trigger_id)
+        cancelling = true_time.perf_counter() - t0
+        book = triggers._books['BBB']
+        print(f"cancelled 4900 of 5000 in {cancelling * 1e3:.0f} ms, {len(book.falling[0].heap)} left in the heap")
+        assert book.armed == 100 and len(book.falling[0].heap) < 2500
+
+        server.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,294 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import numpy as np
+import polars as pl
+import asyncio
+import logging
+import time as true_time
+
+from alpaca.data.models import Quote, Trade
+
+from Finance.positionLedger import PositionLedger
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Mark to market of the ledger positions from the latest prices, without going back to the broker.
+
+Prices come in one tick at a time (quote mids or trade prices, from the live stream or the STOCKFRAME maps) and land
+in a numpy array indexed by symbol, an O(1) write. Valuing the book is then one vectorised pass over the positions:
+    market_value            qty * price
+    cost_basis              qty * avg_entry_price
+    unrealized_pl           market_value - cost_basis
+    unrealized_plpc         unrealized_pl / |cost_basis|
+    unrealized_intraday_pl  qty * (price - lastday_price)
+    change_today            price / lastday_price - 1, also the intraday plpc
+Positions without a price yet keep the values of the ledger.
+'''
+
+
+def _mid(bid: Union[float, None], ask: Union[float, None]) -> Union[float, None]:
+    # one sided or crossed quotes happen around the open and on halts, fall back to whichever side is there
+    if bid and ask and ask >= bid:
+        return (bid + ask) / 2
+
+    return bid or ask or None
+
+
+class Valuation:
+
+    def __init__(self, ledger: PositionLedger):
+        """
+        :param ledger: position ledger to value
+        """
+
+        self.ledger = ledger
+
+        # latest price per symbol, symbols get a slot the first time they are seen
+        self._index: Dict[str, int] = {}
+        self._prices = np.full(64, np.nan)
+
+        # arrays of the positions, rebuilt when the ledger moves
+        self._version = -1
+        self._slots = np.empty(0, dtype = np.int64)
+        self._qty = np.empty(0)
+        self._avg = np.empty(0)
+        self._lastday = np.empty(0)
+        self._current = np.empty(0)
+
+        self.ticks = 0
+
+        # slots of the last symbol list given to update_prices
+        self._batch_symbols: Union[List[str], None] = None
+        self._batch_slots = np.empty(0, dtype = np.int64)
+
+    ############################################ prices ##########################################################
+    def _slot(self, symbol: str) -> int:
+        slot = self._index.get(symbol)
+        if slot is None:
+            slot = len(self._index)
+            self._index[symbol] = slot
+
+            if slot >= len(self._prices):
+                self._prices = np.concatenate([self._prices, np.full(len(self._prices), np.nan)])
+
+        return slot
+
+    def update_price(self, symbol: str, price: Union[float, None]):
+        """
+        :param symbol: symbol of the price
+        :param price: latest quote mid or trade price
+        """
+
+        if price is None or not price > 0:
+            return
+
+        self._prices[self._slot(symbol)] = price
+        self.ticks += 1
+
+    def update_prices(self, symbols: List[str], prices: np.ndarray):
+        """
+        Vectorised update_price, for a row of prices of many symbols (eg the closes of a bar)
+
+        :param symbols: symbols of the prices, the same list on every call keeps this a single numpy write
+        :param prices: prices in the order of symbols, nan for no price
+        """
+
+        if self._batch_symbols is not symbols:
+            self._batch_symbols = symbols
+            self._batch_slots = np.fromiter((self._slot(s) for s in symbols), dtype = np.int64, count = len(symbols))
+
+        valid = prices > 0
+        self._prices[self._batch_slots[valid]] = prices[valid]
+        self.ticks += int(valid.sum())
+
+    def price(self, symbol: str) -> Union[float, None]:
+        slot = self._index.get(symbol)
+        if slot is None or np.isnan(self._prices[slot]):
+            return None
+
+        return float(self._prices[slot])
+
+    async def quote_handler(self, quote: Union[Quote, Dict]):
+        if isinstance(quote, dict):
+            self.update_price(quote['S'], _mid(quote.get('bp'), quote.get('ap')))
+        else:
+            self.update_price(quote.symbol, _mid(quote.bid_price, quote.ask_price))
+
+    async def trade_handler(self, trade: Union[Trade, Dict]):
+        if isinstance(trade, dict):
+            self.update_price(trade['S'], trade.get('p'))
+        else:
+            self.update_price(trade.symbol, trade.price)
+
+    def on_flush(self, kind: str, symbol: str, batch: pl.DataFrame):
+        """
+        Takes the newest price of a micro batch, fits the on_flush hook of liveIngest.INGESTOR
+        """
+
+        if batch.is_empty():
+            return
+
+        if kind == 'quotes':
+            self.update_price(symbol, _mid(batch.get_column('bid_price')[-1], batch.get_column('ask_price')[-1]))
+        elif kind == 'trades':
+            self.update_price(symbol, batch.get_column('price')[-1])
+
+    def update_from_frames(self, stockFrame, kind: str = 'quotes'):
+        """
+        Takes the newest quote or trade of every held symbol from the STOCKFRAME maps
+
+        :param stockFrame: STOCKFRAME holding the data
+        :param kind: quotes for lvl1_data_map mids, trades for trade_data_map prices
+        """
+
+        if kind == 'quotes':
+            store = stockFrame.lvl1_data_map
+        elif kind == 'trades':
+            store = stockFrame.trade_data_map
+        else:
+            raise ValueError("kind must be quotes or trades.")
+
+        for symbol in self.ledger.positions:
+            df = store.get(symbol)
+            if df is not None and not df.is_empty():
+                self.on_flush(kind, symbol, df.tail(1))
+
+    ############################################ valuation #######################################################
+    def _arrays(self):
+        if self._version == self.ledger.version:
+            return
+
+        rows = list(self.ledger.positions.values())
+        n = len(rows)
+
+        self._slots = np.fromiter((self._slot(row['symbol']) for row in rows), dtype = np.int64, count = n)
+        self._qty = np.fromiter((row['qty'] for row in rows), dtype = np.float64, count = n)
+        self._avg = np.fromiter((row['avg_entry_price'] for row in rows), dtype = np.float64, count = n)
+        self._lastday = np.fromiter((np.nan if row['lastday_price'] is None else row['lastday_price'] for row in rows),
+                                    dtype = np.float64, count = n)
+        self._current = np.fromiter((np.nan if row['current_price'] is None else row['current_price'] for row in rows),
+                                    dtype = np.float64, count = n)
+        self._version = self.ledger.version
+
+    def values(self) -> Dict[str, np.ndarray]:
+        """
+        Marked columns of the positions, in the order of ledger.positions
+
+        :return: Dict[column: array]
+        """
+
+        self._arrays()
+
+        price = self._prices[self._slots]
+        price = np.where(np.isnan(price), self._current, price)
+
+        qty = self._qty
+        market_value = qty * price
+        cost_basis = qty * self._avg
+        unrealized_pl = market_value - cost_basis
+        change_today = price / self._lastday - 1
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            unrealized_plpc = np.where(cost_basis != 0, unrealized_pl / np.abs(cost_basis), 0.0)
+
+        return {
+            'current_price': price,
+            'market_value': market_value,
+            'cost_basis': cost_basis,
+            'unrealized_pl': unrealized_pl,
+            'unrealized_plpc': unrealized_plpc,
+            'unrealized_intraday_pl': qty * (price - self._lastday),
+            'unrealized_intraday_plpc': change_today,
+            'change_today': change_today
+        }
+
+    def frame(self) -> pl.DataFrame:
+        """
+        Ledger snapshot with the price dependent columns marked to the latest prices
+        """
+
+        snapshot = self.ledger.snapshot()
+        if snapshot.is_empty():
+            return snapshot
+
+        return snapshot.with_columns([
+            pl.Series(name, values, dtype = pl.Float64, nan_to_null = True) for name, values in self.values().items()
+        ])
+
+    def pnl(self) -> Dict[str, float]:
+        """
+        Totals of the book at the latest prices
+
+        :return: market value, cost basis, unrealised, intraday, realised and total pl
+        """
+
+        values = self.values()
+        realized = sum(self.ledger.realized_pl.values())
+        unrealized = float(np.nansum(values['unrealized_pl']))
+
+        return {
+            'market_value': float(np.nansum(values['market_value'])),
+            'cost_basis': float(np.nansum(values['cost_basis'])),
+            'unrealized_pl': unrealized,
+            'unrealized_intraday_pl': float(np.nansum(values['unrealized_intraday_pl'])),
+            'realized_pl': realized,
+            'total_pl': unrealized + realized
+        }
+
+    async def run(self, callback: Callable, interval: float = 0.25):
+        """
+        Values the book at a fixed cadence
+
+        :param callback: called with the pnl dict every interval
+        :param interval: seconds between valuations
+        """
+
+        while True:
+            callback(self.pnl())
+            await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    import random
+
+    # 500 positions, a stream of quote ticks and a valuation every 100 ticks
+    rng = random.Random(0)
+    ledger = PositionLedger()
+    symbols = [f"SYM{i}" for i in range(500)]
+    for symbol in symbols:
+        ledger.apply_fill(symbol, rng.choice(['buy', 'sell']), rng.randint(1, 100), 50 + rng.random() * 100)
+        ledger.positions[symbol]['lastday_price'] = ledger.positions[symbol]['avg_entry_price']
+
+    valuation = Valuation(ledger)
+    ticks = [(rng.choice(symbols), 50 + rng.random() * 100) for _ in range(200_000)]
+
+    t0 = true_time.perf_counter()
+    valuations = 0
+    for i, (symbol, price) in enumerate(ticks):
+        valuation.update_price(symbol, price)
+        if i % 100 == 0:
+            valuation.pnl()
+            valuations += 1
+    seconds = true_time.perf_counter() - t0
+
+    t0 = true_time.perf_counter()
+    for _ in range(100):
+        valuation.pnl()
+    pnl_us = (true_time.perf_counter() - t0) / 100 * 1e6
+
+    t0 = true_time.perf_counter()
+    for _ in range(100):
+        df = valuation.frame()
+    frame_ms = (true_time.perf_counter() - t0) / 100 * 1e3
+
+    # against a row by row valuation
+    pnl = valuation.pnl()
+    expected = sum(row['qty'] * (valuation.price(row['symbol']) - row['avg_entry_price'])
+                   for row in ledger.positions.values())
+    assert abs(pnl['unrealized_pl'] - expected) < 1e-6 * max(1.0, abs(expected))
+
+    print(f"{len(ticks)} ticks and {valuations} valuations of {len(ledger)} positions in {seconds:.2f} s")
+    print(f"pnl of the book {pnl_us:.0f} us, marked positions frame {frame_ms:.2f} ms")
+    print(pnl)
@@ -0,0 +1,296 @@
+from typing import List, Dict, Tuple, Union, Any, Optional, Callable
+
+import math
+import polars as pl
+import logging
+import time as true_time
+
+from Finance.stockData import STOCKFRAME
+from Finance.indicators import INDICATORS
+
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+'''
+Vectorised backtest of strategies which are pure functions of the bars and the INDICATORS columns.
+
+entry and exit are polars boolean expressions over the long frame of bars + indicators (one row per symbol and bar),
+everything after that is whole column work over all the symbols at once (the rows of a symbol are together, shifts are
+nulled on the first row of every symbol instead of grouping by symbol):
+    target      latched signal, 1 after an entry, 0 after an exit (exit wins when both fire), nulls count as false
+    held        target of the previous bar, a signal on a bar's close trades on the next bar's open
+    shares      allocation / open of the entry bar while held
+    pnl         shares * (close - open) + previous shares * (open - previous close), the holding over the bar plus
+                the gap into it, which is exact for trades at the open
+    cost        |change of shares| * open * (fee_bps + slippage_bps) / 1e4 + |change of shares| * commission
+The equity curve is the cash plus the running sum of pnl - cost over all symbols per timestamp.
+
+This is the fill model of backtest.BACKTEST for notional market orders, the event replay of the same signals gives the
+same equity curve, see the main block.
+'''
+
+
+class VECTORBACKTEST:
+
+    def __init__(self, stockFrame: STOCKFRAME, indicators: INDICATORS = None, cash: float = 100_000.0,
+                 allocation: float = 10_000.0, fee_bps: float = 0.0, slippage_bps: float = 0.0,
+                 commission: float = 0.0, periods_per_year: int = 252 * 390):
+        """
+        :param stockFrame: frame with the bars in data_map
+        :param indicators: indicator engine of the signals, a default INDICATORS of the frame if not given
+        :param cash: starting cash
+        :param allocation: dollars put into every entry
+        :param fee_bps: fees in basis points of the traded notional
+        :param slippage_bps: slippage in basis points of the traded notional
+        :param commission: commission per share
+        :param periods_per_year: bars per year, for the sharpe ratio (252 * 390 for minute bars)
+        """
+
+        self.stockFrame = stockFrame
+        self.indicators = indicators if indicators is not None else INDICATORS(stockFrame)
+        self.cash = cash
+        self.allocation = allocation
+        self.fee_bps = fee_bps
+        self.slippage_bps = slippage_bps
+        self.commission = commission
+        self.periods_per_year = periods_per_year
+
+    def frame(self, symbols: List[str] = None, bars: pl.LazyFrame = None) -> pl.LazyFrame:
+        """
+        Bars and indicators of the symbols as one lazy frame, only the columns the signals use get computed
+
+        :param symbols: symbols to backtest, defaults to every symbol in data_map
+        :param bars: lazy frame of bars with a symbol column to use instead of data_map, eg a scan of an ipc file
+        :return: lazy frame of the bars, the symbol column and the indicator columns
+        """
+
+        if bars is None:
+            bars = self.indicators._frame(symbols)
+        indicators = self.indicators.query(bars).drop('timestamp', 'symbol')
+
+        # the indicator query keeps the row order of the bars
+        return pl.concat([bars, indicators], how = 'horizontal')
+
+    def positions(self, entry: pl.Expr, exit: pl.Expr = None, symbols: List[str] = None,
+                  frame: pl.LazyFrame = None) -> pl.LazyFrame:
+        """
+        Positions, trades, pnl and costs of every bar
+
+        :param entry: boolean expression, enter on the next open where it is true
+        :param exit: boolean expression, exit on the next open where it is true, defaults to not entry
+        :param symbols: symbols to backtest
+        :param frame: bars and indicators already at hand (see frame), the rows of a symbol together and sorted by
+                      timestamp
+        :return: lazy frame of timestamp, symbol, open, close, held, shares, traded, pnl and cost
+        """
+
+        if exit is None:
+            exit = ~entry
+
+        fee = (self.fee_bps + self.slippage_bps) * 1e-4
+        # the rows of a symbol are together, a shift that is nulled on the first row of every symbol does what
+        # shift(1).over('symbol') does without grouping by symbol
+        previous = lambda name: pl.when(pl.col('_first')).then(None).otherwise(pl.col(name).shift(1))
+
+        if frame is None:
+            frame = self.frame(symbols)
+
+        return (
+            frame
+            .with_columns(
+                (pl.col('symbol') != pl.col('symbol').shift(1)).fill_null(True).alias('_first'),
+                pl.when(exit.fill_null(False)).then(pl.lit(0.0))
+                .when(entry.fill_null(False)).then(pl.lit(1.0))
+                .otherwise(pl.lit(None, dtype = pl.Float64))
+                .alias('_target')
+            )
+            .select(
+                'timestamp', 'symbol', 'open', 'close', '_first',
+                # latched, every symbol starts flat so the fill never crosses into the next symbol
+                pl.when(pl.col('_first')).then(pl.col('_target').fill_null(0.0)).otherwise(pl.col('_target'))
+                .forward_fill()
+                .alias('_target')
+            )
+            .with_columns(
+                previous('_target').fill_null(0.0).alias('held')
+            )
+            .with_columns(
+                # open of the bar every holding started on
+                pl.when((pl.col('held') > 0) & (previous('held').fill_null(0.0) == 0))
+                .then(pl.col('open'))
+                .when(pl.col('held') == 0)
+                .then(pl.lit(0.0))
+                .otherwise(pl.lit(None, dtype = pl.Float64))
+                .forward_fill()
+                .alias('_entry_price')
+            )
+            .with_columns(
+                pl.when(pl.col('held') > 0)
+                .then(pl.col('held') * self.allocation / pl.col('_entry_price'))
+                .otherwise(pl.lit(0.0))
+                .alias('shares')
+            )
+            .with_columns(
+                (pl.col('shares') - previous('shares').fill_null(0.0)).alias('traded')
+            )
+            .with_columns(
+                (pl.col('shares') * (pl.col('close') - pl.col('open')) +
+                 previous('shares').fill_null(0.0) * (pl.col('open') - previous('close')).fill_null(0.0))
+                .alias('pnl'),
+                (pl.col('traded').abs() * (pl.col('open') * fee + self.commission)).alias('cost')
+            )
+            .drop('_first', '_target', '_entry_price')
+        )
+
+    def run(self, entry: pl.Expr, exit: pl.Expr = None, symbols: List[str] = None,
+            frame: pl.LazyFrame = None) -> Dict:
+        """
+        Backtests a signal over the symbols
+
+        :param entry: boolean expression, enter on the next open where it is true
+        :param exit: boolean expression, exit on the next open where it is true, defaults to not entry
+        :param symbols: symbols to backtest, defaults to every symbol in data_map
+        :param frame: bars and indicators already at hand, to run many signals over one indicator computation
+        :return: equity curve, per symbol results, stats and the seconds taken
+        """
+
+        t0 = true_time.perf_counter()
+
+        bars = self.positions(entry, exit, symbols, frame).with_columns(
+            # a trade is numbered from its entry bar through its exit bar
+            (pl.col('traded') > 0).cast(pl.UInt32).cum_sum().alias('trade')
+        )
+
+        equity = (
+            bars.group_by('timestamp')
+            .agg((pl.col('pnl') - pl.col('cost')).sum().alias('pnl'),
+                 (pl.col('shares') * pl.col('close')).sum().alias('exposure'))
+            .sort('timestamp')
+            .with_columns((self.cash + pl.col('pnl').cum_sum()).alias('equity'))
+        )
+
+        trades = (
+            bars.filter((pl.col('trade') > 0) & ((pl.col('shares') != 0) | (pl.col('traded') != 0)))
+            .group_by('symbol', 'trade')
+            .agg((pl.col('pnl') - pl.col('cost')).sum().alias('pnl'))
+        )
+
+        per_symbol = (
+            bars.group_by('symbol')
+            .agg(pl.col('pnl').sum(), pl.col('cost').sum(),
+                 (pl.col('traded') > 0).sum().alias('entries'),
+                 (pl.col('shares') != 0).mean().alias('time_in_market'))
+            .sort('symbol')
+        )
+
+        equity, trades, per_symbol = pl.collect_all([equity, trades, per_symbol])
+        seconds = true_time.perf_counter() - t0
+
+        return {
+            'equity': equity,
+            'symbols': per_symbol,
+            'stats': self.stats(equity, trades, per_symbol),
+            'seconds': seconds
+        }
+
+    def stats(self, equity: pl.DataFrame, trades: pl.DataFrame, per_symbol: pl.DataFrame) -> Dict[str, float]:
+        """
+        :return: total return, sharpe, max drawdown, trade count, win rate, fees and bars of the run
+        """
+
+        curve = equity.get_column('equity')
+        returns = curve.pct_change().drop_nulls()
+        std = returns.std()
+        drawdown = (curve / curve.cum_max() - 1).min()
+
+        return {
+            'total_return': curve[-1] / self.cash - 1 if len(curve) else 0.0,
+            'sharpe': returns.mean() / std * math.sqrt(self.periods_per_year) if std else float('nan'),
+            'max_drawdown': -drawdown if drawdown is not None else 0.0,
+            'trades': trades.height,
+            'win_rate': (trades.get_column('pnl') > 0).mean() if trades.height else float('nan'),
+            'fees': per_symbol.get_column('cost').sum(),
+            'timestamps': equity.height
+        }
+
+
+if __name__ == '__main__':
+    import sys
+    import numpy as np
+    from datetime import datetime, timedelta
+
+    from Finance.columnar import BAR_SCHEMA
+    from Finance.backtest import BACKTEST
+
+    n_symbols = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    rng = np.random.default_rng(0)
+    stamps = np.concatenate([
+        np.datetime64(datetime(2024, 1, 2, 14, 30) + timedelta(days = d), 'us') + np.arange(390) * np.timedelta64(1, 'm')
+        for d in range(days)
+    ])
+
+    frame = STOCKFRAME(api_key = 'fake', secret_key = 'fake', trade_client = None, subscribed = True)
+    symbols = [f"SYM{i}" for i in range(n_symbols)]
+    for symbol in symbols:
+        close = 100 * np.exp(np.cumsum(rng.normal(0, 1e-3, len(stamps))))
+        spread = np.abs(rng.normal(0, 3e-4, len(stamps))) * close
+        frame.data_map[symbol] = pl.DataFrame({
+            'timestamp': stamps, 'open': np.r_[close[0], close[:-1]] * (1 + rng.normal(0, 1e-4, len(stamps))),
+            'high': close + spread, 'low': close - spread, 'close': close, 'volume': np.full(len(stamps), 1000.0),
+            'trade_count': np.full(len(stamps), 10.0), 'vwap': close
+        }).select(list(BAR_SCHEMA)).cast(BAR_SCHEMA)
+
+    # enter when rsi < 30, exit when the macd crosses under its signal line
+    entry = pl.col('rsi') < 30
+    exit = (pl.col('macd') < pl.col('macd_signal')) & (pl.col('macd').shift(1).over('symbol') >=
+                                                        pl.col('macd_signal').shift(1).over('symbol'))
+
+    # both engines get the same indicators, computed once
+    vector = VECTORBACKTEST(frame, cash = n_symbols * 10_000.0)
+    t0 = true_time.perf_counter()
+    prepared = vector.frame().select(list(BAR_SCHEMA) + ['symbol', 'rsi', 'macd', 'macd_signal']).collect()
+    indicator_seconds = true_time.perf_counter() - t0
+
+    result = vector.run(entry, exit, frame = prepared.lazy())
+    stats = result['stats']
+    bars = prepared.height
+    print(f"indicators of {n_symbols} symbols x {len(stamps)} bars in {indicator_seconds:.2f} s")
+    print(f"vectorised: {bars:,} bars in {result['seconds']:.2f} s ({bars / result['seconds']:,.0f} bars/s), "
+          f"{stats['trades']:,} trades, return {stats['total_return']:.4%}, sharpe {stats['sharpe']:.2f}, "
+          f"max drawdown {stats['max_drawdown']:.4%}")
+
+    # the same signals replayed bar by bar through ORDERS / PORTFOLIO with notional market orders
+    for (symbol,), df in prepared.select('timestamp', 'symbol', 'rsi', 'macd', 'macd_signal') \
+            .partition_by('symbol', as_dict = True).items():
+        frame.indicator_map[symbol] = df.drop('symbol')
+
+    previous_macd = {}
+
+    def strategy(bt: BACKTEST):
+        rsi, macd, signal = bt.ind['rsi'], bt.ind['macd'], bt.ind['macd_signal']
+        cross = (macd < signal) & (previous_macd.get('macd', macd) >= previous_macd.get('signal', signal))
+        previous_macd.update({'macd': macd, 'signal': signal})
+
+        for column in np.flatnonzero(cross | (rsi < 30)):
+            symbol = bt.symbols[column]
+            position = bt.client.positions.get(symbol)
+            if cross[column]:
+                if position:
+                    bt.orders.new_order(symbol, 'sell', position[0], order_type = 'market', time_in_force = 'gtc')
+            elif not position:
+                bt.orders.new_order(symbol, 'buy', vector.allocation, is_qty = False, order_type = 'market',
+                                    time_in_force = 'gtc')
+
+    event = BACKTEST(frame, strategy, symbols = symbols, cash = vector.cash,
+                     indicator_columns = ['rsi', 'macd', 'macd_signal'])
+    event_result = event.run()
+
+    event_equity = event_result['equity'].get_column('equity')[-1]
+    vector_equity = result['equity'].get_column('equity')[-1]
+    assert abs(event_equity - vector_equity) < 1e-6 * vector_equity, (event_equity, vector_equity)
+
+    print(f"event replay: {event_result['bars']:,} bars in {event_result['seconds']:.2f} s, "
+          f"{event_result['events']:,} events, same final equity ({vector_equity:,.2f}), "
+          f"{event_result['seconds'] / result['seconds']:,.0f}x the vectorised run")